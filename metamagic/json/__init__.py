@@ -6,23 +6,49 @@
 ##
 
 
-__all__ = ('dumps', 'dumpb', 'loads', 'loadb')
+__all__ = ('dumps', 'dumpb', 'load', 'loads', 'loadb', 'lazy_loadb', 'extract', 'JSONLinesWriter',
+           'RawJSON', 'Decoder', 'Schema', 'OutputTooLargeError', 'DecodeError', 'get_include')
 
 
 try:
-    from ._encoder import Encoder
+    from ._encoder import Encoder, RawJSON
 except ImportError:
-    from .encoder import Encoder
+    from .encoder import Encoder, RawJSON
 
+try:
+    from ._decoder import Decoder, decode as _decode, extract as _extract
+except ImportError:
+    from .decoder import Decoder, decode as _decode, extract as _extract
+
+from .exceptions import OutputTooLargeError, DecodeError
+from .lines import JSONLinesWriter
+from .schema import Schema
+
+
+# shared instances of Encoder classes used by dumps() and dumpb()
+_encoders = {}
 
-import json as std_json
+
+def _get_encoder(encoder):
+    """Return the shared instance of the Encoder class ``encoder``; Encoder
+       instances are returned as is."""
+
+    if not isinstance(encoder, type):
+        return encoder
+
+    try:
+        return _encoders[encoder]
+    except KeyError:
+        # if two threads get here at once only one instance is kept
+        return _encoders.setdefault(encoder, encoder())
 
 
 def dumps(obj, encoder=Encoder):
     """Return a JSON representation of ``obj`` in a Python string.
 
        Uses the given Encoder class which is supposed to have a ``dumps``
-       method.
+       method; one instance of the class is created on first use and shared
+       by all calls (and threads).  An Encoder instance can be given as well.
 
        By default tries to use the C version of the Encoder class from the
        ``_encoder`` module. If there is no C version uses the Python version
@@ -62,17 +88,18 @@ def dumps(obj, encoder=Encoder):
            ...             return '*' + str(obj)
            ...         return obj
 
-           >>> MyEncoder().dumps([1])
+           >>> dumps([1], encoder=MyEncoder)
            '["*1"]'
     """
-    return Encoder().dumps(obj)
+    return _get_encoder(encoder).dumps(obj)
 
 
 def dumpb(obj, encoder=Encoder):
     """Return a JSON representation of ``obj`` in a bytes() array.
 
        Uses the given Encoder class which is supposed to have a ``dumpb``
-       method.
+       method; one instance of the class is created on first use and shared
+       by all calls (and threads).  An Encoder instance can be given as well.
 
        By default tries to use the C version of the Encoder class from the
        ``_encoder`` module. If there is no C version uses the Python version
@@ -87,15 +114,237 @@ def dumpb(obj, encoder=Encoder):
            >>> dumpb(True)
            b'true'
     """
-    return Encoder().dumpb(obj)
+    return _get_encoder(encoder).dumpb(obj)
+
+
+def loads(s, decoder=None, schema=None, *, parse_uuid=False, parse_datetime=False,
+          parse_decimal=None):
+    """Deserialize ``s`` (instance of ``str``) to a Python object.
+
+       See ``loadb()``.
+    """
+    return loadb(s.encode('utf-8', 'surrogatepass'), decoder, schema, parse_uuid=parse_uuid,
+                 parse_datetime=parse_datetime, parse_decimal=parse_decimal)
+
+
+# flags of _decode(), see PARSE_* in _decoder/_decoder.h
+_PARSE_UUID, _PARSE_DATETIME, _PARSE_DECIMAL_STRINGS, _PARSE_DECIMAL_NUMBERS = 0x01, 0x02, 0x04, 0x08
+
+
+def _parse_flags(parse_uuid, parse_datetime, parse_decimal):
+    flags = 0
+    if parse_uuid:
+        flags |= _PARSE_UUID
+    if parse_datetime:
+        flags |= _PARSE_DATETIME
+    if parse_decimal == 'strings':
+        flags |= _PARSE_DECIMAL_STRINGS
+    elif parse_decimal == 'numbers':
+        flags |= _PARSE_DECIMAL_NUMBERS
+    elif parse_decimal is not None:
+        raise ValueError("parse_decimal must be 'strings', 'numbers' or None, not {!r}".format(
+                         parse_decimal))
+    return flags
+
+
+def loadb(b, decoder=None, schema=None, *, parse_uuid=False, parse_datetime=False,
+          parse_decimal=None):
+    """Deserialize ``b`` (a bytes-like object with UTF-8 JSON) to a Python object.
+
+       ``b`` can be any object supporting the buffer protocol (``bytes``,
+       ``bytearray``, ``memoryview``, ``mmap``...); it is parsed in place, with
+       no copy made.
+
+       Object keys are interned: equal keys are decoded (and hashed) once and
+       the same string is used in all the objects, and the keys of objects
+       with the same keys as the previous one at the same place (e.g. rows of
+       a table) are only compared with those.  By default keys are only shared
+       within one call; a ``Decoder`` instance given as ``decoder`` keeps them
+       across calls (up to its ``max_keys``), e.g. to decode many small
+       documents with the same keys.
+
+       ``schema`` (a ``Schema``, or a spec compiled to one on every call)
+       describes values to convert to UUIDs, datetimes and Decimals and
+       objects to decode to instances of classes as they are decoded.
+
+       Values with no spec in ``schema`` (all of them with no ``schema``) can
+       be converted back from the formats written by the encoder as they are
+       decoded, with no hook called for every value; values described as
+       ``str``, ``Any`` and the like are left as is:
+
+       * ``parse_uuid=True``: ``str()`` of UUIDs to ``uuid.UUID``;
+
+       * ``parse_datetime=True``: ISO format datetimes, dates and times (with
+         an optional UTC offset or ``Z``) to ``datetime.datetime``, ``date``
+         and ``time``;
+
+       * ``parse_decimal='strings'``: strings of finite numbers (as Decimals
+         are written) to ``decimal.Decimal``; ``parse_decimal='numbers'``:
+         numbers with a fraction or an exponent to ``decimal.Decimal``
+         instead of ``float``.
+
+       Only strings with no escapes and no non-ASCII characters are
+       converted, and only if they are in the exact format (e.g. a valid date
+       of 10 characters); other strings are left as is.  Object keys are never
+       converted.
+
+       By default uses the C version of the decoder from the ``_decoder``
+       module.  If there is no C version uses the ``json`` module of the
+       standard library, with no interning across calls, and converts the
+       decoded value as described by ``schema``.
+
+       ``NaN``, ``Infinity`` and ``-Infinity`` are decoded to floats, as by the
+       ``json`` module (``float`` and ``Decimal`` specs do not accept them).
+
+       Raises ``DecodeError`` for invalid JSON and for values of other types
+       than those described by ``schema``.
+
+       **Example**:
+
+       .. code-block:: pycon
+
+           >>> decoder = Decoder()
+           >>> rows = [loadb(line, decoder) for line in (b'{"id": 1}', b'{"id": 2}')]
+           >>> rows
+           [{'id': 1}, {'id': 2}]
+
+           >>> from decimal import Decimal
+           >>> loadb(b'{"id": 1, "total": 9.90}', schema={'total': Decimal})
+           {'id': 1, 'total': Decimal('9.90')}
+
+           >>> loadb(b'{"day": "2014-05-01", "total": "9.90"}', parse_datetime=True,
+           ...       parse_decimal='strings')
+           {'day': datetime.date(2014, 5, 1), 'total': Decimal('9.90')}
+    """
+    parse = _parse_flags(parse_uuid, parse_datetime, parse_decimal)
 
+    if schema is None and not parse:
+        if decoder is None:
+            return _decode(b)
+        return decoder.decode(b)
 
-def loads(s):
-    """Deserialize ``s`` (instance of ``str``) to a Python object."""
-    return std_json.loads(s)
+    node = None
+    if schema is not None:
+        if not isinstance(schema, Schema):
+            schema = Schema(schema)
+        node = schema.node
 
+    if decoder is None:
+        return _decode(b, 0, None, node, parse)
+    return decoder.decode(b, 0, None, node, parse)
 
-def loadb(b):
-    """Deserialize ``b`` (instance of ``bytes``) to a Python object."""
-    assert isinstance(b, (bytes, bytearray))
-    return std_json.loads(b.decode('utf-8'))
+
+def load(file, decoder=None, schema=None, *, parse_uuid=False, parse_datetime=False,
+         parse_decimal=None):
+    """Deserialize the JSON document in ``file`` to a Python object: a path
+       (``str``, ``bytes`` or ``os.PathLike``) or a file object.
+
+       Regular files (and binary file objects of regular files, from their
+       current position) are memory-mapped and decoded straight from the
+       mapping, so the document is neither read into a ``bytes`` object
+       nor decoded to a ``str``.  Other binary file objects are read, text
+       file objects are read and decoded as with ``loads()``.  File objects
+       are left at the end of the file.
+
+       See ``loadb()`` for the other arguments and the exceptions raised.
+    """
+    import io
+
+    options = {'parse_uuid': parse_uuid, 'parse_datetime': parse_datetime,
+               'parse_decimal': parse_decimal}
+
+    if isinstance(file, (str, bytes)) or hasattr(file, '__fspath__'):
+        with open(file, 'rb') as fp:
+            return _load_fp(fp, decoder, schema, options)
+
+    if isinstance(file, io.TextIOBase):
+        return loads(file.read(), decoder, schema, **options)
+
+    return _load_fp(file, decoder, schema, options)
+
+
+def _load_fp(fp, decoder, schema, options):
+    import mmap
+    import os
+    import stat
+
+    try:
+        fd = fp.fileno()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation is an OSError and a ValueError
+        st = None
+
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return loadb(fp.read(), decoder, schema, **options)
+
+    start = fp.tell()
+    if start >= st.st_size:
+        # an empty file can not be mapped
+        return loadb(fp.read(), decoder, schema, **options)
+
+    mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    try:
+        with memoryview(mapping) as data:
+            with data[start:] as document:
+                value = loadb(document, decoder, schema, **options)
+        fp.seek(0, os.SEEK_END)
+    finally:
+        mapping.close()
+
+    return value
+
+
+def lazy_loadb(b):
+    """Index the JSON document in the bytes-like object ``b`` and return its
+       top-level value, with objects and arrays decoded only when accessed.
+
+       See ``metamagic.json.lazy.lazy_loadb()`` for details.
+
+       **Example**:
+
+       .. code-block:: pycon
+
+           >>> doc = lazy_loadb(b'{"meta": {"tenant": 7}, "items": [1, 2]}')
+           >>> doc['meta']['tenant']
+           7
+    """
+    from .lazy import lazy_loadb
+    return lazy_loadb(b)
+
+
+def extract(b, paths, default=None):
+    """Return a list of the values at ``paths`` in the JSON document in the
+       bytes-like object ``b``, with ``default`` for the paths not found.
+
+       A path is a str of dot-separated object keys (a key of digits can also
+       be an array index, as in ``"items.0.id"``), or a tuple of str keys and
+       int indices.
+
+       Only the objects and arrays on the way to the paths are parsed and only
+       the values found are decoded; everything else is skimmed over, matching
+       strings and brackets with no Python objects created, and reading stops
+       as soon as all the paths are found.  So errors elsewhere in the document
+       may not be detected, and if a key occurs more than once in an object
+       the first value is used.  (The Python version used when the ``_decoder``
+       module is not available decodes the whole document.)
+
+       **Example**:
+
+       .. code-block:: pycon
+
+           >>> extract(b'{"meta": {"tenant_id": 7}, "type": "created", "data": [1, 2]}',
+           ...         ['meta.tenant_id', 'type', 'data.1', 'data.2'])
+           [7, 'created', 2, None]
+    """
+    return _extract(b, paths, default)
+
+
+def get_include():
+    """Return the directory with the ``metamagic_json.h`` header of the C API
+       of the ``_encoder`` extension module, for use by other C extensions::
+
+           Extension('spam', ['spam.c'], include_dirs=[metamagic.json.get_include()])
+    """
+    import os.path
+    return os.path.join(os.path.dirname(__file__), 'include')
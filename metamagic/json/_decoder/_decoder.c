@@ -0,0 +1,1995 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#include "_decoder.h"
+#include "_decoder_scan.h"
+#include "_decoder_scan.c"
+#include "_decoder_keys.h"
+#include "_decoder_keys.c"
+#include "_decoder_types.h"
+#include "_decoder_types.c"
+
+
+/*===========================================================================
+ * declaration and export to python
+ *===========================================================================*/
+
+/* public functions */
+static PyObject * decoder_scan   (PyObject *module, PyObject *args, PyObject *kwargs);
+static PyObject * decoder_decode (PyObject *module, PyObject *args, PyObject *kwargs);
+static PyObject * decoder_find_value_end (PyObject *module, PyObject *args, PyObject *kwargs);
+static PyObject * decoder_extract (PyObject *module, PyObject *args, PyObject *kwargs);
+
+static PyMethodDef DecoderMethods[] = {
+    {"scan", (PyCFunction)decoder_scan, METH_VARARGS | METH_KEYWORDS,
+            "Validate a JSON document and return its structural index (tape) as bytes."},
+
+    {"decode", (PyCFunction)decoder_decode, METH_VARARGS | METH_KEYWORDS,
+            "Decode the JSON value found between the given offsets of a bytes-like object, "
+            "optionally following a compiled schema and converting values in the formats "
+            "of the encoder."},
+
+    {"find_value_end", (PyCFunction)decoder_find_value_end, METH_VARARGS | METH_KEYWORDS,
+            "Find where a JSON value ends, resuming the search over chunks of input."},
+
+    {"extract", (PyCFunction)decoder_extract, METH_VARARGS | METH_KEYWORDS,
+            "Decode the values at the given paths of a JSON document, skimming the rest."},
+
+    {NULL, NULL, 0, NULL}
+};
+
+/* Decoder class, see the "implemention: Decoder class" section */
+static PyObject * decoder_object_decode (PyDecoderObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * decoder_object_clear  (PyDecoderObject *self, PyObject *unused);
+
+static PyMethodDef DecoderObjectMethods[] = {
+    {"decode", (PyCFunction)decoder_object_decode, METH_VARARGS | METH_KEYWORDS,
+            "Decode the JSON value found between the given offsets of a bytes-like object, "
+            "optionally following a compiled schema and converting values in the formats "
+            "of the encoder."},
+
+    {"clear", (PyCFunction)decoder_object_clear, METH_NOARGS,
+            "Forget the object keys interned so far."},
+
+    {NULL, NULL, 0, NULL}
+};
+
+PyDoc_STRVAR(decoder_object_doc, "Decoder(max_keys=4096)\n\
+\n\
+A JSON decoder keeping the object keys it has seen across decode() calls:\n\
+ - equal keys are decoded once and shared by all the decoded objects, up to \
+   max_keys of them (0 disables interning); the table is emptied when it is full\n\
+ - the keys of an object are first compared with those of the last object \
+   at the same place in the document (e.g. the previous record of a list)\n\
+ - can be shared between threads; a call made while another one is using the \
+   keys of the instance uses keys of its own");
+
+static PyObject * decoder_object_new     (PyTypeObject *type, PyObject *args, PyObject *kwargs);
+static void       decoder_object_dealloc (PyObject *self);
+
+static PyType_Slot PyDecoder_Type_slots[] = {
+    {Py_tp_doc,     (void *)decoder_object_doc},
+    {Py_tp_methods, DecoderObjectMethods},
+    {Py_tp_new,     decoder_object_new},
+    {Py_tp_dealloc, decoder_object_dealloc},
+    {0, NULL}
+};
+
+static PyType_Spec PyDecoder_Type_spec = {
+    "metamagic.json._decoder.Decoder",
+    sizeof(PyDecoderObject),
+    0,
+    Py_TPFLAGS_DEFAULT,
+    PyDecoder_Type_slots
+};
+
+/* module state handling and initialization, see the "implemention: module" section */
+static int decoder_module_exec     (PyObject *module);
+static int decoder_module_traverse (PyObject *module, visitproc visit, void *arg);
+static int decoder_module_clear    (PyObject *module);
+static void decoder_module_free    (void *module);
+
+#if PY_VERSION_HEX >= 0x03050000
+static PyModuleDef_Slot decoder_module_slots[] = {
+    {Py_mod_exec, decoder_module_exec},
+#ifdef Py_mod_multiple_interpreters
+    {Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
+#endif
+#ifdef Py_mod_gil
+    {Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+    {0, NULL}
+};
+#else
+#define decoder_module_slots NULL
+#endif
+
+static struct PyModuleDef decodermodule = {
+    PyModuleDef_HEAD_INIT,
+    "_decoder",                        /* name of module */
+    NULL,                              /* module documentation, may be NULL */
+    sizeof(DecoderState),              /* size of per-module state */
+    DecoderMethods,
+    decoder_module_slots,
+    decoder_module_traverse,
+    decoder_module_clear,
+    decoder_module_free
+};
+
+PyMODINIT_FUNC
+PyInit__decoder(void)
+{
+#if PY_VERSION_HEX >= 0x03050000
+    return PyModuleDef_Init(&decodermodule);
+#else
+    PyObject* module = PyModule_Create(&decodermodule);
+
+    if (module != NULL && decoder_module_exec(module) < 0)
+        Py_CLEAR(module);
+
+    return module;
+#endif
+}
+
+
+/*===========================================================================
+ * implemention: public functions
+ *===========================================================================*/
+
+
+static PyObject * decode_value (DecoderInput * input, const char * p, const char ** value_end);
+static PyObject * scan_value   (DecoderInput * input, const char * p, const char ** value_end);
+
+static PyObject * decoder_decode_args (DecoderState * state, DecoderCache * cache,
+                                       PyObject *args, PyObject *kwargs);
+
+static bool         extract_init    (Extraction * ex, PyObject * paths, PyObject * default_value);
+static const char * extract_value   (Extraction * ex, const char * p, Py_ssize_t depth,
+                                     Py_ssize_t active_count);
+static void         extract_destruct (Extraction * ex);
+
+
+/*
+ * Gets a (read-only, contiguous) buffer of the bytes-like object 'data' and
+ * initializes 'input' to decode it (with no interning of keys).  Returns false with an exception set if
+ * 'data' does not support the buffer protocol.
+ */
+static bool decoder_input_init (DecoderInput * input, DecoderState * state, PyObject * data,
+                                Py_buffer * view)
+{
+    if (PyObject_GetBuffer(data, view, PyBUF_SIMPLE) < 0)
+        return false;
+
+    input->start = (const char *)view->buf;
+    input->end   = input->start + view->len;
+    input->state  = state;
+    input->cache  = NULL;
+    input->schema = NULL;
+    input->parse  = 0;
+
+    return true;
+}
+
+/*
+ * Validates the JSON document in the bytes-like object 'data' and returns its
+ * structural index: a bytes() array of TapeEntry structures (3 native 64-bit
+ * integers each: start and end offsets of every value and the index of the
+ * entry after it, see _decoder.h), which can be read with
+ * memoryview(tape).cast('q').
+ *
+ * No Python objects are created for the values; strings are only checked
+ * for valid escapes and control characters (UTF-8 is validated when they are
+ * decoded).  Raises DecodeError for invalid documents.
+ */
+static PyObject *
+decoder_scan (PyObject *module, PyObject *args, PyObject *kwargs)
+{
+    PyObject *data;
+
+    static char *kwlist[] = {"data", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O", kwlist, &data))
+        return NULL;
+
+    Py_buffer    view;
+    DecoderInput input;
+
+    if (!decoder_input_init(&input, (DecoderState*)PyModule_GetState(module), data, &view))
+        return NULL;
+
+    const char * value_end;
+
+    PyObject * tape = scan_value(&input, input.start, &value_end);
+
+    if (tape != NULL && decoder_skip_whitespace(value_end, input.end) != input.end)
+    {
+        decoder_error(&input, "Extra data", decoder_skip_whitespace(value_end, input.end));
+        Py_CLEAR(tape);
+    }
+
+    PyBuffer_Release(&view);
+
+    return tape;
+}
+
+/*
+ * Decodes the JSON value found in the bytes-like object 'data' between the
+ * 'start' and 'end' offsets (by default the whole of 'data'), which may only
+ * be surrounded by whitespace, and returns it as Python objects: dict, list,
+ * str, int, float, True, False or None.
+ *
+ * 'schema' is the root node of a compiled schema (see SCHEMA_* in _decoder.h):
+ * values at the places it describes are converted to UUIDs, datetimes, dates,
+ * times and Decimals as they are decoded, and objects to instances of classes;
+ * values of other types there raise DecodeError, except null.
+ *
+ * 'parse' is a combination of the PARSE_* flags (see _decoder.h): elsewhere,
+ * strings in the formats written by the encoder are converted to UUIDs,
+ * datetimes, dates, times and Decimals, and numbers to Decimals, with no
+ * Python code called for them.
+ *
+ * Object keys are interned for the duration of the call, see DecoderCache;
+ * Decoder instances keep them across calls.
+ *
+ * Raises DecodeError for invalid JSON; the position of the error is the offset
+ * from the beginning of 'data'.
+ */
+static PyObject *
+decoder_decode (PyObject *module, PyObject *args, PyObject *kwargs)
+{
+    DecoderCache cache;
+
+    decoder_cache_init(&cache, DEFAULT_MAX_KEYS);
+
+    PyObject * result = decoder_decode_args((DecoderState*)PyModule_GetState(module), &cache,
+                                            args, kwargs);
+
+    decoder_cache_clear(&cache);
+
+    return result;
+}
+
+/*
+ * decode() of the module and of Decoder instances, interning the object keys
+ * in 'cache' (unless it is NULL).
+ */
+static PyObject *
+decoder_decode_args (DecoderState * state, DecoderCache * cache, PyObject *args, PyObject *kwargs)
+{
+    PyObject *data;
+    Py_ssize_t start = 0;
+    PyObject *end_arg = Py_None;
+    PyObject *schema = Py_None;
+    int parse = 0;
+
+    static char *kwlist[] = {"data", "start", "end", "schema", "parse", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nOOi", kwlist, &data, &start, &end_arg,
+                                     &schema, &parse))
+        return NULL;
+
+    if (parse & ~PARSE_FLAGS)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid parse flags");
+        return NULL;
+    }
+
+    if ((schema != Py_None || parse != 0) && !decoder_load_types(state))
+        return NULL;
+
+    Py_buffer    view;
+    DecoderInput input;
+
+    if (!decoder_input_init(&input, state, data, &view))
+        return NULL;
+
+    input.cache  = cache;
+    input.schema = schema != Py_None ? schema : NULL;
+    input.parse  = parse;
+
+    Py_ssize_t end = view.len;
+
+    if (end_arg != Py_None && (end = PyLong_AsSsize_t(end_arg)) == -1 && PyErr_Occurred())
+    {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    if (start < 0 || end < start || end > view.len)
+    {
+        PyErr_SetString(PyExc_ValueError, "start and end must be offsets within data");
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    input.end = input.start + end;
+
+    const char * value_end;
+
+    PyObject * result = decode_value(&input, input.start + start, &value_end);
+
+    if (result != NULL && decoder_skip_whitespace(value_end, input.end) != input.end)
+    {
+        decoder_error(&input, "Extra data", decoder_skip_whitespace(value_end, input.end));
+        Py_CLEAR(result);
+    }
+
+    PyBuffer_Release(&view);
+
+    return result;
+}
+
+/*
+ * Finds the end of the JSON value starting at the offset 'pos' of the bytes-like
+ * object 'data' (at its first byte, not at whitespace) and returns an
+ * (end offset, state) tuple.  If 'data' ends before the value does, the end
+ * offset is -1 and the search goes on with find_value_end(more_data, len(data),
+ * state), where 'more_data' extends 'data'; bytes are looked at only once.
+ *
+ * The value is not validated, only strings and brackets are followed; decode()
+ * the value to check it.  A top-level number or literal ends at the first
+ * whitespace or punctuation, so it is incomplete until one is found.
+ */
+static PyObject *
+decoder_find_value_end (PyObject *module, PyObject *args, PyObject *kwargs)
+{
+    PyObject *data;
+    Py_ssize_t pos = 0;
+    Py_ssize_t state = 0;
+
+    static char *kwlist[] = {"data", "pos", "state", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|nn", kwlist, &data, &pos, &state))
+        return NULL;
+
+    Py_buffer view;
+
+    if (PyObject_GetBuffer(data, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+
+    if (pos < 0 || pos > view.len || state < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "pos must be an offset within data");
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    const unsigned char * start = (const unsigned char *)view.buf;
+    const unsigned char * end   = start + view.len;
+    const unsigned char * p     = start + pos;
+
+    Py_ssize_t depth = state >> STATE_DEPTH_SHIFT;
+    int        flags = (int)(state & ((1 << STATE_DEPTH_SHIFT) - 1));
+
+    if (state == 0 && p < end)
+    {
+        if (*p == '{' || *p == '[')
+            depth = 1;
+        else if (*p == '"')
+            flags = STATE_STRING;
+        else
+            flags = STATE_SCALAR;
+        p++;
+    }
+
+    while (p < end)
+    {
+        if (flags & STATE_STRING)
+        {
+            if (flags & STATE_ESCAPE)
+            {
+                flags &= ~STATE_ESCAPE;
+                p++;
+            }
+
+            while (p < end && *p != '"' && *p != '\\')
+                p++;
+
+            if (p == end) break;
+
+            if (*p++ == '\\')
+            {
+                flags |= STATE_ESCAPE;
+                continue;
+            }
+
+            flags &= ~STATE_STRING;
+
+            if (depth == 0) goto complete;
+        }
+        else if (flags & STATE_SCALAR)
+        {
+            while (p < end && !scalar_end_char[*p])
+                p++;
+
+            if (p == end) break;
+
+            goto complete;
+        }
+        else
+        {
+            while (p < end && !structural_char[*p])
+                p++;
+
+            if (p == end) break;
+
+            switch (*p++)
+            {
+                case '"':
+                    flags |= STATE_STRING;
+                    break;
+
+                case '{': case '[':
+                    depth++;
+                    break;
+
+                default:
+                    if (--depth == 0) goto complete;
+            }
+        }
+    }
+
+    PyBuffer_Release(&view);
+    return Py_BuildValue("(nn)", (Py_ssize_t)-1, (depth << STATE_DEPTH_SHIFT) | flags);
+
+complete:
+    PyBuffer_Release(&view);
+    return Py_BuildValue("(nn)", (Py_ssize_t)(p - start), (Py_ssize_t)0);
+}
+
+/*
+ * Decodes the values at 'paths' in the JSON document in the bytes-like object
+ * 'data' and returns a list of them, with 'default' for the paths not found.
+ *
+ * A path is a str of dot-separated object keys (a key of digits can also be an
+ * array index, as in "items.0.id"), or a tuple of str keys and int indices.
+ *
+ * Only the containers on the way to the paths are parsed; the other values are
+ * skimmed (see decoder_skip_value()), and reading stops as soon as all the paths
+ * are found, so errors in the rest of the document are not detected.  If a key
+ * occurs more than once in an object, the first value is used.
+ */
+static PyObject *
+decoder_extract (PyObject *module, PyObject *args, PyObject *kwargs)
+{
+    PyObject *data;
+    PyObject *paths;
+    PyObject *default_value = Py_None;
+
+    static char *kwlist[] = {"data", "paths", "default", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|O", kwlist, &data, &paths, &default_value))
+        return NULL;
+
+    Py_buffer    view;
+    DecoderInput input;
+    Extraction   ex;
+
+    if (!decoder_input_init(&input, (DecoderState*)PyModule_GetState(module), data, &view))
+        return NULL;
+
+    ex.input = &input;
+
+    if (!extract_init(&ex, paths, default_value))
+    {
+        extract_destruct(&ex);
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+
+    PyObject   * results = NULL;
+    const char * p;
+
+    if (ex.remaining == 0)
+        results = ex.results;
+    else if ((p = extract_value(&ex, input.start, 0, ex.count)) != NULL)
+    {
+        // the document is only checked to its end if it is read to the end
+        p = decoder_skip_whitespace(p, input.end);
+
+        if (ex.remaining > 0 && p != input.end)
+            decoder_error(&input, "Extra data", p);
+        else
+            results = ex.results;
+    }
+
+    Py_XINCREF(results);
+
+    extract_destruct(&ex);
+    PyBuffer_Release(&view);
+
+    return results;
+}
+
+
+/*===========================================================================
+ * implemention: module
+ *===========================================================================*/
+
+/*
+ * Initializes the module state.  Called for every (sub)interpreter importing
+ * the module.
+ */
+#if PY_VERSION_HEX < 0x03090000
+// heap types have no reference to their module before Python 3.9, so the state
+// of the last initialized module is used (there is no per-interpreter GIL there)
+static DecoderState * decoder_last_state = NULL;
+#endif
+
+/*
+ * Returns the state of the _decoder module defining the Decoder class 'type'.
+ */
+static DecoderState * decoder_type_state (PyTypeObject * type)
+{
+#if PY_VERSION_HEX >= 0x03090000
+    PyObject * module = PyType_GetModule(type);
+
+    return module == NULL ? NULL : (DecoderState*)PyModule_GetState(module);
+#else
+    return decoder_last_state;
+#endif
+}
+
+static int decoder_module_exec (PyObject *module)
+{
+    DecoderState * state = (DecoderState*)PyModule_GetState(module);
+
+    // create the Decoder class
+#if PY_VERSION_HEX >= 0x03090000
+    state->PyDecoder_Type = (PyTypeObject*)PyType_FromModuleAndSpec(module, &PyDecoder_Type_spec, NULL);
+#else
+    state->PyDecoder_Type = (PyTypeObject*)PyType_FromSpec(&PyDecoder_Type_spec);
+#endif
+    if (state->PyDecoder_Type == NULL) return -1;
+
+#if PY_VERSION_HEX < 0x03090000
+    decoder_last_state = state;
+#endif
+
+    Py_INCREF(state->PyDecoder_Type);
+    if (PyModule_AddObject(module, "Decoder", (PyObject *)state->PyDecoder_Type) < 0)
+    {
+        Py_DECREF(state->PyDecoder_Type);
+        return -1;
+    }
+
+    PyObject * exceptions = PyImport_ImportModule("metamagic.json.exceptions");
+
+    if (exceptions == NULL) return -1;
+
+    state->DecodeError = PyObject_GetAttrString(exceptions, "DecodeError");
+
+    Py_DECREF(exceptions);
+
+    return state->DecodeError == NULL ? -1 : 0;
+}
+
+static int decoder_module_traverse (PyObject *module, visitproc visit, void *arg)
+{
+    DecoderState * state = (DecoderState*)PyModule_GetState(module);
+
+    if (state == NULL) return 0;
+
+    Py_VISIT(state->PyDecoder_Type);
+    Py_VISIT(state->DecodeError);
+    Py_VISIT(state->UUID);
+    Py_VISIT(state->SafeUUID_unknown);
+    Py_VISIT(state->Decimal);
+    Py_VISIT(state->timezone);
+
+    return 0;
+}
+
+static int decoder_module_clear (PyObject *module)
+{
+    DecoderState * state = (DecoderState*)PyModule_GetState(module);
+
+    if (state == NULL) return 0;
+
+    Py_CLEAR(state->PyDecoder_Type);
+    Py_CLEAR(state->DecodeError);
+    Py_CLEAR(state->UUID);
+    Py_CLEAR(state->SafeUUID_unknown);
+    Py_CLEAR(state->Decimal);
+    Py_CLEAR(state->timezone);
+    Py_CLEAR(state->str_int);
+    Py_CLEAR(state->str_is_safe);
+
+    state->types_loaded = false;
+
+    return 0;
+}
+
+static void decoder_module_free (void *module)
+{
+#if PY_VERSION_HEX < 0x03090000
+    if (decoder_last_state == PyModule_GetState((PyObject*)module))
+        decoder_last_state = NULL;
+#endif
+
+    decoder_module_clear((PyObject*)module);
+}
+
+
+/*===========================================================================
+ * implemention: Decoder class
+ *===========================================================================*/
+
+static PyObject * decoder_object_new (PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    Py_ssize_t max_keys = DEFAULT_MAX_KEYS;
+
+    static char *kwlist[] = {"max_keys", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|n", kwlist, &max_keys))
+        return NULL;
+
+    if (max_keys < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "max_keys must not be negative");
+        return NULL;
+    }
+
+    PyDecoderObject * self = (PyDecoderObject*)type->tp_alloc(type, 0);
+
+    if (self == NULL) return NULL;
+
+    self->state = decoder_type_state(type);
+    self->busy  = false;
+    decoder_cache_init(&self->cache, max_keys);
+
+    return (PyObject*)self;
+}
+
+static void decoder_object_dealloc (PyObject *self)
+{
+    PyTypeObject * type = Py_TYPE(self);
+
+    decoder_cache_clear(&((PyDecoderObject*)self)->cache);
+
+    type->tp_free(self);
+
+    // instances of heap types own a reference to their type
+    Py_DECREF(type);
+}
+
+/*
+ * Marks the cache of 'self' as in use; returns false if it already is (by
+ * another thread, or by a call made while decoding, e.g. from a finalizer).
+ */
+static bool decoder_object_acquire (PyDecoderObject * self)
+{
+    bool acquired;
+
+#ifdef Py_BEGIN_CRITICAL_SECTION
+    Py_BEGIN_CRITICAL_SECTION(self);
+#endif
+    acquired   = !self->busy;
+    self->busy = true;
+#ifdef Py_BEGIN_CRITICAL_SECTION
+    Py_END_CRITICAL_SECTION();
+#endif
+
+    return acquired;
+}
+
+static void decoder_object_release (PyDecoderObject * self)
+{
+#ifdef Py_BEGIN_CRITICAL_SECTION
+    Py_BEGIN_CRITICAL_SECTION(self);
+#endif
+    self->busy = false;
+#ifdef Py_BEGIN_CRITICAL_SECTION
+    Py_END_CRITICAL_SECTION();
+#endif
+}
+
+/*
+ * Decoder.decode(data, start=0, end=None, schema=None, parse=0): see decoder_decode().
+ */
+static PyObject * decoder_object_decode (PyDecoderObject *self, PyObject *args, PyObject *kwargs)
+{
+    if (self->cache.max_keys == 0)
+        return decoder_decode_args(self->state, NULL, args, kwargs);
+
+    if (decoder_object_acquire(self))
+    {
+        PyObject * result = decoder_decode_args(self->state, &self->cache, args, kwargs);
+
+        decoder_object_release(self);
+
+        return result;
+    }
+
+    // the keys of the instance are in use: intern keys for this call only
+    DecoderCache cache;
+
+    decoder_cache_init(&cache, self->cache.max_keys);
+
+    PyObject * result = decoder_decode_args(self->state, &cache, args, kwargs);
+
+    decoder_cache_clear(&cache);
+
+    return result;
+}
+
+static PyObject * decoder_object_clear (PyDecoderObject *self, PyObject *unused)
+{
+    if (!decoder_object_acquire(self))
+    {
+        PyErr_SetString(PyExc_RuntimeError, "the Decoder is decoding");
+        return NULL;
+    }
+
+    decoder_cache_clear(&self->cache);
+
+    decoder_object_release(self);
+
+    Py_RETURN_NONE;
+}
+
+
+/*===========================================================================
+ * implemention: decoding
+ *===========================================================================*/
+
+/*
+ * Raises DecodeError(msg, pos) with the offset of 'pos' in the input.
+ */
+static void decoder_error (DecoderInput * input, const char * msg, const char * pos)
+{
+    PyObject * error = PyObject_CallFunction(input->state->DecodeError, "sn",
+                                             msg, (Py_ssize_t)(pos - input->start));
+
+    if (error != NULL)
+    {
+        PyErr_SetObject((PyObject*)Py_TYPE(error), error);
+        Py_DECREF(error);
+    }
+}
+
+static void decoder_stack_init (DecoderStack * stack)
+{
+    stack->frames    = stack->frames_inline;
+    stack->depth     = 0;
+    stack->allocated = INLINE_FRAMES;
+}
+
+/*
+ * Returns the new (zeroed) frame on top of the stack, or NULL with a MemoryError set.
+ */
+static DecoderFrame * decoder_stack_push (DecoderStack * stack)
+{
+    if (stack->depth == stack->allocated)
+    {
+        int allocated = stack->allocated * 2;
+        DecoderFrame * frames;
+
+        if (stack->frames == stack->frames_inline)
+        {
+            frames = PyMem_Malloc(allocated * sizeof(DecoderFrame));
+            if (frames != NULL)
+                memcpy(frames, stack->frames_inline, sizeof(stack->frames_inline));
+        }
+        else
+            frames = PyMem_Realloc(stack->frames, allocated * sizeof(DecoderFrame));
+
+        if (frames == NULL)
+        {
+            PyErr_NoMemory();
+            return NULL;
+        }
+
+        stack->frames    = frames;
+        stack->allocated = allocated;
+    }
+
+    DecoderFrame * frame = &stack->frames[stack->depth++];
+
+    memset(frame, 0, sizeof(DecoderFrame));
+
+    return frame;
+}
+
+/*
+ * Releases the containers and keys of all remaining frames (after an error)
+ * and the frames themselves.
+ */
+static void decoder_stack_destruct (DecoderStack * stack)
+{
+    while (stack->depth > 0)
+    {
+        DecoderFrame * frame = &stack->frames[--stack->depth];
+
+        Py_XDECREF(frame->container);
+        Py_XDECREF(frame->key);
+        Py_XDECREF(frame->shape);
+        Py_XDECREF(frame->node);
+    }
+
+    if (stack->frames != stack->frames_inline)
+        PyMem_Free(stack->frames);
+}
+
+// the error for a value of another type than the one of a schema node of each kind
+static const char * schema_expecting[SCHEMA_KINDS] = {
+    NULL,
+    "Expecting a UUID string",
+    "Expecting a datetime string",
+    "Expecting a date string",
+    "Expecting a time string",
+    "Expecting a decimal number or string",
+    "Expecting an array",
+    "Expecting an object",
+    "Expecting an object",
+    NULL,
+};
+
+/*
+ * Returns the kind of the schema 'node' (0 for NULL), or -1 with a TypeError
+ * set if it is not a valid node.
+ */
+static int schema_kind (PyObject * node)
+{
+    static const Py_ssize_t sizes[SCHEMA_KINDS] = {0, 1, 1, 1, 1, 1, 2, 2, 4, 1};
+
+    if (node == NULL) return 0;
+
+    if (PyTuple_Check(node) && PyTuple_GET_SIZE(node) > 0 && PyLong_Check(PyTuple_GET_ITEM(node, 0)))
+    {
+        long kind = PyLong_AsLong(PyTuple_GET_ITEM(node, 0));
+
+        if (kind > 0 && kind < SCHEMA_KINDS && PyTuple_GET_SIZE(node) == sizes[kind] &&
+            (kind != SCHEMA_OBJECT || (PyDict_Check(PyTuple_GET_ITEM(node, 1)) &&
+                                       PyTuple_Check(PyTuple_GET_ITEM(node, 3)))))
+            return (int)kind;
+
+        PyErr_Clear();
+    }
+
+    PyErr_SetString(PyExc_TypeError, "invalid schema node, schemas are compiled by "
+                                     "metamagic.json.Schema");
+    return -1;
+}
+
+/* returns the node 'child' (an item of a node), or NULL for None */
+static inline PyObject * schema_node (PyObject * child)
+{
+    return child == Py_None ? NULL : child;
+}
+
+/*
+ * Converts the contents of the string (or the number) at [p, end) for a node
+ * of a SCHEMA_UUID ... SCHEMA_DECIMAL 'kind', see _decoder_types.h.
+ */
+static PyObject * schema_convert (DecoderState * state, int kind, const char * p, const char * end)
+{
+    switch (kind)
+    {
+        case SCHEMA_UUID:     return decoder_make_uuid(state, p, end);
+        case SCHEMA_DATETIME: return decoder_make_datetime(state, p, end);
+        case SCHEMA_DATE:     return decoder_make_date(state, p, end);
+        case SCHEMA_TIME:     return decoder_make_time(state, p, end);
+        default:              return decoder_make_decimal(state, p, end);
+    }
+}
+
+/*
+ * Converts the contents of the string at [p, end), which has no schema node,
+ * as told by the PARSE_* flags 'parse'.  The first bytes and the size pick the
+ * one format the string may be in, so other strings cost a few comparisons.
+ * Returns NULL with no exception set if the string is not converted.
+ */
+static PyObject * decoder_parse_string (DecoderState * state, int parse,
+                                        const char * p, const char * end)
+{
+    Py_ssize_t size = end - p;
+
+    // only UUIDs may start with a letter
+    if (size == 0 || (*p != '-' && !IS_DIGIT(*p) && !(parse & PARSE_UUID)))
+        return NULL;
+
+    if ((parse & PARSE_UUID) && size == 36 && p[8] == '-')
+        return decoder_make_uuid(state, p, end);
+
+    if (parse & PARSE_DATETIME)
+    {
+        if (size == 10 && p[4] == '-')
+            return decoder_make_date(state, p, end);
+        if (size >= 19 && p[4] == '-' && p[10] == 'T')
+            return decoder_make_datetime(state, p, end);
+        if (size >= 8 && p[2] == ':')
+            return decoder_make_time(state, p, end);
+    }
+
+    if ((parse & PARSE_DECIMAL_STRINGS) && (*p == '-' || IS_DIGIT(*p)))
+        return decoder_make_decimal(state, p, end);
+
+    return NULL;
+}
+
+/*
+ * Sets the field and the node of the value of the pending key of the object
+ * of 'frame', which has a SCHEMA_DICT, SCHEMA_OBJECT or SCHEMA_ANY node.
+ * Returns false with an exception set on failure.
+ */
+static bool schema_set_child (DecoderFrame * frame)
+{
+    frame->field = -1;
+    frame->child = NULL;
+
+    if (frame->kind == SCHEMA_ANY)
+    {
+        // the values of an object taken as is are taken as is as well
+        frame->child = frame->node;
+        return true;
+    }
+
+    if (frame->kind == SCHEMA_DICT)
+    {
+        frame->child = schema_node(PyTuple_GET_ITEM(frame->node, 1));
+        return true;
+    }
+
+    PyObject * entry = PyDict_GetItemWithError(PyTuple_GET_ITEM(frame->node, 1), frame->key);
+
+    if (entry == NULL) return !PyErr_Occurred();
+
+    Py_ssize_t field;
+
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) != 2 ||
+        (field = PyLong_AsSsize_t(PyTuple_GET_ITEM(entry, 0))) < 0 ||
+        field >= PyTuple_GET_SIZE(PyTuple_GET_ITEM(frame->node, 3)))
+    {
+        PyErr_Clear();
+        PyErr_SetString(PyExc_TypeError, "invalid schema node, schemas are compiled by "
+                                         "metamagic.json.Schema");
+        return false;
+    }
+
+    frame->field = field;
+    frame->child = schema_node(PyTuple_GET_ITEM(entry, 1));
+
+    return true;
+}
+
+/*
+ * Returns a new instance of the class of the SCHEMA_OBJECT 'node', called with
+ * the fields in the tuple 'values' (NULL for missing fields, or no tuple for no
+ * fields) as keyword arguments.  Returns NULL with an exception set on failure.
+ */
+static PyObject * schema_make_record (PyObject * node, PyObject * values)
+{
+    PyObject * cls   = PyTuple_GET_ITEM(node, 2);
+    PyObject * names = PyTuple_GET_ITEM(node, 3);
+    Py_ssize_t size  = values != NULL ? PyTuple_GET_SIZE(values) : 0;
+    Py_ssize_t count = 0;
+
+    for (Py_ssize_t i = 0; i < size; i++)
+        count += PyTuple_GET_ITEM(values, i) != NULL;
+
+#if PY_VERSION_HEX >= 0x03090000
+    // no dict of keyword arguments is made
+    if (count == 0)
+        return PyObject_Vectorcall(cls, NULL, 0, NULL);
+
+    if (count == size)
+        return PyObject_Vectorcall(cls, &PyTuple_GET_ITEM(values, 0), 0, names);
+
+    PyObject ** args    = PyMem_Malloc(count * sizeof(PyObject*));
+    PyObject  * kwnames = PyTuple_New(count);
+    PyObject  * result  = NULL;
+
+    if (args == NULL || kwnames == NULL)
+    {
+        if (!PyErr_Occurred()) PyErr_NoMemory();
+        goto done;
+    }
+
+    for (Py_ssize_t i = 0, n = 0; i < size; i++)
+    {
+        if (PyTuple_GET_ITEM(values, i) == NULL) continue;
+
+        args[n] = PyTuple_GET_ITEM(values, i);
+        Py_INCREF(PyTuple_GET_ITEM(names, i));
+        PyTuple_SET_ITEM(kwnames, n, PyTuple_GET_ITEM(names, i));
+        n++;
+    }
+
+    result = PyObject_Vectorcall(cls, args, 0, kwnames);
+
+done:
+    PyMem_Free(args);
+    Py_XDECREF(kwnames);
+
+    return result;
+#else
+    PyObject * no_args = PyTuple_New(0);
+    PyObject * kwargs  = PyDict_New();
+    PyObject * result  = NULL;
+
+    if (no_args == NULL || kwargs == NULL) goto done;
+
+    for (Py_ssize_t i = 0; i < size; i++)
+    {
+        if (PyTuple_GET_ITEM(values, i) != NULL &&
+            PyDict_SetItem(kwargs, PyTuple_GET_ITEM(names, i), PyTuple_GET_ITEM(values, i)) < 0)
+            goto done;
+    }
+
+    result = PyObject_Call(cls, no_args, kwargs);
+
+done:
+    Py_XDECREF(no_args);
+    Py_XDECREF(kwargs);
+
+    return result;
+#endif
+}
+
+/*
+ * Decodes the JSON value starting at 'p' (after optional whitespace) and sets
+ * 'value_end' to the position after it.  Containers are decoded iteratively,
+ * so the nesting depth is only limited by the available memory.
+ *
+ * Returns a new reference, or NULL with an exception set.
+ */
+static PyObject * decode_value (DecoderInput * input, const char * p, const char ** value_end)
+{
+    const char * end = input->end;
+    const char * q;
+
+    DecoderStack   stack;
+    DecoderFrame * frame;
+    PyObject     * value = NULL;
+    PyObject     * node  = input->schema;   // schema node of the value, NULL for none
+
+    int  flags;
+    bool is_float;
+    int  status;
+    int  kind;
+
+    decoder_stack_init(&stack);
+
+parse_value:
+    p = decoder_skip_whitespace(p, end);
+
+    if (p == end)
+    {
+        decoder_error(input, "Expecting value", p);
+        goto error;
+    }
+
+    if ((kind = schema_kind(node)) < 0) goto error;
+
+    switch (*p)
+    {
+        case '{':
+        {
+            if (kind != 0 && kind != SCHEMA_DICT && kind != SCHEMA_OBJECT && kind != SCHEMA_ANY)
+                goto schema_error;
+
+            bool is_record = kind == SCHEMA_OBJECT && PyTuple_GET_ITEM(node, 2) != Py_None;
+
+            p = decoder_skip_whitespace(p + 1, end);
+
+            if (p < end && *p == '}')
+            {
+                value = is_record ? schema_make_record(node, NULL) : PyDict_New();
+                if (value == NULL) goto error;
+                p++;
+                break;
+            }
+
+            // the expected keys: those of the last object at the same place
+            ShapeSlot * slot  = NULL;
+            PyObject  * shape = NULL;
+
+            if (input->cache != NULL && !is_record)
+            {
+                PyObject * parent_key = stack.depth > 0 ? stack.frames[stack.depth - 1].key : NULL;
+
+                if ((slot = decoder_shape_slot(input->cache, stack.depth, parent_key)) == NULL)
+                    goto error;
+
+                if (slot->keys != NULL && slot->depth == stack.depth && slot->parent_key == parent_key)
+                    shape = slot->keys;
+            }
+
+            // avoids resizing the dict while the expected keys are added; since
+            // Python 3.11 presized dicts do not use the compact layout for str
+            // keys, which takes more memory than the resizes save time
+            // records are decoded to a tuple of the values of their fields
+            if (is_record)
+                value = PyTuple_New(PyTuple_GET_SIZE(PyTuple_GET_ITEM(node, 3)));
+#if PY_VERSION_HEX < 0x030B0000
+            else if (shape != NULL)
+                value = _PyDict_NewPresized(PyTuple_GET_SIZE(shape));
+#endif
+            else
+                value = PyDict_New();
+
+            if (value == NULL) goto error;
+
+            if ((frame = decoder_stack_push(&stack)) == NULL) goto error;
+
+            frame->is_object = true;
+            frame->container = value;
+            value = NULL;
+
+            frame->slot          = slot;
+            frame->shape         = shape;
+            frame->shape_matches = shape != NULL;
+            Py_XINCREF(shape);
+
+            frame->node      = node;
+            frame->kind      = kind;
+            frame->is_record = is_record;
+            Py_XINCREF(node);
+
+            goto parse_key;
+        }
+
+        case '[':
+            if (kind != 0 && kind != SCHEMA_LIST && kind != SCHEMA_ANY) goto schema_error;
+
+            if ((value = PyList_New(0)) == NULL) goto error;
+
+            p = decoder_skip_whitespace(p + 1, end);
+
+            if (p < end && *p == ']')
+            {
+                p++;
+                break;
+            }
+
+            if ((frame = decoder_stack_push(&stack)) == NULL) goto error;
+
+            frame->container = value;
+            value = NULL;
+
+            if (kind != 0)
+            {
+                Py_INCREF(frame->node = node);
+                frame->kind  = kind;
+                frame->child = kind == SCHEMA_ANY ? node : schema_node(PyTuple_GET_ITEM(node, 1));
+            }
+
+            node = frame->child;
+            goto parse_value;
+
+        case '"':
+            if ((q = decoder_scan_string(input, p, &flags)) == NULL) goto error;
+
+            if (kind == 0 || kind == SCHEMA_ANY)
+            {
+                value = NULL;
+                if (kind == 0 && input->parse != 0 && !(flags & (STRING_ESCAPES | STRING_NON_ASCII)))
+                    value = decoder_parse_string(input->state, input->parse, p + 1, q - 1);
+                if (value == NULL && !PyErr_Occurred())
+                    value = decoder_make_string(p, q, flags);
+            }
+            else if (kind <= SCHEMA_DECIMAL && !(flags & (STRING_ESCAPES | STRING_NON_ASCII)))
+                value = schema_convert(input->state, kind, p + 1, q - 1);
+            else
+                value = NULL;
+
+            if (value == NULL)
+            {
+                if (PyErr_Occurred()) goto error;
+                goto schema_error;
+            }
+
+            p = q;
+            break;
+
+        case 't':
+            if (kind != 0 && kind != SCHEMA_ANY) goto schema_error;
+            if ((p = decoder_scan_literal(input, p, "true", 4)) == NULL) goto error;
+            Py_INCREF(value = Py_True);
+            break;
+
+        case 'f':
+            if (kind != 0 && kind != SCHEMA_ANY) goto schema_error;
+            if ((p = decoder_scan_literal(input, p, "false", 5)) == NULL) goto error;
+            Py_INCREF(value = Py_False);
+            break;
+
+        case 'n':
+            if ((p = decoder_scan_literal(input, p, "null", 4)) == NULL) goto error;
+            Py_INCREF(value = Py_None);
+            break;
+
+        // NaN and Infinity are not JSON, but are accepted as by the json module
+        case 'N':
+            if (kind != 0 && kind != SCHEMA_ANY) goto schema_error;
+            if ((p = decoder_scan_literal(input, p, "NaN", 3)) == NULL) goto error;
+            if ((value = PyFloat_FromDouble(Py_NAN)) == NULL) goto error;
+            break;
+
+        case 'I':
+            if (kind != 0 && kind != SCHEMA_ANY) goto schema_error;
+            if ((p = decoder_scan_literal(input, p, "Infinity", 8)) == NULL) goto error;
+            if ((value = PyFloat_FromDouble(Py_HUGE_VAL)) == NULL) goto error;
+            break;
+
+        default:
+            if (*p == '-' && end - p > 1 && p[1] == 'I')
+            {
+                if (kind != 0 && kind != SCHEMA_ANY) goto schema_error;
+                if ((p = decoder_scan_literal(input, p, "-Infinity", 9)) == NULL) goto error;
+                if ((value = PyFloat_FromDouble(-Py_HUGE_VAL)) == NULL) goto error;
+                break;
+            }
+
+            if (*p != '-' && !IS_DIGIT(*p))
+            {
+                decoder_error(input, "Expecting value", p);
+                goto error;
+            }
+
+            if (kind != 0 && kind != SCHEMA_DECIMAL && kind != SCHEMA_ANY) goto schema_error;
+
+            if ((q = decoder_scan_number(input, p, &is_float)) == NULL) goto error;
+
+            if (kind == SCHEMA_DECIMAL || (kind == 0 && is_float && (input->parse & PARSE_DECIMAL_NUMBERS)))
+                value = decoder_make_decimal(input->state, p, q);
+            else
+                value = decoder_make_number(p, q, is_float);
+
+            if (value == NULL) goto error;
+            p = q;
+    }
+
+    // 'value' is complete: add it to the enclosing container, and the container
+    // to its own enclosing container if it is complete as well
+    while (stack.depth > 0)
+    {
+        frame = &stack.frames[stack.depth - 1];
+
+        if (frame->is_record)
+        {
+            // values of other keys than the fields are dropped
+            if (frame->field >= 0)
+            {
+                PyObject * previous = PyTuple_GET_ITEM(frame->container, frame->field);
+
+                PyTuple_SET_ITEM(frame->container, frame->field, value);
+                value = NULL;
+                Py_XDECREF(previous);
+            }
+
+            Py_CLEAR(frame->key);
+            status = 0;
+        }
+        else if (frame->is_object)
+        {
+            status = PyDict_SetItem(frame->container, frame->key, value);
+            Py_CLEAR(frame->key);
+        }
+        else
+            status = PyList_Append(frame->container, value);
+
+        Py_CLEAR(value);
+
+        if (status < 0) goto error;
+
+        p = decoder_skip_whitespace(p, end);
+
+        if (p < end && *p == ',')
+        {
+            p++;
+
+            if (frame->is_object) goto parse_key;
+
+            node = frame->child;
+            goto parse_value;
+        }
+
+        if (p < end && *p == (frame->is_object ? '}' : ']'))
+        {
+            p++;
+
+            // a different shape is expected from the next object at the same place
+            if (frame->slot != NULL &&
+                !(frame->shape_matches && frame->key_count == PyTuple_GET_SIZE(frame->shape)))
+            {
+                PyObject * parent_key = stack.depth > 1 ? stack.frames[stack.depth - 2].key : NULL;
+
+                if (decoder_shape_update(frame->slot, stack.depth - 1, parent_key,
+                                         frame->container) < 0)
+                    goto error;
+            }
+
+            Py_CLEAR(frame->shape);
+
+            if (frame->is_record)
+            {
+                value = schema_make_record(frame->node, frame->container);
+                Py_CLEAR(frame->container);
+
+                if (value == NULL) goto error;
+            }
+            else
+            {
+                value = frame->container;
+                frame->container = NULL;
+            }
+
+            Py_CLEAR(frame->node);
+            stack.depth--;
+
+            continue;
+        }
+
+        decoder_error(input, "Expecting ',' delimiter", p);
+        goto error;
+    }
+
+    decoder_stack_destruct(&stack);
+
+    *value_end = p;
+    return value;
+
+parse_key:
+    p = decoder_skip_whitespace(p, end);
+
+    if (p == end || *p != '"')
+    {
+        decoder_error(input, "Expecting property name enclosed in double quotes", p);
+        goto error;
+    }
+
+    if ((q = decoder_scan_string(input, p, &flags)) == NULL) goto error;
+
+    frame = &stack.frames[stack.depth - 1];
+
+    if (frame->shape_matches)
+    {
+        PyObject * expected = frame->key_count < PyTuple_GET_SIZE(frame->shape)
+                                  ? PyTuple_GET_ITEM(frame->shape, frame->key_count) : NULL;
+
+        if (expected != NULL && decoder_key_matches(expected, p, q, flags))
+        {
+            Py_INCREF(expected);
+            frame->key = expected;
+        }
+        else
+            frame->shape_matches = false;
+    }
+
+    if (frame->key == NULL)
+    {
+        frame->key = input->cache != NULL ? decoder_intern_key(input->cache, p, q, flags)
+                                          : decoder_make_string(p, q, flags);
+
+        if (frame->key == NULL) goto error;
+    }
+
+    frame->key_count++;
+
+    if (frame->node != NULL && !schema_set_child(frame)) goto error;
+
+    p = decoder_skip_whitespace(q, end);
+
+    if (p == end || *p != ':')
+    {
+        decoder_error(input, "Expecting ':' delimiter", p);
+        goto error;
+    }
+
+    p++;
+    node = frame->child;
+    goto parse_value;
+
+schema_error:
+    decoder_error(input, schema_expecting[kind], p);
+
+error:
+    Py_XDECREF(value);
+    decoder_stack_destruct(&stack);
+
+    return NULL;
+}
+
+
+/*===========================================================================
+ * implemention: structural index
+ *===========================================================================*/
+
+// the tape is built in a bytes() object which is resized as it grows
+typedef struct
+{
+    PyObject * bytes;
+    Py_ssize_t size;                            // number of entries
+    Py_ssize_t allocated;
+}
+Tape;
+
+static inline TapeEntry * tape_entry (Tape * tape, Py_ssize_t index)
+{
+    return ((TapeEntry*)PyBytes_AS_STRING(tape->bytes)) + index;
+}
+
+/*
+ * Adds an entry for the value starting at 'p'; returns its index or -1 with
+ * a MemoryError set.
+ */
+static Py_ssize_t tape_append (Tape * tape, DecoderInput * input, const char * p)
+{
+    if (tape->size == tape->allocated)
+    {
+        Py_ssize_t allocated = tape->allocated * 2;
+
+        if (allocated > PY_SSIZE_T_MAX / (Py_ssize_t)sizeof(TapeEntry))
+        {
+            PyErr_NoMemory();
+            return -1;
+        }
+
+        if (_PyBytes_Resize(&tape->bytes, allocated * sizeof(TapeEntry)) < 0)
+            return -1;
+
+        tape->allocated = allocated;
+    }
+
+    TapeEntry * entry = tape_entry(tape, tape->size);
+
+    entry->start = p - input->start;
+    entry->end   = entry->start;
+    entry->next  = tape->size + 1;
+
+    return tape->size++;
+}
+
+static inline void tape_set_end (Tape * tape, DecoderInput * input, Py_ssize_t index, const char * p)
+{
+    tape_entry(tape, index)->end = p - input->start;
+}
+
+/*
+ * Validates the JSON value starting at 'p' (after optional whitespace) and
+ * returns its structural index (see decoder_scan()), setting 'value_end' to
+ * the position after the value.  Follows the structure of decode_value(), with
+ * tape entries instead of Python objects.
+ *
+ * Returns a new reference, or NULL with an exception set.
+ */
+static PyObject * scan_value (DecoderInput * input, const char * p, const char ** value_end)
+{
+    const char * end = input->end;
+    const char * q;
+
+    DecoderStack   stack;
+    DecoderFrame * frame;
+    Tape           tape;
+    Py_ssize_t     index;
+
+    int  flags;
+    bool is_float;
+
+    // most values take a few bytes of the input
+    tape.size      = 0;
+    tape.allocated = 16 + (end - p) / 16;
+    tape.bytes     = PyBytes_FromStringAndSize(NULL, tape.allocated * sizeof(TapeEntry));
+
+    if (tape.bytes == NULL) return NULL;
+
+    decoder_stack_init(&stack);
+
+parse_value:
+    p = decoder_skip_whitespace(p, end);
+
+    if (p == end)
+    {
+        decoder_error(input, "Expecting value", p);
+        goto error;
+    }
+
+    if ((index = tape_append(&tape, input, p)) < 0) goto error;
+
+    switch (*p)
+    {
+        case '{':
+        case '[':
+            q = decoder_skip_whitespace(p + 1, end);
+
+            if (q < end && *q == (*p == '{' ? '}' : ']'))
+            {
+                p = q + 1;
+                break;
+            }
+
+            if ((frame = decoder_stack_push(&stack)) == NULL) goto error;
+
+            frame->is_object = *p == '{';
+            frame->index     = index;
+
+            p = q;
+
+            if (frame->is_object) goto parse_key;
+
+            goto parse_value;
+
+        case '"':
+            if ((p = decoder_scan_string(input, p, &flags)) == NULL) goto error;
+            break;
+
+        case 't':
+            if ((p = decoder_scan_literal(input, p, "true", 4)) == NULL) goto error;
+            break;
+
+        case 'f':
+            if ((p = decoder_scan_literal(input, p, "false", 5)) == NULL) goto error;
+            break;
+
+        case 'n':
+            if ((p = decoder_scan_literal(input, p, "null", 4)) == NULL) goto error;
+            break;
+
+        // accepted as by decode_value()
+        case 'N':
+            if ((p = decoder_scan_literal(input, p, "NaN", 3)) == NULL) goto error;
+            break;
+
+        case 'I':
+            if ((p = decoder_scan_literal(input, p, "Infinity", 8)) == NULL) goto error;
+            break;
+
+        default:
+            if (*p == '-' && end - p > 1 && p[1] == 'I')
+            {
+                if ((p = decoder_scan_literal(input, p, "-Infinity", 9)) == NULL) goto error;
+                break;
+            }
+
+            if (*p != '-' && !IS_DIGIT(*p))
+            {
+                decoder_error(input, "Expecting value", p);
+                goto error;
+            }
+
+            if ((p = decoder_scan_number(input, p, &is_float)) == NULL) goto error;
+    }
+
+    tape_set_end(&tape, input, index, p);
+
+    // the value is complete: close all containers which end with it
+    while (stack.depth > 0)
+    {
+        frame = &stack.frames[stack.depth - 1];
+
+        p = decoder_skip_whitespace(p, end);
+
+        if (p < end && *p == ',')
+        {
+            p++;
+
+            if (frame->is_object) goto parse_key;
+
+            goto parse_value;
+        }
+
+        if (p < end && *p == (frame->is_object ? '}' : ']'))
+        {
+            p++;
+
+            tape_set_end(&tape, input, frame->index, p);
+            tape_entry(&tape, frame->index)->next = tape.size;
+            stack.depth--;
+
+            continue;
+        }
+
+        decoder_error(input, "Expecting ',' delimiter", p);
+        goto error;
+    }
+
+    decoder_stack_destruct(&stack);
+
+    if (_PyBytes_Resize(&tape.bytes, tape.size * sizeof(TapeEntry)) < 0)
+        return NULL;
+
+    *value_end = p;
+    return tape.bytes;
+
+parse_key:
+    p = decoder_skip_whitespace(p, end);
+
+    if (p == end || *p != '"')
+    {
+        decoder_error(input, "Expecting property name enclosed in double quotes", p);
+        goto error;
+    }
+
+    if ((index = tape_append(&tape, input, p)) < 0) goto error;
+    if ((p = decoder_scan_string(input, p, &flags)) == NULL) goto error;
+
+    tape_set_end(&tape, input, index, p);
+
+    p = decoder_skip_whitespace(p, end);
+
+    if (p == end || *p != ':')
+    {
+        decoder_error(input, "Expecting ':' delimiter", p);
+        goto error;
+    }
+
+    p++;
+    goto parse_value;
+
+error:
+    Py_XDECREF(tape.bytes);
+    decoder_stack_destruct(&stack);
+
+    return NULL;
+}
+
+
+/*===========================================================================
+ * implemention: extraction
+ *===========================================================================*/
+
+/*
+ * Sets the components of 'path' (a dotted str or a tuple); they refer to
+ * objects owned by 'owner', a new list.  Returns false with an exception set.
+ */
+static bool extract_path_init (ExtractPath * path, PyObject * spec, PyObject ** owner)
+{
+    bool dotted = PyUnicode_Check(spec);
+
+    if (dotted)
+    {
+        PyObject * separator = PyUnicode_FromString(".");
+
+        if (separator == NULL) return false;
+
+        *owner = PyUnicode_Split(spec, separator, -1);
+
+        Py_DECREF(separator);
+    }
+    else if (PyTuple_Check(spec))
+        *owner = PySequence_List(spec);
+    else
+    {
+        PyErr_Format(PyExc_TypeError, "a path must be a str or a tuple, not %.200s",
+                     Py_TYPE(spec)->tp_name);
+        return false;
+    }
+
+    if (*owner == NULL) return false;
+
+    path->length = PyList_GET_SIZE(*owner);
+
+    if ((path->components = PyMem_Calloc(path->length + 1, sizeof(PathComponent))) == NULL)
+    {
+        PyErr_NoMemory();
+        return false;
+    }
+
+    for (Py_ssize_t i = 0; i < path->length; i++)
+    {
+        PathComponent * component = &path->components[i];
+        PyObject      * item      = PyList_GET_ITEM(*owner, i);
+
+        component->index = -1;
+
+        if (PyUnicode_Check(item))
+        {
+            component->key = item;
+
+            // keys of up to 18 digits are array indices as well
+            Py_ssize_t size = PyUnicode_GET_LENGTH(item);
+
+            if (dotted && size > 0 && size <= 18)
+            {
+                Py_ssize_t index = 0;
+
+                for (Py_ssize_t j = 0; j < size && index >= 0; j++)
+                {
+                    Py_UCS4 c = PyUnicode_READ_CHAR(item, j);
+
+                    index = (c >= '0' && c <= '9') ? index * 10 + (c - '0') : -1;
+                }
+
+                component->index = index;
+            }
+        }
+        else if (PyLong_Check(item))
+        {
+            component->index = PyLong_AsSsize_t(item);
+
+            if (component->index == -1 && PyErr_Occurred())
+                PyErr_Clear();                  // too large: never found
+            else if (component->index < 0)
+                component->index = -1;
+        }
+        else
+        {
+            PyErr_Format(PyExc_TypeError, "path components must be str or int, not %.200s",
+                         Py_TYPE(item)->tp_name);
+            return false;
+        }
+    }
+
+    return true;
+}
+
+/*
+ * Initializes 'ex' (with 'ex->input' set) for the sequence of 'paths'.  Returns
+ * false with an exception set; 'ex' must be destructed in any case.
+ */
+static bool extract_init (Extraction * ex, PyObject * paths, PyObject * default_value)
+{
+    ex->paths   = NULL;
+    ex->found   = NULL;
+    ex->active  = NULL;
+    ex->results = NULL;
+    ex->owners  = NULL;
+    ex->count   = 0;
+
+    if (PyUnicode_Check(paths))
+    {
+        PyErr_SetString(PyExc_TypeError, "paths must be a sequence of paths, not a str");
+        return false;
+    }
+
+    // keeps the components of the paths
+    PyObject * owners = ex->owners = PySequence_List(paths);
+
+    if (owners == NULL) return false;
+
+    Py_ssize_t count = PyList_GET_SIZE(owners);
+    Py_ssize_t max_length = 0;
+
+    ex->results = PyList_New(count);
+    ex->paths   = PyMem_Calloc(count + 1, sizeof(ExtractPath));
+    ex->found   = PyMem_Calloc(count + 1, sizeof(bool));
+
+    if (ex->results == NULL || ex->paths == NULL || ex->found == NULL)
+    {
+        if (!PyErr_Occurred()) PyErr_NoMemory();
+        return false;
+    }
+
+    for (; ex->count < count; ex->count++)
+    {
+        Py_INCREF(default_value);
+        PyList_SET_ITEM(ex->results, ex->count, default_value);
+
+        PyObject * owner = NULL;
+        bool       ok    = extract_path_init(&ex->paths[ex->count], PyList_GET_ITEM(owners, ex->count),
+                                             &owner);
+
+        // 'owner' replaces the path in the list, keeping its components alive
+        if (owner != NULL)
+            PyList_SetItem(owners, ex->count, owner);
+
+        if (!ok)
+        {
+            ex->count++;
+            return false;
+        }
+
+        if (ex->paths[ex->count].length > max_length)
+            max_length = ex->paths[ex->count].length;
+    }
+
+    ex->remaining = count;
+
+    if ((ex->active = PyMem_Malloc((max_length + 1) * (count + 1) * sizeof(Py_ssize_t))) == NULL)
+    {
+        PyErr_NoMemory();
+        return false;
+    }
+
+    for (Py_ssize_t i = 0; i < count; i++)
+        ex->active[i] = i;
+
+    return true;
+}
+
+static void extract_destruct (Extraction * ex)
+{
+    for (Py_ssize_t i = 0; i < ex->count; i++)
+        PyMem_Free(ex->paths[i].components);
+
+    PyMem_Free(ex->paths);
+    PyMem_Free(ex->found);
+    PyMem_Free(ex->active);
+
+    Py_XDECREF(ex->results);
+    Py_XDECREF(ex->owners);
+}
+
+/*
+ * Returns the item of 'value' at 'component' (a borrowed reference), or NULL
+ * with no exception set if there is none.
+ */
+static PyObject * extract_item (PyObject * value, PathComponent * component)
+{
+    if (PyDict_CheckExact(value) && component->key != NULL)
+        return PyDict_GetItem(value, component->key);
+
+    if (PyList_CheckExact(value) && component->index >= 0 &&
+        component->index < PyList_GET_SIZE(value))
+        return PyList_GET_ITEM(value, component->index);
+
+    return NULL;
+}
+
+/* records 'value' (a borrowed reference) as the value of the path 'i' */
+static void extract_found (Extraction * ex, Py_ssize_t i, PyObject * value)
+{
+    Py_INCREF(value);
+    PyList_SetItem(ex->results, i, value);
+
+    ex->found[i] = true;
+    ex->remaining--;
+}
+
+/*
+ * Reads the value at 'p' (after optional whitespace), reached by following the
+ * first 'depth' components of the first 'active_count' paths of
+ * ex->active[depth * ex->count ...]: decodes it if one of them ends here,
+ * otherwise follows them into its items and skims the rest.
+ *
+ * Returns the position after the value (or anywhere, once all the paths are
+ * found), or NULL with an exception set.
+ */
+static const char * extract_value (Extraction * ex, const char * p, Py_ssize_t depth,
+                                   Py_ssize_t active_count)
+{
+    DecoderInput * input  = ex->input;
+    const char   * end    = input->end;
+    Py_ssize_t   * active = ex->active + depth * ex->count;
+    Py_ssize_t   * next   = active + ex->count;
+
+    // a path ends here: decode the value, and find the longer paths in it
+    for (Py_ssize_t n = 0; n < active_count; n++)
+    {
+        if (ex->paths[active[n]].length != depth) continue;
+
+        PyObject * value = decode_value(input, p, &p);
+
+        if (value == NULL) return NULL;
+
+        for (Py_ssize_t m = 0; m < active_count; m++)
+        {
+            ExtractPath * path = &ex->paths[active[m]];
+            PyObject    * item = value;
+
+            for (Py_ssize_t i = depth; i < path->length && item != NULL; i++)
+                item = extract_item(item, &path->components[i]);
+
+            if (item != NULL)
+                extract_found(ex, active[m], item);
+        }
+
+        Py_DECREF(value);
+        return p;
+    }
+
+    p = decoder_skip_whitespace(p, end);
+
+    bool is_object = p < end && *p == '{';
+
+    if (!is_object && (p == end || *p != '['))
+        return decoder_skip_value(input, p);
+
+    if (Py_EnterRecursiveCall(" while extracting from a JSON document"))
+        return NULL;
+
+    const char * result = NULL;
+
+    p = decoder_skip_whitespace(p + 1, end);
+
+    if (p < end && *p == (is_object ? '}' : ']'))
+    {
+        result = p + 1;
+        goto done;
+    }
+
+    for (Py_ssize_t index = 0; ; index++)
+    {
+        // the paths going through this item
+        Py_ssize_t next_count = 0;
+
+        if (is_object)
+        {
+            const char * q;
+            int          flags;
+            PyObject   * key = NULL;
+
+            if (p == end || *p != '"')
+            {
+                decoder_error(input, "Expecting property name enclosed in double quotes", p);
+                goto done;
+            }
+
+            if ((q = decoder_scan_string(input, p, &flags)) == NULL) goto done;
+
+            for (Py_ssize_t n = 0; n < active_count; n++)
+            {
+                PathComponent * component = &ex->paths[active[n]].components[depth];
+
+                if (ex->found[active[n]] || component->key == NULL) continue;
+
+                bool matches;
+
+                if (flags & STRING_ESCAPES)
+                {
+                    // rare: compare the decoded key
+                    if (key == NULL && (key = decoder_make_string(p, q, flags)) == NULL)
+                        goto done;
+
+                    int cmp = PyUnicode_Compare(key, component->key);
+
+                    if (cmp == -1 && PyErr_Occurred())
+                    {
+                        Py_DECREF(key);
+                        goto done;
+                    }
+
+                    matches = cmp == 0;
+                }
+                else
+                    matches = decoder_key_matches(component->key, p, q, flags);
+
+                if (matches)
+                    next[next_count++] = active[n];
+            }
+
+            Py_XDECREF(key);
+
+            p = decoder_skip_whitespace(q, end);
+
+            if (p == end || *p != ':')
+            {
+                decoder_error(input, "Expecting ':' delimiter", p);
+                goto done;
+            }
+
+            p++;
+        }
+        else
+        {
+            for (Py_ssize_t n = 0; n < active_count; n++)
+            {
+                if (!ex->found[active[n]] && ex->paths[active[n]].components[depth].index == index)
+                    next[next_count++] = active[n];
+            }
+        }
+
+        p = next_count > 0 ? extract_value(ex, p, depth + 1, next_count)
+                           : decoder_skip_value(input, p);
+
+        if (p == NULL) goto done;
+
+        if (ex->remaining == 0)
+        {
+            result = p;
+            goto done;
+        }
+
+        p = decoder_skip_whitespace(p, end);
+
+        if (p < end && *p == ',')
+        {
+            p = decoder_skip_whitespace(p + 1, end);
+            continue;
+        }
+
+        if (p < end && *p == (is_object ? '}' : ']'))
+        {
+            result = p + 1;
+            goto done;
+        }
+
+        decoder_error(input, "Expecting ',' delimiter", p);
+        goto done;
+    }
+
+done:
+    Py_LeaveRecursiveCall();
+    return result;
+}
@@ -0,0 +1,235 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#ifndef __DECODER_H__
+#define __DECODER_H__
+
+#include <Python.h>
+#include <stdbool.h>
+
+#define INLINE_FRAMES                   32   // frames stored on the C stack
+
+#define DEFAULT_MAX_KEYS              4096   // interned object keys, see DecoderCache
+#define INTERN_MAX_SIZE                 64   // longer keys are not interned
+#define MIN_KEY_TABLE_SIZE              64
+#define SHAPE_SLOTS                     64   // a power of 2
+
+/*
+ * State of the _decoder module.  Every (sub)interpreter importing the module
+ * gets its own copy, so no Python objects are shared between interpreters.
+ */
+typedef struct _DecoderState
+{
+    PyTypeObject * PyDecoder_Type;
+
+    // metamagic.json.exceptions.DecodeError
+    PyObject * DecodeError;
+
+    // classes of the values converted by schemas, see decoder_load_types()
+    bool       types_loaded;
+    PyObject * UUID;
+    PyObject * SafeUUID_unknown;                // NULL before Python 3.7
+    PyObject * Decimal;
+    PyObject * timezone;                        // only used before Python 3.7
+    PyObject * str_int;
+    PyObject * str_is_safe;
+#ifdef Py_GIL_DISABLED
+    PyMutex    types_mutex;
+#endif
+}
+DecoderState;
+
+// an interned object key, found by the hash of its JSON text
+typedef struct
+{
+    Py_hash_t  hash;
+    PyObject * key;                             // owned reference, NULL if unused
+}
+KeyEntry;
+
+// the keys of the last object decoded at a given depth under a given key
+typedef struct
+{
+    Py_ssize_t depth;
+    PyObject * parent_key;                      // owned reference, NULL for array items
+    PyObject * keys;                            // owned tuple, NULL if unused
+}
+ShapeSlot;
+
+/*
+ * Object keys seen by the decoder: a bounded table of interned keys, so that
+ * equal keys are decoded (and hashed) once and shared by all the objects, and
+ * the "shapes" (key sequences) of recently decoded objects.  The keys of an
+ * object with the same keys as the last one found at the same place (e.g. the
+ * next record of a list) are only compared with the expected ones, with no
+ * hashing or lookups, and before Python 3.11 the object is created with room
+ * for all of them.
+ *
+ * Kept for one call by decode() and across calls by Decoder instances.
+ */
+typedef struct
+{
+    KeyEntry * keys;                            // open addressing, NULL until needed
+    Py_ssize_t mask;                            // size of 'keys' - 1
+    Py_ssize_t used;
+    Py_ssize_t max_keys;                        // the table is emptied when it is full
+
+    ShapeSlot * shapes;                         // SHAPE_SLOTS entries, NULL until needed
+}
+DecoderCache;
+
+typedef struct
+{
+    PyObject_HEAD
+    DecoderState * state;                       // of the module defining the Decoder class
+    DecoderCache   cache;
+    bool           busy;                        // 'cache' is in use by a decode() call
+}
+PyDecoderObject;
+
+// the JSON document being decoded
+typedef struct
+{
+    const char * start;                         // first byte of the input
+    const char * end;                           // == start + size
+
+    DecoderState * state;
+    DecoderCache * cache;                       // NULL to not intern keys
+    PyObject     * schema;                      // root node of the schema, or NULL
+    int            parse;                       // PARSE_* flags
+}
+DecoderInput;
+
+/*
+ * Flags of decode(): values with no schema node in the formats written by the
+ * encoder are converted as they are decoded, see decoder_parse_string().
+ * Strings with escapes or non-ASCII characters are left as is.
+ */
+#define PARSE_UUID              0x01            // UUID strings
+#define PARSE_DATETIME          0x02            // datetime, date and time strings
+#define PARSE_DECIMAL_STRINGS   0x04            // decimal number strings
+#define PARSE_DECIMAL_NUMBERS   0x08            // numbers with a fraction or an exponent
+#define PARSE_FLAGS             0x0f
+
+/*
+ * Kinds of the nodes of a compiled schema, built by metamagic.json.schema.Schema.
+ * A node is None (the value is not described: decoded as is, or converted by
+ * the PARSE_* flags) or a tuple starting with its kind:
+ */
+#define SCHEMA_UUID        1                    // (kind,): strings
+#define SCHEMA_DATETIME    2                    // (kind,): strings
+#define SCHEMA_DATE        3                    // (kind,): strings
+#define SCHEMA_TIME        4                    // (kind,): strings
+#define SCHEMA_DECIMAL     5                    // (kind,): numbers and strings
+#define SCHEMA_LIST        6                    // (kind, node of the items): arrays
+#define SCHEMA_DICT        7                    // (kind, node of the values): objects
+#define SCHEMA_OBJECT      8                    // (kind, {key: (field index, node)},
+                                                //  class or None, field names): objects
+#define SCHEMA_ANY         9                    // (kind,): any value, decoded as is and
+                                                //  not converted by the PARSE_* flags
+#define SCHEMA_KINDS       10
+
+// properties of a scanned string, see decoder_scan_string()
+#define STRING_ESCAPES     0x01                 // has backslash escapes
+#define STRING_NON_ASCII   0x02                 // has non-ASCII (UTF-8) bytes
+
+// state of a container being decoded (or scanned): the decoder keeps an
+// explicit stack of these instead of recursing on the C stack
+typedef struct
+{
+    bool is_object;
+
+    PyObject * container;                       // owned reference (decode only)
+    PyObject * key;                             // pending object key, owned or NULL
+    Py_ssize_t index;                           // tape entry of the container (scan only)
+
+    // objects only (decode only), see DecoderCache
+    ShapeSlot * slot;                           // NULL if keys are not interned
+    PyObject  * shape;                          // expected keys, owned or NULL
+    Py_ssize_t  key_count;                      // number of keys so far
+    bool        shape_matches;                  // all the keys so far were expected
+
+    // schema (decode only): objects decoded to instances of a class of a
+    // SCHEMA_OBJECT node are "records", whose container is a tuple of the
+    // values of the fields (NULL for missing ones)
+    PyObject  * node;                           // of the container, owned or NULL
+    int         kind;                           // of 'node', 0 if there is none
+    PyObject  * child;                          // node of the items, or of the pending value
+    Py_ssize_t  field;                          // field of the pending key, -1 for other keys
+    bool        is_record;
+}
+DecoderFrame;
+
+typedef struct
+{
+    DecoderFrame * frames;
+    int            depth;                       // number of frames in use
+    int            allocated;
+    DecoderFrame   frames_inline[INLINE_FRAMES];
+}
+DecoderStack;
+
+/*
+ * Entry of the structural index ("tape") built by scan(): one entry per value
+ * (and per object key) in document order.  'next' is the index of the entry
+ * following the value, so the children of a container are found by starting
+ * at its index + 1 and following 'next' up to the container's own 'next'.
+ */
+typedef struct
+{
+    long long start;                            // offset of the first byte of the value
+    long long end;                              // offset after its last byte
+    long long next;                             // index of the entry after the value
+}
+TapeEntry;
+
+// a component of a path given to extract()
+typedef struct
+{
+    PyObject   * key;                           // borrowed str, NULL if only an index
+    Py_ssize_t   index;                         // array index, -1 if only a key
+}
+PathComponent;
+
+typedef struct
+{
+    PathComponent * components;
+    Py_ssize_t      length;
+}
+ExtractPath;
+
+// an extract() call
+typedef struct
+{
+    DecoderInput * input;
+
+    ExtractPath  * paths;
+    Py_ssize_t     count;                       // number of paths
+    PyObject     * results;                     // a list with a value for every path
+    bool         * found;
+    Py_ssize_t     remaining;                   // number of paths not found yet
+
+    // the paths to follow at each depth: 'count' path indices per depth
+    Py_ssize_t   * active;
+
+    PyObject     * owners;                      // a list owning the path components
+}
+Extraction;
+
+/*
+ * State of find_value_end() when the input ends before the value does, to be
+ * passed to the next call: STATE_* flags, and the number of open containers
+ * shifted left by STATE_DEPTH_SHIFT.  0 is the state before the value.
+ */
+#define STATE_ESCAPE        0x01                // after a backslash in a string
+#define STATE_STRING        0x02                // in a string
+#define STATE_SCALAR        0x04                // in a top-level number or literal
+#define STATE_DEPTH_SHIFT   3
+
+static void decoder_error (DecoderInput * input, const char * msg, const char * pos);
+
+#endif
@@ -0,0 +1,240 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#include "_decoder_keys.h"
+
+static void decoder_cache_init (DecoderCache * cache, Py_ssize_t max_keys)
+{
+    cache->keys     = NULL;
+    cache->mask     = 0;
+    cache->used     = 0;
+    cache->max_keys = max_keys;
+    cache->shapes   = NULL;
+}
+
+static void decoder_cache_release_keys (DecoderCache * cache)
+{
+    if (cache->keys == NULL) return;
+
+    for (Py_ssize_t i = 0; i <= cache->mask; i++)
+        Py_CLEAR(cache->keys[i].key);
+
+    cache->used = 0;
+}
+
+static void decoder_cache_clear (DecoderCache * cache)
+{
+    if (cache->keys != NULL)
+    {
+        decoder_cache_release_keys(cache);
+        PyMem_Free(cache->keys);
+        cache->keys = NULL;
+        cache->mask = 0;
+    }
+
+    if (cache->shapes != NULL)
+    {
+        for (int i = 0; i < SHAPE_SLOTS; i++)
+        {
+            Py_XDECREF(cache->shapes[i].parent_key);
+            Py_XDECREF(cache->shapes[i].keys);
+        }
+
+        PyMem_Free(cache->shapes);
+        cache->shapes = NULL;
+    }
+}
+
+/* FNV-1a: keys are short, and the table only needs their JSON text hashed */
+static Py_hash_t decoder_hash_key (const char * p, Py_ssize_t size)
+{
+    size_t hash = (size_t)14695981039346656037ULL;
+
+    for (Py_ssize_t i = 0; i < size; i++)
+        hash = (hash ^ (unsigned char)p[i]) * (size_t)1099511628211ULL;
+
+    return (Py_hash_t)hash;
+}
+
+static bool decoder_key_matches (PyObject * key, const char * p, const char * end, int flags)
+{
+    // skip the quotes
+    p++;
+    end--;
+
+    if (flags & STRING_ESCAPES) return false;
+
+    const char * data;
+    Py_ssize_t   size;
+
+    if (PyUnicode_IS_COMPACT_ASCII(key))
+    {
+        if (flags & STRING_NON_ASCII) return false;
+
+        data = (const char *)PyUnicode_DATA(key);
+        size = PyUnicode_GET_LENGTH(key);
+    }
+    else
+    {
+        if (!(flags & STRING_NON_ASCII)) return false;
+
+        // cached by the string after the first call, see decoder_intern_key()
+        if ((data = PyUnicode_AsUTF8AndSize(key, &size)) == NULL)
+        {
+            PyErr_Clear();
+            return false;
+        }
+    }
+
+    return size == end - p && memcmp(data, p, size) == 0;
+}
+
+/* inserts 'key' (not in the table) with 'hash'; the table has a free entry */
+static void decoder_cache_insert (DecoderCache * cache, Py_hash_t hash, PyObject * key)
+{
+    Py_ssize_t i = (Py_ssize_t)((size_t)hash & (size_t)cache->mask);
+
+    while (cache->keys[i].key != NULL)
+        i = (i + 1) & cache->mask;
+
+    Py_INCREF(key);
+    cache->keys[i].hash = hash;
+    cache->keys[i].key  = key;
+    cache->used++;
+}
+
+/* makes room for one more key: the table is kept at most half full, and is
+ * emptied when it has 'max_keys' keys.  Returns false with a MemoryError set */
+static bool decoder_cache_reserve (DecoderCache * cache)
+{
+    if (cache->used >= cache->max_keys)
+        decoder_cache_release_keys(cache);
+
+    Py_ssize_t size = cache->keys == NULL ? 0 : cache->mask + 1;
+
+    if ((cache->used + 1) * 2 <= size)
+        return true;
+
+    Py_ssize_t new_size = size == 0 ? MIN_KEY_TABLE_SIZE : size * 2;
+    KeyEntry * old_keys = cache->keys;
+
+    if ((cache->keys = PyMem_Calloc(new_size, sizeof(KeyEntry))) == NULL)
+    {
+        cache->keys = old_keys;
+        PyErr_NoMemory();
+        return false;
+    }
+
+    cache->mask = new_size - 1;
+    cache->used = 0;
+
+    for (Py_ssize_t i = 0; i < size; i++)
+    {
+        if (old_keys[i].key != NULL)
+        {
+            decoder_cache_insert(cache, old_keys[i].hash, old_keys[i].key);
+            Py_DECREF(old_keys[i].key);
+        }
+    }
+
+    PyMem_Free(old_keys);
+
+    return true;
+}
+
+static PyObject * decoder_intern_key (DecoderCache * cache, const char * p, const char * end,
+                                      int flags)
+{
+    Py_ssize_t size = end - p - 2;
+
+    // keys with escapes are rare, and long keys are more likely data than names
+    if ((flags & STRING_ESCAPES) || size > INTERN_MAX_SIZE || cache->max_keys == 0)
+        return decoder_make_string(p, end, flags);
+
+    Py_hash_t hash = decoder_hash_key(p + 1, size);
+
+    if (cache->keys != NULL)
+    {
+        Py_ssize_t i = (Py_ssize_t)((size_t)hash & (size_t)cache->mask);
+
+        for (PyObject * key; (key = cache->keys[i].key) != NULL; i = (i + 1) & cache->mask)
+        {
+            if (cache->keys[i].hash == hash && decoder_key_matches(key, p, end, flags))
+            {
+                Py_INCREF(key);
+                return key;
+            }
+        }
+    }
+
+    PyObject * key = decoder_make_string(p, end, flags);
+
+    if (key == NULL) return NULL;
+
+    if (flags & STRING_NON_ASCII)
+    {
+        // keeps the UTF-8 text in the string for decoder_key_matches(); strings
+        // with (encoded) lone surrogates have none and are not interned
+        if (PyUnicode_AsUTF8AndSize(key, NULL) == NULL)
+        {
+            PyErr_Clear();
+            return key;
+        }
+    }
+
+    if (!decoder_cache_reserve(cache))
+    {
+        Py_DECREF(key);
+        return NULL;
+    }
+
+    decoder_cache_insert(cache, hash, key);
+
+    return key;
+}
+
+static ShapeSlot * decoder_shape_slot (DecoderCache * cache, Py_ssize_t depth,
+                                       PyObject * parent_key)
+{
+    if (cache->shapes == NULL &&
+        (cache->shapes = PyMem_Calloc(SHAPE_SLOTS, sizeof(ShapeSlot))) == NULL)
+    {
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    size_t hash = ((size_t)parent_key >> 4) * 31 + (size_t)depth;
+
+    return &cache->shapes[hash & (SHAPE_SLOTS - 1)];
+}
+
+static int decoder_shape_update (ShapeSlot * slot, Py_ssize_t depth, PyObject * parent_key,
+                                 PyObject * dict)
+{
+    PyObject * keys = PyTuple_New(PyDict_Size(dict));
+
+    if (keys == NULL) return -1;
+
+    PyObject * key;
+    Py_ssize_t pos = 0;
+
+    for (Py_ssize_t i = 0; PyDict_Next(dict, &pos, &key, NULL); i++)
+    {
+        Py_INCREF(key);
+        PyTuple_SET_ITEM(keys, i, key);
+    }
+
+    Py_XINCREF(parent_key);
+    Py_XDECREF(slot->parent_key);
+    Py_XDECREF(slot->keys);
+
+    slot->depth      = depth;
+    slot->parent_key = parent_key;
+    slot->keys       = keys;
+
+    return 0;
+}
@@ -0,0 +1,39 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#ifndef ___DECODER_KEYS_H__
+#define ___DECODER_KEYS_H__
+
+#include "_decoder.h"
+
+/* initializes an empty 'cache' keeping at most 'max_keys' interned keys */
+static void decoder_cache_init (DecoderCache * cache, Py_ssize_t max_keys);
+
+/* releases all the keys and shapes of 'cache' and its memory; it can be used again */
+static void decoder_cache_clear (DecoderCache * cache);
+
+/* returns a new reference to the key for the JSON string at [p, end) (quotes
+ * included) scanned by decoder_scan_string(): the interned one if the same key
+ * was seen before.  Returns NULL with an exception set on failure */
+static PyObject * decoder_intern_key (DecoderCache * cache, const char * p, const char * end,
+                                      int flags);
+
+/* returns true if the Python string 'key' is the decoded JSON string at [p, end)
+ * (quotes included); keys with escapes never match */
+static bool decoder_key_matches (PyObject * key, const char * p, const char * end, int flags);
+
+/* returns the shape slot for the objects at 'depth' under 'parent_key' (NULL
+ * for array items), or NULL with a MemoryError set */
+static ShapeSlot * decoder_shape_slot (DecoderCache * cache, Py_ssize_t depth,
+                                       PyObject * parent_key);
+
+/* records the keys of 'dict' as the shape of the objects at 'depth' under
+ * 'parent_key' in 'slot'; returns -1 with an exception set on failure */
+static int decoder_shape_update (ShapeSlot * slot, Py_ssize_t depth, PyObject * parent_key,
+                                 PyObject * dict);
+
+#endif
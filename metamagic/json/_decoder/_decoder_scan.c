@@ -0,0 +1,431 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#include "_decoder_scan.h"
+
+// classes of bytes inside JSON strings
+#define CHAR_PLAIN      0
+#define CHAR_QUOTE      1
+#define CHAR_BACKSLASH  2
+#define CHAR_CONTROL    3                       // not allowed unescaped
+#define CHAR_NON_ASCII  4
+
+static const unsigned char string_char_class[256] = {
+    3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3,
+    0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
+};
+
+// bytes that matter when looking for the end of a container
+static const unsigned char structural_char[256] = {
+    ['"'] = 1, ['{'] = 1, ['['] = 1, ['}'] = 1, [']'] = 1
+};
+
+// bytes that end a number or literal
+static const unsigned char scalar_end_char[256] = {
+    [' '] = 1, ['\t'] = 1, ['\n'] = 1, ['\r'] = 1,
+    [','] = 1, ['"'] = 1, ['{'] = 1, ['['] = 1, ['}'] = 1, [']'] = 1
+};
+
+#define IS_DIGIT(c) ((c) >= '0' && (c) <= '9')
+
+static const char * decoder_skip_whitespace (const char * p, const char * end)
+{
+    while (p < end && (*p == ' ' || *p == '\n' || *p == '\r' || *p == '\t'))
+        p++;
+
+    return p;
+}
+
+/* returns the value of the 4 hex digits at 'p', or -1 if they are not all hex digits */
+static long decoder_hex4 (const char * p)
+{
+    long value = 0;
+
+    for (int i = 0; i < 4; i++)
+    {
+        char c = p[i];
+
+        value <<= 4;
+
+        if (IS_DIGIT(c))
+            value |= c - '0';
+        else if (c >= 'a' && c <= 'f')
+            value |= c - 'a' + 10;
+        else if (c >= 'A' && c <= 'F')
+            value |= c - 'A' + 10;
+        else
+            return -1;
+    }
+
+    return value;
+}
+
+static const char * decoder_scan_string (DecoderInput * input, const char * p, int * flags)
+{
+    const char * start = p++;
+    const char * end   = input->end;
+
+    int string_flags = 0;
+
+    while (true)
+    {
+        while (p < end && string_char_class[(unsigned char)*p] == CHAR_PLAIN)
+            p++;
+
+        if (p == end) break;
+
+        switch (string_char_class[(unsigned char)*p])
+        {
+            case CHAR_QUOTE:
+                *flags = string_flags;
+                return p + 1;
+
+            case CHAR_NON_ASCII:
+                string_flags |= STRING_NON_ASCII;
+                p++;
+                continue;
+
+            case CHAR_CONTROL:
+                decoder_error(input, "Invalid control character at", p);
+                return NULL;
+        }
+
+        // a backslash
+        string_flags |= STRING_ESCAPES;
+
+        if (end - p < 2) break;
+
+        switch (p[1])
+        {
+            case '"': case '\\': case '/':
+            case 'b': case 'f': case 'n': case 'r': case 't':
+                p += 2;
+                continue;
+
+            case 'u':
+                if (end - p < 6 || decoder_hex4(p + 2) < 0)
+                {
+                    decoder_error(input, "Invalid \\uXXXX escape", p);
+                    return NULL;
+                }
+                p += 6;
+                continue;
+
+            default:
+                decoder_error(input, "Invalid \\escape", p);
+                return NULL;
+        }
+    }
+
+    decoder_error(input, "Unterminated string starting at", start);
+    return NULL;
+}
+
+static const char * decoder_skip_value (DecoderInput * input, const char * p)
+{
+    const char * end = input->end;
+    Py_ssize_t   depth = 0;
+
+    p = decoder_skip_whitespace(p, end);
+
+    if (p < end && *p != '"' && *p != '{' && *p != '[')
+    {
+        // a number or literal
+        const char * start = p;
+
+        while (p < end && !scalar_end_char[(unsigned char)*p])
+            p++;
+
+        if (p > start) return p;
+    }
+
+    if (p == end || (*p != '"' && *p != '{' && *p != '['))
+    {
+        decoder_error(input, "Expecting value", p);
+        return NULL;
+    }
+
+    do
+    {
+        const char * start = p;
+
+        switch (*p++)
+        {
+            case '"':
+                while (true)
+                {
+                    while (p < end && *p != '"' && *p != '\\')
+                        p++;
+
+                    if (p >= end)
+                    {
+                        decoder_error(input, "Unterminated string starting at", start);
+                        return NULL;
+                    }
+
+                    if (*p == '"') break;
+
+                    p += 2;                     // a backslash and the escaped char
+                }
+                p++;
+                break;
+
+            case '{': case '[':
+                depth++;
+                break;
+
+            default:
+                depth--;
+        }
+
+        if (depth == 0) return p;
+
+        while (p < end && !structural_char[(unsigned char)*p])
+            p++;
+    }
+    while (p < end);
+
+    decoder_error(input, "Expecting ',' delimiter", p);
+    return NULL;
+}
+
+static const char * decoder_scan_number (DecoderInput * input, const char * p, bool * is_float)
+{
+    const char * start = p;
+    const char * end   = input->end;
+
+    if (*p == '-') p++;
+
+    if (p < end && *p == '0')
+        p++;
+    else if (p < end && IS_DIGIT(*p))
+        while (p < end && IS_DIGIT(*p)) p++;
+    else
+    {
+        decoder_error(input, "Expecting value", start);
+        return NULL;
+    }
+
+    *is_float = false;
+
+    if (p < end && *p == '.')
+    {
+        p++;
+
+        if (p == end || !IS_DIGIT(*p))
+        {
+            decoder_error(input, "Invalid number", start);
+            return NULL;
+        }
+
+        while (p < end && IS_DIGIT(*p)) p++;
+
+        *is_float = true;
+    }
+
+    if (p < end && (*p == 'e' || *p == 'E'))
+    {
+        p++;
+
+        if (p < end && (*p == '+' || *p == '-')) p++;
+
+        if (p == end || !IS_DIGIT(*p))
+        {
+            decoder_error(input, "Invalid number", start);
+            return NULL;
+        }
+
+        while (p < end && IS_DIGIT(*p)) p++;
+
+        *is_float = true;
+    }
+
+    return p;
+}
+
+static const char * decoder_scan_literal (DecoderInput * input, const char * p,
+                                          const char * literal, Py_ssize_t size)
+{
+    if (input->end - p < size || memcmp(p, literal, size) != 0)
+    {
+        decoder_error(input, "Expecting value", p);
+        return NULL;
+    }
+
+    return p + size;
+}
+
+/* writes the UTF-8 encoding of 'c' to 'out' (surrogates are encoded as any other
+ * character, the "surrogatepass" way); returns the position after it */
+static char * decoder_put_utf8 (char * out, Py_UCS4 c)
+{
+    if (c < 0x80)
+        *out++ = (char)c;
+    else if (c < 0x800)
+    {
+        *out++ = (char)(0xc0 | (c >> 6));
+        *out++ = (char)(0x80 | (c & 0x3f));
+    }
+    else if (c < 0x10000)
+    {
+        *out++ = (char)(0xe0 | (c >> 12));
+        *out++ = (char)(0x80 | ((c >> 6) & 0x3f));
+        *out++ = (char)(0x80 | (c & 0x3f));
+    }
+    else
+    {
+        *out++ = (char)(0xf0 | (c >> 18));
+        *out++ = (char)(0x80 | ((c >> 12) & 0x3f));
+        *out++ = (char)(0x80 | ((c >> 6) & 0x3f));
+        *out++ = (char)(0x80 | (c & 0x3f));
+    }
+
+    return out;
+}
+
+static PyObject * decoder_make_ascii (const char * p, Py_ssize_t size)
+{
+    PyObject * str = PyUnicode_New(size, 127);
+
+    if (str != NULL)
+        memcpy(PyUnicode_DATA(str), p, size);
+
+    return str;
+}
+
+static PyObject * decoder_make_string (const char * p, const char * end, int flags)
+{
+    // skip the quotes
+    p++;
+    end--;
+
+    Py_ssize_t size = end - p;
+
+    if (!(flags & (STRING_ESCAPES | STRING_NON_ASCII)))
+        return decoder_make_ascii(p, size);
+
+    // like json.loads() of bytes, accepts (escaped and encoded) lone surrogates
+    if (!(flags & STRING_ESCAPES))
+        return PyUnicode_DecodeUTF8(p, size, "surrogatepass");
+
+    // escapes never take less space than the UTF-8 encoding of the characters they stand for
+    char   stack_buffer[256];
+    char * buffer = stack_buffer;
+
+    if (size > (Py_ssize_t)sizeof(stack_buffer) && (buffer = PyMem_Malloc(size)) == NULL)
+        return PyErr_NoMemory();
+
+    char * out   = buffer;
+    bool   ascii = !(flags & STRING_NON_ASCII);
+
+    while (p < end)
+    {
+        if (*p != '\\')
+        {
+            *out++ = *p++;
+            continue;
+        }
+
+        switch (p[1])
+        {
+            case 'b': *out++ = '\b'; break;
+            case 'f': *out++ = '\f'; break;
+            case 'n': *out++ = '\n'; break;
+            case 'r': *out++ = '\r'; break;
+            case 't': *out++ = '\t'; break;
+
+            case 'u':
+            {
+                Py_UCS4 c = (Py_UCS4)decoder_hex4(p + 2);
+
+                p += 6;
+
+                // a surrogate pair stands for one character
+                if ((c & 0xfc00) == 0xd800 && end - p >= 6 && p[0] == '\\' && p[1] == 'u')
+                {
+                    Py_UCS4 low = (Py_UCS4)decoder_hex4(p + 2);
+
+                    if ((low & 0xfc00) == 0xdc00)
+                    {
+                        c = 0x10000 + (((c & 0x3ff) << 10) | (low & 0x3ff));
+                        p += 6;
+                    }
+                }
+
+                if (c >= 0x80) ascii = false;
+
+                out = decoder_put_utf8(out, c);
+                continue;
+            }
+
+            default:                            // '"', '\\' and '/'
+                *out++ = p[1];
+        }
+
+        p += 2;
+    }
+
+    PyObject * str = ascii ? decoder_make_ascii(buffer, out - buffer)
+                           : PyUnicode_DecodeUTF8(buffer, out - buffer, "surrogatepass");
+
+    if (buffer != stack_buffer)
+        PyMem_Free(buffer);
+
+    return str;
+}
+
+static PyObject * decoder_make_number (const char * p, const char * end, bool is_float)
+{
+    Py_ssize_t size = end - p;
+
+    // at most 18 digits always fit into a long long
+    if (!is_float && size <= 18)
+    {
+        bool negative = *p == '-';
+
+        if (negative) p++;
+
+        long long n = 0;
+
+        while (p < end)
+            n = n * 10 + (*p++ - '0');
+
+        return PyLong_FromLongLong(negative ? -n : n);
+    }
+
+    // both conversion functions need a NUL-terminated string
+    char   stack_buffer[64];
+    char * buffer = stack_buffer;
+
+    if (size >= (Py_ssize_t)sizeof(stack_buffer) && (buffer = PyMem_Malloc(size + 1)) == NULL)
+        return PyErr_NoMemory();
+
+    memcpy(buffer, p, size);
+    buffer[size] = '\0';
+
+    PyObject * result;
+
+    if (is_float)
+    {
+        double d = PyOS_string_to_double(buffer, NULL, NULL);
+
+        result = (d == -1.0 && PyErr_Occurred()) ? NULL : PyFloat_FromDouble(d);
+    }
+    else
+        result = PyLong_FromString(buffer, NULL, 10);
+
+    if (buffer != stack_buffer)
+        PyMem_Free(buffer);
+
+    return result;
+}
@@ -0,0 +1,43 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#ifndef ___DECODER_SCAN_H__
+#define ___DECODER_SCAN_H__
+
+#include "_decoder.h"
+
+/* returns the first non-whitespace position at or after 'p' (or 'end') */
+static const char * decoder_skip_whitespace (const char * p, const char * end);
+
+/* 'p' should point to the opening quote of a string; returns the position after
+ * the closing quote and sets the STRING_* 'flags' of the string, or returns NULL
+ * with a DecodeError set if the string is invalid */
+static const char * decoder_scan_string (DecoderInput * input, const char * p, int * flags);
+
+/* returns the position after the JSON value at 'p' (after optional whitespace),
+ * skimming it: only strings and brackets are matched, and nothing else is
+ * validated.  Returns NULL with a DecodeError set if the input ends first */
+static const char * decoder_skip_value (DecoderInput * input, const char * p);
+
+/* returns the position after the number starting at 'p' and sets 'is_float' if
+ * it has a fraction or an exponent, or returns NULL with a DecodeError set */
+static const char * decoder_scan_number (DecoderInput * input, const char * p, bool * is_float);
+
+/* returns the position after 'literal' (of 'size' chars) if it is found at 'p',
+ * otherwise returns NULL with a DecodeError set */
+static const char * decoder_scan_literal (DecoderInput * input, const char * p,
+                                          const char * literal, Py_ssize_t size);
+
+/* returns a new Python string for the JSON string at [p, end) (quotes included),
+ * scanned by decoder_scan_string() */
+static PyObject * decoder_make_string (const char * p, const char * end, int flags);
+
+/* returns a new Python int or float for the number at [p, end) scanned by
+ * decoder_scan_number() */
+static PyObject * decoder_make_number (const char * p, const char * end, bool is_float);
+
+#endif
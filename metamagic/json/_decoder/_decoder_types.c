@@ -0,0 +1,350 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#include "_decoder_types.h"
+#include <datetime.h>
+
+static PyObject * decoder_module_attr (const char * module_name, const char * name)
+{
+    PyObject * module = PyImport_ImportModule(module_name);
+
+    if (module == NULL) return NULL;
+
+    PyObject * attr = PyObject_GetAttrString(module, name);
+
+    Py_DECREF(module);
+
+    return attr;
+}
+
+static bool decoder_load_types (DecoderState * state)
+{
+    if (state->types_loaded) return true;
+
+    bool loaded = false;
+
+#ifdef Py_GIL_DISABLED
+    PyMutex_Lock(&state->types_mutex);
+#endif
+
+    if (state->types_loaded)
+    {
+        loaded = true;
+        goto done;
+    }
+
+    // the datetime C API is a table of process-wide static types
+    if (PyDateTimeAPI == NULL)
+    {
+        PyDateTime_IMPORT;
+        if (PyDateTimeAPI == NULL) goto done;
+    }
+
+#if PY_VERSION_HEX < 0x03070000
+    if (state->timezone == NULL &&
+        (state->timezone = decoder_module_attr("datetime", "timezone")) == NULL)
+        goto done;
+#endif
+
+    if (state->UUID == NULL && (state->UUID = decoder_module_attr("uuid", "UUID")) == NULL)
+        goto done;
+
+    if (!PyType_Check(state->UUID))
+    {
+        PyErr_SetString(PyExc_TypeError, "uuid.UUID is not a class");
+        goto done;
+    }
+
+    // UUID.is_safe (Python 3.7+) is SafeUUID.unknown unless the UUID is generated
+    if (state->SafeUUID_unknown == NULL)
+    {
+        PyObject * safe_uuid = decoder_module_attr("uuid", "SafeUUID");
+
+        if (safe_uuid != NULL)
+        {
+            state->SafeUUID_unknown = PyObject_GetAttrString(safe_uuid, "unknown");
+            Py_DECREF(safe_uuid);
+
+            if (state->SafeUUID_unknown == NULL) goto done;
+        }
+        else if (PyErr_ExceptionMatches(PyExc_AttributeError))
+            PyErr_Clear();
+        else
+            goto done;
+    }
+
+    if (state->Decimal == NULL && (state->Decimal = decoder_module_attr("decimal", "Decimal")) == NULL)
+        goto done;
+
+    if (state->str_int == NULL && (state->str_int = PyUnicode_InternFromString("int")) == NULL)
+        goto done;
+
+    if (state->str_is_safe == NULL &&
+        (state->str_is_safe = PyUnicode_InternFromString("is_safe")) == NULL)
+        goto done;
+
+    loaded = state->types_loaded = true;
+
+done:
+#ifdef Py_GIL_DISABLED
+    PyMutex_Unlock(&state->types_mutex);
+#endif
+
+    return loaded;
+}
+
+static inline int decoder_hex_digit (char c)
+{
+    if (c >= '0' && c <= '9') return c - '0';
+    if (c >= 'a' && c <= 'f') return c - 'a' + 10;
+    if (c >= 'A' && c <= 'F') return c - 'A' + 10;
+    return -1;
+}
+
+static PyObject * decoder_make_uuid (DecoderState * state, const char * p, const char * end)
+{
+    if (end - p != 36) return NULL;
+
+    // the 32 hex digits, which make the UUID.int
+    char       digits[33];
+    int        n = 0;
+
+    for (int i = 0; i < 36; i++)
+    {
+        if (i == 8 || i == 13 || i == 18 || i == 23)
+        {
+            if (p[i] != '-') return NULL;
+        }
+        else if (decoder_hex_digit(p[i]) < 0)
+            return NULL;
+        else
+            digits[n++] = p[i];
+    }
+
+    digits[n] = '\0';
+
+    PyObject * value = PyLong_FromString(digits, NULL, 16);
+
+    if (value == NULL) return NULL;
+
+    // what UUID.__init__() does, with no parsing and checks in Python: UUIDs
+    // are immutable, their attributes are set with object.__setattr__()
+    PyTypeObject * type = (PyTypeObject*)state->UUID;
+    PyObject     * args = PyTuple_New(0);
+    PyObject     * uuid = args != NULL ? type->tp_new(type, args, NULL) : NULL;
+
+    Py_XDECREF(args);
+
+    if (uuid != NULL &&
+        (PyObject_GenericSetAttr(uuid, state->str_int, value) < 0 ||
+         (state->SafeUUID_unknown != NULL &&
+          PyObject_GenericSetAttr(uuid, state->str_is_safe, state->SafeUUID_unknown) < 0)))
+        Py_CLEAR(uuid);
+
+    Py_DECREF(value);
+
+    return uuid;
+}
+
+/* reads 'count' digits at 'p' into 'value'; returns false if they are not all digits */
+static inline bool decoder_read_digits (const char * p, int count, int * value)
+{
+    int result = 0;
+
+    for (int i = 0; i < count; i++)
+    {
+        if (p[i] < '0' || p[i] > '9') return false;
+        result = result * 10 + (p[i] - '0');
+    }
+
+    *value = result;
+    return true;
+}
+
+/* returns the value of the ISO date at 'p' (10 chars), see decoder_make_date() */
+static bool decoder_read_date (const char * p, int * year, int * month, int * day)
+{
+    return decoder_read_digits(p, 4, year) && p[4] == '-' &&
+           decoder_read_digits(p + 5, 2, month) && p[7] == '-' &&
+           decoder_read_digits(p + 8, 2, day);
+}
+
+/*
+ * Reads the ISO time at [p, end) (see decoder_make_time()); sets 'tzinfo' to a
+ * new reference, or to NULL if there is no UTC offset.  Returns false if the text
+ * is not a time (or on failure, with an exception set).
+ */
+static bool decoder_read_time (DecoderState * state, const char * p, const char * end,
+                               int * hour, int * minute, int * second, int * usecond,
+                               PyObject ** tzinfo)
+{
+    *tzinfo  = NULL;
+    *usecond = 0;
+
+    if (end - p < 8 ||
+        !decoder_read_digits(p, 2, hour) || p[2] != ':' ||
+        !decoder_read_digits(p + 3, 2, minute) || p[5] != ':' ||
+        !decoder_read_digits(p + 6, 2, second))
+        return false;
+
+    p += 8;
+
+    // 1 to 6 digits of fraction
+    if (p < end && *p == '.')
+    {
+        int digits = 0;
+
+        for (p++; p < end && *p >= '0' && *p <= '9' && digits < 6; p++, digits++)
+            *usecond = *usecond * 10 + (*p - '0');
+
+        if (digits == 0) return false;
+
+        for (; digits < 6; digits++)
+            *usecond *= 10;
+    }
+
+    if (p == end) return true;
+
+    int offset;
+
+    if (end - p == 1 && *p == 'Z')
+        offset = 0;
+    else
+    {
+        int tz_hour, tz_minute;
+
+        if (end - p != 6 || (*p != '+' && *p != '-') ||
+            !decoder_read_digits(p + 1, 2, &tz_hour) || p[3] != ':' ||
+            !decoder_read_digits(p + 4, 2, &tz_minute) ||
+            tz_hour > 23 || tz_minute > 59)
+            return false;
+
+        offset = (tz_hour * 60 + tz_minute) * 60 * (*p == '-' ? -1 : 1);
+    }
+
+#if PY_VERSION_HEX >= 0x03070000
+    if (offset == 0)
+    {
+        Py_INCREF(*tzinfo = PyDateTime_TimeZone_UTC);
+        return true;
+    }
+
+    PyObject * delta = PyDelta_FromDSU(0, offset, 0);
+
+    if (delta == NULL) return false;
+
+    *tzinfo = PyTimeZone_FromOffset(delta);
+#else
+    PyObject * delta = PyDelta_FromDSU(0, offset, 0);
+
+    if (delta == NULL) return false;
+
+    *tzinfo = PyObject_CallFunctionObjArgs(state->timezone, delta, NULL);
+#endif
+
+    Py_DECREF(delta);
+
+    return *tzinfo != NULL;
+}
+
+/* out of range values are not dates, like malformed ones */
+static PyObject * decoder_check_range (PyObject * value)
+{
+    if (value == NULL && PyErr_ExceptionMatches(PyExc_ValueError))
+        PyErr_Clear();
+
+    return value;
+}
+
+static PyObject * decoder_make_datetime (DecoderState * state, const char * p, const char * end)
+{
+    int year, month, day, hour, minute, second, usecond;
+    PyObject * tzinfo;
+
+    if (end - p < 19 || !decoder_read_date(p, &year, &month, &day) || p[10] != 'T')
+        return NULL;
+
+    if (!decoder_read_time(state, p + 11, end, &hour, &minute, &second, &usecond, &tzinfo))
+        return NULL;
+
+    PyObject * value = PyDateTimeAPI->DateTime_FromDateAndTime(
+                           year, month, day, hour, minute, second, usecond,
+                           tzinfo != NULL ? tzinfo : Py_None, PyDateTimeAPI->DateTimeType);
+
+    Py_XDECREF(tzinfo);
+
+    return decoder_check_range(value);
+}
+
+static PyObject * decoder_make_date (DecoderState * state, const char * p, const char * end)
+{
+    int year, month, day;
+
+    if (end - p != 10 || !decoder_read_date(p, &year, &month, &day))
+        return NULL;
+
+    return decoder_check_range(PyDateTimeAPI->Date_FromDate(year, month, day,
+                                                            PyDateTimeAPI->DateType));
+}
+
+static PyObject * decoder_make_time (DecoderState * state, const char * p, const char * end)
+{
+    int hour, minute, second, usecond;
+    PyObject * tzinfo;
+
+    if (!decoder_read_time(state, p, end, &hour, &minute, &second, &usecond, &tzinfo))
+        return NULL;
+
+    PyObject * value = PyDateTimeAPI->Time_FromTime(hour, minute, second, usecond,
+                                                    tzinfo != NULL ? tzinfo : Py_None,
+                                                    PyDateTimeAPI->TimeType);
+
+    Py_XDECREF(tzinfo);
+
+    return decoder_check_range(value);
+}
+
+static PyObject * decoder_make_decimal (DecoderState * state, const char * p, const char * end)
+{
+    const char * q = p;
+
+    // -?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?, as numbers in JSON
+    if (q < end && *q == '-') q++;
+
+    const char * digits = q;
+    while (q < end && IS_DIGIT(*q)) q++;
+    if (q == digits || (*digits == '0' && q - digits > 1)) return NULL;
+
+    if (q < end && *q == '.')
+    {
+        digits = ++q;
+        while (q < end && IS_DIGIT(*q)) q++;
+        if (q == digits) return NULL;
+    }
+
+    if (q < end && (*q == 'e' || *q == 'E'))
+    {
+        q++;
+        if (q < end && (*q == '+' || *q == '-')) q++;
+
+        digits = q;
+        while (q < end && IS_DIGIT(*q)) q++;
+        if (q == digits) return NULL;
+    }
+
+    if (q != end) return NULL;
+
+    PyObject * text = PyUnicode_FromStringAndSize(p, end - p);
+
+    if (text == NULL) return NULL;
+
+    PyObject * value = PyObject_CallFunctionObjArgs(state->Decimal, text, NULL);
+
+    Py_DECREF(text);
+
+    return value;
+}
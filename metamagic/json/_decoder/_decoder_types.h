@@ -0,0 +1,40 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#ifndef ___DECODER_TYPES_H__
+#define ___DECODER_TYPES_H__
+
+#include "_decoder.h"
+
+/* imports the uuid, decimal and datetime modules and keeps the classes the
+ * converters below create in 'state', once; returns false with an exception set */
+static bool decoder_load_types (DecoderState * state);
+
+/*
+ * Converters of the text at [p, end) (the contents of a JSON string with no
+ * escapes, or a JSON number) in the formats written by the encoder.  They
+ * return a new reference, or NULL with no exception set if the text is not in
+ * the format (or out of range), or NULL with an exception set on failure.
+ * decoder_load_types() must have been called.
+ */
+
+/* "12345678-1234-5678-1234-567812345678" (any case) -> uuid.UUID */
+static PyObject * decoder_make_uuid     (DecoderState * state, const char * p, const char * end);
+
+/* "YYYY-MM-DDTHH:MM:SS[.ffffff][+HH:MM|-HH:MM|Z]" -> datetime.datetime */
+static PyObject * decoder_make_datetime (DecoderState * state, const char * p, const char * end);
+
+/* "YYYY-MM-DD" -> datetime.date */
+static PyObject * decoder_make_date     (DecoderState * state, const char * p, const char * end);
+
+/* "HH:MM:SS[.ffffff][+HH:MM|-HH:MM|Z]" -> datetime.time */
+static PyObject * decoder_make_time     (DecoderState * state, const char * p, const char * end);
+
+/* a finite decimal number ("-12.50", "1E+3") -> decimal.Decimal */
+static PyObject * decoder_make_decimal  (DecoderState * state, const char * p, const char * end);
+
+#endif
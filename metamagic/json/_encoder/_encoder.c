@@ -9,8 +9,18 @@
 #include "_encoder_buffer.c"
 #include "_encoder_stringify.h"
 #include "_encoder_stringify.c"
+#include "_encoder_binary.h"
+#include "_encoder_binary.c"
 #include "_encoder.h"
 #include "datetime.h"
+#include <math.h>
+
+#ifdef MS_WINDOWS
+#include <io.h>
+#else
+#include <unistd.h>
+#include <poll.h>
+#endif
 
 
 /*===========================================================================
@@ -20,6 +30,15 @@
 /* public methods */
 static PyObject * encoder_dumps   (PyObject *self, PyObject *args, PyObject *kwargs);
 static PyObject * encoder_dumpb   (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dump    (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dump_fd (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dumpb_many (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dumpb_diff (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dumpb_rows (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dumpb_columns (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_digest  (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dumpmsgpack (PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject * encoder_dumpcbor    (PyObject *self, PyObject *args, PyObject *kwargs);
 static PyObject * encoder_default (PyObject *self, PyObject *args);
 
 /* serves as __init__; only needed to support the encode_hook() functionality */
@@ -30,7 +49,38 @@ static PyMethodDef EncodeMethods[] = {
             "JSON-encode a Python object to a Python string."},
 
     {"dumpb", (PyCFunction)encoder_dumpb, METH_VARARGS | METH_KEYWORDS,
-            "JSON-encode a Python object to a Python bytes() array."},
+            "JSON-encode a Python object to a Python bytes() array, optionally compressed."},
+
+    {"dump", (PyCFunction)encoder_dump, METH_VARARGS | METH_KEYWORDS,
+            "JSON-encode a Python object writing the output to a file-like object chunk by chunk."},
+
+    {"dump_fd", (PyCFunction)encoder_dump_fd, METH_VARARGS | METH_KEYWORDS,
+            "JSON-encode a Python object writing the output to a file descriptor or a socket "
+            "with the GIL released."},
+
+    {"dumpb_many", (PyCFunction)encoder_dumpb_many, METH_VARARGS | METH_KEYWORDS,
+            "JSON-encode every object of an iterable to one bytes() array, each followed by a separator."},
+
+    {"dumpb_diff", (PyCFunction)encoder_dumpb_diff, METH_VARARGS | METH_KEYWORDS,
+            "Return a JSON merge patch (RFC 7386) turning the JSON-encoding of one Python "
+            "object into that of another, as a bytes() array."},
+
+    {"dumpb_rows", (PyCFunction)encoder_dumpb_rows, METH_VARARGS | METH_KEYWORDS,
+            "JSON-encode a sequence of rows of values to a bytes() array of objects "
+            "with the given keys."},
+
+    {"dumpb_columns", (PyCFunction)encoder_dumpb_columns, METH_VARARGS | METH_KEYWORDS,
+            "JSON-encode a mapping of column names to columns of values to a bytes() array "
+            "of row objects."},
+
+    {"digest", (PyCFunction)encoder_digest, METH_VARARGS | METH_KEYWORDS,
+            "Return the hex digest of the canonical JSON-encoding of a Python object."},
+
+    {"dumpmsgpack", (PyCFunction)encoder_dumpmsgpack, METH_VARARGS | METH_KEYWORDS,
+            "Encode a Python object to a bytes() array in the MessagePack format."},
+
+    {"dumpcbor", (PyCFunction)encoder_dumpcbor, METH_VARARGS | METH_KEYWORDS,
+            "Encode a Python object to a bytes() array in the CBOR format."},
 
     {"default", encoder_default, METH_VARARGS,
             "Encodes an object to a dumpable object or throws a TypeError"},
@@ -41,101 +91,143 @@ static PyMethodDef EncodeMethods[] = {
 PyDoc_STRVAR(encoder_doc, "A C implementation of a JSON encoder for Python objects.\n\
 \n\
 Completely eqivalent to the metamagic.json.encoder.Encoder class:\n\
- - has equivalent dumps(), dumpb() and default() methods\n\
+ - has equivalent dumps(), dumpb(), dump(), dump_fd(), dumpb_many(), dumpb_diff(), \
+   dumpb_rows(), dumpb_columns(), digest(), dumpmsgpack(), dumpcbor() and default() methods\n\
  - natively supports the same set of Python objects (str, int, float, True, \
    False, None, list, tuple, dict, set, frozenset, collections.OrderedDict, \
    colections.Set, collections.Sequence, collections.Mapping, \
    uuid.UUID, decimal.Decimal, datetime.datetime and derived classes)\n\
- - supports __mm_serialize__() and encode_hook() methods, when available\n\
- - raises the same set of exceptions under the same conditions");
-
-// see http://docs.python.org/release/3.2.1/extending/newtypes.html
-PyTypeObject PyEncoder_Type = {
-    PyObject_HEAD_INIT(NULL)
-    "_encoder.Encoder",                         /* tp_name */
-    sizeof(PyEncoderObject),                    /* tp_basicsize */
-    0,                                          /* tp_itemsize */
-    0,                                          /* tp_dealloc */
-    0,                                          /* tp_print */
-    0,                                          /* tp_getattr */
-    0,                                          /* tp_setattr */
-    0,                                          /* tp_reserved */
-    0,                                          /* tp_repr */
-    0,                                          /* tp_as_number */
-    0,                                          /* tp_as_sequence */
-    0,                                          /* tp_as_mapping */
-    0,                                          /* tp_hash */
-    0,                                          /* tp_call */
-    0,                                          /* tp_str */
-    0,                                          /* tp_getattro */
-    0,                                          /* tp_setattro */
-    0,                                          /* tp_as_buffer */
-    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,   /* tp_flags */
-    encoder_doc,                                /* tp_doc */
-    0,                                          /* tp_traverse */
-    0,                                          /* tp_clear */
-    0,                                          /* tp_richcompare */
-    0,                                          /* tp_weaklistoffset */
-    0,                                          /* tp_iter */
-    0,                                          /* tp_iternext */
-    EncodeMethods,                              /* tp_methods */
-    0,                                          /* tp_members */
-    0,                                          /* tp_getset */
-    0,                                          /* tp_base */
-    0,                                          /* tp_dict */
-    0,                                          /* tp_descr_get */
-    0,                                          /* tp_descr_set */
-    0,                                          /* tp_dictoffset */
-    (initproc)_encoder_init                     /* tp_init */
+ - supports __mm_serialize__() and encode_hook() methods, when available, and \
+   RawJSON fragments\n\
+ - raises the same set of exceptions under the same conditions\n\
+ - keeps no state between calls, so one instance can be shared between threads");
+
+/* Encoder instances keep a pointer to the state of the module defining their class */
+static PyObject * _encoder_new (PyTypeObject *type, PyObject *args, PyObject *kwds);
+static void       _encoder_dealloc (PyObject *self);
+
+static PyType_Slot PyEncoder_Type_slots[] = {
+    {Py_tp_doc,     (void *)encoder_doc},
+    {Py_tp_methods, EncodeMethods},
+    {Py_tp_new,     _encoder_new},
+    {Py_tp_init,    _encoder_init},
+    {Py_tp_dealloc, _encoder_dealloc},
+    {0, NULL}
+};
+
+static PyType_Spec PyEncoder_Type_spec = {
+    "metamagic.json._encoder.Encoder",
+    sizeof(PyEncoderObject),
+    0,
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+    PyEncoder_Type_slots
+};
+
+/* pre-encoded JSON fragments, see the "implemention: RawJSON class" section below */
+static PyObject * _rawjson_new      (PyTypeObject *type, PyObject *args, PyObject *kwds);
+static void       _rawjson_dealloc  (PyObject *self);
+static PyObject * _rawjson_repr     (PyObject *self);
+static PyObject * rawjson_get_data  (PyObject *self, void *closure);
+static PyObject * rawjson_mm_json   (PyObject *self, PyObject *unused);
+static PyObject * rawjson_reduce    (PyObject *self, PyObject *unused);
+
+static PyMethodDef RawJSONMethods[] = {
+    {"__mm_json__", rawjson_mm_json, METH_NOARGS,
+            "Return the JSON text, so that any encoder can splice it into its output."},
+
+    {"__reduce__", rawjson_reduce, METH_NOARGS, NULL},
+
+    {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef RawJSONGetSet[] = {
+    {"data", rawjson_get_data, NULL, "The JSON text, as bytes.", NULL},
+    {NULL, NULL, NULL, NULL, NULL}
+};
+
+PyDoc_STRVAR(rawjson_doc, "RawJSON(data, validated=True)\n\
+\n\
+A fragment of pre-encoded JSON text (str or a bytes-like object) which the \
+encoders insert into their output as is, with a single memcpy: as a value, or \
+as the return value of __mm_json__().\n\
+\n\
+The text is trusted to be valid JSON.  With 'validated' false it is checked once, \
+here, for the characters the encoder never outputs (non-ASCII, the HTML special \
+chars <>& and control characters other than whitespace), which are escaped; \
+in valid JSON they can only be inside strings, where the escapes mean the same.");
+
+static PyType_Slot PyRawJSON_Type_slots[] = {
+    {Py_tp_doc,     (void *)rawjson_doc},
+    {Py_tp_methods, RawJSONMethods},
+    {Py_tp_getset,  RawJSONGetSet},
+    {Py_tp_new,     _rawjson_new},
+    {Py_tp_dealloc, _rawjson_dealloc},
+    {Py_tp_repr,    _rawjson_repr},
+    {0, NULL}
+};
+
+// not subclassable: fragments are recognized by their exact type
+static PyType_Spec PyRawJSON_Type_spec = {
+    "metamagic.json._encoder.RawJSON",
+    sizeof(PyRawJSONObject),
+    0,
+    Py_TPFLAGS_DEFAULT,
+    PyRawJSON_Type_slots
+};
+
+/* C API, see metamagic_json.h and the "implemention: C API" section below */
+static int encoder_capi_encode (PyObject * encoder, PyObject * obj, MMJsonBuffer * buffer,
+                                int flags, int max_nested_level);
+static int encoder_capi_encode_to_writer (PyObject * encoder, PyObject * obj,
+                                          MMJsonWriteFunc write, void * context,
+                                          int flags, int max_nested_level);
+
+/* module state handling and initialization, see the "implemention: module" section */
+static int  encoder_module_exec     (PyObject *module);
+static int  encoder_module_traverse (PyObject *module, visitproc visit, void *arg);
+static int  encoder_module_clear    (PyObject *module);
+static void encoder_module_free     (void *module);
+
+#if PY_VERSION_HEX >= 0x03050000
+static PyModuleDef_Slot encoder_module_slots[] = {
+    {Py_mod_exec, encoder_module_exec},
+#ifdef Py_mod_multiple_interpreters
+    {Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
+#endif
+#ifdef Py_mod_gil
+    {Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+    {0, NULL}
 };
+#else
+#define encoder_module_slots NULL
+#endif
 
 static struct PyModuleDef encodermodule = {
     PyModuleDef_HEAD_INIT,
     "_encoder",                        /* name of module */
     NULL,                              /* module documentation, may be NULL */
-    -1,                                /* -1 if the module keeps state in global variables. */
+    sizeof(EncoderState),              /* size of per-module state */
     NULL,                              /* methods - no class methods */
-    NULL,
-    NULL,
-    NULL,
-    NULL
+    encoder_module_slots,
+    encoder_module_traverse,
+    encoder_module_clear,
+    encoder_module_free
 };
 
 PyMODINIT_FUNC
 PyInit__encoder(void)
 {
-    PyObject* mod_decimal = PyImport_ImportModule("decimal");
-    PyType_Decimal = (PyTypeObject*)PyObject_GetAttrString(mod_decimal, "Decimal");
-    Py_DECREF(mod_decimal);
-
-    PyObject* mod_uuid = PyImport_ImportModule("uuid");
-    PyType_UUID = (PyTypeObject*)PyObject_GetAttrString(mod_uuid, "UUID");
-    Py_DECREF(mod_uuid);
-
-    PyObject* mod_collections = PyImport_ImportModule("collections");
-    PyType_Col_OrderedDict = (PyTypeObject*)PyObject_GetAttrString(mod_collections, "OrderedDict");
-    PyType_Col_Set         = (PyTypeObject*)PyObject_GetAttrString(mod_collections, "Set");
-    PyType_Col_Sequence    = (PyTypeObject*)PyObject_GetAttrString(mod_collections, "Sequence");
-    PyType_Col_Mapping     = (PyTypeObject*)PyObject_GetAttrString(mod_collections, "Mapping");
-    Py_DECREF(mod_collections);
-
-    PyDateTime_IMPORT;
-
-    // prepare Encoder class type/blueprint
-    PyEncoder_Type.tp_new = PyType_GenericNew;
-    if (PyType_Ready(&PyEncoder_Type) < 0)
-        return NULL;
-
-    // create "_encoder" module
+#if PY_VERSION_HEX >= 0x03050000
+    return PyModuleDef_Init(&encodermodule);
+#else
     PyObject* module = PyModule_Create(&encodermodule);
-    if (module == NULL)
-        return NULL;
 
-    // add Encoder class to the _encoder module
-    Py_INCREF(&PyEncoder_Type);
-    PyModule_AddObject(module, "Encoder", (PyObject *)&PyEncoder_Type);
+    if (module != NULL && encoder_module_exec(module) < 0)
+        Py_CLEAR(module);
 
     return module;
+#endif
 }
 
 
@@ -145,6 +237,53 @@ PyInit__encoder(void)
 
 
 static void encode (PyObject *obj, EncodedData * encodedData);
+static void encode_hooked (PyObject *obj, EncodedData * encodedData);
+static int  encode_diff (PyObject *old, PyObject *new, EncodedData * encodedData);
+
+// a column of dumpb_columns(), see encoder_column_open()
+typedef struct
+{
+    PyObject * seq;                             // tuple of the values, or NULL
+    Py_buffer  view;                            // buffer of the numbers if 'format' is set
+    char       format;                          // struct module code of the numbers
+}
+EncoderColumn;
+
+static PyObject * encode_row_prefixes (PyObject * keys, EncodedData * encodedData);
+static bool encode_begin_rows (PyObject * obj, EncodedData * encodedData);
+static void encode_end_rows   (EncodedData * encodedData);
+static void encode_row (PyObject * prefixes, PyObject * values, EncoderColumn * columns,
+                        Py_ssize_t index, EncodedData * encodedData);
+static Py_ssize_t encoder_column_open  (EncoderColumn * column, PyObject * obj, EncodedData * encodedData);
+static void       encoder_column_close (EncoderColumn * column);
+static void encode_column_value (EncoderColumn * column, Py_ssize_t index, EncodedData * encodedData);
+
+
+/*
+ * "O&" converter for the 'max_output_bytes' argument: None (no limit) or
+ * a non-negative integer.
+ */
+static int encoder_convert_max_output (PyObject *arg, void *result)
+{
+    if (arg == Py_None)
+    {
+        *(Py_ssize_t*)result = -1;
+        return 1;
+    }
+
+    Py_ssize_t max_output_size = PyLong_AsSsize_t(arg);
+
+    if (max_output_size == -1 && PyErr_Occurred()) return 0;
+
+    if (max_output_size < 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "max_output_bytes must not be negative");
+        return 0;
+    }
+
+    *(Py_ssize_t*)result = max_output_size;
+    return 1;
+}
 
 
 /*
@@ -154,6 +293,9 @@ static void encode (PyObject *obj, EncodedData * encodedData);
  * The first argument is the object to be JSON-encoded; the second is optional
  * integer parameter specifying max allowed recursion depth (default: 100).
  *
+ * With the keyword-only 'canonical' argument set dict keys and set items are
+ * sorted, so that equal objects are always encoded to the same output.
+ *
  * Supports optional __mm_json__() and __mm_serialize__() methods and calls
  * self.default() as the last resort for all objects that could not be encoded
  * in any other way.
@@ -164,20 +306,26 @@ static PyObject *
 encoder_dumps (PyObject *self, PyObject *args, PyObject *kwargs)
 {
     long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
     PyObject *obj;
 
-    static char *kwlist[] = {"obj", "max_nested_level", NULL};
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|l", kwlist,
-                                     &obj, &max_recursion_depth))
+    int canonical = 0;
+
+    static char *kwlist[] = {"obj", "max_nested_level", "max_output_bytes", "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|l$O&p", kwlist,
+                                     &obj, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size, &canonical))
         return NULL;
 
     EncodedData output;
 
     encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+    encoder_data_set_canonical(&output, canonical);
 
     encode(obj, &output);
 
-    if (encoder_data_has_error(&output))
+    if (encoder_data_has_error(&output) || !encoder_data_check_output_size(&output, 0))
     {
         encoder_data_destruct(&output);
         return NULL;
@@ -190,12 +338,102 @@ encoder_dumps (PyObject *self, PyObject *args, PyObject *kwargs)
     return result;
 }
 
+/*
+ * Passes an encoded chunk of output to the Python callable stored in
+ * EncodedData.flush_arg (usually a write() method of a file-like object).
+ */
+static bool encoder_flush_to_callable (EncodedData * data, const BUFFERTYPE * chunk, Py_ssize_t size)
+{
+    PyObject * bytes = PyBytes_FromStringAndSize(chunk, size);
+
+    if (bytes == NULL) return false;
+
+    PyObject * result = PyObject_CallFunctionObjArgs((PyObject*)data->flush_arg, bytes, NULL);
+
+    Py_DECREF(bytes);
+
+    if (result == NULL) return false;
+
+    Py_DECREF(result);
+    return true;
+}
+
+/*
+ * JSON-encodes 'obj' using the (initialized) 'output' and passing the output to
+ * the 'write' callable in chunks of at most DEFAULT_BUFFER_SIZE bytes (unless
+ * a single value requires more space).
+ *
+ * Returns false with a Python exception set on failure.
+ */
+static bool encoder_write_chunks (EncodedData *output, PyObject *obj, PyObject *write)
+{
+    encoder_data_set_flush(output, encoder_flush_to_callable, write);
+
+    encode(obj, output);
+
+    encoder_data_flush(output);
+
+    return !encoder_data_has_error(output);
+}
+
+/*
+ * Returns a new metamagic.json.compression.CompressedWriter instance writing
+ * to 'fp' (or collecting the compressed output if 'fp' is None).
+ */
+static PyObject * encoder_compressed_writer (PyObject *fp, PyObject *compress, PyObject *level)
+{
+    PyObject* mod_compression = PyImport_ImportModule("metamagic.json.compression");
+
+    if (mod_compression == NULL) return NULL;
+
+    PyObject* writer = PyObject_CallMethod(mod_compression, "CompressedWriter", "OOO",
+                                           fp, compress, level);
+    Py_DECREF(mod_compression);
+
+    return writer;
+}
+
+/*
+ * Encodes 'obj' through a CompressedWriter created for 'fp'; returns the result of
+ * the writer's finish() method.
+ */
+static PyObject * encoder_write_compressed (EncodedData *output, PyObject *obj,
+                                            PyObject *fp, PyObject *compress, PyObject *level)
+{
+    PyObject * writer = encoder_compressed_writer(fp, compress, level);
+
+    if (writer == NULL) return NULL;
+
+    PyObject * result = NULL;
+    PyObject * write  = PyObject_GetAttrString(writer, "write");
+
+    if (write != NULL)
+    {
+        if (encoder_write_chunks(output, obj, write))
+            result = PyObject_CallMethod(writer, "finish", NULL);
+
+        Py_DECREF(write);
+    }
+
+    Py_DECREF(writer);
+
+    return result;
+}
+
 /*
  * JSON-encodes a python object into a Python bytes() array.
  *
  * The first argument is the object to be JSON-encoded; the second is optional
  * integer parameter specifying max allowed recursion depth (default: 100).
  *
+ * If the keyword-only 'compress' argument is given (one of the methods supported
+ * by metamagic.json.compression) the output is compressed on the fly, chunk by
+ * chunk, and only the compressed output is kept in memory; 'level' is the
+ * compression level.
+ *
+ * Accepts the same keyword-only 'max_output_bytes' and 'canonical' arguments
+ * as dumps().
+ *
  * Supports optional __mm_json__() and __mm_serialize__() methods and calls
  * self.default() as the last resort for all objects that could not be encoded
  * in any other way.
@@ -206,947 +444,3496 @@ static PyObject *
 encoder_dumpb (PyObject *self, PyObject *args, PyObject *kwargs)
 {
     long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
     PyObject *obj;
+    PyObject *compress = Py_None;
+    PyObject *level    = Py_None;
 
-    static char *kwlist[] = {"obj", "max_nested_level", NULL};
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|l", kwlist,
-                                     &obj, &max_recursion_depth))
+    int canonical = 0;
+
+    static char *kwlist[] = {"obj", "max_nested_level", "compress", "level", "max_output_bytes",
+                             "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|l$OOO&p", kwlist,
+                                     &obj, &max_recursion_depth, &compress, &level,
+                                     encoder_convert_max_output, &max_output_size, &canonical))
         return NULL;
 
     EncodedData output;
 
     encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+    encoder_data_set_canonical(&output, canonical);
 
-    encode(obj, &output);
+    PyObject * result = NULL;
 
-    if (encoder_data_has_error(&output))
+    if (compress != Py_None)
+        result = encoder_write_compressed(&output, obj, Py_None, compress, level);
+    else
     {
-        encoder_data_destruct(&output);
-        return NULL;
-    }
+        encode(obj, &output);
 
-    PyObject * result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
+        if (!encoder_data_has_error(&output) && encoder_data_check_output_size(&output, 0))
+            result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
+    }
 
     encoder_data_destruct(&output);
 
     return result;
 }
 
+/*
+ * JSON-encodes a python object writing the output to the file-like object 'fp'.
+ *
+ * The output is written with fp.write() in chunks as soon as the internal buffer
+ * fills up, so the complete encoded document is never held in memory.
+ *
+ * Accepts the same arguments as dumpb(); with 'compress' only the compressed
+ * output is written to 'fp'.
+ */
 static PyObject *
-encoder_default (PyObject *self, PyObject *args)
+encoder_dump (PyObject *self, PyObject *args, PyObject *kwargs)
 {
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
     PyObject *obj;
+    PyObject *fp;
+    PyObject *compress = Py_None;
+    PyObject *level    = Py_None;
 
-    if (!PyArg_ParseTuple(args, "O", &obj)) return NULL;
+    int canonical = 0;
 
-    PyErr_Format(PyExc_TypeError, "%R is not JSON serializable by this encoder", obj);
+    static char *kwlist[] = {"obj", "fp", "max_nested_level", "compress", "level",
+                             "max_output_bytes", "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|l$OOO&p", kwlist,
+                                     &obj, &fp, &max_recursion_depth, &compress, &level,
+                                     encoder_convert_max_output, &max_output_size, &canonical))
+        return NULL;
 
-    return NULL;
+    EncodedData output;
+
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+    encoder_data_set_canonical(&output, canonical);
+
+    bool success = false;
+
+    if (compress != Py_None)
+    {
+        PyObject * result = encoder_write_compressed(&output, obj, fp, compress, level);
+
+        success = result != NULL;
+        Py_XDECREF(result);
+    }
+    else
+    {
+        PyObject * write = PyObject_GetAttrString(fp, "write");
+
+        if (write != NULL)
+        {
+            success = encoder_write_chunks(&output, obj, write);
+            Py_DECREF(write);
+        }
+    }
+
+    encoder_data_destruct(&output);
+
+    if (!success) return NULL;
+
+    Py_RETURN_NONE;
+}
+
+// max number of bytes passed to one write() call (_write() takes an unsigned int)
+#define MAX_FD_WRITE_SIZE  0x40000000
+
+// the destination of dump_fd()
+typedef struct
+{
+    int fd;
+    int timeout;                                // ms to wait for a non-blocking fd to
+                                                //   become writable, -1: no limit
 }
+EncoderFdWriter;
 
+#ifndef MS_WINDOWS
 /*
- * __init__ method: needed to suport the encode_hook functionality: at construction time
- * check if the class has encode_hook() method and if it does flip the use_hook flag.
- *
- * The idea is to avoid checking the existence of the method at every dumps/dumpb call.
- *
+ * Waits with the GIL released until the non-blocking 'writer' fd accepts more
+ * data.  Returns false with a Python exception set on timeout or failure.
  */
-static int _encoder_init (PyEncoderObject *self, PyObject *args, PyObject *kwds)
+static bool encoder_wait_writable (EncoderFdWriter * writer)
 {
-    if (PyObject_HasAttrString((PyObject*)self, "encode_hook"))
-        self->use_hook = true;
-    else
-        self->use_hook = false;
+    struct pollfd pfd;
 
-    return 0;
-}
+    pfd.fd     = writer->fd;
+    pfd.events = POLLOUT;
 
-/*===========================================================================
- * implemention: internal methods
- *===========================================================================*/
+    for (;;)
+    {
+        int ready, err;
 
-static void _encode        (PyObject * obj,  EncodedData * encodedData);
-static void encode_default (PyObject * obj,  EncodedData * encodedData);
-static void encode_integer (PyObject * obj,  EncodedData * encodedData);
-static void encode_float   (PyObject * obj,  EncodedData * encodedData);
-static void encode_decimal (PyObject * obj,  EncodedData * encodedData);
-static void encode_string  (PyObject * obj,  EncodedData * encodedData);
-static void encode_uuid    (PyObject * obj,  EncodedData * encodedData);
-static void encode_datetime(PyObject * obj,  EncodedData * encodedData);
-static void encode_date    (PyObject * obj,  EncodedData * encodedData);
-static void encode_time    (PyObject * obj,  EncodedData * encodedData);
-static void encode_list    (PyObject * obj,  EncodedData * encodedData);
-static void encode_tuple   (PyObject * obj,  EncodedData * encodedData);
-static void encode_set     (PyObject * obj,  EncodedData * encodedData);
-static void encode_dict    (PyObject * obj,  EncodedData * encodedData);
-static void encode_mapping (PyObject * obj,  EncodedData * encodedData);
-static void encode_json    (PyObject * pystr, EncodedData * encodedData);
-static void encode_jsonb   (PyObject * pybytes, EncodedData * encodedData);
-static void encode_true    (EncodedData * encodedData);
-static void encode_false   (EncodedData * encodedData);
-static void encode_none    (EncodedData * encodedData);
+        Py_BEGIN_ALLOW_THREADS
+        ready = poll(&pfd, 1, writer->timeout);
+        err   = errno;
+        Py_END_ALLOW_THREADS
+
+        if (ready > 0) return true;
+
+        if (ready == 0)
+        {
+            PyErr_SetString(PyExc_TimeoutError, "timed out");
+            return false;
+        }
+
+        if (err != EINTR)
+        {
+            errno = err;
+            PyErr_SetFromErrno(PyExc_OSError);
+            return false;
+        }
 
+        if (PyErr_CheckSignals() < 0) return false;
+    }
+}
+#endif
 
 /*
- * JSON-encodes a python object into the given EncodedData buffer.
- *
- * The order in which various encoders are applied to the given 'obj' is as follows:
- *
- *  1) iff encoder class has encode_hook() method (not present by default) it
- *     is called first and the rest of the processing is applied to the output of encode_hook(obj).
- *
- *  2) next, the exact check for some known types (strings, int/float, true/false/none,
- *     list/tuple/dict/set, OrderedDict, UUID and Decimal) is performed and if type matches
- *     the corresponding encoder is used and the result stored in EncodedData buffer.
- *
- *  3) next, the object's __mm_json__() method is tried and if exists and does not raise
- *     NotImplementedError, its return value is used.
- *
- *  4) next, the object's __mm_serialize__() method is tried and this function is applied
- *     to the output of __mm_serialize__.
- *
- *  5) If none of the baove worked, the more generic isinstance() check is performed
- *     against the same known object types.
- *
- *  6) If there were no match self.default() method is applied to the object and in case
- *     there were no exceptions this function is applied to the result.
+ * Writes an encoded chunk of output to the file descriptor of the EncoderFdWriter
+ * stored in EncodedData.flush_arg.  The GIL is released during each write(), so
+ * other threads run while the kernel copies the data; partial writes are resumed,
+ * interrupted ones retried (after running signal handlers), and a non-blocking
+ * fd is waited on when it would block.
  */
-static void encode (PyObject *obj, EncodedData * encodedData)
+static bool encoder_flush_to_fd (EncodedData * data, const BUFFERTYPE * chunk, Py_ssize_t size)
 {
-    // if we already found an error stop and do not encode anything else
-    if (encoder_data_has_error(encodedData)) return;
+    EncoderFdWriter * writer = (EncoderFdWriter*)data->flush_arg;
 
-    // first try the special hook ------------------------------------------
-
-    if (encodedData->use_hook)
+    while (size > 0)
     {
-        PyObject* _encode_hook_ = PyObject_GetAttrString(encodedData->self, "encode_hook");
+        Py_ssize_t written;
+        int        err;
+
+        Py_BEGIN_ALLOW_THREADS
+#ifdef MS_WINDOWS
+        written = _write(writer->fd, chunk,
+                         (unsigned int)(size > MAX_FD_WRITE_SIZE ? MAX_FD_WRITE_SIZE : size));
+#else
+        written = write(writer->fd, chunk, size > MAX_FD_WRITE_SIZE ? MAX_FD_WRITE_SIZE : size);
+#endif
+        err     = errno;
+        Py_END_ALLOW_THREADS
 
-        if (_encode_hook_ != NULL)
+        if (written >= 0)
         {
-            PyObject* obj_encoded = PyObject_CallFunctionObjArgs(_encode_hook_, obj, NULL);
+            chunk += written;
+            size  -= written;
+            continue;
+        }
 
-            if (obj_encoded == NULL)
-                encoder_data_set_error(encodedData);
-            else
-            {
-                _encode(obj_encoded, encodedData);
-                Py_DECREF(obj_encoded);
-            }
+        if (err == EINTR)
+        {
+            if (PyErr_CheckSignals() < 0) return false;
+            continue;
+        }
 
-            Py_DECREF(_encode_hook_);
-            return;
+#ifndef MS_WINDOWS
+        if (err == EAGAIN || err == EWOULDBLOCK)
+        {
+            if (!encoder_wait_writable(writer)) return false;
+            continue;
         }
-        else
-            PyErr_Clear();
+#endif
+
+        errno = err;
+        PyErr_SetFromErrno(PyExc_OSError);
+        return false;
     }
 
-    _encode(obj, encodedData);
+    return true;
 }
 
-/* internal encoder - does all of the processing except encode_hook() */
-static void _encode (PyObject * obj, EncodedData * encodedData)
+/*
+ * Sets up 'writer' for 'fd': an integer file descriptor or an object with a
+ * fileno() method.  The timeout of socket objects limits each wait for the
+ * socket to become writable; TLS sockets are rejected, as writing to their
+ * descriptor would bypass the encryption.
+ */
+static bool encoder_fd_writer_init (EncoderFdWriter * writer, PyObject * fd)
 {
-    // First try strict checks ---------------------------------------------
+    writer->timeout = -1;
 
-    if (PyUnicode_CheckExact(obj)) return encode_string (obj, encodedData);
-    if (PyLong_CheckExact   (obj)) return encode_integer(obj, encodedData);
-    if (PyFloat_CheckExact  (obj)) return encode_float  (obj, encodedData);
-
-    if (obj == Py_True)  return encode_true (encodedData);
-    if (obj == Py_False) return encode_false(encodedData);
-    if (obj == Py_None)  return encode_none (encodedData);
+    if (PyLong_Check(fd))
+    {
+        writer->fd = PyObject_AsFileDescriptor(fd);
+        return writer->fd >= 0;
+    }
 
-    if (PyList_CheckExact(obj))   return encode_list (obj, encodedData);
-    if (PyTuple_CheckExact(obj))  return encode_tuple(obj, encodedData);
-    if (PyDict_CheckExact(obj))   return encode_dict (obj, encodedData);
-    if (PyAnySet_CheckExact(obj)) return encode_set  (obj, encodedData);
+    PyObject * modules = PySys_GetObject("modules");
+    PyObject * ssl     = modules != NULL ? PyDict_GetItemString(modules, "ssl") : NULL;
 
-    if (obj->ob_type == PyType_UUID)            return encode_uuid    (obj, encodedData);
-    if (obj->ob_type == PyType_Decimal)         return encode_decimal (obj, encodedData);
-    if (obj->ob_type == PyType_Col_OrderedDict) return encode_mapping (obj, encodedData);
+    if (ssl != NULL)
+    {
+        PyObject * ssl_socket = PyObject_GetAttrString(ssl, "SSLSocket");
 
-    // try __mm_json__ method ----------------------------------------------
+        if (ssl_socket == NULL)
+            PyErr_Clear();
+        else
+        {
+            int is_ssl = PyObject_IsInstance(fd, ssl_socket);
 
-    PyObject* _sx_json_ = PyObject_GetAttrString(obj, "__mm_json__");
+            Py_DECREF(ssl_socket);
 
-    if (_sx_json_ != NULL)
-    {
-        PyObject* obj_encoded = PyObject_CallObject(_sx_json_, NULL);
-        int implemented = 1;
+            if (is_ssl < 0) return false;
 
-        if (obj_encoded == NULL)
-        {
-            if (PyErr_ExceptionMatches(PyExc_NotImplementedError))
+            if (is_ssl)
             {
-                PyErr_Clear();
-                implemented = 0;
+                PyErr_SetString(PyExc_TypeError,
+                                "dump_fd() cannot write to TLS sockets, use dump() instead");
+                return false;
             }
-            else
-                encoder_data_set_error(encodedData);
-        }
-        else
-        {
-            if (PyBytes_CheckExact(obj_encoded))
-                encode_jsonb(obj_encoded, encodedData);
-            else
-                encode_json(obj_encoded, encodedData);
-            Py_DECREF(obj_encoded);
         }
+    }
 
-        Py_DECREF(_sx_json_);
+    if ((writer->fd = PyObject_AsFileDescriptor(fd)) < 0) return false;
 
-        if (implemented)
-            return;
-    }
-    else
-        PyErr_Clear();
+    if (!PyObject_HasAttrString(fd, "gettimeout")) return true;
 
-    // try __mm_serialize__ method -----------------------------------------
+    PyObject * timeout = PyObject_CallMethod(fd, "gettimeout", NULL);
 
-    PyObject* _sx_serialize_ = PyObject_GetAttrString(obj, "__mm_serialize__");
+    if (timeout == NULL) return false;
 
-    if (_sx_serialize_ != NULL)
+    if (timeout != Py_None)
     {
-        PyObject* obj_encoded = PyObject_CallObject(_sx_serialize_, NULL);
-        int implemented = 1;
+        double seconds = PyFloat_AsDouble(timeout);
 
-        if (obj_encoded == NULL)
-            if (PyErr_ExceptionMatches(PyExc_NotImplementedError))
-            {
-                PyErr_Clear();
-                implemented = 0;
-            }
-            else
-                encoder_data_set_error(encodedData);
-        else
+        if (seconds == -1.0 && PyErr_Occurred())
         {
-            encode(obj_encoded, encodedData);
-            Py_DECREF(obj_encoded);
+            Py_DECREF(timeout);
+            return false;
         }
 
-        Py_DECREF(_sx_serialize_);
-
-        if (implemented)
-            return;
+        // 0 is the timeout of sockets in the non-blocking mode: wait with no limit
+        if (seconds > 0)
+            writer->timeout = seconds * 1000 >= INT_MAX ? INT_MAX : (int)ceil(seconds * 1000);
     }
-    else
-        PyErr_Clear();
 
-    // try isinstance() checks ---------------------------------------------
+    Py_DECREF(timeout);
 
-    // need to check ordereddict-derived classes before dict-derived classes
-    if (PyObject_TypeCheck(obj, PyType_Col_OrderedDict)) return encode_mapping (obj, encodedData);
+    return true;
+}
 
-    if (PyDict_Check(obj))   return encode_mapping (obj, encodedData);
-    if (PyList_Check(obj))   return encode_list    (obj, encodedData);
-    if (PyTuple_Check(obj))  return encode_tuple   (obj, encodedData);
-    if (PyAnySet_Check(obj)) return encode_set     (obj, encodedData);
+/*
+ * JSON-encodes a python object writing the output to the file descriptor 'fd'
+ * (an int or an object with a fileno() method, like a socket).
+ *
+ * Like with dump() the output is written in chunks as the internal buffer fills
+ * up, but with write() calls made with the GIL released instead of calls of a
+ * Python method.  Partial writes are resumed and non-blocking descriptors are
+ * waited on until they accept more data (at most for the socket's timeout,
+ * raising TimeoutError).
+ *
+ * Accepts the same arguments as dump(), except for 'compress'.
+ */
+static PyObject *
+encoder_dump_fd (PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
+    PyObject *obj;
+    PyObject *fd;
 
-    if (PyUnicode_Check(obj)) return encode_string (obj, encodedData);
-    if (PyLong_Check   (obj)) return encode_integer(obj, encodedData);
-    if (PyFloat_Check  (obj)) return encode_float  (obj, encodedData);
+    int canonical = 0;
 
-    if (PyObject_TypeCheck(obj, PyType_UUID))    return encode_uuid   (obj, encodedData);
-    if (PyObject_TypeCheck(obj, PyType_Decimal)) return encode_decimal(obj, encodedData);
+    static char *kwlist[] = {"obj", "fd", "max_nested_level", "max_output_bytes", "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|l$O&p", kwlist,
+                                     &obj, &fd, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size, &canonical))
+        return NULL;
 
-    if (PyDateTime_Check(obj)) return encode_datetime(obj, encodedData);
-    if (PyDate_Check(obj)) return encode_date(obj, encodedData);
-    if (PyTime_Check(obj)) return encode_time(obj, encodedData);
+    EncoderFdWriter writer;
 
-    if (PyBytes_Check(obj) || PyByteArray_Check(obj)) return encode_default(obj, encodedData);
+    if (!encoder_fd_writer_init(&writer, fd)) return NULL;
 
-    if (PyObject_IsInstance(obj,(PyObject*)PyType_Col_Mapping )==1)
-        return encode_mapping (obj, encodedData);
-    if (PyObject_IsInstance(obj,(PyObject*)PyType_Col_Set)     ==1)
-        return encode_set (obj, encodedData);
-    if (PyObject_IsInstance(obj,(PyObject*)PyType_Col_Sequence)==1)
-        return encode_set (obj, encodedData);
+    EncodedData output;
 
-    // try self.default() method -------------------------------------------
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+    encoder_data_set_canonical(&output, canonical);
+    encoder_data_set_flush(&output, encoder_flush_to_fd, &writer);
+
+    encode(obj, &output);
+
+    encoder_data_flush(&output);
+
+    bool success = !encoder_data_has_error(&output);
+
+    encoder_data_destruct(&output);
+
+    if (!success) return NULL;
 
-    return encode_default(obj, encodedData);
+    Py_RETURN_NONE;
 }
 
 /*
- * JSON-encodes a dictionary key object into the given EncodedData buffer.
+ * JSON-encodes every object produced by 'iterable' into one Python bytes() array,
+ * appending the 'sep' bytes (default: b"\n") after each encoded object; with the
+ * default separator the output is in the JSON Lines (NDJSON) format.
  *
- * By JSON specification only strings can be keys, thus only strings are encoded and
- * a TypeError is raised for all other object types; an exception is made for UUID
- * objects since they are also encoded to strings and UUIDs are a common dictionary
- * key in the metamagic framework.
+ * All objects are encoded in one loop into the same buffer, which is much cheaper
+ * than calling dumpb() for each of them when the objects are small.
  *
- * The order in which different checks/encoders are applied is the same as in the
- * encode() method; __mm_serialize__() is also supported and is supposed to return
- * an object encodable to a string. If everything else fails the default() method
- * is called.
+ * The keyword-only 'max_nested_level' argument applies to each object separately.
  */
-static void encode_key (PyObject *obj, EncodedData * encodedData)
+static PyObject *
+encoder_dumpb_many (PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    // if we already found an error stop and do not encode anything else
-    if (encoder_data_has_error(encodedData)) return;
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
+    PyObject *iterable;
+    PyObject *sep = NULL;
 
-    // first try strict checks ---------------------------------------------
+    int canonical = 0;
 
-    if (PyUnicode_CheckExact(obj))   return encode_string (obj, encodedData);
-    if (obj->ob_type == PyType_UUID) return encode_uuid   (obj, encodedData);
+    static char *kwlist[] = {"iterable", "sep", "max_nested_level", "max_output_bytes",
+                             "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|S$lO&p", kwlist,
+                                     &iterable, &sep, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size, &canonical))
+        return NULL;
 
-    // try __mm_serialize__ method -----------------------------------------
+    PyObject * it = PyObject_GetIter(iterable);
 
-    PyObject* _sx_serialize_ = PyObject_GetAttrString(obj, "__mm_serialize__");
+    if (it == NULL) return NULL;
 
-    if (_sx_serialize_ != NULL)
+    const char * sep_str  = sep == NULL ? "\n" : PyBytes_AS_STRING(sep);
+    Py_ssize_t   sep_size = sep == NULL ? 1    : PyBytes_GET_SIZE(sep);
+
+    EncodedData output;
+
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+    encoder_data_set_canonical(&output, canonical);
+
+    PyObject *item;
+    while ((item = PyIter_Next(it)) != NULL)
     {
-        PyObject* obj_encoded = PyObject_CallObject(_sx_serialize_, NULL);
-        int implemented = 1;
+        encode(item, &output);
 
-        if (obj_encoded == NULL)
-            if (PyErr_ExceptionMatches(PyExc_NotImplementedError))
-            {
-                PyErr_Clear();
-                implemented = 0;
-            }
-            else
-                encoder_data_set_error(encodedData);
-        else
-        {
-            encode_key(obj_encoded, encodedData);
-            Py_DECREF(obj_encoded);
-        }
+        Py_DECREF(item);
 
-        Py_DECREF(_sx_serialize_);
+        if (encoder_data_has_error(&output)) break;
 
-        if (implemented)
-            return;
+        encoder_data_append(&output, sep_str, sep_size);
     }
-    else
-        PyErr_Clear();
 
-    // try isinstance() checks ---------------------------------------------
+    Py_DECREF(it);
 
-    if (PyUnicode_Check(obj))                 return encode_string (obj, encodedData);
-    if (PyObject_TypeCheck(obj, PyType_UUID)) return encode_uuid   (obj, encodedData);
+    PyObject * result = NULL;
 
-    // try self.default() method -------------------------------------------
+    if (!encoder_data_has_error(&output) && encoder_data_check_output_size(&output, 0) && !PyErr_Occurred())
+        result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
 
-    encode_default(obj, encodedData);
+    encoder_data_destruct(&output);
 
-    if (PyErr_Occurred())
-    {
-        // re-raise TypeError exceptions to a specifically type-error-for-dict-key;
-        // leave all other exceptions as is
-        if (PyErr_ExceptionMatches(PyExc_TypeError))
-        {
-            PyErr_Clear();
-            PyErr_Format(PyExc_TypeError, "%R is not a valid dictionary key", obj);
-        }
+    return result;
+}
 
-        encoder_data_set_error(encodedData);
-    }
+/*
+ * Returns a JSON merge patch (RFC 7386) which turns the JSON-encoding of 'old' into
+ * the JSON-encoding of 'new', as a Python bytes() array.
+ *
+ * Both objects are walked together, see encode_diff(): only the values which differ
+ * are encoded, so for large and mostly unchanged objects the patch is both smaller
+ * and faster to produce than the JSON-encoding of 'new'.  Accepts the same
+ * 'max_nested_level' and 'max_output_bytes' arguments as dumpb().
+ */
+static PyObject *
+encoder_dumpb_diff (PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
+    PyObject *old;
+    PyObject *new;
+
+    static char *kwlist[] = {"old", "new", "max_nested_level", "max_output_bytes", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|$lO&", kwlist,
+                                     &old, &new, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size))
+        return NULL;
+
+    EncodedData output;
+
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+
+    encode_diff(old, new, &output);
+
+    PyObject * result = NULL;
+
+    if (!encoder_data_has_error(&output) && encoder_data_check_output_size(&output, 0))
+        result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
+
+    encoder_data_destruct(&output);
+
+    return result;
 }
 
-static void encode_default (PyObject * obj, EncodedData * encodedData)
+/*
+ * Encodes rows of values (e.g. the tuples returned by DB-API cursors) into a Python
+ * bytes() array with a JSON array of objects: one per row, with the keys given by
+ * 'columns' and the values of the row in the same order.
+ *
+ * The keys are encoded once, and the objects are written directly from the rows,
+ * with no dict created per row.  Accepts the same 'max_nested_level' and
+ * 'max_output_bytes' arguments as dumpb(); rows with another number of values than
+ * 'columns' raise ValueError.
+ */
+static PyObject *
+encoder_dumpb_rows (PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    // call the "default" method of 'self' and encode the resulting Python object, if not NULL
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
+    PyObject *columns;
+    PyObject *rows;
+
+    static char *kwlist[] = {"columns", "rows", "max_nested_level", "max_output_bytes", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO|$lO&", kwlist,
+                                     &columns, &rows, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size))
+        return NULL;
 
-    PyObject* default_method = PyObject_GetAttrString(encodedData->self, "default");
+    EncodedData output;
 
-    if (default_method != NULL)
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+
+    PyObject * prefixes = encode_row_prefixes(columns, &output);
+    PyObject * it       = prefixes != NULL ? PyObject_GetIter(rows) : NULL;
+
+    if (it == NULL)
+        encoder_data_set_error(&output);
+    else if (encode_begin_rows(rows, &output))
     {
-        PyObject* obj_encoded = PyObject_CallFunctionObjArgs(default_method, obj, NULL);
+        Py_ssize_t index = 0;
+        PyObject * row;
 
-        if (obj_encoded != NULL)
+        while ((row = PyIter_Next(it)) != NULL)
         {
-            encode(obj_encoded, encodedData);
-            Py_DECREF(obj_encoded);
+            // the values of the row, which can not change while they are encoded
+            PyObject * values = PySequence_Tuple(row);
+
+            Py_DECREF(row);
+
+            if (values == NULL)
+            {
+                encoder_data_set_error(&output);
+                break;
+            }
+
+            if (PyTuple_GET_SIZE(values) != PyList_GET_SIZE(prefixes))
+            {
+                PyErr_Format(PyExc_ValueError, "row %zd has %zd values, expected %zd", index,
+                             PyTuple_GET_SIZE(values), PyList_GET_SIZE(prefixes));
+                encoder_data_set_error(&output);
+            }
+            else
+                encode_row(prefixes, values, NULL, index++, &output);
+
+            Py_DECREF(values);
+
+            if (encoder_data_has_error(&output)) break;
         }
 
-        Py_DECREF(default_method);
+        if (!encoder_data_has_error(&output) && PyErr_Occurred())
+            encoder_data_set_error(&output);
+
+        encode_end_rows(&output);
     }
 
-    if (PyErr_Occurred())
-        encoder_data_set_error(encodedData);
-}
+    Py_XDECREF(it);
+    Py_XDECREF(prefixes);
 
-/*==  errors  ======================================================*/
+    PyObject * result = NULL;
 
-static void encoder_simple_value_error (const char * msg, EncodedData * encodedData)
-{
-    PyErr_SetString(PyExc_ValueError, msg);
+    if (!encoder_data_has_error(&output) && encoder_data_check_output_size(&output, 0))
+        result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
 
-    encoder_data_set_error(encodedData);
+    encoder_data_destruct(&output);
+
+    return result;
 }
 
-static void encoder_value_error (const char * msg, PyObject * obj, EncodedData * encodedData)
+/*
+ * Encodes a mapping of column names to columns of values of the same length into
+ * a Python bytes() array with a JSON array of row objects, as dumpb_rows() does.
+ *
+ * Columns are sequences of values, or one-dimensional buffers (array.array,
+ * numpy arrays...) of native integers, floats or bools, whose numbers are read
+ * and written directly, with no Python objects created for them.  Columns of
+ * different lengths raise ValueError.
+ */
+static PyObject *
+encoder_dumpb_columns (PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    PyErr_Clear();
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
+    PyObject *columns;
 
-    PyErr_Format(PyExc_ValueError, msg, obj);
+    static char *kwlist[] = {"columns", "max_nested_level", "max_output_bytes", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|$lO&", kwlist,
+                                     &columns, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size))
+        return NULL;
 
-    encoder_data_set_error(encodedData);
-}
+    PyObject * items = PyMapping_Items(columns);
 
-static void encoder_not_serializable (PyObject * obj, EncodedData * encodedData)
-{
-    PyErr_Clear();
+    if (items == NULL) return NULL;
 
-    PyErr_Format(PyExc_TypeError, "%R is not JSON serializable", obj);
+    Py_ssize_t n_columns = PyList_GET_SIZE(items);
 
-    encoder_data_set_error(encodedData);
-}
+    PyObject * keys = PyList_New(n_columns);
+    EncoderColumn * column_data = PyMem_Calloc(n_columns > 0 ? n_columns : 1, sizeof(EncoderColumn));
 
+    if (keys == NULL || column_data == NULL)
+    {
+        if (column_data == NULL) PyErr_NoMemory();
 
-/*==  type-specific encoders  =====================================*/
+        Py_DECREF(items);
+        Py_XDECREF(keys);
+        PyMem_Free(column_data);
+        return NULL;
+    }
 
+    for (Py_ssize_t i = 0; i < n_columns; i++)
+    {
+        PyObject * key = PyTuple_GET_ITEM(PyList_GET_ITEM(items, i), 0);
 
-static void encode_integer (PyObject * obj, EncodedData * encodedData)
-{
-    long long int_val = PyLong_AsLongLong(obj);
+        Py_INCREF(key);
+        PyList_SET_ITEM(keys, i, key);
+    }
 
-    if (PyErr_Occurred())
-        return encoder_value_error("Number out of range: %R", obj, encodedData);
+    EncodedData output;
 
-    if (int_val > JAVASCRIPT_MAXINT ||
-        int_val < -JAVASCRIPT_MAXINT )
-        return encoder_value_error("Number out of range: %R", obj, encodedData);
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
 
-    longlong_to_string(int_val, encodedData);
-}
+    PyObject * prefixes = encode_row_prefixes(keys, &output);
 
-static void encode_float (PyObject * obj, EncodedData * encodedData)
-{
-    double double_val = PyFloat_AS_DOUBLE(obj);
+    // all columns should have the length of the first one
+    Py_ssize_t n_rows = 0;
 
-    if (Py_IS_INFINITY(double_val) || Py_IS_NAN(double_val))
+    for (Py_ssize_t i = 0; prefixes != NULL && i < n_columns; i++)
     {
-        if (double_val > 0 || double_val < 0)
-            return encoder_simple_value_error("Infinity is not supported", encodedData);
-        else
-            return encoder_simple_value_error("NaN is not supported", encodedData);
-    }
+        PyObject * item = PyList_GET_ITEM(items, i);
 
-    // note: std json uses "return PyObject_Repr(obj)"
-    //       one difference is that it keeps .0 for the whole numbers such as 2.0
-    //       - but it should not matter for JavaScript
+        Py_ssize_t size = encoder_column_open(&column_data[i], PyTuple_GET_ITEM(item, 1), &output);
 
-    char buffer[32];
-    snprintf(buffer, 32, "%.16g", double_val);
+        if (size == -1) break;
 
-    encoder_data_append_cstr(encodedData, buffer, 32);
-}
+        if (i == 0)
+            n_rows = size;
+        else if (size != n_rows)
+        {
+            PyErr_Format(PyExc_ValueError, "column %R has %zd values, expected %zd",
+                         PyTuple_GET_ITEM(item, 0), size, n_rows);
+            encoder_data_set_error(&output);
+            break;
+        }
+    }
 
-static void encode_decimal (PyObject * obj, EncodedData * encodedData)
-{
-    PyObject * str_repr = PyObject_Str(obj);
+    if (!encoder_data_has_error(&output) && encode_begin_rows(columns, &output))
+    {
+        for (Py_ssize_t index = 0; index < n_rows; index++)
+        {
+            encode_row(prefixes, NULL, column_data, index, &output);
 
-    if (str_repr == NULL) return encoder_not_serializable(obj, encodedData);
+            if (encoder_data_has_error(&output)) break;
+        }
 
-    encode_string(str_repr, encodedData);
+        encode_end_rows(&output);
+    }
 
-    Py_DECREF(str_repr);
-}
+    for (Py_ssize_t i = 0; i < n_columns; i++)
+        encoder_column_close(&column_data[i]);
 
-static void encode_uuid (PyObject * obj, EncodedData * encodedData)
-{
-    PyObject * str_repr = PyObject_Str(obj);
+    PyMem_Free(column_data);
+    Py_XDECREF(prefixes);
+    Py_DECREF(keys);
+    Py_DECREF(items);
 
-    if (str_repr == NULL) return encoder_not_serializable(obj, encodedData);
+    PyObject * result = NULL;
 
-    encode_string(str_repr, encodedData);
+    if (!encoder_data_has_error(&output) && encoder_data_check_output_size(&output, 0))
+        result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
 
-    Py_DECREF(str_repr);
-}
+    encoder_data_destruct(&output);
 
-#define HASTZINFO(p) (((_PyDateTime_BaseTZInfo *)(p))->hastzinfo)
-#define GET_DT_TZINFO(p) (HASTZINFO(p) ? \
-                          ((PyDateTime_DateTime *)(p))->tzinfo : Py_None)
-#define GET_TD_DAYS(o)          (((PyDateTime_Delta *)(o))->days)
-#define GET_TD_SECONDS(o)       (((PyDateTime_Delta *)(o))->seconds)
-#define GET_TD_MICROSECONDS(o)  (((PyDateTime_Delta *)(o))->microseconds)
-#define GET_TD_TOTAL_SECONDS(o) ((GET_TD_DAYS(o) * 86400) + GET_TD_SECONDS(o))
+    return result;
+}
 
 /*
- * 'obj' is assumed to be based on datetime.datetime.
+ * Returns the hex digest of the JSON-encoding of a python object computed with
+ * the given hashlib 'algorithm' (default: "sha256").
  *
- * outputs date/time in ISO format "YYYY-MM-DDTHH:MM:SS.mmmmmm+HH:MM" to EncodedData
+ * The output is passed to the hash object chunk by chunk as it is produced, so
+ * it is never held in memory as a whole.  By default (keyword-only 'canonical'
+ * argument) the object is encoded in the canonical mode, so the digest can be
+ * used as an ETag or a cache key.
  */
-static void encode_datetime (PyObject * obj, EncodedData * encodedData)
+static PyObject *
+encoder_digest (PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    if (encoder_data_has_error(encodedData)) return;
+    long max_recursion_depth = 100;
+    PyObject *obj;
+    PyObject *algorithm = NULL;
+    int canonical = 1;
 
-    // date in ISO format is at most 32 characters long, plus need two enclosing quotes
-    encoder_data_reserve_space(encodedData, 34);
+    static char *kwlist[] = {"obj", "algorithm", "max_nested_level", "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|U$lp", kwlist,
+                                     &obj, &algorithm, &max_recursion_depth, &canonical))
+        return NULL;
+
+    PyObject* mod_hashlib = PyImport_ImportModule("hashlib");
+
+    if (mod_hashlib == NULL) return NULL;
+
+    PyObject* hash = algorithm == NULL ?
+                        PyObject_CallMethod(mod_hashlib, "new", "s", "sha256") :
+                        PyObject_CallMethod(mod_hashlib, "new", "O", algorithm);
+    Py_DECREF(mod_hashlib);
+
+    if (hash == NULL) return NULL;
+
+    PyObject * result = NULL;
+    PyObject * update = PyObject_GetAttrString(hash, "update");
+
+    if (update != NULL)
+    {
+        EncodedData output;
+
+        encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+        encoder_data_set_canonical(&output, canonical);
+
+        if (encoder_write_chunks(&output, obj, update))
+            result = PyObject_CallMethod(hash, "hexdigest", NULL);
+
+        encoder_data_destruct(&output);
+        Py_DECREF(update);
+    }
+
+    Py_DECREF(hash);
+
+    return result;
+}
+
+/*
+ * Encodes a python object into a Python bytes() array using the given binary
+ * format emitter instead of JSON.
+ *
+ * The same objects as with dumpb() are supported, in the same way (encode_hook(),
+ * __mm_serialize__() and default() are used), except that __mm_json__() methods
+ * are ignored.  Accepts the same 'max_nested_level', 'max_output_bytes' and
+ * 'canonical' arguments as dumpb().
+ */
+static PyObject *
+encoder_dump_binary (PyObject *self, PyObject *args, PyObject *kwargs, const EncoderEmitter *emitter)
+{
+    long max_recursion_depth = 100;
+    Py_ssize_t max_output_size = -1;
+    PyObject *obj;
+    int canonical = 0;
+
+    static char *kwlist[] = {"obj", "max_nested_level", "max_output_bytes", "canonical", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|l$O&p", kwlist,
+                                     &obj, &max_recursion_depth,
+                                     encoder_convert_max_output, &max_output_size, &canonical))
+        return NULL;
+
+    EncodedData output;
+
+    encoder_data_init(&output, self, max_recursion_depth, ((PyEncoderObject*)self)->use_hook);
+    encoder_data_set_max_output_size(&output, max_output_size);
+    encoder_data_set_canonical(&output, canonical);
+    encoder_data_set_emitter(&output, emitter);
+
+    encode(obj, &output);
+
+    PyObject * result = NULL;
+
+    if (!encoder_data_has_error(&output) && encoder_data_check_output_size(&output, 0))
+        result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
+
+    encoder_data_destruct(&output);
+
+    return result;
+}
+
+static PyObject *
+encoder_dumpmsgpack (PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    return encoder_dump_binary(self, args, kwargs, &msgpack_emitter);
+}
+
+static PyObject *
+encoder_dumpcbor (PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    return encoder_dump_binary(self, args, kwargs, &cbor_emitter);
+}
+
+static PyObject *
+encoder_default (PyObject *self, PyObject *args)
+{
+    PyObject *obj;
+
+    if (!PyArg_ParseTuple(args, "O", &obj)) return NULL;
+
+    PyErr_Format(PyExc_TypeError, "%R is not JSON serializable by this encoder", obj);
+
+    return NULL;
+}
+
+/*===========================================================================
+ * implemention: C API
+ *===========================================================================*/
+
+static EncoderState * encoder_type_state (PyTypeObject * type);
+
+/*
+ * Returns (a borrowed reference to) the encoder to be used: 'encoder' itself or,
+ * if it is NULL, the default Encoder of the current interpreter.  Returns NULL
+ * with a Python exception set on failure.
+ */
+static PyObject * encoder_capi_get_encoder (PyObject * encoder)
+{
+    if (encoder == NULL)
+    {
+        // the C API functions are shared by all interpreters, so the module
+        // state is looked up in the current one
+        PyObject * module = PyImport_ImportModule("metamagic.json._encoder");
+
+        if (module == NULL) return NULL;
+
+        encoder = ((EncoderState*)PyModule_GetState(module))->capi_default_encoder;
+
+        Py_DECREF(module);
+
+        return encoder;
+    }
+
+    if (encoder_type_state(Py_TYPE(encoder)) == NULL)
+    {
+        PyErr_Format(PyExc_TypeError, "%R is not a metamagic.json._encoder.Encoder instance",
+                     encoder);
+        return NULL;
+    }
+
+    return encoder;
+}
+
+/* applies the C API 'flags' to the (initialized) 'output' */
+static void encoder_capi_set_flags (EncodedData * output, int flags)
+{
+    encoder_data_set_canonical(output, (flags & MMJSON_CANONICAL) != 0);
+
+    if (flags & MMJSON_MSGPACK)
+        encoder_data_set_emitter(output, &msgpack_emitter);
+    else if (flags & MMJSON_CBOR)
+        encoder_data_set_emitter(output, &cbor_emitter);
+}
+
+static int encoder_capi_encode (PyObject * encoder, PyObject * obj, MMJsonBuffer * buffer,
+                                int flags, int max_nested_level)
+{
+    if ((encoder = encoder_capi_get_encoder(encoder)) == NULL) return -1;
+
+    EncodedData output;
+
+    encoder_data_init_external(&output, encoder, max_nested_level > 0 ? max_nested_level : 100,
+                               ((PyEncoderObject*)encoder)->use_hook, buffer);
+    encoder_capi_set_flags(&output, flags);
+
+    encode(obj, &output);
+
+    bool success = !encoder_data_has_error(&output);
+
+    encoder_data_destruct(&output);
+
+    return success ? 0 : -1;
+}
+
+typedef struct
+{
+    MMJsonWriteFunc write;
+    void *          context;
+}
+CAPIWriter;
+
+static bool encoder_flush_to_capi_writer (EncodedData * data, const BUFFERTYPE * chunk, Py_ssize_t size)
+{
+    CAPIWriter * writer = (CAPIWriter*)data->flush_arg;
+
+    return writer->write(writer->context, chunk, size) == 0;
+}
+
+static int encoder_capi_encode_to_writer (PyObject * encoder, PyObject * obj,
+                                          MMJsonWriteFunc write, void * context,
+                                          int flags, int max_nested_level)
+{
+    if ((encoder = encoder_capi_get_encoder(encoder)) == NULL) return -1;
+
+    EncodedData output;
+    CAPIWriter  writer = {write, context};
+
+    encoder_data_init(&output, encoder, max_nested_level > 0 ? max_nested_level : 100,
+                      ((PyEncoderObject*)encoder)->use_hook);
+    encoder_capi_set_flags(&output, flags);
+    encoder_data_set_flush(&output, encoder_flush_to_capi_writer, &writer);
+
+    encode(obj, &output);
+
+    encoder_data_flush(&output);
+
+    bool success = !encoder_data_has_error(&output);
+
+    encoder_data_destruct(&output);
+
+    return success ? 0 : -1;
+}
+
+/*===========================================================================
+ * implemention: module
+ *===========================================================================*/
+
+#if PY_VERSION_HEX < 0x03090000
+// heap types have no reference to their module before Python 3.9, so the state
+// of the last initialized module is used (there is no per-interpreter GIL there)
+static EncoderState * encoder_last_state = NULL;
+#endif
+
+/*
+ * Returns the state of the _encoder module defining 'type' or one of its base
+ * classes, or NULL (with no exception set) if 'type' is not an Encoder subclass.
+ */
+static EncoderState * encoder_type_state (PyTypeObject * type)
+{
+#if PY_VERSION_HEX >= 0x030B0000
+    PyObject * module = PyType_GetModuleByDef(type, &encodermodule);
+
+    if (module == NULL)
+    {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    return (EncoderState*)PyModule_GetState(module);
+#elif PY_VERSION_HEX >= 0x03090000
+    PyObject * mro = type->tp_mro;
+
+    for (Py_ssize_t i = 0; mro != NULL && i < PyTuple_GET_SIZE(mro); i++)
+    {
+        PyTypeObject * base = (PyTypeObject*)PyTuple_GET_ITEM(mro, i);
+
+        if (!PyType_HasFeature(base, Py_TPFLAGS_HEAPTYPE)) continue;
+
+        PyObject * module = ((PyHeapTypeObject*)base)->ht_module;
+
+        if (module != NULL && PyModule_GetDef(module) == &encodermodule)
+            return (EncoderState*)PyModule_GetState(module);
+    }
+
+    return NULL;
+#else
+    if (encoder_last_state == NULL || !PyType_IsSubtype(type, encoder_last_state->PyEncoder_Type))
+        return NULL;
+
+    return encoder_last_state;
+#endif
+}
+
+// names of the modules of the classes natively supported by the encoder
+static const char * encoder_module_names[ENCODER_MODULES] = {
+    "uuid",
+    "decimal",
+    "collections",
+#if PY_VERSION_HEX >= 0x03040000
+    "_collections_abc",     // defines the collections.abc classes (imported at startup)
+#else
+    "collections.abc",
+#endif
+    "datetime"
+};
+
+/* returns a new reference to the module if it is imported, or NULL (with no exception set) */
+static PyObject * encoder_imported_module (EncoderState * state, EncoderModule module_id)
+{
+    PyObject * modules = PyImport_GetModuleDict();
+    PyObject * module;
+
+#if PY_VERSION_HEX >= 0x030D0000
+    if (PyDict_GetItemRef(modules, state->module_names[module_id], &module) < 0)
+        PyErr_Clear();
+#else
+    module = PyDict_GetItem(modules, state->module_names[module_id]);
+    Py_XINCREF(module);
+#endif
+
+    return module;
+}
+
+/*
+ * Sets '*type' to (a new reference to) the class 'name' of the module if it is
+ * not set yet and the module is imported.  Modules are never imported here: no
+ * instances of a class can exist before its module is imported.
+ */
+static void encoder_load_type (EncoderState * state, PyTypeObject ** type,
+                               EncoderModule module_id, const char * name)
+{
+    if (*type != NULL) return;
+
+    PyObject * module = encoder_imported_module(state, module_id);
+
+    if (module == NULL) return;
+
+    // fails while the module is still being imported
+    PyObject * attr = PyObject_GetAttrString(module, name);
+
+    Py_DECREF(module);
+
+    if (attr != NULL && PyType_Check(attr))
+        *type = (PyTypeObject*)attr;
+    else
+    {
+        PyErr_Clear();
+        Py_XDECREF(attr);
+    }
+}
+
+/*
+ * Resolves the classes natively supported by the encoder whose modules were imported
+ * since the last call, so importing the _encoder module does not import decimal, uuid,
+ * collections and datetime.  Only called before the isinstance() checks: until their
+ * classes are resolved objects take that generic path, where they are then recognized.
+ */
+static void encoder_state_load_types (EncoderState * state)
+{
+    if (state->types_loaded) return;
+
+#ifdef Py_GIL_DISABLED
+    PyMutex_Lock(&state->types_mutex);
+#endif
+
+    encoder_load_type(state, &state->PyType_UUID,            MODULE_UUID, "UUID");
+    encoder_load_type(state, &state->PyType_Decimal,         MODULE_DECIMAL, "Decimal");
+    encoder_load_type(state, &state->PyType_Col_OrderedDict, MODULE_COLLECTIONS, "OrderedDict");
+    encoder_load_type(state, &state->PyType_Col_Set,         MODULE_COLLECTIONS_ABC, "Set");
+    encoder_load_type(state, &state->PyType_Col_Sequence,    MODULE_COLLECTIONS_ABC, "Sequence");
+    encoder_load_type(state, &state->PyType_Col_Mapping,     MODULE_COLLECTIONS_ABC, "Mapping");
+
+    // the datetime C API is a table of process-wide static types
+    if (PyDateTimeAPI == NULL)
+    {
+        PyObject * datetime = encoder_imported_module(state, MODULE_DATETIME);
+
+        if (datetime != NULL)
+        {
+            Py_DECREF(datetime);
+
+            PyDateTime_IMPORT;
+            if (PyDateTimeAPI == NULL) PyErr_Clear();
+        }
+    }
+
+    state->types_loaded = state->PyType_UUID != NULL && state->PyType_Decimal != NULL &&
+                          state->PyType_Col_OrderedDict != NULL && state->PyType_Col_Set != NULL &&
+                          state->PyType_Col_Sequence != NULL && state->PyType_Col_Mapping != NULL &&
+                          PyDateTimeAPI != NULL;
+
+#ifdef Py_GIL_DISABLED
+    PyMutex_Unlock(&state->types_mutex);
+#endif
+}
+
+/*
+ * Initializes the module state and adds the Encoder class and the _C_API capsule
+ * to the module.  Called for every (sub)interpreter importing the module.
+ */
+static int encoder_module_exec (PyObject *module)
+{
+    EncoderState * state = (EncoderState*)PyModule_GetState(module);
+
+    for (int i = 0; i < ENCODER_MODULES; i++)
+        if ((state->module_names[i] = PyUnicode_InternFromString(encoder_module_names[i])) == NULL)
+            return -1;
+
+    // create the Encoder class
+#if PY_VERSION_HEX >= 0x03090000
+    state->PyEncoder_Type = (PyTypeObject*)PyType_FromModuleAndSpec(module, &PyEncoder_Type_spec, NULL);
+#else
+    state->PyEncoder_Type = (PyTypeObject*)PyType_FromSpec(&PyEncoder_Type_spec);
+#endif
+    if (state->PyEncoder_Type == NULL) return -1;
+
+#if PY_VERSION_HEX < 0x03090000
+    encoder_last_state = state;
+#endif
+
+    // add Encoder class to the _encoder module
+    Py_INCREF(state->PyEncoder_Type);
+    if (PyModule_AddObject(module, "Encoder", (PyObject *)state->PyEncoder_Type) < 0)
+    {
+        Py_DECREF(state->PyEncoder_Type);
+        return -1;
+    }
+
+    // create the RawJSON class and add it to the _encoder module
+#if PY_VERSION_HEX >= 0x03090000
+    state->PyRawJSON_Type = (PyTypeObject*)PyType_FromModuleAndSpec(module, &PyRawJSON_Type_spec, NULL);
+#else
+    state->PyRawJSON_Type = (PyTypeObject*)PyType_FromSpec(&PyRawJSON_Type_spec);
+#endif
+    if (state->PyRawJSON_Type == NULL) return -1;
+
+    Py_INCREF(state->PyRawJSON_Type);
+    if (PyModule_AddObject(module, "RawJSON", (PyObject *)state->PyRawJSON_Type) < 0)
+    {
+        Py_DECREF(state->PyRawJSON_Type);
+        return -1;
+    }
+
+    // export the C API, see metamagic_json.h
+    state->capi_default_encoder = PyObject_CallObject((PyObject *)state->PyEncoder_Type, NULL);
+    if (state->capi_default_encoder == NULL) return -1;
+
+    state->capi.version          = METAMAGIC_JSON_API_VERSION;
+    state->capi.EncoderType      = state->PyEncoder_Type;
+    state->capi.encode           = encoder_capi_encode;
+    state->capi.encode_to_writer = encoder_capi_encode_to_writer;
+
+    PyObject * capi = PyCapsule_New(&state->capi, METAMAGIC_JSON_CAPSULE_NAME, NULL);
+    if (capi == NULL || PyModule_AddObject(module, "_C_API", capi) < 0)
+    {
+        Py_XDECREF(capi);
+        return -1;
+    }
+
+    return 0;
+}
+
+static int encoder_module_traverse (PyObject *module, visitproc visit, void *arg)
+{
+    EncoderState * state = (EncoderState*)PyModule_GetState(module);
+
+    if (state == NULL) return 0;
+
+    Py_VISIT(state->PyEncoder_Type);
+    Py_VISIT(state->PyRawJSON_Type);
+    Py_VISIT(state->PyType_UUID);
+    Py_VISIT(state->PyType_Decimal);
+    Py_VISIT(state->PyType_Col_OrderedDict);
+    Py_VISIT(state->PyType_Col_Set);
+    Py_VISIT(state->PyType_Col_Sequence);
+    Py_VISIT(state->PyType_Col_Mapping);
+    Py_VISIT(state->capi_default_encoder);
+
+    for (int i = 0; i < ENCODER_MODULES; i++)
+        Py_VISIT(state->module_names[i]);
+
+    return 0;
+}
+
+static int encoder_module_clear (PyObject *module)
+{
+    EncoderState * state = (EncoderState*)PyModule_GetState(module);
+
+    if (state == NULL) return 0;
+
+    Py_CLEAR(state->PyEncoder_Type);
+    Py_CLEAR(state->PyRawJSON_Type);
+    Py_CLEAR(state->PyType_UUID);
+    Py_CLEAR(state->PyType_Decimal);
+    Py_CLEAR(state->PyType_Col_OrderedDict);
+    Py_CLEAR(state->PyType_Col_Set);
+    Py_CLEAR(state->PyType_Col_Sequence);
+    Py_CLEAR(state->PyType_Col_Mapping);
+    Py_CLEAR(state->capi_default_encoder);
+
+    for (int i = 0; i < ENCODER_MODULES; i++)
+        Py_CLEAR(state->module_names[i]);
+
+    return 0;
+}
+
+static void encoder_module_free (void *module)
+{
+#if PY_VERSION_HEX < 0x03090000
+    if (encoder_last_state == PyModule_GetState((PyObject*)module))
+        encoder_last_state = NULL;
+#endif
+
+    encoder_module_clear((PyObject*)module);
+}
+
+/*===========================================================================
+ * implemention: Encoder class
+ *===========================================================================*/
+
+static PyObject * _encoder_new (PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    EncoderState * state = encoder_type_state(type);
+
+    if (state == NULL)
+    {
+        PyErr_Format(PyExc_TypeError, "%s is not a metamagic.json._encoder.Encoder subclass",
+                     type->tp_name);
+        return NULL;
+    }
+
+    PyEncoderObject * self = (PyEncoderObject*)type->tp_alloc(type, 0);
+
+    if (self != NULL) self->state = state;
+
+    return (PyObject*)self;
+}
+
+static void _encoder_dealloc (PyObject *self)
+{
+    PyTypeObject * type = Py_TYPE(self);
+
+    type->tp_free(self);
+
+    // instances of heap types own a reference to their type; before Python 3.8
+    // subtype_dealloc() releases it for the instances of Python subclasses
+#if PY_VERSION_HEX < 0x03080000
+    if (type->tp_dealloc == _encoder_dealloc)
+#endif
+        Py_DECREF(type);
+}
+
+/*
+ * __init__ method: needed to suport the encode_hook functionality: at construction time
+ * check if the class has encode_hook() method and if it does flip the use_hook flag.
+ *
+ * The idea is to avoid checking the existence of the method at every dumps/dumpb call.
+ *
+ */
+static int _encoder_init (PyEncoderObject *self, PyObject *args, PyObject *kwds)
+{
+    if (PyObject_HasAttrString((PyObject*)self, "encode_hook"))
+        self->use_hook = true;
+    else
+        self->use_hook = false;
+
+    return 0;
+}
+
+/*===========================================================================
+ * implemention: internal methods
+ *===========================================================================*/
+
+static void       encode_from    (PyObject * obj,  bool hooked, EncodedData * encodedData);
+static void       encode_value   (PyObject * obj,  bool hooked, EncodedData * encodedData);
+static PyObject * apply_encode_hook (PyObject * obj, EncodedData * encodedData);
+static PyObject * encode_next_item (EncodedData * encodedData);
+static PyObject * _encode        (PyObject * obj,  EncodedData * encodedData);
+static PyObject * call_default   (PyObject * obj,  EncodedData * encodedData);
+static void encode_key     (PyObject * obj,  EncodedData * encodedData);
+static PyObject * resolve_key  (PyObject * obj,  EncodedData * encodedData);
+static void encoder_not_serializable (PyObject * obj, EncodedData * encodedData);
+static void encode_integer (PyObject * obj,  EncodedData * encodedData);
+static void encode_float   (PyObject * obj,  EncodedData * encodedData);
+static void encode_double  (double double_val, EncodedData * encodedData);
+static void encode_longlong  (long long n, EncodedData * encodedData);
+static void encode_ulonglong (unsigned long long n, EncodedData * encodedData);
+static void encode_decimal (PyObject * obj,  EncodedData * encodedData);
+static void encode_string  (PyObject * obj,  EncodedData * encodedData);
+static void encode_uuid    (PyObject * obj,  EncodedData * encodedData);
+static void encode_datetime(PyObject * obj,  EncodedData * encodedData);
+static void encode_date    (PyObject * obj,  EncodedData * encodedData);
+static void encode_time    (PyObject * obj,  EncodedData * encodedData);
+static void encode_list    (PyObject * obj,  EncodedData * encodedData);
+static void encode_tuple   (PyObject * obj,  EncodedData * encodedData);
+static void encode_set     (PyObject * obj,  EncodedData * encodedData);
+static void encode_iterable(PyObject * obj,  EncodedData * encodedData);
+static void encode_sorted_dict (PyObject * obj, EncodedData * encodedData);
+static void encode_sorted_set  (PyObject * obj, EncodedData * encodedData);
+static void encode_dict    (PyObject * obj,  EncodedData * encodedData);
+static void encode_mapping (PyObject * obj,  EncodedData * encodedData);
+static void encode_json    (PyObject * pystr, EncodedData * encodedData);
+static void encode_jsonb   (PyObject * pybytes, EncodedData * encodedData);
+static void encode_true    (EncodedData * encodedData);
+static void encode_false   (EncodedData * encodedData);
+static void encode_none    (EncodedData * encodedData);
+
+
+/*
+ * JSON-encodes a python object into the given EncodedData buffer.
+ *
+ * The order in which various encoders are applied to the given 'obj' is as follows:
+ *
+ *  1) iff encoder class has encode_hook() method (not present by default) it
+ *     is called first and the rest of the processing is applied to the output of encode_hook(obj).
+ *
+ *  2) next, the exact check for some known types (strings, int/float, true/false/none,
+ *     list/tuple/dict/set, OrderedDict, UUID and Decimal) is performed and if type matches
+ *     the corresponding encoder is used and the result stored in EncodedData buffer.
+ *
+ *  3) next, the object's __mm_json__() method is tried and if exists and does not raise
+ *     NotImplementedError, its return value is used.
+ *
+ *  4) next, the object's __mm_serialize__() method is tried and this function is applied
+ *     to the output of __mm_serialize__.
+ *
+ *  5) If none of the baove worked, the more generic isinstance() check is performed
+ *     against the same known object types.
+ *
+ *  6) If there were no match self.default() method is applied to the object and in case
+ *     there were no exceptions this function is applied to the result.
+ *
+ * Containers are not encoded recursively: encoding a container only writes its opening
+ * bracket and pushes a frame to the EncodedData frame stack.  The loop below then takes
+ * the items of the innermost container one by one, so the nesting depth is limited
+ * by max_depth (and memory) only, and never by the C stack.
+ */
+static void encode (PyObject *obj, EncodedData * encodedData)
+{
+    encode_from(obj, false, encodedData);
+}
+
+/*
+ * encode() of an object which is already the output of encode_hook(): the hook
+ * is not applied to it again (but is to its items and replacements).
+ */
+static void encode_hooked (PyObject *obj, EncodedData * encodedData)
+{
+    encode_from(obj, true, encodedData);
+}
+
+static void encode_from (PyObject *obj, bool hooked, EncodedData * encodedData)
+{
+    // if we already found an error stop and do not encode anything else
+    if (encoder_data_has_error(encodedData)) return;
+
+    int base_depth = encodedData->depth;
+
+    Py_INCREF(obj);
+
+    while (true)
+    {
+        encode_value(obj, hooked, encodedData);
+        hooked = false;
+
+        Py_DECREF(obj);
+
+        if (encoder_data_has_error(encodedData)) break;
+
+        // take the next item of the innermost container; containers with
+        // no items left are closed and popped from the stack
+        obj = NULL;
+        while (encodedData->depth > base_depth)
+        {
+            obj = encode_next_item(encodedData);
+
+            if (obj != NULL || encoder_data_has_error(encodedData)) break;
+        }
+
+        if (obj == NULL) break;
+    }
+
+    // release the containers left on the stack after an error
+    while (encodedData->depth > base_depth)
+        encoder_data_pop_frame(encodedData);
+}
+
+/*
+ * Encodes a single value: applies encode_hook() (if present, and unless 'hooked')
+ * and _encode(), and repeats for the objects _encode() returns to be encoded
+ * instead (the output of __mm_serialize__ or default()).  Containers are only
+ * opened, see encode().
+ */
+static void encode_value (PyObject *obj, bool hooked, EncodedData * encodedData)
+{
+    PyObject * replacement = NULL;  // owned reference to 'obj', if any
+    int        replacements = 0;
+
+    do
+    {
+        // __mm_serialize__() returning the object itself (or a cycle of
+        // replacements) is caught as a circular reference
+        if (replacements++ > encodedData->max_depth)
+        {
+            Py_DECREF(replacement);
+            encoder_data_depth_error(encodedData);
+            return;
+        }
+
+        // first try the special hook --------------------------------------
+
+        if (encodedData->use_hook && !hooked)
+        {
+            PyObject* obj_encoded = apply_encode_hook(obj, encodedData);
+
+            Py_XDECREF(replacement);
+
+            if (obj_encoded == NULL) return;
+
+            obj = replacement = obj_encoded;
+        }
+
+        PyObject * obj_encoded = _encode(obj, encodedData);
+
+        Py_XDECREF(replacement);
+
+        obj = replacement = obj_encoded;
+        hooked = false;
+    }
+    while (obj != NULL);
+}
+
+/*
+ * Returns a new reference to the output of the encode_hook() method of the encoder
+ * for 'obj', or to 'obj' itself if there is no such method; NULL (with the error
+ * set) on errors.
+ */
+static PyObject * apply_encode_hook (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject* _encode_hook_ = PyObject_GetAttrString(encodedData->self, "encode_hook");
+
+    if (_encode_hook_ == NULL)
+    {
+        PyErr_Clear();
+        Py_INCREF(obj);
+        return obj;
+    }
+
+    PyObject* obj_encoded = PyObject_CallFunctionObjArgs(_encode_hook_, obj, NULL);
+
+    Py_DECREF(_encode_hook_);
+
+    if (obj_encoded == NULL)
+        encoder_data_set_error(encodedData);
+
+    return obj_encoded;
+}
+
+/*
+ * Encodes 'obj' as the next item of the list or tuple 'frame' if it is a string, an
+ * integer, a float, True, False or None (exact types only); returns false otherwise.
+ */
+static inline bool encode_scalar_item (PyObject * obj, EncoderFrame * frame, EncodedData * encodedData)
+{
+    if (!(PyUnicode_CheckExact(obj) || PyLong_CheckExact(obj) || PyFloat_CheckExact(obj) ||
+          obj == Py_True || obj == Py_False || obj == Py_None))
+        return false;
+
+    if (frame->count++ > 0 && encodedData->emitter == NULL)
+        encoder_data_append_char(encodedData, ',');
+
+    if      (PyUnicode_CheckExact(obj)) encode_string (obj, encodedData);
+    else if (PyLong_CheckExact   (obj)) encode_integer(obj, encodedData);
+    else if (PyFloat_CheckExact  (obj)) encode_float  (obj, encodedData);
+    else if (obj == Py_True)            encode_true   (encodedData);
+    else if (obj == Py_False)           encode_false  (encodedData);
+    else                                encode_none   (encodedData);
+
+    return true;
+}
+
+/*
+ * Takes the next item of the innermost container being encoded: writes the item
+ * separator (and the key, for dicts and mappings) and returns a new reference to
+ * the item.
+ *
+ * If the container has no more items writes the closing bracket, pops the frame and
+ * returns NULL.  Also returns NULL, with the error set, on errors.
+ */
+static PyObject * encode_next_item (EncodedData * encodedData)
+{
+    EncoderFrame * frame = &encodedData->frames[encodedData->depth - 1];
+
+    PyObject * key   = NULL;
+    PyObject * value = NULL;
+
+    switch (frame->type)
+    {
+        case FRAME_LIST:
+            // lists (and dicts) may be changed by other threads in free-threaded builds
+            Py_BEGIN_CRITICAL_SECTION(frame->container);
+            while (frame->pos < PyList_GET_SIZE(frame->container))
+            {
+                // the output may be flushed to a Python write() while the
+                // item is encoded, which may change the list
+                value = PyList_GET_ITEM(frame->container, frame->pos++);
+                Py_INCREF(value);
+
+                if (encodedData->use_hook || !encode_scalar_item(value, frame, encodedData))
+                    break;
+
+                Py_CLEAR(value);
+                if (encoder_data_has_error(encodedData)) break;
+            }
+            Py_END_CRITICAL_SECTION();
+
+            if (encoder_data_has_error(encodedData)) return NULL;
+            break;
+
+        case FRAME_TUPLE:
+            while (frame->pos < PyTuple_GET_SIZE(frame->container))
+            {
+                value = PyTuple_GET_ITEM(frame->container, frame->pos++);
+
+                if (encodedData->use_hook || !encode_scalar_item(value, frame, encodedData))
+                {
+                    Py_INCREF(value);
+                    break;
+                }
+
+                value = NULL;
+                if (encoder_data_has_error(encodedData)) return NULL;
+            }
+            break;
+
+        case FRAME_DICT:
+            Py_BEGIN_CRITICAL_SECTION(frame->container);
+            if (PyDict_Next(frame->container, &frame->pos, &key, &value))
+            {
+                Py_INCREF(key);
+                Py_INCREF(value);
+            }
+            Py_END_CRITICAL_SECTION();
+            break;
+
+        case FRAME_ITERABLE:
+            value = PyIter_Next(frame->iterator);
+
+            if (value == NULL && PyErr_Occurred())
+            {
+                encoder_not_serializable(frame->container, encodedData);
+                return NULL;
+            }
+            break;
+
+        case FRAME_MAPPING:
+            key = PyIter_Next(frame->iterator);
+
+            if (key != NULL)
+            {
+                value = PyObject_GetItem(frame->container, key);
+
+                if (value == NULL)
+                {
+                    Py_DECREF(key);
+                    encoder_data_set_error(encodedData);
+                    return NULL;
+                }
+            }
+            else if (PyErr_Occurred())
+            {
+                encoder_data_set_error(encodedData);
+                return NULL;
+            }
+            break;
+
+        case FRAME_SORTED_DICT:
+            if (frame->pos < PyList_GET_SIZE(frame->container))
+            {
+                // (sort key, index, encoded key, value), see encode_sorted_dict()
+                PyObject * item = PyList_GET_ITEM(frame->container, frame->pos++);
+
+                key   = PyTuple_GET_ITEM(item, 2);
+                value = PyTuple_GET_ITEM(item, 3);
+
+                Py_INCREF(value);
+            }
+            break;
+
+        case FRAME_SORTED_SET:
+            // the items are already encoded, see encode_sorted_set()
+            while (frame->pos < PyList_GET_SIZE(frame->container))
+            {
+                PyObject * item = PyList_GET_ITEM(frame->container, frame->pos++);
+
+                if (frame->count++ > 0 && encodedData->emitter == NULL)
+                    encoder_data_append_char(encodedData, ',');
+
+                encoder_data_append(encodedData, PyBytes_AS_STRING(item), PyBytes_GET_SIZE(item));
+
+                if (encoder_data_has_error(encodedData)) return NULL;
+            }
+            break;
+    }
+
+    if (value == NULL)
+    {
+        if (encodedData->emitter != NULL)
+        {
+            // binary formats: the number of items was written out in advance
+            if (frame->count != frame->size)
+            {
+                PyErr_Format(PyExc_RuntimeError, "%R changed size during encoding",
+                             frame->container);
+                encoder_data_set_error(encodedData);
+                return NULL;
+            }
+        }
+        else if (frame->type == FRAME_DICT || frame->type == FRAME_MAPPING ||
+                 frame->type == FRAME_SORTED_DICT)
+            encoder_data_append_char(encodedData, '}');
+        else
+            encoder_data_append_char(encodedData, ']');
+
+        encoder_data_pop_frame(encodedData);
+        return NULL;
+    }
+
+    if (frame->count++ > 0 && encodedData->emitter == NULL)
+        encoder_data_append_char(encodedData, ',');
+
+    if (frame->type == FRAME_SORTED_DICT)
+    {
+        encoder_data_append(encodedData, PyBytes_AS_STRING(key), PyBytes_GET_SIZE(key));
+
+        if (encodedData->emitter == NULL)
+            encoder_data_append_char(encodedData, ':');
+    }
+    else if (key != NULL)
+    {
+        encode_key(key, encodedData);
+
+        Py_DECREF(key);
+
+        if (encoder_data_has_error(encodedData))
+        {
+            Py_DECREF(value);
+            return NULL;
+        }
+
+        if (encodedData->emitter == NULL)
+            encoder_data_append_char(encodedData, ':');
+    }
+
+    return value;
+}
+
+/*
+ * Internal encoder - does all of the processing except encode_hook().
+ *
+ * Returns a new reference to an object which should be encoded instead of 'obj'
+ * (the output of __mm_serialize__ or default()), or NULL if 'obj' was encoded or
+ * an error was found.
+ */
+static PyObject * _encode (PyObject * obj, EncodedData * encodedData)
+{
+    EncoderState * state = encoder_state(encodedData);
+
+    // First try strict checks ---------------------------------------------
+
+    if (PyUnicode_CheckExact(obj)) { encode_string (obj, encodedData); return NULL; }
+    if (PyLong_CheckExact   (obj)) { encode_integer(obj, encodedData); return NULL; }
+    if (PyFloat_CheckExact  (obj)) { encode_float  (obj, encodedData); return NULL; }
+
+    if (obj == Py_True)  { encode_true (encodedData); return NULL; }
+    if (obj == Py_False) { encode_false(encodedData); return NULL; }
+    if (obj == Py_None)  { encode_none (encodedData); return NULL; }
+
+    if (PyList_CheckExact(obj))   { encode_list (obj, encodedData); return NULL; }
+    if (PyTuple_CheckExact(obj))  { encode_tuple(obj, encodedData); return NULL; }
+    if (PyDict_CheckExact(obj))   { encode_dict (obj, encodedData); return NULL; }
+    if (PyAnySet_CheckExact(obj)) { encode_set  (obj, encodedData); return NULL; }
+
+    if (obj->ob_type == state->PyType_UUID)            { encode_uuid    (obj, encodedData); return NULL; }
+    if (obj->ob_type == state->PyType_Decimal)         { encode_decimal (obj, encodedData); return NULL; }
+    if (obj->ob_type == state->PyType_Col_OrderedDict) { encode_mapping (obj, encodedData); return NULL; }
+
+    if (obj->ob_type == state->PyRawJSON_Type && encodedData->emitter == NULL)
+        { encode_jsonb(((PyRawJSONObject*)obj)->data, encodedData); return NULL; }
+
+    // set once the first date is seen, see encoder_state_load_types()
+    if (PyDateTimeAPI != NULL)
+    {
+        if (PyDateTime_CheckExact(obj)) { encode_datetime(obj, encodedData); return NULL; }
+        if (PyDate_CheckExact(obj))     { encode_date    (obj, encodedData); return NULL; }
+        if (PyTime_CheckExact(obj))     { encode_time    (obj, encodedData); return NULL; }
+    }
+
+    // try __mm_json__ method (JSON output only) ----------------------------
+
+    PyObject* _sx_json_ = encodedData->emitter == NULL ?
+                            PyObject_GetAttrString(obj, "__mm_json__") : NULL;
+
+    if (_sx_json_ != NULL)
+    {
+        PyObject* obj_encoded = PyObject_CallObject(_sx_json_, NULL);
+        int implemented = 1;
+
+        if (obj_encoded == NULL)
+        {
+            if (PyErr_ExceptionMatches(PyExc_NotImplementedError))
+            {
+                PyErr_Clear();
+                implemented = 0;
+            }
+            else
+                encoder_data_set_error(encodedData);
+        }
+        else if (!PyBytes_CheckExact(obj_encoded) && !PyUnicode_Check(obj_encoded) &&
+                 obj_encoded->ob_type != state->PyRawJSON_Type)
+        {
+            // any other object (e.g. a RawJSON of the Python encoder) is encoded in turn
+            Py_DECREF(_sx_json_);
+            return obj_encoded;
+        }
+        else
+        {
+            if (PyBytes_CheckExact(obj_encoded))
+                encode_jsonb(obj_encoded, encodedData);
+            else if (obj_encoded->ob_type == state->PyRawJSON_Type)
+                encode_jsonb(((PyRawJSONObject*)obj_encoded)->data, encodedData);
+            else
+                encode_json(obj_encoded, encodedData);
+            Py_DECREF(obj_encoded);
+        }
+
+        Py_DECREF(_sx_json_);
+
+        if (implemented)
+            return NULL;
+    }
+    else
+        PyErr_Clear();
+
+    // try __mm_serialize__ method -----------------------------------------
+
+    PyObject* _sx_serialize_ = PyObject_GetAttrString(obj, "__mm_serialize__");
+
+    if (_sx_serialize_ != NULL)
+    {
+        PyObject* obj_encoded = PyObject_CallObject(_sx_serialize_, NULL);
+
+        Py_DECREF(_sx_serialize_);
+
+        if (obj_encoded != NULL)
+            return obj_encoded;
+
+        if (!PyErr_ExceptionMatches(PyExc_NotImplementedError))
+        {
+            encoder_data_set_error(encodedData);
+            return NULL;
+        }
+
+        PyErr_Clear();
+    }
+    else
+        PyErr_Clear();
+
+    // try isinstance() checks ---------------------------------------------
+
+    encoder_state_load_types(state);
+
+    // need to check ordereddict-derived classes before dict-derived classes
+    if (encoder_type_check(obj, state->PyType_Col_OrderedDict)) { encode_mapping (obj, encodedData); return NULL; }
+
+    if (PyDict_Check(obj))   { encode_mapping (obj, encodedData); return NULL; }
+    if (PyList_Check(obj))   { encode_list    (obj, encodedData); return NULL; }
+    if (PyTuple_Check(obj))  { encode_tuple   (obj, encodedData); return NULL; }
+    if (PyAnySet_Check(obj)) { encode_set     (obj, encodedData); return NULL; }
+
+    if (PyUnicode_Check(obj)) { encode_string (obj, encodedData); return NULL; }
+    if (PyLong_Check   (obj)) { encode_integer(obj, encodedData); return NULL; }
+    if (PyFloat_Check  (obj)) { encode_float  (obj, encodedData); return NULL; }
+
+    if (encoder_type_check(obj, state->PyType_UUID))    { encode_uuid   (obj, encodedData); return NULL; }
+    if (encoder_type_check(obj, state->PyType_Decimal)) { encode_decimal(obj, encodedData); return NULL; }
+
+    if (PyDateTimeAPI != NULL)
+    {
+        if (PyDateTime_Check(obj)) { encode_datetime(obj, encodedData); return NULL; }
+        if (PyDate_Check(obj))     { encode_date    (obj, encodedData); return NULL; }
+        if (PyTime_Check(obj))     { encode_time    (obj, encodedData); return NULL; }
+    }
+
+    if (PyBytes_Check(obj) || PyByteArray_Check(obj)) return call_default(obj, encodedData);
+
+    if (encoder_is_instance(obj, state->PyType_Col_Mapping))
+        { encode_mapping (obj, encodedData); return NULL; }
+    if (encoder_is_instance(obj, state->PyType_Col_Set))
+        { encode_set (obj, encodedData); return NULL; }
+    if (encoder_is_instance(obj, state->PyType_Col_Sequence))
+        { encode_iterable (obj, encodedData); return NULL; }
+
+    // try self.default() method -------------------------------------------
+
+    return call_default(obj, encodedData);
+}
+
+/*
+ * JSON-encodes a dictionary key object into the given EncodedData buffer.
+ *
+ * By JSON specification only strings can be keys, thus only strings are encoded and
+ * a TypeError is raised for all other object types; an exception is made for UUID
+ * objects since they are also encoded to strings and UUIDs are a common dictionary
+ * key in the metamagic framework.
+ *
+ * The order in which different checks/encoders are applied is the same as in the
+ * encode() method; __mm_serialize__() is also supported and is supposed to return
+ * an object encodable to a string. If everything else fails the default() method
+ * is called and its output is encoded as a key.
+ */
+static void encode_key (PyObject *obj, EncodedData * encodedData)
+{
+    // if we already found an error stop and do not encode anything else
+    if (encoder_data_has_error(encodedData)) return;
+
+    EncoderState * state = encoder_state(encodedData);
+
+    // first try strict checks ---------------------------------------------
+
+    if (PyUnicode_CheckExact(obj))   return encode_string (obj, encodedData);
+    if (obj->ob_type == state->PyType_UUID) return encode_uuid   (obj, encodedData);
+
+    PyObject * key = resolve_key(obj, encodedData);
+
+    if (key == NULL) return encoder_data_set_error(encodedData);
+
+    if (PyUnicode_CheckExact(key))
+        encode_string(key, encodedData);
+    else
+        encode_uuid(key, encodedData);
+
+    Py_DECREF(key);
+}
+
+/*
+ * Returns a new reference to the str or UUID object the dictionary key 'obj' is
+ * encoded as, see encode_key(), or NULL with the error set.  Subclasses of str
+ * are returned as a str.
+ */
+static PyObject * resolve_key (PyObject * obj, EncodedData * encodedData)
+{
+    EncoderState * state = encoder_state(encodedData);
+
+    if (PyUnicode_CheckExact(obj) || obj->ob_type == state->PyType_UUID)
+    {
+        Py_INCREF(obj);
+        return obj;
+    }
+
+    // try __mm_serialize__ method -----------------------------------------
+
+    PyObject* _sx_serialize_ = PyObject_GetAttrString(obj, "__mm_serialize__");
+
+    if (_sx_serialize_ != NULL)
+    {
+        PyObject* obj_encoded = PyObject_CallObject(_sx_serialize_, NULL);
+
+        Py_DECREF(_sx_serialize_);
+
+        if (obj_encoded != NULL)
+        {
+            PyObject * key = resolve_key(obj_encoded, encodedData);
+            Py_DECREF(obj_encoded);
+            return key;
+        }
+
+        if (!PyErr_ExceptionMatches(PyExc_NotImplementedError))
+            return NULL;
+    }
+
+    PyErr_Clear();
+
+    // try isinstance() checks ---------------------------------------------
+
+    encoder_state_load_types(state);
+
+    if (PyUnicode_Check(obj)) return PyUnicode_FromObject(obj);
+
+    if (encoder_type_check(obj, state->PyType_UUID))
+    {
+        Py_INCREF(obj);
+        return obj;
+    }
+
+    // try self.default() method -------------------------------------------
+
+    PyObject * obj_encoded = call_default(obj, encodedData);
+    PyObject * key         = NULL;
+
+    if (obj_encoded != NULL)
+    {
+        key = resolve_key(obj_encoded, encodedData);
+        Py_DECREF(obj_encoded);
+    }
+
+    // re-raise TypeError exceptions to a specifically type-error-for-dict-key;
+    // leave all other exceptions as is
+    if (key == NULL && PyErr_ExceptionMatches(PyExc_TypeError))
+    {
+        PyErr_Clear();
+        PyErr_Format(PyExc_TypeError, "%R is not a valid dictionary key", obj);
+    }
+
+    return key;
+}
+
+/*
+ * Calls the "default" method of 'self'; returns a new reference to its output,
+ * or NULL with the error set.
+ */
+static PyObject * call_default (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject* obj_encoded    = NULL;
+    PyObject* default_method = PyObject_GetAttrString(encodedData->self, "default");
+
+    if (default_method != NULL)
+    {
+        obj_encoded = PyObject_CallFunctionObjArgs(default_method, obj, NULL);
+
+        Py_DECREF(default_method);
+    }
+
+    if (obj_encoded == NULL)
+        encoder_data_set_error(encodedData);
+
+    return obj_encoded;
+}
+
+/*==  errors  ======================================================*/
+
+static void encoder_simple_value_error (const char * msg, EncodedData * encodedData)
+{
+    PyErr_SetString(PyExc_ValueError, msg);
+
+    encoder_data_set_error(encodedData);
+}
+
+static void encoder_value_error (const char * msg, PyObject * obj, EncodedData * encodedData)
+{
+    PyErr_Clear();
+
+    PyErr_Format(PyExc_ValueError, msg, obj);
+
+    encoder_data_set_error(encodedData);
+}
+
+static void encoder_not_serializable (PyObject * obj, EncodedData * encodedData)
+{
+    PyErr_Clear();
+
+    PyErr_Format(PyExc_TypeError, "%R is not JSON serializable", obj);
+
+    encoder_data_set_error(encodedData);
+}
+
+
+/*==  type-specific encoders  =====================================*/
+
+
+static void encode_integer (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_integer(obj, encodedData);
+
+    // ids and counters are mostly compact ints, always in the JavaScript range
+    if (ENCODER_LONG_IS_COMPACT(obj))
+        return longlong_to_string(ENCODER_LONG_COMPACT_VALUE(obj), encodedData);
+
+    int overflow;
+    long long int_val = PyLong_AsLongLongAndOverflow(obj, &overflow);
+
+    if (overflow || (int_val == -1 && PyErr_Occurred()))
+        return encoder_value_error("Number out of range: %R", obj, encodedData);
+
+    if (int_val > JAVASCRIPT_MAXINT ||
+        int_val < -JAVASCRIPT_MAXINT )
+        return encoder_value_error("Number out of range: %R", obj, encodedData);
+
+    longlong_to_string(int_val, encodedData);
+}
+
+static void encode_float (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_float(obj, encodedData);
+
+    encode_double(PyFloat_AS_DOUBLE(obj), encodedData);
+}
+
+static void encode_double (double double_val, EncodedData * encodedData)
+{
+    if (Py_IS_INFINITY(double_val) || Py_IS_NAN(double_val))
+    {
+        if (double_val > 0 || double_val < 0)
+            return encoder_simple_value_error("Infinity is not supported", encodedData);
+        else
+            return encoder_simple_value_error("NaN is not supported", encodedData);
+    }
+
+    // note: std json uses "return PyObject_Repr(obj)"
+    //       one difference is that it keeps .0 for the whole numbers such as 2.0
+    //       - but it should not matter for JavaScript
+
+    char buffer[32];
+    snprintf(buffer, 32, "%.16g", double_val);
+
+    encoder_data_append_cstr(encodedData, buffer, 32);
+}
+
+/*
+ * Encode C integers, e.g. the numbers of arrays; Python ints are only created
+ * for the error messages.
+ */
+static void encoder_integer_range_error (PyObject * obj, EncodedData * encodedData)
+// steals the reference to 'obj'
+{
+    if (obj == NULL) return encoder_data_set_error(encodedData);
+
+    encoder_value_error("Number out of range: %R", obj, encodedData);
+
+    Py_DECREF(obj);
+}
+
+static void encode_longlong (long long n, EncodedData * encodedData)
+{
+    if (n > JAVASCRIPT_MAXINT || n < -JAVASCRIPT_MAXINT)
+        return encoder_integer_range_error(PyLong_FromLongLong(n), encodedData);
+
+    longlong_to_string(n, encodedData);
+}
+
+static void encode_ulonglong (unsigned long long n, EncodedData * encodedData)
+{
+    if (n > JAVASCRIPT_MAXINT)
+        return encoder_integer_range_error(PyLong_FromUnsignedLongLong(n), encodedData);
+
+    longlong_to_string((long long)n, encodedData);
+}
+
+static void encode_decimal (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * str_repr = PyObject_Str(obj);
+
+    if (str_repr == NULL) return encoder_not_serializable(obj, encodedData);
+
+    encode_string(str_repr, encodedData);
+
+    Py_DECREF(str_repr);
+}
+
+static void encode_uuid (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_uuid(obj, encodedData);
+
+    PyObject * str_repr = PyObject_Str(obj);
+
+    if (str_repr == NULL) return encoder_not_serializable(obj, encodedData);
+
+    encode_string(str_repr, encodedData);
+
+    Py_DECREF(str_repr);
+}
+
+/*
+ * Binary formats: dates and times are encoded as ISO format strings.
+ */
+static void encode_isoformat (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * str_repr = PyObject_CallMethod(obj, "isoformat", NULL);
+
+    if (str_repr == NULL) return encoder_data_set_error(encodedData);
+
+    encode_string(str_repr, encodedData);
+
+    Py_DECREF(str_repr);
+}
+
+#define HASTZINFO(p) (((_PyDateTime_BaseTZInfo *)(p))->hastzinfo)
+#define GET_DT_TZINFO(p) (HASTZINFO(p) ? \
+                          ((PyDateTime_DateTime *)(p))->tzinfo : Py_None)
+#define GET_TD_DAYS(o)          (((PyDateTime_Delta *)(o))->days)
+#define GET_TD_SECONDS(o)       (((PyDateTime_Delta *)(o))->seconds)
+#define GET_TD_MICROSECONDS(o)  (((PyDateTime_Delta *)(o))->microseconds)
+#define GET_TD_TOTAL_SECONDS(o) ((GET_TD_DAYS(o) * 86400) + GET_TD_SECONDS(o))
+
+/*
+ * 'obj' is assumed to be based on datetime.datetime.
+ *
+ * outputs date/time in ISO format "YYYY-MM-DDTHH:MM:SS.mmmmmm+HH:MM" to EncodedData
+ */
+static void encode_datetime (PyObject * obj, EncodedData * encodedData)
+{
+    if (encoder_data_has_error(encodedData)) return;
+
+    if (encodedData->emitter != NULL) return encode_isoformat(obj, encodedData);
+
+    // date in ISO format is at most 32 characters long, plus need two enclosing quotes
+    if (!encoder_data_reserve_space(encodedData, 34)) return;
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+
+    datevalue_to_string(PyDateTime_GET_YEAR(obj), encodedData, 4);
+    encoder_data_append_ch_nocheck(encodedData,'-');
+    datevalue_to_string(PyDateTime_GET_MONTH(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,'-');
+    datevalue_to_string(PyDateTime_GET_DAY(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,'T');
+    datevalue_to_string(PyDateTime_DATE_GET_HOUR(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,':');
+    datevalue_to_string(PyDateTime_DATE_GET_MINUTE(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,':');
+    datevalue_to_string(PyDateTime_DATE_GET_SECOND(obj), encodedData, 2);
+
+    int microseconds = PyDateTime_DATE_GET_MICROSECOND(obj);
+    if (microseconds != 0)
+    {
+        encoder_data_append_ch_nocheck(encodedData,'.');
+        datevalue_to_string(microseconds, encodedData, 6);
+    }
+
+    if (HASTZINFO(obj))
+    {
+        PyObject* timedelta = PyObject_CallMethod(obj, "utcoffset", NULL);
+
+        if (timedelta != NULL)
+        {
+            int tz_total_seconds = GET_TD_TOTAL_SECONDS(timedelta);
+
+            Py_DECREF(timedelta);
+
+            if (tz_total_seconds >= 0) {
+                encoder_data_append_ch_nocheck(encodedData,'+');
+            } else {
+                encoder_data_append_ch_nocheck(encodedData,'-');
+            }
+
+            tz_total_seconds = abs(tz_total_seconds);
+
+            int tz_hour   = tz_total_seconds/3600;
+            int tz_minute = (tz_total_seconds%3600)/60;
+
+            datevalue_to_string(tz_hour, encodedData, 2);
+            encoder_data_append_ch_nocheck(encodedData,':');
+            datevalue_to_string(tz_minute, encodedData, 2);
+        }
+        else
+            PyErr_Clear();
+    }
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+}
+
+
+/*
+ * 'obj' is assumed to be based on datetime.date.
+ *
+ * outputs date in ISO format "YYYY-MM-DD" to EncodedData
+ */
+static void encode_date (PyObject * obj, EncodedData * encodedData)
+{
+    if (encoder_data_has_error(encodedData)) return;
+
+    if (encodedData->emitter != NULL) return encode_isoformat(obj, encodedData);
+
+    // date in ISO format is at most 10 characters long, plus need two enclosing quotes
+    if (!encoder_data_reserve_space(encodedData, 12)) return;
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+
+    datevalue_to_string(PyDateTime_GET_YEAR(obj), encodedData, 4);
+    encoder_data_append_ch_nocheck(encodedData,'-');
+    datevalue_to_string(PyDateTime_GET_MONTH(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,'-');
+    datevalue_to_string(PyDateTime_GET_DAY(obj), encodedData, 2);
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+}
+
+
+/*
+ * 'obj' is assumed to be based on datetime.time.
+ *
+ * outputs date in ISO format "HH:MM:SS.mmmmmm+HH:MM" to EncodedData
+ */
+static void encode_time (PyObject * obj, EncodedData * encodedData)
+{
+    if (encoder_data_has_error(encodedData)) return;
+
+    if (encodedData->emitter != NULL) return encode_isoformat(obj, encodedData);
+
+    // date in ISO format is at most 21 characters long, plus need two enclosing quotes
+    if (!encoder_data_reserve_space(encodedData, 23)) return;
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+
+    datevalue_to_string(PyDateTime_TIME_GET_HOUR(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,':');
+    datevalue_to_string(PyDateTime_TIME_GET_MINUTE(obj), encodedData, 2);
+    encoder_data_append_ch_nocheck(encodedData,':');
+    datevalue_to_string(PyDateTime_TIME_GET_SECOND(obj), encodedData, 2);
+
+    int microseconds = PyDateTime_TIME_GET_MICROSECOND(obj);
+    if (microseconds != 0)
+    {
+        encoder_data_append_ch_nocheck(encodedData,'.');
+        datevalue_to_string(microseconds, encodedData, 6);
+    }
+
+    if (HASTZINFO(obj))
+    {
+        PyObject* timedelta = PyObject_CallMethod(obj, "utcoffset", NULL);
+
+        if (timedelta != NULL)
+        {
+            int tz_total_seconds = GET_TD_TOTAL_SECONDS(timedelta);
+
+            Py_DECREF(timedelta);
+
+            if (tz_total_seconds >= 0) {
+                encoder_data_append_ch_nocheck(encodedData,'+');
+            } else {
+                encoder_data_append_ch_nocheck(encodedData,'-');
+            }
+
+            tz_total_seconds = abs(tz_total_seconds);
+
+            int tz_hour   = tz_total_seconds/3600;
+            int tz_minute = (tz_total_seconds%3600)/60;
+
+            datevalue_to_string(tz_hour, encodedData, 2);
+            encoder_data_append_ch_nocheck(encodedData,':');
+            datevalue_to_string(tz_minute, encodedData, 2);
+        }
+        else
+            PyErr_Clear();
+    }
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+}
+
+
+// a character above U+FFFF is escaped as a surrogate pair "\uXXXX\uXXXX"
+#define CHAR_MAX_EXPANSION (2 * 6)
+
+// all strings are "ready" (PEP 393) since Python 3.12
+#if PY_VERSION_HEX >= 0x030C0000
+#define ENCODER_UNICODE_READY(op) 0
+#else
+#define ENCODER_UNICODE_READY(op) PyUnicode_READY(op)
+#endif
+
+/*
+ * Converts unicode character c to ASCII escape sequence and stores it in EncodedData.
+ *
+ * In the worst case EncodedData.buffer must have at least CHAR_MAX_EXPANSION bytes
+ * unused to store the escaped surrogate pair "\uXXXX\uXXXX"
+ */
+static void encode_special_char (EncodedData * encodedData, Py_UCS4 c)
+{
+    static char hexchars[16] = "0123456789abcdef";
+
+    encoder_data_append_ch_nocheck(encodedData,'\\');
+
+    switch (c) {
+        case '\\': encoder_data_append_ch_nocheck(encodedData, '\\'); break;
+        case '"':  encoder_data_append_ch_nocheck(encodedData, '"');  break;
+        case '\b': encoder_data_append_ch_nocheck(encodedData, 'b');  break;
+        case '\f': encoder_data_append_ch_nocheck(encodedData, 'f');  break;
+        case '\n': encoder_data_append_ch_nocheck(encodedData, 'n');  break;
+        case '\r': encoder_data_append_ch_nocheck(encodedData, 'r');  break;
+        case '\t': encoder_data_append_ch_nocheck(encodedData, 't');  break;
+        default:
+            if (c >= 0x10000) {
+                // UTF-16 surrogate pair
+                Py_UCS4 v = c - 0x10000;
+                c = 0xd800 | ((v >> 10) & 0x3ff);
+                encoder_data_append_ch_nocheck(encodedData, 'u');
+                encoder_data_append_ch_nocheck(encodedData, hexchars[(c >> 12) & 0xf]);
+                encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  8) & 0xf]);
+                encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  4) & 0xf]);
+                encoder_data_append_ch_nocheck(encodedData, hexchars[(c      ) & 0xf]);
+                c = 0xdc00 | (v & 0x3ff);
+                encoder_data_append_ch_nocheck(encodedData, '\\');
+            }
+            encoder_data_append_ch_nocheck(encodedData, 'u');
+            encoder_data_append_ch_nocheck(encodedData, hexchars[(c >> 12) & 0xf]);
+            encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  8) & 0xf]);
+            encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  4) & 0xf]);
+            encoder_data_append_ch_nocheck(encodedData, hexchars[(c      ) & 0xf]);
+    }
+}
+
+/*
+ * Appends a character, escaping it if it is not printable ASCII or is one of the
+ * HTML special chars; with 'quoted' set '"' and '\' are escaped too.
+ */
+static inline void encode_char (EncodedData * encodedData, Py_UCS4 c, bool quoted)
+{
+    if (c >= ' ' && c <= '~' && c != '<' && c != '>' && c != '&'
+                 && (!quoted || (c != '"' && c != '\\')))
+        encoder_data_append_ch_nocheck(encodedData, c);
+    else
+        encode_special_char(encodedData, c);
+}
+
+/*
+ * Appends the characters of a (ready) string, with the loop specialized for
+ * each of the PEP 393 representations.
+ *
+ * EncodedData.buffer must have at least CHAR_MAX_EXPANSION bytes per character unused.
+ */
+static inline void encode_chars (EncodedData * encodedData, PyObject * pystr, bool quoted)
+{
+    Py_ssize_t   size = PyUnicode_GET_LENGTH(pystr);
+    const void * data = PyUnicode_DATA(pystr);
+    Py_ssize_t   i;
+
+    switch (PyUnicode_KIND(pystr))
+    {
+        case PyUnicode_1BYTE_KIND:
+            for (i = 0; i < size; i++)
+                encode_char(encodedData, ((const Py_UCS1 *)data)[i], quoted);
+            break;
+
+        case PyUnicode_2BYTE_KIND:
+            for (i = 0; i < size; i++)
+                encode_char(encodedData, ((const Py_UCS2 *)data)[i], quoted);
+            break;
+
+        default:
+            for (i = 0; i < size; i++)
+                encode_char(encodedData, ((const Py_UCS4 *)data)[i], quoted);
+    }
+}
+
+static void encode_string (PyObject * pystr, EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_string(pystr, encodedData);
+
+    if (ENCODER_UNICODE_READY(pystr) < 0) return encoder_data_set_error(encodedData);
+
+    // reserve as much space as we may possibly need assuming we have to
+    // unicode-expand all the symbols in this python string
+    if (!encoder_data_reserve_space(encodedData, PyUnicode_GET_LENGTH(pystr) * CHAR_MAX_EXPANSION + 2))
+        return;
+
+    encoder_data_append_ch_nocheck(encodedData,'"');
+
+    encode_chars(encodedData, pystr, true);
 
     encoder_data_append_ch_nocheck(encodedData,'"');
+}
+
+static void encode_json (PyObject * pystr, EncodedData * encodedData)
+{
+    if (ENCODER_UNICODE_READY(pystr) < 0) return encoder_data_set_error(encodedData);
+
+    // reserve as much space as we may possibly need assuming we have to
+    // unicode-expand all the symbols in this python string
+    if (!encoder_data_reserve_space(encodedData, PyUnicode_GET_LENGTH(pystr) * CHAR_MAX_EXPANSION))
+        return;
+
+    encode_chars(encodedData, pystr, false);
+}
+
+static void encode_jsonb (PyObject * pybytes, EncodedData * encodedData)
+{
+    Py_ssize_t  input_size;
+    char       *input_bytes;
+
+    input_size  = PyBytes_GET_SIZE(pybytes);
+    input_bytes = PyBytes_AS_STRING(pybytes);
+
+    encoder_data_append(encodedData, input_bytes, input_size);
+}
+
+static void encode_true (EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_bool(true, encodedData);
+
+    // 'true' stored as a 4-byte integer: 't' + 'r'<<8 + 'u'<<16 + 'e'<<24
+    static uint32_t true_string = 1702195828;
+
+    if (!encoder_data_reserve_space(encodedData, 4)) return;
+
+    *(uint32_t*)(encodedData->buffer_free) = true_string;
+    encodedData->buffer_free += 4;
+
+    //encoder_data_append_ch_nocheck(encodedData, 't');
+    //encoder_data_append_ch_nocheck(encodedData, 'r');
+    //encoder_data_append_ch_nocheck(encodedData, 'u');
+    //encoder_data_append_ch_nocheck(encodedData, 'e');
+}
+
+static void encode_false (EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_bool(false, encodedData);
+
+    // 'fals' stored as a 4-byte integer: 'f' + 'a'<<8 + 'l'<<16 + 's'<<24
+    static uint32_t false_string = 1936482662;
+
+    if (!encoder_data_reserve_space(encodedData, 5)) return;
+
+    *(uint32_t*)(encodedData->buffer_free) = false_string;
+    encodedData->buffer_free += 4;
+    encoder_data_append_ch_nocheck(encodedData, 'e');
+
+    //encoder_data_append_ch_nocheck(encodedData, 'f');
+    //encoder_data_append_ch_nocheck(encodedData, 'a');
+    //encoder_data_append_ch_nocheck(encodedData, 'l');
+    //encoder_data_append_ch_nocheck(encodedData, 's');
+    //encoder_data_append_ch_nocheck(encodedData, 'e');
+}
+
+static void encode_none (EncodedData * encodedData)
+{
+    if (encodedData->emitter != NULL) return encodedData->emitter->encode_none(encodedData);
+
+    // 'fals' stored as a 4-byte integer: 'n' + 'u'<<8 + 'l'<<16 + 'l'<<24
+    static uint32_t null_string = 1819047278;
+
+    if (!encoder_data_reserve_space(encodedData, 4)) return;
+
+    *(uint32_t*)(encodedData->buffer_free) = null_string;
+    encodedData->buffer_free += 4;
+
+    //encoder_data_append_ch_nocheck(encodedData, 'n');
+    //encoder_data_append_ch_nocheck(encodedData, 'u');
+    //encoder_data_append_ch_nocheck(encodedData, 'l');
+    //encoder_data_append_ch_nocheck(encodedData, 'l');
+}
+
+/*
+ * Container encoders: write the opening bracket and push the container to the frame
+ * stack (see encode()); the items are encoded by encode() as they are taken from the
+ * frame by encode_next_item().
+ */
+
+/*
+ * Writes the opening bracket of the container of the (just pushed) 'frame', or,
+ * for binary formats, the container header with the number of items, 'size'.
+ */
+static void encode_begin_container (EncoderFrame * frame, Py_ssize_t size, EncodedData * encodedData)
+{
+    if (frame == NULL) return;
+
+    bool is_map = frame->type == FRAME_DICT || frame->type == FRAME_MAPPING ||
+                  frame->type == FRAME_SORTED_DICT;
+
+    if (encodedData->emitter == NULL)
+        return encoder_data_append_char(encodedData, is_map ? '{' : '[');
+
+    frame->size = size;
+
+    if (is_map)
+        encodedData->emitter->begin_map(size, encodedData);
+    else
+        encodedData->emitter->begin_array(size, encodedData);
+}
+
+/* the size of a container for the binary formats; -1 (with no error) for JSON */
+static Py_ssize_t encode_container_size (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->emitter == NULL) return -1;
+
+    Py_ssize_t size = PyObject_Size(obj);
+
+    if (size == -1) encoder_not_serializable(obj, encodedData);
+
+    return size;
+}
+
+static void encode_list (PyObject * obj, EncodedData * encodedData)
+{
+    encode_begin_container(encoder_data_push_frame(encodedData, FRAME_LIST, obj, NULL),
+                           PyList_GET_SIZE(obj), encodedData);
+}
+
+static void encode_tuple (PyObject * obj, EncodedData * encodedData)
+{
+    encode_begin_container(encoder_data_push_frame(encodedData, FRAME_TUPLE, obj, NULL),
+                           PyTuple_GET_SIZE(obj), encodedData);
+}
+
+static void encode_dict (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->canonical) return encode_sorted_dict(obj, encodedData);
+
+    encode_begin_container(encoder_data_push_frame(encodedData, FRAME_DICT, obj, NULL),
+                           PyDict_Size(obj), encodedData);
+}
+
+static void encode_set (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->canonical) return encode_sorted_set(obj, encodedData);
+
+    encode_iterable(obj, encodedData);
+}
+
+static void encode_iterable (PyObject * obj, EncodedData * encodedData)
+{
+    Py_ssize_t set_size = PyObject_Size(obj);
+
+    if (set_size == -1) return encoder_not_serializable(obj, encodedData);
+
+    PyObject * it = PyObject_GetIter(obj);
+
+    if (it == NULL) return encoder_not_serializable(obj, encodedData);
+
+    encode_begin_container(encoder_data_push_frame(encodedData, FRAME_ITERABLE, obj, it),
+                           set_size, encodedData);
+}
+
+static void encode_mapping (PyObject * obj, EncodedData * encodedData)
+{
+    if (encodedData->canonical) return encode_sorted_dict(obj, encodedData);
+
+    Py_ssize_t size = encode_container_size(obj, encodedData);
+
+    if (encoder_data_has_error(encodedData)) return;
+
+    PyObject * it = PyObject_GetIter(obj);
+
+    if (it == NULL) return encoder_not_serializable(obj, encodedData);
+
+    encode_begin_container(encoder_data_push_frame(encodedData, FRAME_MAPPING, obj, it),
+                           size, encodedData);
+}
+
+/*
+ * Canonical mode: dict and mapping keys are written sorted by their string (by
+ * their encoding in the binary formats), and set items are written sorted by
+ * their encoding.
+ *
+ * Keys and set items are encoded into the output buffer as usual and moved out of
+ * it into bytes() objects right away (see encode_to_bytes()); once sorted, they are
+ * written back by encode_next_item().  Dict values are encoded as usual, in
+ * the order of their sorted keys.
+ */
+
+static PyObject * encode_to_bytes (PyObject * obj, bool as_key, EncodedData * encodedData)
+// returns a new bytes() object with the encoding of 'obj', or NULL with the error set;
+// the output buffer is left as it was
+{
+    Py_ssize_t start = encoder_data_get_size(encodedData);
+
+    // the encoding is not a part of the output yet: it should not be flushed
+    // or counted against the output size limit
+    encoder_flush_func flush      = encodedData->flush;
+    Py_ssize_t max_output_size    = encodedData->max_output_size;
+
+    encodedData->flush           = NULL;
+    encodedData->max_output_size = -1;
+
+    if (as_key)
+        encode_key(obj, encodedData);
+    else
+        encode(obj, encodedData);
+
+    encodedData->flush           = flush;
+    encodedData->max_output_size = max_output_size;
+
+    PyObject * result = NULL;
+
+    if (!encoder_data_has_error(encodedData))
+    {
+        result = PyBytes_FromStringAndSize(encodedData->buffer + start,
+                                           encoder_data_get_size(encodedData) - start);
+        if (result == NULL)
+            encoder_data_set_error(encodedData);
+    }
+
+    encodedData->buffer_free = encodedData->buffer + start;
+
+    return result;
+}
+
+static void encode_sorted_dict (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * keys = PyDict_CheckExact(obj) ? PyDict_Keys(obj) : PySequence_List(obj);
+
+    if (keys == NULL) return encoder_not_serializable(obj, encodedData);
+
+    // (sort key, index, encoded key, value): the index makes sure values are never
+    // compared.  JSON keys are sorted by their string (str() of UUIDs), as by
+    // json.dumps(sort_keys=True); keys of the binary formats by their encoding
+    PyObject * items = PyList_New(PyList_GET_SIZE(keys));
+
+    Py_ssize_t i;
+    for (i = 0; items != NULL && i < PyList_GET_SIZE(keys); i++)
+    {
+        PyObject * key   = PyList_GET_ITEM(keys, i);
+        PyObject * value = PyObject_GetItem(obj, key);
+        PyObject * item  = NULL;
+
+        PyObject * sort_key    = NULL;
+        PyObject * encoded_key = NULL;
+
+        if (value != NULL && encodedData->emitter == NULL)
+        {
+            PyObject * resolved = resolve_key(key, encodedData);
+
+            if (resolved != NULL)
+            {
+                sort_key = PyUnicode_CheckExact(resolved) ? resolved : PyObject_Str(resolved);
+
+                if (sort_key != resolved)
+                    Py_DECREF(resolved);
+            }
+
+            if (sort_key != NULL)
+                encoded_key = encode_to_bytes(sort_key, true, encodedData);
+        }
+        else if (value != NULL)
+        {
+            if ((encoded_key = encode_to_bytes(key, true, encodedData)) != NULL)
+                Py_INCREF(sort_key = encoded_key);
+        }
+
+        if (encoded_key != NULL)
+        {
+            PyObject * index = PyLong_FromSsize_t(i);
+
+            if (index != NULL)
+            {
+                item = PyTuple_Pack(4, sort_key, index, encoded_key, value);
+                Py_DECREF(index);
+            }
+        }
+
+        Py_XDECREF(sort_key);
+        Py_XDECREF(encoded_key);
+        Py_XDECREF(value);
+
+        if (item == NULL)
+        {
+            Py_CLEAR(items);
+            break;
+        }
+
+        PyList_SET_ITEM(items, i, item);
+    }
+
+    Py_DECREF(keys);
 
-    datevalue_to_string(PyDateTime_GET_YEAR(obj), encodedData, 4);
-    encoder_data_append_ch_nocheck(encodedData,'-');
-    datevalue_to_string(PyDateTime_GET_MONTH(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,'-');
-    datevalue_to_string(PyDateTime_GET_DAY(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,'T');
-    datevalue_to_string(PyDateTime_DATE_GET_HOUR(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,':');
-    datevalue_to_string(PyDateTime_DATE_GET_MINUTE(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,':');
-    datevalue_to_string(PyDateTime_DATE_GET_SECOND(obj), encodedData, 2);
+    if (items != NULL && PyList_Sort(items) == 0)
+        encode_begin_container(encoder_data_push_frame(encodedData, FRAME_SORTED_DICT, items, NULL),
+                               PyList_GET_SIZE(items), encodedData);
+    else
+        encoder_data_set_error(encodedData);
 
-    int microseconds = PyDateTime_DATE_GET_MICROSECOND(obj);
-    if (microseconds != 0)
+    Py_XDECREF(items);
+}
+
+static void encode_sorted_set (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * it = PyObject_GetIter(obj);
+
+    if (it == NULL) return encoder_not_serializable(obj, encodedData);
+
+    // the frame is pushed first so that the items are encoded one level deeper
+    if (encoder_data_push_frame(encodedData, FRAME_SORTED_SET, obj, NULL) == NULL)
     {
-        encoder_data_append_ch_nocheck(encodedData,'.');
-        datevalue_to_string(microseconds, encodedData, 6);
+        Py_DECREF(it);
+        return;
     }
 
-    if (HASTZINFO(obj))
+    int depth = encodedData->depth;
+
+    PyObject * items = PyList_New(0);
+    PyObject * item;
+
+    while (items != NULL && (item = PyIter_Next(it)) != NULL)
     {
-        PyObject* timedelta = PyObject_CallMethod(obj, "utcoffset", NULL);
+        PyObject * encoded = encode_to_bytes(item, false, encodedData);
 
-        if (timedelta != NULL)
+        Py_DECREF(item);
+
+        if (encoded == NULL || PyList_Append(items, encoded) < 0)
+            Py_CLEAR(items);
+
+        Py_XDECREF(encoded);
+    }
+
+    Py_DECREF(it);
+
+    if (items == NULL || PyErr_Occurred() || PyList_Sort(items) < 0)
+    {
+        if (!encoder_data_has_error(encodedData))
+            encoder_not_serializable(obj, encodedData);
+
+        Py_XDECREF(items);
+        return;
+    }
+
+    // the frame stack may have been reallocated while encoding the items
+    EncoderFrame * frame = &encodedData->frames[depth - 1];
+
+    Py_DECREF(frame->container);
+    frame->container = items;
+
+    encode_begin_container(frame, PyList_GET_SIZE(items), encodedData);
+}
+
+/*===========================================================================
+ * implemention: merge patches
+ *===========================================================================*/
+
+/*
+ * Returns a new reference to the object 'obj' is encoded as, to be compared with
+ * another one: the output of encode_hook() and, for objects which are not natively
+ * supported and have no __mm_json__() method, of __mm_serialize__(), applied until
+ * there is no replacement.  Sets 'is_mapping' if the object is encoded as a JSON
+ * object with its keys and values (dicts, OrderedDicts and other mappings).
+ * Chains of replacements are limited as in encode_value().
+ *
+ * Returns NULL (with the error set) on errors.
+ */
+static PyObject * diff_resolve (PyObject * obj, bool * is_mapping, EncodedData * encodedData)
+{
+    EncoderState * state = encoder_state(encodedData);
+
+    *is_mapping = false;
+
+    Py_INCREF(obj);
+
+    for (int replacements = 0; ; replacements++)
+    {
+        if (replacements > encodedData->max_depth)
         {
-            int tz_total_seconds = GET_TD_TOTAL_SECONDS(timedelta);
+            Py_DECREF(obj);
+            encoder_data_depth_error(encodedData);
+            return NULL;
+        }
 
-            Py_DECREF(timedelta);
+        if (encodedData->use_hook)
+        {
+            PyObject * obj_encoded = apply_encode_hook(obj, encodedData);
 
-            if (tz_total_seconds >= 0) {
-                encoder_data_append_ch_nocheck(encodedData,'+');
-            } else {
-                encoder_data_append_ch_nocheck(encodedData,'-');
-            }
+            Py_DECREF(obj);
 
-            tz_total_seconds = abs(tz_total_seconds);
+            if (obj_encoded == NULL) return NULL;
 
-            int tz_hour   = tz_total_seconds/3600;
-            int tz_minute = (tz_total_seconds%3600)/60;
+            obj = obj_encoded;
+        }
 
-            datevalue_to_string(tz_hour, encodedData, 2);
-            encoder_data_append_ch_nocheck(encodedData,':');
-            datevalue_to_string(tz_minute, encodedData, 2);
+        if (PyDict_CheckExact(obj) || obj->ob_type == state->PyType_Col_OrderedDict)
+        {
+            *is_mapping = true;
+            return obj;
         }
-        else
+
+        // other natively supported objects
+        if (PyUnicode_CheckExact(obj) || PyLong_CheckExact(obj) || PyFloat_CheckExact(obj) ||
+            obj == Py_True || obj == Py_False || obj == Py_None ||
+            PyList_CheckExact(obj) || PyTuple_CheckExact(obj) || PyAnySet_CheckExact(obj) ||
+            obj->ob_type == state->PyType_UUID || obj->ob_type == state->PyType_Decimal ||
+            obj->ob_type == state->PyRawJSON_Type)
+            return obj;
+
+        PyObject * _sx_json_ = PyObject_GetAttrString(obj, "__mm_json__");
+
+        if (_sx_json_ != NULL)
+        {
+            Py_DECREF(_sx_json_);
+            return obj;
+        }
+
+        PyErr_Clear();
+
+        PyObject * _sx_serialize_ = PyObject_GetAttrString(obj, "__mm_serialize__");
+
+        if (_sx_serialize_ == NULL)
+        {
+            PyErr_Clear();
+            break;
+        }
+
+        PyObject * obj_encoded = PyObject_CallObject(_sx_serialize_, NULL);
+
+        Py_DECREF(_sx_serialize_);
+
+        if (obj_encoded == NULL)
+        {
+            if (!PyErr_ExceptionMatches(PyExc_NotImplementedError))
+            {
+                Py_DECREF(obj);
+                encoder_data_set_error(encodedData);
+                return NULL;
+            }
+
             PyErr_Clear();
+            break;
+        }
+
+        Py_DECREF(obj);
+        obj = obj_encoded;
     }
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
+    // same checks and in the same order as in _encode()
+    encoder_state_load_types(state);
+
+    if (PyList_Check(obj) || PyTuple_Check(obj) || PyAnySet_Check(obj))
+        return obj;
+
+    *is_mapping = PyDict_Check(obj) || encoder_is_instance(obj, state->PyType_Col_Mapping);
+
+    return obj;
 }
 
+/*
+ * Looks 'key' up in the mapping 'obj': returns 1 and a new reference to the value
+ * in 'value' if found, 0 if not found and -1 on errors.  Missing keys are never
+ * created (e.g. by collections.defaultdict).
+ */
+static int diff_lookup (PyObject * obj, PyObject * key, PyObject ** value)
+{
+    if (PyDict_Check(obj))
+    {
+        *value = PyDict_GetItemWithError(obj, key);
+
+        if (*value == NULL) return PyErr_Occurred() ? -1 : 0;
+
+        Py_INCREF(*value);
+        return 1;
+    }
+
+    int found = PySequence_Contains(obj, key);
+
+    if (found <= 0) return found;
+
+    *value = PyObject_GetItem(obj, key);
+
+    return *value == NULL ? -1 : 1;
+}
 
 /*
- * 'obj' is assumed to be based on datetime.date.
+ * Returns 1 if 'a' and 'b' are known to have the same JSON-encoding: they are the
+ * same object, or strings, numbers, UUIDs, Decimals, dates or times of the same type
+ * which compare equal, or lists, tuples, dicts or OrderedDicts of the same type whose
+ * items are compared in the same way, so that e.g. 1, 1.0 and True are never equal.
+ * Floats, Decimals, datetimes and times are also compared by their sign, exponent
+ * and time zone, which equality ignores.  Other objects (sets, instances of other
+ * classes) are only equal to themselves.
  *
- * outputs date in ISO format "YYYY-MM-DD" to EncodedData
+ * Returns 0 otherwise and -1 (with a Python exception set) on errors.
  */
-static void encode_date (PyObject * obj, EncodedData * encodedData)
+static int diff_equal (PyObject * a, PyObject * b, EncoderState * state)
 {
-    if (encoder_data_has_error(encodedData)) return;
+    if (a == b) return 1;
 
-    // date in ISO format is at most 10 characters long, plus need two enclosing quotes
-    encoder_data_reserve_space(encodedData, 12);
+    if (a->ob_type != b->ob_type) return 0;
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
+    encoder_state_load_types(state);
 
-    datevalue_to_string(PyDateTime_GET_YEAR(obj), encodedData, 4);
-    encoder_data_append_ch_nocheck(encodedData,'-');
-    datevalue_to_string(PyDateTime_GET_MONTH(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,'-');
-    datevalue_to_string(PyDateTime_GET_DAY(obj), encodedData, 2);
+    if (PyFloat_CheckExact(a))
+    {
+        double x = PyFloat_AS_DOUBLE(a);
+        double y = PyFloat_AS_DOUBLE(b);
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
+        return x == y && copysign(1.0, x) == copysign(1.0, y);
+    }
+
+    bool is_dict = PyDict_CheckExact(a) || a->ob_type == state->PyType_Col_OrderedDict;
+
+    if (PyList_CheckExact(a) || PyTuple_CheckExact(a) || is_dict)
+    {
+        if (Py_EnterRecursiveCall(" while comparing objects")) return -1;
+
+        int equal = 1;
+
+        if (is_dict)
+        {
+            // take a snapshot of the items: comparing them may run Python code
+            PyObject * items = PyDict_Size(a) == PyDict_Size(b) ? PyDict_Items(a) : NULL;
+
+            if (items == NULL)
+                equal = PyErr_Occurred() ? -1 : 0;
+
+            for (Py_ssize_t i = 0; equal == 1 && i < PyList_GET_SIZE(items); i++)
+            {
+                PyObject * item = PyList_GET_ITEM(items, i);
+                PyObject * value;
+
+                equal = diff_lookup(b, PyTuple_GET_ITEM(item, 0), &value);
+
+                if (equal == 1)
+                {
+                    equal = diff_equal(PyTuple_GET_ITEM(item, 1), value, state);
+                    Py_DECREF(value);
+                }
+            }
+
+            Py_XDECREF(items);
+        }
+        else
+        {
+            PyObject * seq_a = PySequence_Fast(a, "");
+            PyObject * seq_b = PySequence_Fast(b, "");
+
+            if (seq_a == NULL || seq_b == NULL)
+                equal = -1;
+            else if (PySequence_Fast_GET_SIZE(seq_a) != PySequence_Fast_GET_SIZE(seq_b))
+                equal = 0;
+
+            // lists may be changed while their items are compared
+            for (Py_ssize_t i = 0; equal == 1 && i < PySequence_Fast_GET_SIZE(seq_a) &&
+                                                 i < PySequence_Fast_GET_SIZE(seq_b); i++)
+            {
+                PyObject * item_a = PySequence_Fast_GET_ITEM(seq_a, i);
+                PyObject * item_b = PySequence_Fast_GET_ITEM(seq_b, i);
+
+                Py_INCREF(item_a);
+                Py_INCREF(item_b);
+
+                equal = diff_equal(item_a, item_b, state);
+
+                Py_DECREF(item_a);
+                Py_DECREF(item_b);
+            }
+
+            Py_XDECREF(seq_a);
+            Py_XDECREF(seq_b);
+        }
+
+        Py_LeaveRecursiveCall();
+
+        return equal;
+    }
+
+    if (a->ob_type == state->PyType_Decimal)
+    {
+        // Decimal('1.0') == Decimal('1.00')
+        PyObject * str_a = PyObject_Str(a);
+        PyObject * str_b = str_a != NULL ? PyObject_Str(b) : NULL;
+
+        int equal = str_b == NULL ? -1 : PyUnicode_Compare(str_a, str_b) == 0;
+
+        Py_XDECREF(str_a);
+        Py_XDECREF(str_b);
+
+        return equal;
+    }
+
+    if (PyDateTimeAPI != NULL && (PyDateTime_CheckExact(a) || PyTime_CheckExact(a)))
+    {
+        // equal datetimes may be in different time zones
+        PyObject * tz_a = PyObject_GetAttrString(a, "tzinfo");
+        PyObject * tz_b = tz_a != NULL ? PyObject_GetAttrString(b, "tzinfo") : NULL;
+
+        int equal = tz_b == NULL ? -1 : tz_a == tz_b;
+
+        Py_XDECREF(tz_a);
+        Py_XDECREF(tz_b);
+
+        if (equal != 1) return equal;
+    }
+
+    if (PyUnicode_CheckExact(a) || PyLong_CheckExact(a) || a->ob_type == state->PyType_UUID ||
+        (PyDateTimeAPI != NULL && (PyDateTime_CheckExact(a) || PyDate_CheckExact(a) ||
+                                   PyTime_CheckExact(a))))
+        return PyObject_RichCompareBool(a, b, Py_EQ);
+
+    return 0;
 }
 
+/* writes the separator of the members of a JSON object and a key */
+static void encode_diff_key (PyObject * key, EncoderFrame * frame, EncodedData * encodedData)
+{
+    if (frame->count++ > 0)
+        encoder_data_append_char(encodedData, ',');
+
+    encode_key(key, encodedData);
+
+    encoder_data_append_char(encodedData, ':');
+}
 
 /*
- * 'obj' is assumed to be based on datetime.time.
- *
- * outputs date in ISO format "HH:MM:SS.mmmmmm+HH:MM" to EncodedData
+ * Writes the members of the merge patch turning the mapping 'old' into the mapping
+ * 'new' to the object at the top of the frame stack: the keys of 'new' missing in
+ * 'old' with their values, the patches of the values which differ, and the keys of
+ * 'old' missing in 'new' with null values.  Patches of values with no differences
+ * (e.g. objects which compare unequal but are encoded the same way) are left out.
  */
-static void encode_time (PyObject * obj, EncodedData * encodedData)
+static void encode_mapping_diff (PyObject * old, PyObject * new, EncodedData * encodedData)
 {
-    if (encoder_data_has_error(encodedData)) return;
+    int depth = encodedData->depth;
 
-    // date in ISO format is at most 21 characters long, plus need two enclosing quotes
-    encoder_data_reserve_space(encodedData, 23);
+    EncoderState * state = encoder_state(encodedData);
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
+    PyObject * it = PyObject_GetIter(new);
 
-    datevalue_to_string(PyDateTime_TIME_GET_HOUR(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,':');
-    datevalue_to_string(PyDateTime_TIME_GET_MINUTE(obj), encodedData, 2);
-    encoder_data_append_ch_nocheck(encodedData,':');
-    datevalue_to_string(PyDateTime_TIME_GET_SECOND(obj), encodedData, 2);
+    if (it == NULL) return encoder_not_serializable(new, encodedData);
 
-    int microseconds = PyDateTime_TIME_GET_MICROSECOND(obj);
-    if (microseconds != 0)
+    PyObject * key;
+    while ((key = PyIter_Next(it)) != NULL)
     {
-        encoder_data_append_ch_nocheck(encodedData,'.');
-        datevalue_to_string(microseconds, encodedData, 6);
+        PyObject * value     = NULL;
+        PyObject * old_value = NULL;
+
+        int found = diff_lookup(new, key, &value);
+
+        if (found == 0)
+        {
+            PyErr_SetObject(PyExc_KeyError, key);
+            found = -1;
+        }
+
+        if (found == 1)
+            found = diff_lookup(old, key, &old_value);
+
+        if (found == -1)
+        {
+            Py_DECREF(key);
+            Py_XDECREF(value);
+            encoder_data_set_error(encodedData);
+            break;
+        }
+
+        // the frame stack may be reallocated while encoding the values
+        EncoderFrame * frame = &encodedData->frames[depth - 1];
+
+        if (found == 0)
+        {
+            encode_diff_key(key, frame, encodedData);
+            encode(value, encodedData);
+        }
+        else
+        {
+            int equal = diff_equal(old_value, value, state);
+
+            if (equal == -1)
+                encoder_data_set_error(encodedData);
+            else if (!equal)
+            {
+                Py_ssize_t start = encoder_data_get_size(encodedData);
+
+                encode_diff_key(key, frame, encodedData);
+
+                if (encode_diff(old_value, value, encodedData) == 0)
+                {
+                    // an empty patch: take the key back
+                    encodedData->buffer_free = encodedData->buffer + start;
+                    encodedData->frames[depth - 1].count--;
+                }
+            }
+
+            Py_DECREF(old_value);
+        }
+
+        Py_DECREF(key);
+        Py_DECREF(value);
+
+        if (encoder_data_has_error(encodedData)) break;
     }
 
-    if (HASTZINFO(obj))
+    Py_DECREF(it);
+
+    if (encoder_data_has_error(encodedData)) return;
+
+    if (PyErr_Occurred())
+        return encoder_not_serializable(new, encodedData);
+
+    // deleted keys
+    it = PyObject_GetIter(old);
+
+    if (it == NULL) return encoder_not_serializable(old, encodedData);
+
+    while ((key = PyIter_Next(it)) != NULL)
     {
-        PyObject* timedelta = PyObject_CallMethod(obj, "utcoffset", NULL);
+        PyObject * value;
 
-        if (timedelta != NULL)
+        int found = diff_lookup(new, key, &value);
+
+        if (found == 1)
+            Py_DECREF(value);
+        else if (found == 0)
         {
-            int tz_total_seconds = GET_TD_TOTAL_SECONDS(timedelta);
+            encode_diff_key(key, &encodedData->frames[depth - 1], encodedData);
+            encode_none(encodedData);
+        }
+        else
+            encoder_data_set_error(encodedData);
 
-            Py_DECREF(timedelta);
+        Py_DECREF(key);
+
+        if (encoder_data_has_error(encodedData)) break;
+    }
+
+    Py_DECREF(it);
+
+    if (!encoder_data_has_error(encodedData) && PyErr_Occurred())
+        encoder_not_serializable(old, encodedData);
+}
+
+/*
+ * JSON-encodes the merge patch (RFC 7386) turning the JSON-encoding of 'old' into the
+ * JSON-encoding of 'new' into the given EncodedData buffer.
+ *
+ * If both objects are encoded as JSON objects (see diff_resolve()) their keys are
+ * compared and only the values which differ are written: values of new keys in full,
+ * and values of the existing keys as patches in turn.  Values which are known to be
+ * encoded the same way (see diff_equal()) are skipped without being encoded.
+ * Anything else (including arrays, which merge patches cannot change in part) is
+ * replaced: 'new' is encoded in full.
+ *
+ * Merge patches remove the keys which are null in the patch, so keys of 'new' with
+ * None values are removed by the patch as well.
+ *
+ * Returns the number of the members of the patch object, 1 if 'new' was encoded in
+ * full or -1 on errors.
+ */
+static int encode_diff (PyObject * old, PyObject * new, EncodedData * encodedData)
+{
+    if (encoder_data_has_error(encodedData)) return -1;
+
+    bool old_is_mapping, new_is_mapping;
+
+    PyObject * old_resolved = diff_resolve(old, &old_is_mapping, encodedData);
+    PyObject * new_resolved = old_resolved != NULL ?
+                                diff_resolve(new, &new_is_mapping, encodedData) : NULL;
+
+    int count = 1;
+
+    if (new_resolved == NULL)
+        count = -1;
+    else if (!old_is_mapping || !new_is_mapping)
+        // encode_hook() and __mm_serialize__() are not called again
+        encode_hooked(new_resolved, encodedData);
+    else
+    {
+        // keeps the nesting depth accounted as for dicts being encoded
+        EncoderFrame * frame = encoder_data_push_frame(encodedData, FRAME_DICT, new_resolved, NULL);
 
-            if (tz_total_seconds >= 0) {
-                encoder_data_append_ch_nocheck(encodedData,'+');
-            } else {
-                encoder_data_append_ch_nocheck(encodedData,'-');
-            }
+        if (frame != NULL)
+        {
+            encoder_data_append_char(encodedData, '{');
 
-            tz_total_seconds = abs(tz_total_seconds);
+            encode_mapping_diff(old_resolved, new_resolved, encodedData);
 
-            int tz_hour   = tz_total_seconds/3600;
-            int tz_minute = (tz_total_seconds%3600)/60;
+            count = encodedData->frames[encodedData->depth - 1].count;
 
-            datevalue_to_string(tz_hour, encodedData, 2);
-            encoder_data_append_ch_nocheck(encodedData,':');
-            datevalue_to_string(tz_minute, encodedData, 2);
+            encoder_data_append_char(encodedData, '}');
+            encoder_data_pop_frame(encodedData);
         }
-        else
-            PyErr_Clear();
     }
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
-}
+    Py_XDECREF(old_resolved);
+    Py_XDECREF(new_resolved);
 
+    return encoder_data_has_error(encodedData) ? -1 : count;
+}
 
-#ifdef Py_UNICODE_WIDE
-#define CHAR_MAX_EXPANSION (2 * 6)
-#else
-#define CHAR_MAX_EXPANSION 6
-#endif
+/*===========================================================================
+ * implemention: row objects
+ *===========================================================================*/
 
 /*
- * Converts unicode character c to ASCII escape sequence and stores it in EncodedData.
- *
- * In the worst case EncodedData.buffer must have at least CHAR_MAX_EXPANSION bytes
- * unused to store the escaped surrogate pair "\uXXXX\uXXXX"
+ * Returns a new list of the bytes() written before each value of the row objects of
+ * dumpb_rows() and dumpb_columns(): '{' or ',' and the encoded key followed by ':'.
+ * Returns NULL (with the error set) on errors.
  */
-static void encode_special_char (EncodedData * encodedData, Py_UNICODE c)
+static PyObject * encode_row_prefixes (PyObject * keys, EncodedData * encodedData)
 {
-    static char hexchars[16] = "0123456789abcdef";
-
-    encoder_data_append_ch_nocheck(encodedData,'\\');
+    PyObject * it = PyObject_GetIter(keys);
 
-    switch (c) {
-        case '\\': encoder_data_append_ch_nocheck(encodedData, '\\'); break;
-        case '"':  encoder_data_append_ch_nocheck(encodedData, '"');  break;
-        case '\b': encoder_data_append_ch_nocheck(encodedData, 'b');  break;
-        case '\f': encoder_data_append_ch_nocheck(encodedData, 'f');  break;
-        case '\n': encoder_data_append_ch_nocheck(encodedData, 'n');  break;
-        case '\r': encoder_data_append_ch_nocheck(encodedData, 'r');  break;
-        case '\t': encoder_data_append_ch_nocheck(encodedData, 't');  break;
-        default:
-            #ifdef Py_UNICODE_WIDE
-            if (c >= 0x10000) {
-                // UTF-16 surrogate pair
-                Py_UNICODE v = c - 0x10000;
-                c = 0xd800 | ((v >> 10) & 0x3ff);
-                encoder_data_append_ch_nocheck(encodedData, 'u');
-                encoder_data_append_ch_nocheck(encodedData, hexchars[(c >> 12) & 0xf]);
-                encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  8) & 0xf]);
-                encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  4) & 0xf]);
-                encoder_data_append_ch_nocheck(encodedData, hexchars[(c      ) & 0xf]);
-                c = 0xdc00 | (v & 0x3ff);
-                encoder_data_append_ch_nocheck(encodedData, '\\');
-            }
-            #endif
-            encoder_data_append_ch_nocheck(encodedData, 'u');
-            encoder_data_append_ch_nocheck(encodedData, hexchars[(c >> 12) & 0xf]);
-            encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  8) & 0xf]);
-            encoder_data_append_ch_nocheck(encodedData, hexchars[(c >>  4) & 0xf]);
-            encoder_data_append_ch_nocheck(encodedData, hexchars[(c      ) & 0xf]);
+    if (it == NULL)
+    {
+        encoder_data_set_error(encodedData);
+        return NULL;
     }
-}
 
-static void encode_string (PyObject * pystr, EncodedData * encodedData)
-{
-    Py_ssize_t  input_size;
-    Py_UNICODE* input_unicode;
-    Py_ssize_t  i;
+    PyObject * prefixes = PyList_New(0);
 
-    input_size    = PyUnicode_GET_SIZE(pystr);
-    input_unicode = PyUnicode_AS_UNICODE(pystr);
+    if (prefixes == NULL) encoder_data_set_error(encodedData);
 
-    // reserve as much space as we may possibly need assuming we have to
-    // unicode-expand all the symbols in this python string
-    encoder_data_reserve_space(encodedData, input_size * CHAR_MAX_EXPANSION + 2);
+    PyObject * key;
+    while (prefixes != NULL && (key = PyIter_Next(it)) != NULL)
+    {
+        PyObject * encoded = encode_to_bytes(key, true, encodedData);
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
+        Py_DECREF(key);
 
-    for (i = 0; i < input_size; i++)
-    {
-        const Py_UNICODE c = input_unicode[i];
+        if (encoded == NULL) break;
 
-        if (c >= ' ' && c <= '~' && c != '"' && c != '\\'
-                     && c != '<' && c != '>' && c != '&')
-            encoder_data_append_ch_nocheck(encodedData, c);
-        else
-            encode_special_char(encodedData, c);
-    }
+        Py_ssize_t size   = PyBytes_GET_SIZE(encoded);
+        PyObject * prefix = PyBytes_FromStringAndSize(NULL, size + 2);
 
-    encoder_data_append_ch_nocheck(encodedData,'"');
-}
+        if (prefix != NULL)
+        {
+            char * p = PyBytes_AS_STRING(prefix);
 
-static void encode_json (PyObject * pystr, EncodedData * encodedData)
-{
-    Py_ssize_t  input_size;
-    Py_UNICODE* input_unicode;
-    Py_ssize_t  i;
+            p[0] = PyList_GET_SIZE(prefixes) == 0 ? '{' : ',';
+            memcpy(p + 1, PyBytes_AS_STRING(encoded), size);
+            p[size + 1] = ':';
+        }
 
-    input_size    = PyUnicode_GET_SIZE(pystr);
-    input_unicode = PyUnicode_AS_UNICODE(pystr);
+        Py_DECREF(encoded);
 
-    // reserve as much space as we may possibly need assuming we have to
-    // unicode-expand all the symbols in this python string
-    encoder_data_reserve_space(encodedData, input_size * CHAR_MAX_EXPANSION);
+        if (prefix == NULL || PyList_Append(prefixes, prefix) < 0)
+        {
+            Py_XDECREF(prefix);
+            encoder_data_set_error(encodedData);
+            break;
+        }
 
-    for (i = 0; i < input_size; i++)
-    {
-        const Py_UNICODE c = input_unicode[i];
+        Py_DECREF(prefix);
+    }
 
-        if (c >= ' ' && c <= '~' && c != '<' && c != '>' && c != '&')
-            encoder_data_append_ch_nocheck(encodedData, c);
-        else
-            encode_special_char(encodedData, c);
+    Py_DECREF(it);
+
+    if (!encoder_data_has_error(encodedData) && PyErr_Occurred())
+        encoder_data_set_error(encodedData);
+
+    if (encoder_data_has_error(encodedData))
+    {
+        Py_XDECREF(prefixes);
+        return NULL;
     }
+
+    return prefixes;
 }
 
-static void encode_jsonb (PyObject * pybytes, EncodedData * encodedData)
+/*
+ * Writes the opening bracket of the array of row objects.  The frames of the array
+ * and of the row objects keep the nesting depth accounted as for lists of dicts.
+ */
+static bool encode_begin_rows (PyObject * obj, EncodedData * encodedData)
 {
-    Py_ssize_t  input_size;
-    char       *input_bytes;
+    if (encoder_data_push_frame(encodedData, FRAME_LIST, obj, NULL) == NULL)
+        return false;
 
-    input_size  = PyBytes_GET_SIZE(pybytes);
-    input_bytes = PyBytes_AS_STRING(pybytes);
+    if (encoder_data_push_frame(encodedData, FRAME_DICT, obj, NULL) == NULL)
+    {
+        encoder_data_pop_frame(encodedData);
+        return false;
+    }
 
-    encoder_data_append(encodedData, input_bytes, input_size);
+    encoder_data_append_char(encodedData, '[');
+
+    return true;
 }
 
-static void encode_true (EncodedData * encodedData)
+static void encode_end_rows (EncodedData * encodedData)
 {
-    // 'true' stored as a 4-byte integer: 't' + 'r'<<8 + 'u'<<16 + 'e'<<24
-    static uint32_t true_string = 1702195828;
-
-    if (!encoder_data_reserve_space(encodedData, 4)) return;
-
-    *(uint32_t*)(encodedData->buffer_free) = true_string;
-    encodedData->buffer_free += 4;
+    encoder_data_append_char(encodedData, ']');
 
-    //encoder_data_append_ch_nocheck(encodedData, 't');
-    //encoder_data_append_ch_nocheck(encodedData, 'r');
-    //encoder_data_append_ch_nocheck(encodedData, 'u');
-    //encoder_data_append_ch_nocheck(encodedData, 'e');
+    encoder_data_pop_frame(encodedData);
+    encoder_data_pop_frame(encodedData);
 }
 
-static void encode_false (EncodedData * encodedData)
+/*
+ * Writes the row object number 'index', with the values from the tuple 'values' or,
+ * if it is NULL, from the 'columns'.
+ */
+static void encode_row (PyObject * prefixes, PyObject * values, EncoderColumn * columns,
+                        Py_ssize_t index, EncodedData * encodedData)
 {
-    // 'fals' stored as a 4-byte integer: 'f' + 'a'<<8 + 'l'<<16 + 's'<<24
-    static uint32_t false_string = 1936482662;
+    Py_ssize_t n_columns = PyList_GET_SIZE(prefixes);
 
-    if (!encoder_data_reserve_space(encodedData, 5)) return;
+    if (index > 0)
+        encoder_data_append_char(encodedData, ',');
 
-    *(uint32_t*)(encodedData->buffer_free) = false_string;
-    encodedData->buffer_free += 4;
-    encoder_data_append_ch_nocheck(encodedData, 'e');
+    if (n_columns == 0)
+        encoder_data_append_char(encodedData, '{');
 
-    //encoder_data_append_ch_nocheck(encodedData, 'f');
-    //encoder_data_append_ch_nocheck(encodedData, 'a');
-    //encoder_data_append_ch_nocheck(encodedData, 'l');
-    //encoder_data_append_ch_nocheck(encodedData, 's');
-    //encoder_data_append_ch_nocheck(encodedData, 'e');
+    for (Py_ssize_t i = 0; i < n_columns; i++)
+    {
+        PyObject * prefix = PyList_GET_ITEM(prefixes, i);
+
+        encoder_data_append(encodedData, PyBytes_AS_STRING(prefix), PyBytes_GET_SIZE(prefix));
+
+        if (values != NULL)
+            encode(PyTuple_GET_ITEM(values, i), encodedData);
+        else
+            encode_column_value(&columns[i], index, encodedData);
+
+        if (encoder_data_has_error(encodedData)) return;
+    }
+
+    encoder_data_append_char(encodedData, '}');
 }
 
-static void encode_none (EncodedData * encodedData)
+/*
+ * Returns the struct module code of the numbers in the buffer 'view' if they can be
+ * read directly: a one-dimensional buffer of native integers, floats or bools.
+ * Returns 0 otherwise.
+ */
+static char encoder_column_format (Py_buffer * view)
 {
-    // 'fals' stored as a 4-byte integer: 'n' + 'u'<<8 + 'l'<<16 + 'l'<<24
-    static uint32_t null_string = 1819047278;
+    if (view->ndim != 1 || view->format == NULL) return 0;
 
-    if (!encoder_data_reserve_space(encodedData, 4)) return;
+    const char * format = view->format;
 
-    *(uint32_t*)(encodedData->buffer_free) = null_string;
-    encodedData->buffer_free += 4;
+    if (format[0] == '@') format++;
 
-    //encoder_data_append_ch_nocheck(encodedData, 'n');
-    //encoder_data_append_ch_nocheck(encodedData, 'u');
-    //encoder_data_append_ch_nocheck(encodedData, 'l');
-    //encoder_data_append_ch_nocheck(encodedData, 'l');
+    if (format[0] == 0 || format[1] != 0) return 0;
+
+    Py_ssize_t itemsize;
+
+    switch (format[0])
+    {
+        case 'b': case 'B': itemsize = sizeof(char);      break;
+        case 'h': case 'H': itemsize = sizeof(short);     break;
+        case 'i': case 'I': itemsize = sizeof(int);       break;
+        case 'l': case 'L': itemsize = sizeof(long);      break;
+        case 'q': case 'Q': itemsize = sizeof(long long); break;
+        case 'n': case 'N': itemsize = sizeof(size_t);    break;
+        case 'f': itemsize = sizeof(float);  break;
+        case 'd': itemsize = sizeof(double); break;
+        case '?': itemsize = sizeof(_Bool);  break;
+        default:
+            return 0;
+    }
+
+    return view->itemsize == itemsize ? format[0] : 0;
 }
 
-/* used for max-recursion-depth/loop tracking */
-static void inc_depth (EncodedData * encodedData)
+/*
+ * Prepares a column of dumpb_columns() to be encoded: keeps the buffer of arrays of
+ * numbers (see encoder_column_format()) and a tuple of the values of other columns.
+ * Returns the number of values, -1 (with the error set) on errors.
+ */
+static Py_ssize_t encoder_column_open (EncoderColumn * column, PyObject * obj, EncodedData * encodedData)
 {
-    encodedData->depth++;
+    if (PyUnicode_Check(obj) || PyBytes_Check(obj) || PyByteArray_Check(obj))
+    {
+        PyErr_Format(PyExc_TypeError, "columns must be sequences or arrays of numbers, not %.200s",
+                     Py_TYPE(obj)->tp_name);
+        encoder_data_set_error(encodedData);
+        return -1;
+    }
 
-    if (encodedData->depth > encodedData->max_depth)
+    if (!PyList_Check(obj) && !PyTuple_Check(obj) && PyObject_CheckBuffer(obj))
     {
-        PyErr_Format(PyExc_ValueError,
-                     "Exceeded maximum allowed recursion level (%d), " \
-                     "possibly circular reference detected", encodedData->max_depth);
+        if (PyObject_GetBuffer(obj, &column->view, PyBUF_STRIDES | PyBUF_FORMAT) == 0)
+        {
+            column->format = encoder_column_format(&column->view);
+
+            if (column->format != 0) return column->view.shape[0];
+
+            PyBuffer_Release(&column->view);
+        }
+        else
+            PyErr_Clear();
+    }
+
+    column->seq = PySequence_Tuple(obj);
 
+    if (column->seq == NULL)
+    {
         encoder_data_set_error(encodedData);
+        return -1;
     }
+
+    return PyTuple_GET_SIZE(column->seq);
 }
 
-/* used for max-recursion-depth/loop tracking */
-static void dec_depth (EncodedData * encodedData)
+static void encoder_column_close (EncoderColumn * column)
 {
-    encodedData->depth--;
+    if (column->format != 0)
+        PyBuffer_Release(&column->view);
+
+    Py_CLEAR(column->seq);
 }
 
-static void encode_list (PyObject * obj, EncodedData * encodedData)
+// reads a number of type 'type' from 'p', which may not be aligned
+#define COLUMN_READ(type, p, var) do { type _item; memcpy(&_item, (p), sizeof(type)); var = _item; } while (0)
+
+static void encode_column_value (EncoderColumn * column, Py_ssize_t index, EncodedData * encodedData)
 {
-    inc_depth(encodedData);
+    if (column->seq != NULL)
+        return encode(PyTuple_GET_ITEM(column->seq, index), encodedData);
 
-    encoder_data_append_char(encodedData, '[');
+    const char * p = (const char *)column->view.buf + index * column->view.strides[0];
 
-    Py_ssize_t i;
-    for (i = 0; i < PyList_GET_SIZE(obj); i++)
-    {
-        if (i!=0) encoder_data_append_char(encodedData, ',');
+    long long          n = 0;
+    unsigned long long u = 0;
+    double             d = 0;
 
-        encode(PyList_GET_ITEM(obj, i), encodedData);
+    switch (column->format)
+    {
+        case 'b': COLUMN_READ(signed char, p, n); return encode_longlong(n, encodedData);
+        case 'h': COLUMN_READ(short,       p, n); return encode_longlong(n, encodedData);
+        case 'i': COLUMN_READ(int,         p, n); return encode_longlong(n, encodedData);
+        case 'l': COLUMN_READ(long,        p, n); return encode_longlong(n, encodedData);
+        case 'q': COLUMN_READ(long long,   p, n); return encode_longlong(n, encodedData);
+        case 'n': COLUMN_READ(Py_ssize_t,  p, n); return encode_longlong(n, encodedData);
+
+        case 'B': COLUMN_READ(unsigned char,      p, u); return encode_ulonglong(u, encodedData);
+        case 'H': COLUMN_READ(unsigned short,     p, u); return encode_ulonglong(u, encodedData);
+        case 'I': COLUMN_READ(unsigned int,       p, u); return encode_ulonglong(u, encodedData);
+        case 'L': COLUMN_READ(unsigned long,      p, u); return encode_ulonglong(u, encodedData);
+        case 'Q': COLUMN_READ(unsigned long long, p, u); return encode_ulonglong(u, encodedData);
+        case 'N': COLUMN_READ(size_t,             p, u); return encode_ulonglong(u, encodedData);
+
+        case 'f': COLUMN_READ(float,  p, d); return encode_double(d, encodedData);
+        case 'd': COLUMN_READ(double, p, d); return encode_double(d, encodedData);
+
+        case '?':
+            COLUMN_READ(_Bool, p, n);
+            return n ? encode_true(encodedData) : encode_false(encodedData);
     }
-
-    encoder_data_append_char(encodedData, ']');
-
-    dec_depth(encodedData);
 }
 
-static void encode_tuple (PyObject * obj, EncodedData * encodedData)
-{
-    inc_depth(encodedData);
-
-    encoder_data_append_char(encodedData, '[');
+/*===========================================================================
+ * implemention: RawJSON class
+ *===========================================================================*/
 
-    Py_ssize_t i;
-    for (i = 0; i < PyTuple_GET_SIZE(obj); i++)
+/*
+ * Returns true if the bytes can be output as is: printable ASCII other than
+ * the HTML special chars, and whitespace.
+ */
+static bool rawjson_is_safe (const unsigned char * p, Py_ssize_t size)
+{
+    for (Py_ssize_t i = 0; i < size; i++)
     {
-        if (i!=0) encoder_data_append_char(encodedData, ',');
+        unsigned char c = p[i];
 
-        encode(PyTuple_GET_ITEM(obj, i), encodedData);
+        if ((c < ' ' || c > '~' || c == '<' || c == '>' || c == '&') &&
+            c != '\t' && c != '\n' && c != '\r')
+            return false;
     }
 
-    encoder_data_append_char(encodedData, ']');
-
-    dec_depth(encodedData);
+    return true;
 }
 
-static void encode_dict (PyObject * obj, EncodedData * encodedData)
+/*
+ * Returns the text of 'str' as bytes, with the characters which are not safe
+ * (see rawjson_is_safe()) escaped the way the encoder escapes them in strings.
+ */
+static PyObject * rawjson_escape (PyObject * str)
 {
-    inc_depth(encodedData);
-
-    encoder_data_append_char(encodedData, '{');
+    if (ENCODER_UNICODE_READY(str) < 0) return NULL;
 
-    bool has_values = false;
-    Py_ssize_t pos;
-    PyObject *key, *value;
+    int          kind = PyUnicode_KIND(str);
+    const void * data = PyUnicode_DATA(str);
+    Py_ssize_t   size = PyUnicode_GET_LENGTH(str);
 
-    pos = 0;
-    while (PyDict_Next(obj, &pos, &key, &value))
-    {
-        if (has_values) encoder_data_append_char(encodedData, ',');
-        has_values = true;
+    EncodedData output;
 
-        encode_key (key, encodedData);
+    encoder_data_init(&output, NULL, 0, false);
 
-        if (encoder_data_has_error(encodedData)) return;
+    PyObject * result = NULL;
 
-        encoder_data_append_char(encodedData, ':');
+    if (!encoder_data_has_error(&output) &&
+        encoder_data_reserve_space(&output, size * CHAR_MAX_EXPANSION))
+    {
+        for (Py_ssize_t i = 0; i < size; i++)
+        {
+            Py_UCS4 c = PyUnicode_READ(kind, data, i);
 
-        encode (value, encodedData);
+            if (c == '\t' || c == '\n' || c == '\r')
+                encoder_data_append_ch_nocheck(&output, c);
+            else
+                encode_char(&output, c, false);
+        }
 
-        if (encoder_data_has_error(encodedData)) return;
+        result = PyBytes_FromStringAndSize(output.buffer, encoder_data_get_size(&output));
     }
 
-    encoder_data_append_char(encodedData, '}');
+    encoder_data_destruct(&output);
 
-    dec_depth(encodedData);
+    return result;
 }
 
-static void encode_set (PyObject * obj, EncodedData * encodedData)
+/*
+ * Returns a new reference to the bytes to splice into the output for the JSON
+ * text 'data' (a str or a bytes-like object), see rawjson_doc.
+ */
+static PyObject * rawjson_text (PyObject * data, bool validated)
 {
-    inc_depth(encodedData);
+    PyObject * str;
 
-    Py_ssize_t set_size = PyObject_Size(obj);
+    if (PyUnicode_Check(data))
+    {
+        if (validated) return PyUnicode_AsUTF8String(data);
 
-    if (set_size == -1) return encoder_not_serializable(obj, encodedData);
+        Py_INCREF(str = data);
+    }
+    else
+    {
+        Py_buffer view;
 
-    PyObject * it = PyObject_GetIter(obj);
+        if (PyObject_GetBuffer(data, &view, PyBUF_SIMPLE) < 0) return NULL;
 
-    if (it == NULL) return encoder_not_serializable(obj, encodedData);
+        if (validated || rawjson_is_safe((const unsigned char *)view.buf, view.len))
+        {
+            PyObject * bytes;
 
-    encoder_data_append_char(encodedData, '[');
+            if (PyBytes_CheckExact(data))
+                Py_INCREF(bytes = data);
+            else
+                bytes = PyBytes_FromStringAndSize((const char *)view.buf, view.len);
 
-    bool has_values = false;
-    PyObject *value;
-    while ((value = PyIter_Next(it)) != NULL)
-    {
-        if (has_values) encoder_data_append_char(encodedData, ',');
-        has_values = true;
+            PyBuffer_Release(&view);
+            return bytes;
+        }
 
-        encode(value, encodedData);
+        str = PyUnicode_DecodeUTF8((const char *)view.buf, view.len, NULL);
 
-        Py_DECREF(value);
+        PyBuffer_Release(&view);
+
+        if (str == NULL) return NULL;
     }
-    Py_DECREF(it);
 
-    encoder_data_append_char(encodedData, ']');
+    PyObject * bytes = rawjson_escape(str);
 
-    dec_depth(encodedData);
+    Py_DECREF(str);
 
-    if (PyErr_Occurred()) return encoder_not_serializable(obj, encodedData);
+    return bytes;
 }
 
-static void encode_mapping (PyObject * obj, EncodedData * encodedData)
+static PyObject * _rawjson_new (PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
-    inc_depth(encodedData);
+    PyObject *data;
+    int validated = 1;
 
-    PyObject * it = PyObject_GetIter(obj);
+    static char *kwlist[] = {"data", "validated", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p", kwlist, &data, &validated))
+        return NULL;
 
-    if (it == NULL) return encoder_not_serializable(obj, encodedData);
+    PyObject * text = rawjson_text(data, validated);
 
-    encoder_data_append_char(encodedData, '{');
+    if (text == NULL) return NULL;
 
-    bool has_values = false;
-    PyObject *value;
-    PyObject *key;
-    while ((key = PyIter_Next(it)) != NULL)
+    PyRawJSONObject * self = (PyRawJSONObject*)type->tp_alloc(type, 0);
+
+    if (self == NULL)
     {
-        if (has_values) encoder_data_append_char(encodedData, ',');
-        has_values = true;
+        Py_DECREF(text);
+        return NULL;
+    }
 
-        encode_key(key, encodedData);
+    self->data = text;
 
-        if (encoder_data_has_error(encodedData)) goto done;
+    return (PyObject*)self;
+}
 
-        encoder_data_append_char(encodedData, ':');
+static void _rawjson_dealloc (PyObject *self)
+{
+    PyTypeObject * type = Py_TYPE(self);
 
-        value = PyObject_GetItem(obj, key);
+    Py_XDECREF(((PyRawJSONObject*)self)->data);
 
-        if (value==NULL) {
-            Py_DECREF(key);
-            encoder_data_set_error(encodedData);
-            goto done;
-        }
+    type->tp_free(self);
 
-        encode(value, encodedData);
+    Py_DECREF(type);
+}
 
-        Py_DECREF(key);
-        Py_DECREF(value);
+static PyObject * _rawjson_repr (PyObject *self)
+{
+    return PyUnicode_FromFormat("RawJSON(%R)", ((PyRawJSONObject*)self)->data);
+}
 
-        if (encoder_data_has_error(encodedData)) goto done;
-    }
+static PyObject * rawjson_get_data (PyObject *self, void *closure)
+{
+    PyObject * data = ((PyRawJSONObject*)self)->data;
 
-    encoder_data_append_char(encodedData, '}');
+    Py_INCREF(data);
+    return data;
+}
 
-    dec_depth(encodedData);
+static PyObject * rawjson_mm_json (PyObject *self, PyObject *unused)
+{
+    return rawjson_get_data(self, NULL);
+}
 
-  done:
-    Py_DECREF(it);
+static PyObject * rawjson_reduce (PyObject *self, PyObject *unused)
+{
+    // the data is safe already, no need to check it again
+    return Py_BuildValue("O(O)", (PyObject*)Py_TYPE(self), ((PyRawJSONObject*)self)->data);
 }
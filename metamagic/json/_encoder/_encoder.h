@@ -13,20 +13,86 @@
 // see http://ecma262-5.com/ELS5_HTML.htm#Section_8.5 for Java number specs
 #define JAVASCRIPT_MAXINT 9007199254740992
 
-// type objects for some not-built-in types natively supported by the encoder
-static PyTypeObject* PyType_UUID;
-static PyTypeObject* PyType_Decimal;
-static PyTypeObject* PyType_Col_OrderedDict;
-static PyTypeObject* PyType_Col_Set;
-static PyTypeObject* PyType_Col_Sequence;
-static PyTypeObject* PyType_Col_Mapping;
+// critical sections only exist (and are only needed) in free-threaded builds
+#ifndef Py_BEGIN_CRITICAL_SECTION
+#define Py_BEGIN_CRITICAL_SECTION(op) {
+#define Py_END_CRITICAL_SECTION()     }
+#endif
+
+// modules of the classes natively supported by the encoder, which are not
+// imported by the encoder itself
+typedef enum
+{
+    MODULE_UUID,
+    MODULE_DECIMAL,
+    MODULE_COLLECTIONS,
+    MODULE_COLLECTIONS_ABC,
+    MODULE_DATETIME,
+    ENCODER_MODULES
+}
+EncoderModule;
+
+/*
+ * State of the _encoder module.  Every (sub)interpreter importing the module
+ * gets its own copy, so no Python objects are shared between interpreters.
+ */
+typedef struct _EncoderState
+{
+    // the Encoder and RawJSON classes (heap types)
+    PyTypeObject * PyEncoder_Type;
+    PyTypeObject * PyRawJSON_Type;
+
+    // type objects for some not-built-in types natively supported by the encoder;
+    // NULL until their modules are imported, see encoder_state_load_types()
+    PyTypeObject * PyType_UUID;
+    PyTypeObject * PyType_Decimal;
+    PyTypeObject * PyType_Col_OrderedDict;
+    PyTypeObject * PyType_Col_Set;
+    PyTypeObject * PyType_Col_Sequence;
+    PyTypeObject * PyType_Col_Mapping;
+    bool           types_loaded;        // all of the above (and datetime) are loaded
+
+    PyObject * module_names[ENCODER_MODULES];
+
+#ifdef Py_GIL_DISABLED
+    PyMutex types_mutex;
+#endif
 
-// base class for the Encoder class we implement in c
-static PyTypeObject* PyType_BaseEncoder;
+    // the Encoder used when C API users pass no encoder instance
+    PyObject * capi_default_encoder;
+
+    // exported as the _C_API capsule, see metamagic_json.h
+    MMJson_CAPI capi;
+}
+EncoderState;
 
 typedef struct {
     PyObject_HEAD
     bool use_hook;
+    EncoderState * state;       // of the module defining the Encoder class
 } PyEncoderObject;
 
+// a pre-encoded JSON fragment, spliced into the output as is
+typedef struct {
+    PyObject_HEAD
+    PyObject * data;            // bytes, ASCII unless created with unchecked non-ASCII data
+} PyRawJSONObject;
+
+// the module state of the encoder instance doing the encoding
+static inline EncoderState * encoder_state (EncodedData * data)
+{
+    return ((PyEncoderObject*)data->self)->state;
+}
+
+// isinstance() checks against the classes of the module state, which may be NULL
+static inline bool encoder_type_check (PyObject * obj, PyTypeObject * type)
+{
+    return type != NULL && PyObject_TypeCheck(obj, type);
+}
+
+static inline bool encoder_is_instance (PyObject * obj, PyTypeObject * type)
+{
+    return type != NULL && PyObject_IsInstance(obj, (PyObject*)type) == 1;
+}
+
 #endif
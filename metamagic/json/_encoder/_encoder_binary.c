@@ -0,0 +1,299 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#include "_encoder_binary.h"
+
+
+/*==  common helpers  ==============================================*/
+
+static void binary_out_of_range (PyObject * obj, EncodedData * encodedData)
+{
+    PyErr_Clear();
+    PyErr_Format(PyExc_ValueError, "Number out of range: %R", obj);
+    encoder_data_set_error(encodedData);
+}
+
+/*
+ * Writes the 'prefix' byte followed by the 'size' lowest bytes of 'value'
+ * in the big-endian (network) byte order.
+ */
+static void binary_append_header (EncodedData * encodedData, unsigned char prefix,
+                                  uint64_t value, int size)
+{
+    if (!encoder_data_reserve_space(encodedData, size + 1)) return;
+
+    encoder_data_append_ch_nocheck(encodedData, prefix);
+
+    while (size-- > 0)
+        encoder_data_append_ch_nocheck(encodedData, (unsigned char)(value >> (size * 8)));
+}
+
+static uint64_t binary_double_bits (PyObject * obj)
+{
+    double value = PyFloat_AsDouble(obj);
+    uint64_t bits;
+
+    memcpy(&bits, &value, sizeof(bits));
+
+    return bits;
+}
+
+/*
+ * Returns the 16 bytes of a UUID as a new bytes() object, or NULL with
+ * the error set.
+ */
+static PyObject * binary_uuid_bytes (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * bytes = PyObject_GetAttrString(obj, "bytes");
+
+    if (bytes != NULL && (!PyBytes_Check(bytes) || PyBytes_GET_SIZE(bytes) != 16))
+    {
+        Py_CLEAR(bytes);
+        PyErr_Format(PyExc_TypeError, "%R is not serializable: invalid UUID bytes", obj);
+    }
+
+    if (bytes == NULL) encoder_data_set_error(encodedData);
+
+    return bytes;
+}
+
+/*==  MessagePack  =================================================*/
+
+static void msgpack_encode_none (EncodedData * encodedData)
+{
+    encoder_data_append_char(encodedData, (char)0xc0);
+}
+
+static void msgpack_encode_bool (bool value, EncodedData * encodedData)
+{
+    encoder_data_append_char(encodedData, value ? (char)0xc3 : (char)0xc2);
+}
+
+static void msgpack_encode_integer (PyObject * obj, EncodedData * encodedData)
+{
+    int overflow;
+    long long value = PyLong_AsLongLongAndOverflow(obj, &overflow);
+
+    if (overflow > 0)
+    {
+        unsigned long long uvalue = PyLong_AsUnsignedLongLong(obj);
+
+        if (PyErr_Occurred()) return binary_out_of_range(obj, encodedData);
+
+        return binary_append_header(encodedData, 0xcf, uvalue, 8);
+    }
+
+    if (overflow < 0 || (value == -1 && PyErr_Occurred()))
+        return binary_out_of_range(obj, encodedData);
+
+    if (value >= 0)
+    {
+        if      (value < 0x80)        encoder_data_append_char(encodedData, (char)value);
+        else if (value < 0x100)       binary_append_header(encodedData, 0xcc, value, 1);
+        else if (value < 0x10000)     binary_append_header(encodedData, 0xcd, value, 2);
+        else if (value < 0x100000000) binary_append_header(encodedData, 0xce, value, 4);
+        else                          binary_append_header(encodedData, 0xcf, value, 8);
+    }
+    else
+    {
+        if      (value >= -32)          encoder_data_append_char(encodedData, (char)value);
+        else if (value >= -0x80)        binary_append_header(encodedData, 0xd0, value, 1);
+        else if (value >= -0x8000)      binary_append_header(encodedData, 0xd1, value, 2);
+        else if (value >= -0x80000000LL) binary_append_header(encodedData, 0xd2, value, 4);
+        else                            binary_append_header(encodedData, 0xd3, value, 8);
+    }
+}
+
+static void msgpack_encode_float (PyObject * obj, EncodedData * encodedData)
+{
+    binary_append_header(encodedData, 0xcb, binary_double_bits(obj), 8);
+}
+
+static void msgpack_encode_string (PyObject * obj, EncodedData * encodedData)
+{
+    Py_ssize_t size;
+    const char * utf8 = PyUnicode_AsUTF8AndSize(obj, &size);
+
+    if (utf8 == NULL) return encoder_data_set_error(encodedData);
+
+    if      (size < 32)          encoder_data_append_char(encodedData, (char)(0xa0 | size));
+    else if (size < 0x100)       binary_append_header(encodedData, 0xd9, size, 1);
+    else if (size < 0x10000)     binary_append_header(encodedData, 0xda, size, 2);
+    else if (size < 0x100000000) binary_append_header(encodedData, 0xdb, size, 4);
+    else
+    {
+        PyErr_SetString(PyExc_ValueError, "String is too long for MessagePack");
+        return encoder_data_set_error(encodedData);
+    }
+
+    encoder_data_append(encodedData, utf8, size);
+}
+
+static void msgpack_encode_uuid (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * bytes = binary_uuid_bytes(obj, encodedData);
+
+    if (bytes == NULL) return;
+
+    // bin 8
+    binary_append_header(encodedData, 0xc4, 16, 1);
+    encoder_data_append(encodedData, PyBytes_AS_STRING(bytes), 16);
+
+    Py_DECREF(bytes);
+}
+
+static void msgpack_begin_container (Py_ssize_t size, EncodedData * encodedData,
+                                     unsigned char fix, unsigned char prefix16)
+{
+    if      (size < 16)          encoder_data_append_char(encodedData, (char)(fix | size));
+    else if (size < 0x10000)     binary_append_header(encodedData, prefix16, size, 2);
+    else if (size < 0x100000000) binary_append_header(encodedData, prefix16 + 1, size, 4);
+    else
+    {
+        PyErr_SetString(PyExc_ValueError, "Container is too large for MessagePack");
+        encoder_data_set_error(encodedData);
+    }
+}
+
+static void msgpack_begin_array (Py_ssize_t size, EncodedData * encodedData)
+{
+    msgpack_begin_container(size, encodedData, 0x90, 0xdc);
+}
+
+static void msgpack_begin_map (Py_ssize_t size, EncodedData * encodedData)
+{
+    msgpack_begin_container(size, encodedData, 0x80, 0xde);
+}
+
+static const EncoderEmitter msgpack_emitter = {
+    "MessagePack",
+    msgpack_encode_none,
+    msgpack_encode_bool,
+    msgpack_encode_integer,
+    msgpack_encode_float,
+    msgpack_encode_string,
+    msgpack_encode_uuid,
+    msgpack_begin_array,
+    msgpack_begin_map
+};
+
+/*==  CBOR  ========================================================*/
+
+#define CBOR_UNSIGNED   0
+#define CBOR_NEGATIVE   1
+#define CBOR_BYTES      2
+#define CBOR_TEXT       3
+#define CBOR_ARRAY      4
+#define CBOR_MAP        5
+#define CBOR_TAG        6
+
+#define CBOR_TAG_UUID  37   // see http://www.iana.org/assignments/cbor-tags
+
+/* writes the initial byte of a data item of the 'major' type and its argument */
+static void cbor_append_head (EncodedData * encodedData, int major, uint64_t value)
+{
+    unsigned char prefix = (unsigned char)(major << 5);
+
+    if      (value < 24)          encoder_data_append_char(encodedData, (char)(prefix | value));
+    else if (value < 0x100)       binary_append_header(encodedData, prefix | 24, value, 1);
+    else if (value < 0x10000)     binary_append_header(encodedData, prefix | 25, value, 2);
+    else if (value < 0x100000000) binary_append_header(encodedData, prefix | 26, value, 4);
+    else                          binary_append_header(encodedData, prefix | 27, value, 8);
+}
+
+static void cbor_encode_none (EncodedData * encodedData)
+{
+    encoder_data_append_char(encodedData, (char)0xf6);
+}
+
+static void cbor_encode_bool (bool value, EncodedData * encodedData)
+{
+    encoder_data_append_char(encodedData, value ? (char)0xf5 : (char)0xf4);
+}
+
+static void cbor_encode_integer (PyObject * obj, EncodedData * encodedData)
+{
+    int overflow;
+    long long value = PyLong_AsLongLongAndOverflow(obj, &overflow);
+
+    if (overflow == 0)
+    {
+        if (value == -1 && PyErr_Occurred()) return binary_out_of_range(obj, encodedData);
+
+        if (value >= 0)
+            cbor_append_head(encodedData, CBOR_UNSIGNED, (uint64_t)value);
+        else
+            cbor_append_head(encodedData, CBOR_NEGATIVE, ~(uint64_t)value);  // -1 - value
+
+        return;
+    }
+
+    // integers up to 2**64 - 1 and down to -2**64 are supported without tags;
+    // a negative integer is encoded as (-1 - value)
+    PyObject * argument = overflow > 0 ? (Py_INCREF(obj), obj) : PyNumber_Invert(obj);
+
+    if (argument == NULL) return encoder_data_set_error(encodedData);
+
+    unsigned long long uvalue = PyLong_AsUnsignedLongLong(argument);
+
+    Py_DECREF(argument);
+
+    if (PyErr_Occurred()) return binary_out_of_range(obj, encodedData);
+
+    cbor_append_head(encodedData, overflow > 0 ? CBOR_UNSIGNED : CBOR_NEGATIVE, uvalue);
+}
+
+static void cbor_encode_float (PyObject * obj, EncodedData * encodedData)
+{
+    binary_append_header(encodedData, 0xfb, binary_double_bits(obj), 8);
+}
+
+static void cbor_encode_string (PyObject * obj, EncodedData * encodedData)
+{
+    Py_ssize_t size;
+    const char * utf8 = PyUnicode_AsUTF8AndSize(obj, &size);
+
+    if (utf8 == NULL) return encoder_data_set_error(encodedData);
+
+    cbor_append_head(encodedData, CBOR_TEXT, size);
+    encoder_data_append(encodedData, utf8, size);
+}
+
+static void cbor_encode_uuid (PyObject * obj, EncodedData * encodedData)
+{
+    PyObject * bytes = binary_uuid_bytes(obj, encodedData);
+
+    if (bytes == NULL) return;
+
+    cbor_append_head(encodedData, CBOR_TAG, CBOR_TAG_UUID);
+    cbor_append_head(encodedData, CBOR_BYTES, 16);
+    encoder_data_append(encodedData, PyBytes_AS_STRING(bytes), 16);
+
+    Py_DECREF(bytes);
+}
+
+static void cbor_begin_array (Py_ssize_t size, EncodedData * encodedData)
+{
+    cbor_append_head(encodedData, CBOR_ARRAY, size);
+}
+
+static void cbor_begin_map (Py_ssize_t size, EncodedData * encodedData)
+{
+    cbor_append_head(encodedData, CBOR_MAP, size);
+}
+
+static const EncoderEmitter cbor_emitter = {
+    "CBOR",
+    cbor_encode_none,
+    cbor_encode_bool,
+    cbor_encode_integer,
+    cbor_encode_float,
+    cbor_encode_string,
+    cbor_encode_uuid,
+    cbor_begin_array,
+    cbor_begin_map
+};
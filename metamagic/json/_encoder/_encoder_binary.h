@@ -0,0 +1,46 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+#ifndef ___ENCODER_BINARY_H__
+#define ___ENCODER_BINARY_H__
+
+#include <stdint.h>
+
+#include "_encoder_buffer.h"
+
+/*
+ * Binary output formats share the traversal (type dispatch, __mm_serialize__,
+ * default(), encode_hook() and the nesting depth checks) with the JSON encoder;
+ * an emitter only writes the encoded values.
+ *
+ * Binary formats have no item separators or closing brackets, but the number
+ * of items has to be known when a container is opened.
+ *
+ * Decimals and dates/times are written as strings, the same as in JSON.
+ */
+struct _EncoderEmitter
+{
+    const char * name;
+
+    void (*encode_none)    (EncodedData * encodedData);
+    void (*encode_bool)    (bool value, EncodedData * encodedData);
+    void (*encode_integer) (PyObject * obj, EncodedData * encodedData);
+    void (*encode_float)   (PyObject * obj, EncodedData * encodedData);
+    void (*encode_string)  (PyObject * obj, EncodedData * encodedData);
+    void (*encode_uuid)    (PyObject * obj, EncodedData * encodedData);
+
+    void (*begin_array)    (Py_ssize_t size, EncodedData * encodedData);
+    void (*begin_map)      (Py_ssize_t size, EncodedData * encodedData);
+};
+
+// MessagePack, see https://github.com/msgpack/msgpack/blob/master/spec.md
+static const EncoderEmitter msgpack_emitter;
+
+// CBOR, see RFC 7049
+static const EncoderEmitter cbor_emitter;
+
+#endif
@@ -7,18 +7,54 @@
 
 #include "_encoder_buffer.h"
 
-static void encoder_data_init (EncodedData * data, PyObject *self, int max_depth, bool use_hook)
+static void _encoder_data_init_state (EncodedData * data, PyObject *self, int max_depth, bool use_hook)
 {
     data->depth     = 0;
     data->max_depth = max_depth;
+
+    data->frames           = data->frames_inline;
+    data->frames_allocated = INLINE_FRAMES;
     data->self      = self;
     data->use_hook  = use_hook;
+    data->error     = false;
+
+    data->flush        = NULL;
+    data->flush_arg    = NULL;
+    data->flushed_size = 0;
+
+    data->max_output_size = -1;
+
+    data->canonical = false;
+    data->emitter   = NULL;
+
+    data->external      = NULL;
+    data->external_size = 0;
+}
+
+static void encoder_data_init (EncodedData * data, PyObject *self, int max_depth, bool use_hook)
+{
+    _encoder_data_init_state(data, self, max_depth, use_hook);
 
     _encoder_buffer_allocate(data, DEFAULT_BUFFER_SIZE);
 
     data->buffer_free = data->buffer;
 }
 
+static void encoder_data_init_external (EncodedData * data, PyObject *self, int max_depth, bool use_hook,
+                                        MMJsonBuffer * external)
+// the output is appended to the 'external' buffer instead of the encoder's own one
+{
+    _encoder_data_init_state(data, self, max_depth, use_hook);
+
+    data->external      = external;
+    data->external_size = external->size;
+
+    data->buffer      = external->data;
+    data->buffer_size = external->allocated;
+    data->buffer_end  = data->buffer + data->buffer_size;
+    data->buffer_free = data->buffer + external->size;
+}
+
 static bool _encoder_buffer_allocate (EncodedData * data, Py_ssize_t size)
 // current allocation is ignored
 {
@@ -44,6 +80,26 @@ static bool _encoder_buffer_grow (EncodedData * data, Py_ssize_t new_size)
 {
     if (new_size <= data->buffer_size) return true;
 
+    if (data->external != NULL)
+    {
+        MMJsonBuffer * external = data->external;
+
+        external->size = data->buffer_free - data->buffer;
+
+        if (external->grow(external, new_size) < 0)
+        {
+            encoder_data_set_error(data);
+            return false;
+        }
+
+        data->buffer      = external->data;
+        data->buffer_size = external->allocated;
+        data->buffer_end  = data->buffer + data->buffer_size;
+        data->buffer_free = data->buffer + external->size;
+
+        return true;
+    }
+
     BUFFERTYPE * old_buffer      = data->buffer;
     Py_ssize_t   old_buffer_size = data->buffer_size;
     BUFFERTYPE * old_buffer_free = data->buffer_free;
@@ -62,9 +118,168 @@ static bool _encoder_buffer_grow (EncodedData * data, Py_ssize_t new_size)
 
 static void encoder_data_destruct (EncodedData * data)
 {
+    while (data->depth > 0)
+        encoder_data_pop_frame(data);
+
+    if (data->frames != data->frames_inline)
+        PyMem_Free(data->frames);
+
+    if (data->external != NULL)
+    {
+        // on errors the output is discarded
+        data->external->size = encoder_data_has_error(data) ?
+                                    data->external_size : data->buffer_free - data->buffer;
+        return;
+    }
+
     PyMem_Free(data->buffer);
 }
 
+static void encoder_data_depth_error (EncodedData * data)
+{
+    PyErr_Format(PyExc_ValueError,
+                 "Exceeded maximum allowed recursion level (%d), " \
+                 "possibly circular reference detected", data->max_depth);
+
+    encoder_data_set_error(data);
+}
+
+static EncoderFrame * encoder_data_push_frame (EncodedData * data, EncoderFrameType type,
+                                               PyObject * container, PyObject * iterator)
+// steals the reference to 'iterator'; returns NULL (with the error set) if the
+// maximum nesting depth is exceeded or the frame stack could not be grown
+{
+    if (data->depth >= data->max_depth)
+    {
+        Py_XDECREF(iterator);
+        encoder_data_depth_error(data);
+        return NULL;
+    }
+
+    if (data->depth == data->frames_allocated)
+    {
+        int new_allocated = data->frames_allocated * 2;
+        EncoderFrame * frames = PyMem_Malloc(new_allocated * sizeof(EncoderFrame));
+
+        if (frames == NULL)
+        {
+            PyErr_NoMemory();
+            Py_XDECREF(iterator);
+            encoder_data_set_error(data);
+            return NULL;
+        }
+
+        memcpy(frames, data->frames, data->depth * sizeof(EncoderFrame));
+
+        if (data->frames != data->frames_inline)
+            PyMem_Free(data->frames);
+
+        data->frames           = frames;
+        data->frames_allocated = new_allocated;
+    }
+
+    EncoderFrame * frame = &data->frames[data->depth++];
+
+    Py_INCREF(container);
+
+    frame->type       = type;
+    frame->container  = container;
+    frame->iterator   = iterator;
+    frame->pos        = 0;
+    frame->count      = 0;
+    frame->size       = -1;
+
+    return frame;
+}
+
+static void encoder_data_pop_frame (EncodedData * data)
+{
+    EncoderFrame * frame = &data->frames[--data->depth];
+
+    Py_DECREF(frame->container);
+    Py_XDECREF(frame->iterator);
+}
+
+static void encoder_data_set_flush (EncodedData * data, encoder_flush_func flush, void * flush_arg)
+{
+    data->flush     = flush;
+    data->flush_arg = flush_arg;
+}
+
+static void encoder_data_set_max_output_size (EncodedData * data, Py_ssize_t max_output_size)
+{
+    data->max_output_size = max_output_size;
+}
+
+static void encoder_data_set_canonical (EncodedData * data, bool canonical)
+{
+    data->canonical = canonical;
+}
+
+static void encoder_data_set_emitter (EncodedData * data, const EncoderEmitter * emitter)
+{
+    data->emitter = emitter;
+}
+
+static bool encoder_data_check_output_size (EncodedData * data, Py_ssize_t pending_size)
+// sets a metamagic.json.exceptions.OutputTooLargeError error if the output produced
+// so far plus 'pending_size' bytes exceeds the allowed output size
+{
+    if (data->max_output_size < 0) return true;
+
+    Py_ssize_t size = data->flushed_size + encoder_data_get_size(data) + pending_size;
+
+    if (size <= data->max_output_size) return true;
+
+    if (encoder_data_has_error(data)) return false;
+
+    PyObject* mod_exceptions = PyImport_ImportModule("metamagic.json.exceptions");
+
+    if (mod_exceptions != NULL)
+    {
+        PyObject* exc = PyObject_CallMethod(mod_exceptions, "OutputTooLargeError", "nn",
+                                            size, data->max_output_size);
+        if (exc != NULL)
+        {
+            PyErr_SetObject((PyObject*)Py_TYPE(exc), exc);
+            Py_DECREF(exc);
+        }
+
+        Py_DECREF(mod_exceptions);
+    }
+
+    encoder_data_set_error(data);
+    return false;
+}
+
+static bool encoder_data_flush (EncodedData * data)
+// passes all buffered data to the flush function and empties the buffer
+{
+    if (encoder_data_has_error(data)) return false;
+
+    Py_ssize_t size = encoder_data_get_size(data);
+
+    if (size == 0) return true;
+
+    // never pass anything above the allowed output size to the consumer
+    if (!encoder_data_check_output_size(data, 0))
+    {
+        data->buffer_free = data->buffer;
+        return false;
+    }
+
+    bool flushed = data->flush(data, data->buffer, size);
+
+    // the buffer is emptied even if flush() failed: the output is discarded
+    // anyway, and the caller may still rely on the space it has reserved
+    data->buffer_free   = data->buffer;
+    data->flushed_size += size;
+
+    if (!flushed) encoder_data_set_error(data);
+
+    return flushed;
+}
+
 static Py_ssize_t encoder_data_get_size (EncodedData * data)
 {
     return (data->buffer_free - data->buffer);
@@ -74,7 +289,18 @@ static bool encoder_data_reserve_space (EncodedData * data, Py_ssize_t size)
 {
     if (data->buffer_free + size >= data->buffer_end)
     {
-        if (encoder_data_has_error(data)) return false;
+        // the output limit is checked as the buffer fills up, so that the encoding
+        // is stopped early; space is still reserved, the output will be discarded
+        encoder_data_check_output_size(data, 0);
+
+        if (data->flush != NULL && !encoder_data_has_error(data))
+        {
+            // streaming output: hand over the filled buffer and reuse it
+            encoder_data_flush(data);
+
+            if (data->buffer_free + size < data->buffer_end)
+                return !encoder_data_has_error(data);
+        }
 
         // try to allocate twice the size of currently used space + size
         Py_ssize_t need_size = data->buffer_size > size? data->buffer_size*2 : size*2;
@@ -83,6 +309,16 @@ static bool encoder_data_reserve_space (EncodedData * data, Py_ssize_t size)
         if (need_size > data->buffer_size + MAX_EXTRA_ALLOCATION_SIZE)
             need_size = encoder_data_get_size(data) + size + MAX_EXTRA_ALLOCATION_SIZE;
 
+        // do not allocate much more than the allowed output size
+        if (data->max_output_size >= 0 &&
+            need_size > data->max_output_size - data->flushed_size + size)
+        {
+            need_size = data->max_output_size - data->flushed_size + size;
+
+            if (need_size < encoder_data_get_size(data) + size)
+                need_size = encoder_data_get_size(data) + size;
+        }
+
         // make requested size a multiple of DEFAULT_BUFFER_SIZE
         // (in theory shoudl improve memory fragmentation in the OS)
         Py_ssize_t alloc_size = need_size + (DEFAULT_BUFFER_SIZE - need_size % DEFAULT_BUFFER_SIZE);
@@ -91,17 +327,17 @@ static bool encoder_data_reserve_space (EncodedData * data, Py_ssize_t size)
     }
     // else: do nothing, already have enough space in currently allocated buffer
 
-    return true;
+    return !encoder_data_has_error(data);
 }
 
 static bool encoder_data_has_error (EncodedData * data)
 {
-    return data->buffer_size == -1;
+    return data->error;
 }
 
 static void encoder_data_set_error (EncodedData * data)
 {
-    data->buffer_size = -1;
+    data->error = true;
 }
 
 static void encoder_data_append (EncodedData * data, const BUFFERTYPE* str, Py_ssize_t str_length)
@@ -125,11 +361,6 @@ static void encoder_data_append_ch_nocheck (EncodedData * data, const BUFFERTYPE
     *data->buffer_free++ = ch;
 }
 
-static void encoder_data_place_ch_nocheck (EncodedData * data, const BUFFERTYPE ch, int offset)
-{
-    data->buffer_free[offset] = ch;
-}
-
 static void encoder_data_append_cstr (EncodedData * data, const char * cstr, Py_ssize_t max_size)
 {
     if(!encoder_data_reserve_space(data, max_size)) return;
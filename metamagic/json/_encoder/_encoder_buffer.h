@@ -11,17 +11,64 @@
 #include <Python.h>
 #include <stdbool.h>
 
+#define METAMAGIC_JSON_MODULE
+#include "../include/metamagic_json.h"
+
 #define BUFFERTYPE char
 
 #define DEFAULT_BUFFER_SIZE          65536   // initial size of the buffer
 #define MAX_EXTRA_ALLOCATION_SIZE  4194304   // max allocated above requested
 
+#define INLINE_FRAMES                   32   // frames stored in EncodedData itself
+
 /*====================================================================*/
 
+typedef struct _EncodedData EncodedData;
+
+// output format other than JSON, see _encoder_binary.h
+typedef struct _EncoderEmitter EncoderEmitter;
+
+// kinds of containers being encoded
+typedef enum
+{
+    FRAME_LIST,                                 // exact list or subclass
+    FRAME_TUPLE,                                // exact tuple or subclass
+    FRAME_DICT,                                 // exact dict
+    FRAME_ITERABLE,                             // set, collections.Set/Sequence
+    FRAME_MAPPING,                              // any other mapping
+    FRAME_SORTED_DICT,                          // canonical mode: list of (key, index, value)
+    FRAME_SORTED_SET                            // canonical mode: list of encoded items
+}
+EncoderFrameType;
+
+// state of a container being encoded: the encoder keeps an explicit stack
+// of these instead of recursing on the C stack
 typedef struct
 {
-    int depth;                                  // current recursion depth
-    int max_depth;                              // max alowed recursion depth
+    EncoderFrameType type;
+
+    PyObject * container;                       // owned reference
+    PyObject * iterator;                        // owned reference or NULL
+    Py_ssize_t pos;                             // list/tuple index, dict position
+
+    Py_ssize_t count;                           // number of items taken so far
+    Py_ssize_t size;                            // number of items announced in the output
+                                                //   (binary formats only)
+}
+EncoderFrame;
+
+// consumer of the encoded output: called with the contents of the filled
+// buffer, should return false (with a Python exception set) on failure
+typedef bool (*encoder_flush_func) (EncodedData * data, const BUFFERTYPE * chunk, Py_ssize_t size);
+
+struct _EncodedData
+{
+    int depth;                                  // current nesting depth == number of frames
+    int max_depth;                              // max alowed nesting depth
+
+    EncoderFrame * frames;                      // stack of containers being encoded
+    int            frames_allocated;
+    EncoderFrame   frames_inline[INLINE_FRAMES];
 
     BUFFERTYPE * buffer;                        // output buffer start
     BUFFERTYPE * buffer_free;                   // first empty char in the buffer
@@ -32,12 +79,44 @@ typedef struct
     PyObject *self;
 
     bool use_hook;
-}
-EncodedData;
+
+    bool error;                                 // a Python exception is set
+
+    encoder_flush_func flush;                   // when set the buffer is flushed
+    void *             flush_arg;               //   instead of being grown
+    Py_ssize_t         flushed_size;            // total size of flushed output
+
+    Py_ssize_t max_output_size;                 // max allowed output size, -1 if unlimited
+
+    bool canonical;                             // sort dict keys and set items
+
+    const EncoderEmitter * emitter;             // NULL for JSON
+
+    MMJsonBuffer * external;                    // buffer owned by a C API user, or NULL
+    Py_ssize_t     external_size;               //   its size before encoding
+};
 
 static void encoder_data_init (EncodedData * data, PyObject *self, int max_depth, bool use_hook);
+static void encoder_data_init_external (EncodedData * data, PyObject *self, int max_depth, bool use_hook,
+                                        MMJsonBuffer * external);
 static void encoder_data_destruct (EncodedData * data);
 
+static EncoderFrame * encoder_data_push_frame (EncodedData * data, EncoderFrameType type,
+                                               PyObject * container, PyObject * iterator);
+static void encoder_data_pop_frame (EncodedData * data);
+
+// raises the "Exceeded maximum allowed recursion level" ValueError
+static void encoder_data_depth_error (EncodedData * data);
+
+static void encoder_data_set_flush (EncodedData * data, encoder_flush_func flush, void * flush_arg);
+static bool encoder_data_flush (EncodedData * data);
+
+static void encoder_data_set_max_output_size (EncodedData * data, Py_ssize_t max_output_size);
+static bool encoder_data_check_output_size (EncodedData * data, Py_ssize_t pending_size);
+
+static void encoder_data_set_canonical (EncodedData * data, bool canonical);
+static void encoder_data_set_emitter   (EncodedData * data, const EncoderEmitter * emitter);
+
 static bool encoder_data_reserve_space (EncodedData * data, Py_ssize_t size);
 
 static Py_ssize_t encoder_data_get_size (EncodedData * data);
@@ -45,10 +124,10 @@ static Py_ssize_t encoder_data_get_size (EncodedData * data);
 static bool encoder_data_has_error (EncodedData * data);
 static void encoder_data_set_error (EncodedData * data);
 
+static void encoder_data_append (EncodedData * data, const BUFFERTYPE* str, Py_ssize_t str_length);
 static void encoder_data_append_cstr (EncodedData * data, const char * cstr, Py_ssize_t max_size);
 static void encoder_data_append_char (EncodedData * data, const BUFFERTYPE ch);
 static void encoder_data_append_ch_nocheck (EncodedData * data, const BUFFERTYPE ch);
-static void encoder_data_place_ch_nocheck (EncodedData * data, const BUFFERTYPE ch, int offset);
 
 // current memory is ignored
 static bool _encoder_buffer_allocate (EncodedData * data, Py_ssize_t size);
@@ -7,156 +7,80 @@
 
 #include "_encoder_stringify.h"
 
+/* "00" "01" ... "99": the two decimal digits of every number below 100 */
+static const char DIGIT_PAIRS[201] =
+    "00010203040506070809"
+    "10111213141516171819"
+    "20212223242526272829"
+    "30313233343536373839"
+    "40414243444546474849"
+    "50515253545556575859"
+    "60616263646566676869"
+    "70717273747576777879"
+    "80818283848586878889"
+    "90919293949596979899";
+
 /*
- * See http://stackoverflow.com/questions/4351371/c-performance-challenge-integer-to-stdstring-conversion
- *
- * This implementation is based on http://ideone.com/0uhhX
+ * Digits are produced two at a time (one division by 100 per pair) from the end
+ * of a small buffer, so the length of the number need not be known in advance.
  *
+ * See http://stackoverflow.com/questions/4351371/c-performance-challenge-integer-to-stdstring-conversion
  */
 static void longlong_to_string (long long n, EncodedData * encodedData)
 {
     // longest possible integer is -JAVASCRIPT_MAXINT which is 17 bytes long
-    encoder_data_reserve_space(encodedData, 18);
+    if (!encoder_data_reserve_space(encodedData, 18)) return;
 
-    if (n == 0)
-    {
-        encoder_data_append_ch_nocheck(encodedData, '0');
-        return;
-    }
+    char   digits[20];
+    char * p = digits + sizeof(digits);
 
-    int sign = -(n<0);
+    unsigned long long val = n < 0 ? 0 - (unsigned long long)n : (unsigned long long)n;
 
-    if (sign) encoder_data_append_ch_nocheck(encodedData, '-');
+    while (val >= 100)
+    {
+        unsigned int pair = (unsigned int)(val % 100);
 
-    unsigned long long val = (n^sign)-sign;
+        val /= 100;
+        p   -= 2;
+        memcpy(p, DIGIT_PAIRS + pair * 2, 2);
+    }
 
-    // JAVASCRIPT_MAXINT == 9007199254740992
-    int size;
-    if (val >= 10000)
+    if (val >= 10)
     {
-        if (val >= 10000000)
-        {
-            if (val >= 1000000000)
-            {
-                if (val >= 1000000000000)
-                {
-                    if (val >= 1000000000000000)
-                        size = 16;
-                    else if (val >= 100000000000000)
-                        size = 15;
-                    else if (val >= 10000000000000)
-                        size = 14;
-                    else
-                        size = 13;
-                }
-                else
-                {
-                    if (val >= 100000000000)
-                        size = 12;
-                    else if (val >= 10000000000)
-                        size = 11;
-                    else
-                        size = 10;
-                }
-            }
-            else if (val >= 100000000)
-                size = 9;
-            else
-                size = 8;
-        }
-        else
-        {
-            if (val >= 1000000)
-                size = 7;
-            else if (val >= 100000)
-                size = 6;
-            else
-                size = 5;
-        }
+        p -= 2;
+        memcpy(p, DIGIT_PAIRS + val * 2, 2);
     }
     else
-    {
-        if (val >= 100)
-        {
-            if (val >= 1000)
-                size = 4;
-            else
-                size = 3;
-        }
-        else
-        {
-            if (val >= 10)
-            {
-                encoder_data_append_ch_nocheck(encodedData, '0' + val/10);
-                encoder_data_append_ch_nocheck(encodedData, '0' + val % 10);
-                return;
-            }
-            else
-            {
-                encoder_data_append_ch_nocheck(encodedData, '0' + val);
-                return;
-            }
-        }
-    }
+        *--p = (char)('0' + val);
 
-    int offset = size-1;
-    while (val >= 10)
-    {
-        encoder_data_place_ch_nocheck(encodedData, '0' + (val%10), offset--);
-        val /= 10;
-    }
-    encoder_data_place_ch_nocheck(encodedData, '0' + val, offset);
+    if (n < 0) *--p = '-';
 
+    Py_ssize_t size = digits + sizeof(digits) - p;
+
+    memcpy(encodedData->buffer_free, p, size);
     encodedData->buffer_free += size;
 }
 
 
 static void datevalue_to_string (unsigned int n, EncodedData * encodedData, int fill_to_size)
 {
-    // longest supported number is 999999 (to support 100000 microseconds)
-    encoder_data_reserve_space(encodedData, 6);
+    // fields are fixed-width: the pairs are written from the right, with no
+    // need to count the digits (6 is for microseconds, up to 999999)
+    char * p = encodedData->buffer_free + fill_to_size;
 
-    int size;
-    if (n >= 100)
-    {
-        if (n >= 10000)
-        {
-            if (n >= 100000)
-                size = 6;
-            else
-                size = 5;
-        }
-        else
-        {
-            if (n >= 1000)
-                size = 4;
-            else
-                size = 3;
-        }
-    }
-    else
+    switch (fill_to_size)
     {
-        if (n >= 10)
-            size = 2;
-        else
-            size = 1;
+        case 6:
+            memcpy(p - 6, DIGIT_PAIRS + (n / 10000) * 2, 2);
+            n %= 10000;
+            // fall through
+        case 4:
+            memcpy(p - 4, DIGIT_PAIRS + (n / 100) * 2, 2);
+            n %= 100;
+            // fall through
+        default:
+            memcpy(p - 2, DIGIT_PAIRS + n * 2, 2);
     }
 
-    int i;
-    for (i = 0; i < fill_to_size - size; i++)
-        encoder_data_append_ch_nocheck(encodedData, '0');
-
-    if (n == 0)
-    {
-        encoder_data_append_ch_nocheck(encodedData, '0');
-        return;
-    }
-
-    int offset = size-1;
-    while (n > 0)
-    {
-        encoder_data_place_ch_nocheck(encodedData, '0' + (n%10), offset--);
-        n /= 10;
-    }
-    encodedData->buffer_free += size;
+    encodedData->buffer_free = p;
 }
@@ -10,11 +10,23 @@
 
 #include "_encoder_buffer.h"
 
+/* ints of at most one internal digit (abs < 2**30, or 2**15 with 15-bit digits)
+ * are "compact": their value is read directly, with no overflow checks */
+#if PY_VERSION_HEX >= 0x030C0000
+#define ENCODER_LONG_IS_COMPACT(op)     PyUnstable_Long_IsCompact((PyLongObject*)(op))
+#define ENCODER_LONG_COMPACT_VALUE(op)  PyUnstable_Long_CompactValue((PyLongObject*)(op))
+#else
+// before 3.12 the size of an int is its number of digits, negative for negative ints
+#define ENCODER_LONG_IS_COMPACT(op)     (Py_SIZE(op) >= -1 && Py_SIZE(op) <= 1)
+#define ENCODER_LONG_COMPACT_VALUE(op)  (Py_SIZE(op) * (Py_ssize_t)((PyLongObject*)(op))->ob_digit[0])
+#endif
+
 /* prints 'n' to buffer 'encodedData'. There should be at most 16 decimal digits */
 static void longlong_to_string (long long n, EncodedData * encodedData);
 
 /* prints 'n' to buffer 'encodedData', filling with 0s on the left until
- * printed size is 'fill_to_size' characters. 'n' sould have at most 6 significant digits */
+ * printed size is 'fill_to_size' characters (2, 4 or 6). 'n' should have at most
+ * 'fill_to_size' digits; space for them should be reserved by the caller */
 static void datevalue_to_string (unsigned int n, EncodedData * encodedData, int fill_to_size);
 
 #endif
@@ -0,0 +1,204 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""asyncio-friendly encoding and decoding.
+
+   Encoding a large object holds the event loop for as long as it takes;
+   ``dumpb_async()`` encodes small objects inline and offloads large ones to
+   an executor, and ``dumpb_chunks()`` produces the output of the encoder
+   piece by piece, so that the consumer can apply backpressure
+   (e.g. with ``StreamWriter.drain()``) between the chunks.
+
+   ``loadb_iter_async()`` decodes the JSON values of a stream (e.g. JSON Lines
+   read from a socket) as they arrive.
+
+   Note: the C encoder holds the GIL while encoding, so with a thread
+   executor the event loop keeps running in the GIL switch intervals
+   (see ``sys.setswitchinterval()``) rather than fully in parallel.
+"""
+
+
+__all__ = ('dumpb_async', 'dumpb_chunks', 'loadb_iter_async')
+
+
+import asyncio
+import functools
+import threading
+
+try:
+    from ._encoder import Encoder
+except ImportError:
+    from .encoder import Encoder
+
+from .stream import IncrementalDecoder
+
+
+def _is_small(obj, limit):
+    """Return True if ``obj`` has less than ``limit`` items, counting the items
+       of all nested lists, tuples and dicts (a string counts as an item per each
+       64 characters).  Stops as soon as the limit is reached.
+    """
+    count = 0
+    stack = [obj]
+
+    while stack:
+        obj = stack.pop()
+        _objtype = obj.__class__
+
+        if _objtype is list or _objtype is tuple:
+            count += len(obj)
+            if count >= limit:
+                return False
+            stack.extend(obj)
+
+        elif _objtype is dict:
+            count += len(obj)
+            if count >= limit:
+                return False
+            stack.extend(obj.values())
+
+        elif _objtype is str or _objtype is bytes:
+            count += 1 + (len(obj) >> 6)
+            if count >= limit:
+                return False
+
+        else:
+            count += 1
+
+    return count < limit
+
+
+async def dumpb_async(obj, *, encoder=Encoder, executor=None, inline_threshold=2000,
+                      max_nested_level=100):
+    """Return a JSON representation of ``obj`` in a bytes() array.
+
+       Objects with less than ``inline_threshold`` items (counting the items of
+       all nested lists, tuples and dicts) are encoded right away, larger ones
+       are encoded in ``executor`` (the default executor of the event loop if
+       ``None``).  ``encoder`` is an Encoder class or instance.
+    """
+    if isinstance(encoder, type):
+        encoder = encoder()
+
+    if _is_small(obj, inline_threshold):
+        return encoder.dumpb(obj, max_nested_level=max_nested_level)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(encoder.dumpb, obj, max_nested_level=max_nested_level))
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _ChunkWriter:
+    """File-like object passing chunks written by ``Encoder.dump()`` in an
+       executor thread to a queue consumed in the event loop."""
+
+    def __init__(self, loop, queue, max_pending):
+        self.loop = loop
+        self.queue = queue
+        self.slots = threading.Semaphore(max_pending)
+        self.cancelled = False
+
+    def write(self, data):
+        # blocks the encoding thread while the consumer is behind
+        self.slots.acquire()
+        if self.cancelled:
+            raise _Cancelled()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, data)
+
+
+_DONE = object()
+
+
+async def dumpb_chunks(obj, *, encoder=Encoder, executor=None, max_pending=4,
+                       max_nested_level=100):
+    """Asynchronously iterate over the JSON representation of ``obj`` in chunks.
+
+       The object is encoded with ``Encoder.dump()`` in ``executor`` (the default
+       executor of the event loop if ``None``); chunks of output are produced
+       as soon as the encoder's buffer fills up.  At most ``max_pending`` chunks
+       are buffered: the encoder waits until the consumer catches up.
+
+       Exceptions raised by the encoder are re-raised by the iterator.  Closing
+       the iterator early (``aclose()``) aborts the encoder.
+
+       **Example**:
+
+       .. code-block:: python
+
+           async for chunk in dumpb_chunks(data):
+               writer.write(chunk)
+               await writer.drain()
+    """
+    if isinstance(encoder, type):
+        encoder = encoder()
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    writer = _ChunkWriter(loop, queue, max_pending)
+
+    def produce():
+        try:
+            encoder.dump(obj, writer, max_nested_level=max_nested_level)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+    producer = loop.run_in_executor(executor, produce)
+
+    try:
+        while True:
+            data = await queue.get()
+            if data is _DONE:
+                break
+            writer.slots.release()
+            yield data
+
+    except BaseException:
+        # the consumer has stopped early: abort the encoder
+        writer.cancelled = True
+        writer.slots.release()
+        try:
+            await producer
+        except Exception:
+            pass
+        raise
+
+    await producer
+
+
+async def loadb_iter_async(reader, *, array=False, schema=None, chunk_size=65536, **options):
+    """Asynchronously iterate over the JSON values read from ``reader``, an
+       ``asyncio.StreamReader`` or any object with a ``read(n)`` coroutine method,
+       in chunks of at most ``chunk_size`` bytes; see
+       ``metamagic.json.stream.IncrementalDecoder`` for the other arguments.
+
+       Values are produced as soon as they are complete, and only the unfinished
+       value is buffered: the peer is slowed down by the transport's flow control
+       while the consumer is busy.
+
+       **Example**:
+
+       .. code-block:: python
+
+           async for record in loadb_iter_async(reader):
+               await process(record)
+    """
+    decoder = IncrementalDecoder(array=array, schema=schema, **options)
+
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        for value in decoder.feed(chunk):
+            yield value
+
+    for value in decoder.close():
+        yield value
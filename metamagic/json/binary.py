@@ -0,0 +1,148 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""Binary output formats (MessagePack and CBOR) for the Python version of the
+encoder, see ``Encoder.dumpmsgpack()`` and ``Encoder.dumpcbor()``.
+
+Emitters only produce the encoded representation of single values and of
+container headers; the traversal (and the ``__mm_serialize__``, ``default()``
+and ``encode_hook()`` protocol) is shared with the JSON encoder.
+"""
+
+
+import struct
+
+
+__all__ = ('MsgPackEmitter', 'CBOREmitter')
+
+
+_pack_double = struct.Struct('>d').pack
+
+
+class MsgPackEmitter:
+    """See https://github.com/msgpack/msgpack/blob/master/spec.md"""
+
+    name = 'MessagePack'
+
+    # (prefix, format, max/min value), in the order of preference
+    _UINT_FORMATS = ((0xcc, '>BB', 0xff), (0xcd, '>BH', 0xffff),
+                     (0xce, '>BI', 0xffffffff), (0xcf, '>BQ', 0xffffffffffffffff))
+    _INT_FORMATS = ((0xd0, '>Bb', -0x80), (0xd1, '>Bh', -0x8000),
+                    (0xd2, '>Bi', -0x80000000), (0xd3, '>Bq', -0x8000000000000000))
+
+    def none(self):
+        return b'\xc0'
+
+    def boolean(self, value):
+        return b'\xc3' if value else b'\xc2'
+
+    def integer(self, value):
+        if -32 <= value < 0x80:
+            return struct.pack('>b', value)
+
+        if value > 0:
+            for prefix, fmt, max_value in self._UINT_FORMATS:
+                if value <= max_value:
+                    return struct.pack(fmt, prefix, value)
+        else:
+            for prefix, fmt, min_value in self._INT_FORMATS:
+                if value >= min_value:
+                    return struct.pack(fmt, prefix, value)
+
+        raise ValueError('Number out of range: {!r}'.format(value))
+
+    def float(self, value):
+        return b'\xcb' + _pack_double(value)
+
+    def string(self, value):
+        data = value.encode('utf-8')
+        size = len(data)
+
+        if size < 32:
+            return bytes((0xa0 | size,)) + data
+        if size < 0x100:
+            return struct.pack('>BB', 0xd9, size) + data
+        if size < 0x10000:
+            return struct.pack('>BH', 0xda, size) + data
+        if size < 0x100000000:
+            return struct.pack('>BI', 0xdb, size) + data
+
+        raise ValueError('String is too long for MessagePack')
+
+    def uuid(self, value):
+        return b'\xc4\x10' + value.bytes
+
+    def _container(self, size, fix, prefix16):
+        if size < 16:
+            return bytes((fix | size,))
+        if size < 0x10000:
+            return struct.pack('>BH', prefix16, size)
+        if size < 0x100000000:
+            return struct.pack('>BI', prefix16 + 1, size)
+
+        raise ValueError('Container is too large for MessagePack')
+
+    def array(self, size):
+        return self._container(size, 0x90, 0xdc)
+
+    def map(self, size):
+        return self._container(size, 0x80, 0xde)
+
+
+class CBOREmitter:
+    """See RFC 7049"""
+
+    name = 'CBOR'
+
+    _UNSIGNED, _NEGATIVE, _BYTES, _TEXT, _ARRAY, _MAP, _TAG = range(7)
+
+    _TAG_UUID = 37
+
+    def _head(self, major, value):
+        major <<= 5
+
+        if value < 24:
+            return bytes((major | value,))
+        if value < 0x100:
+            return struct.pack('>BB', major | 24, value)
+        if value < 0x10000:
+            return struct.pack('>BH', major | 25, value)
+        if value < 0x100000000:
+            return struct.pack('>BI', major | 26, value)
+        return struct.pack('>BQ', major | 27, value)
+
+    def none(self):
+        return b'\xf6'
+
+    def boolean(self, value):
+        return b'\xf5' if value else b'\xf4'
+
+    def integer(self, value):
+        if not -0x10000000000000000 <= value <= 0xffffffffffffffff:
+            raise ValueError('Number out of range: {!r}'.format(value))
+
+        if value >= 0:
+            return self._head(self._UNSIGNED, value)
+        else:
+            return self._head(self._NEGATIVE, -1 - value)
+
+    def float(self, value):
+        return b'\xfb' + _pack_double(value)
+
+    def string(self, value):
+        data = value.encode('utf-8')
+        return self._head(self._TEXT, len(data)) + data
+
+    def uuid(self, value):
+        return self._head(self._TAG, self._TAG_UUID) + self._head(self._BYTES, 16) + value.bytes
+
+    def array(self, size):
+        return self._head(self._ARRAY, size)
+
+    def map(self, size):
+        return self._head(self._MAP, size)
@@ -0,0 +1,83 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""Compression of the encoded output using the standard library codecs."""
+
+
+__all__ = ('COMPRESSION_METHODS', 'get_compressor', 'compress', 'CompressedWriter')
+
+
+COMPRESSION_METHODS = ('gzip', 'deflate', 'bz2', 'xz')
+
+
+def get_compressor(method, level=None):
+    """Return a new compressor object for the given compression ``method``.
+
+       ``method`` is one of ``'gzip'``, ``'deflate'`` (zlib format, as used by
+       the HTTP "deflate" content coding), ``'bz2'`` or ``'xz'``.  ``level`` is
+       the codec-specific compression level; codec default is used if ``None``.
+
+       The returned object has the ``compress(data)`` and ``flush()`` methods.
+    """
+    if method == 'gzip' or method == 'deflate':
+        import zlib
+        wbits = zlib.MAX_WBITS | 16 if method == 'gzip' else zlib.MAX_WBITS
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    if method == 'bz2':
+        import bz2
+        return bz2.BZ2Compressor(9 if level is None else level)
+
+    if method == 'xz':
+        import lzma
+        return lzma.LZMACompressor(preset=level)
+
+    raise ValueError('unsupported compression method: {!r}'.format(method))
+
+
+def compress(data, method, level=None):
+    """Return ``data`` compressed with the given ``method`` (see ``get_compressor``)."""
+    compressor = get_compressor(method, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressedWriter:
+    """A file-like wrapper which compresses everything written to it.
+
+       Compressed output is written to ``fp``, as soon as the compressor
+       produces it.  If ``fp`` is ``None`` the compressed output is collected
+       in memory and returned by ``finish()``.
+
+       ``finish()`` must be called after the last ``write()`` to flush the
+       compressor; ``fp`` itself is never closed.
+    """
+
+    def __init__(self, fp, method, level=None):
+        self._compressor = get_compressor(method, level)
+
+        if fp is None:
+            self._chunks = []
+            self._write = self._chunks.append
+        else:
+            self._chunks = None
+            self._write = fp.write
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._write(compressed)
+
+    def finish(self):
+        self._write(self._compressor.flush())
+
+        if self._chunks is not None:
+            result = b''.join(self._chunks)
+            self._chunks.clear()
+            return result
@@ -0,0 +1,557 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""A Python implementation of the ``_decoder`` extension module, used when
+the extension is not available."""
+
+
+__all__ = ('Decoder', 'scan', 'decode', 'find_value_end', 'extract')
+
+
+import json
+import re
+from array import array
+
+from .exceptions import DecodeError
+
+
+# a token after optional whitespace; the group matched tells its kind
+_TOKEN = re.compile(br'''
+    [ \t\n\r]*
+    (?:
+        ("(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*")            # string
+      | (-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null   # other scalars
+         |NaN|-?Infinity)
+      | ([{\[])                                                              # container start
+      | ([}\],:])                                                            # punctuation
+    )''', re.VERBOSE)
+
+_WHITESPACE = re.compile(br'[ \t\n\r]*')
+
+_STRING, _SCALAR, _OPEN, _PUNCTUATION = 1, 2, 3, 4
+
+# what the scanner expects next
+_VALUE, _KEY, _COLON, _COMMA = range(4)
+
+_EXPECTING = {
+    _VALUE: 'Expecting value',
+    _KEY:   'Expecting property name enclosed in double quotes',
+    _COLON: "Expecting ':' delimiter",
+    _COMMA: "Expecting ',' delimiter",
+}
+
+_CLOSING = {ord('{'): ord('}'), ord('['): ord(']')}
+
+
+def _skip_whitespace(data, pos):
+    return _WHITESPACE.match(data, pos).end()
+
+
+def scan(data):
+    """Validate the JSON document in the bytes-like object ``data`` and return its
+       structural index: a ``bytes`` array of (start offset, end offset, index of
+       the next entry) triples of native 64-bit integers, one for every value and
+       object key in document order, which can be read with ``memoryview(tape).cast('q')``.
+
+       Raises ``DecodeError`` for invalid documents.
+    """
+
+    data = memoryview(data).cast('B')
+
+    tape = array('q')
+    stack = []                          # (tape index, closing char) of open containers
+    match = _TOKEN.match
+    expect = _VALUE
+    pos = 0
+
+    while True:
+        token = match(data, pos)
+        if token is None:
+            pos = _skip_whitespace(data, pos)
+            if expect in (_VALUE, _KEY) and pos < len(data) and data[pos] == ord('"'):
+                raise DecodeError('Invalid string', pos)
+            raise DecodeError(_EXPECTING[expect], pos)
+
+        kind = token.lastindex
+        start, pos = token.span(kind)
+
+        if expect == _VALUE or (expect == _KEY and kind == _STRING):
+            index = len(tape) // 3
+
+            if kind == _STRING or kind == _SCALAR:
+                tape.extend((start, pos, index + 1))
+                if expect == _KEY:
+                    expect = _COLON
+                    continue
+
+            elif kind == _OPEN:
+                closing = _CLOSING[data[start]]
+                tape.extend((start, start, index + 1))
+
+                after = _skip_whitespace(data, pos)
+                if after < len(data) and data[after] == closing:
+                    pos = after + 1
+                    tape[index * 3 + 1] = pos
+                else:
+                    stack.append((index, closing))
+                    expect = _KEY if closing == ord('}') else _VALUE
+                    continue
+
+            else:
+                raise DecodeError(_EXPECTING[expect], start)
+
+        elif expect == _COLON and data[start] == ord(':'):
+            expect = _VALUE
+            continue
+
+        elif expect == _COMMA and kind == _PUNCTUATION and data[start] != ord(':'):
+            index, closing = stack[-1]
+
+            if data[start] == ord(','):
+                expect = _KEY if closing == ord('}') else _VALUE
+                continue
+
+            if data[start] != closing:
+                raise DecodeError(_EXPECTING[expect], start)
+
+            tape[index * 3 + 1] = pos
+            tape[index * 3 + 2] = len(tape) // 3
+            stack.pop()
+
+        else:
+            raise DecodeError(_EXPECTING[expect], start)
+
+        # a value is complete
+        if not stack:
+            break
+        expect = _COMMA
+
+    end = _skip_whitespace(data, pos)
+    if end != len(data):
+        raise DecodeError('Extra data', end)
+
+    return tape.tobytes()
+
+
+def decode(data, start=0, end=None, schema=None, parse=0):
+    """Decode the JSON value found in the bytes-like object ``data`` between the
+       ``start`` and ``end`` offsets (by default the whole of ``data``), which may
+       only be surrounded by whitespace.
+
+       ``schema`` is the ``node`` of a compiled ``metamagic.json.Schema``; unlike
+       in the C version the value is decoded first and then converted.
+
+       ``parse`` is a combination of the ``PARSE_*`` flags of the C version:
+       values not described by ``schema`` in the formats written by the encoder
+       are converted.  Unlike in the C version, strings with escapes are
+       converted as well.
+
+       Raises ``DecodeError`` for invalid JSON; unlike in the C version the
+       position of the error is only exact for ASCII input, and the position
+       of values not matching the schema is ``start``.
+    """
+
+    # the views are released on return, so that e.g. an mmap can be closed
+    # even if a traceback refers to this frame
+    with memoryview(data) as view, view.cast('B') as data:
+        if end is None:
+            end = len(data)
+        if not 0 <= start <= end <= len(data):
+            raise ValueError('start and end must be offsets within data')
+
+        with data[start:end] as value:
+            text = str(value, 'utf-8', 'surrogatepass')
+
+    if parse & ~_PARSE_FLAGS:
+        raise ValueError('invalid parse flags')
+
+    # numbers are decoded to Decimals from their text, as in the C version,
+    # and the floats of the values with no Decimal spec are converted back
+    parse_float = None
+    if parse & _PARSE_DECIMAL_NUMBERS or _has_decimal(schema, set()):
+        from decimal import Decimal as parse_float
+        parse |= _DECIMAL_FLOATS
+
+    try:
+        value = json.loads(text, parse_float=parse_float)
+    except json.JSONDecodeError as e:
+        raise DecodeError(e.msg, start + e.pos) from None
+
+    if schema is not None or parse & _PARSE_STRINGS:
+        value = _convert(value, schema, start, parse)
+
+    return value
+
+
+class Decoder:
+    """A Python version of the ``_decoder.Decoder`` class: ``decode()`` is the
+       same as the ``decode()`` function, whose keys are only shared within one
+       call; ``max_keys`` is ignored.
+    """
+
+    def __init__(self, max_keys=4096):
+        if max_keys < 0:
+            raise ValueError('max_keys must not be negative')
+
+    def decode(self, data, start=0, end=None, schema=None, parse=0):
+        """Decode the JSON value found in ``data`` between the ``start`` and
+           ``end`` offsets, see ``decode()``."""
+        return decode(data, start, end, schema, parse)
+
+    def clear(self):
+        """Forget the object keys interned so far."""
+
+
+# see SCHEMA_* in _decoder/_decoder.h and metamagic.json.schema
+_SCHEMA_UUID, _SCHEMA_DATETIME, _SCHEMA_DATE, _SCHEMA_TIME, _SCHEMA_DECIMAL, \
+    _SCHEMA_LIST, _SCHEMA_DICT, _SCHEMA_OBJECT, _SCHEMA_ANY = range(1, 10)
+
+_SCHEMA_EXPECTING = {
+    _SCHEMA_UUID:     'Expecting a UUID string',
+    _SCHEMA_DATETIME: 'Expecting a datetime string',
+    _SCHEMA_DATE:     'Expecting a date string',
+    _SCHEMA_TIME:     'Expecting a time string',
+    _SCHEMA_DECIMAL:  'Expecting a decimal number or string',
+    _SCHEMA_LIST:     'Expecting an array',
+    _SCHEMA_DICT:     'Expecting an object',
+    _SCHEMA_OBJECT:   'Expecting an object',
+}
+
+# the formats written by the encoder, see _decoder/_decoder_types.h
+_UUID_FORMAT = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                          r'[0-9a-fA-F]{12}\Z')
+_DATE_FORMAT = r'([0-9]{4})-([0-9]{2})-([0-9]{2})'
+_TIME_FORMAT = r'([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?(?:([-+])([0-9]{2}):([0-9]{2})|(Z))?'
+_DATETIME_FORMAT = re.compile(_DATE_FORMAT + 'T' + _TIME_FORMAT + r'\Z')
+_TIME_FORMAT = re.compile(_TIME_FORMAT + r'\Z')
+_DATE_FORMAT = re.compile(_DATE_FORMAT + r'\Z')
+_DECIMAL_FORMAT = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?\Z')
+
+# see PARSE_* in _decoder/_decoder.h
+_PARSE_UUID, _PARSE_DATETIME, _PARSE_DECIMAL_STRINGS, _PARSE_DECIMAL_NUMBERS = 0x01, 0x02, 0x04, 0x08
+_PARSE_STRINGS = _PARSE_UUID | _PARSE_DATETIME | _PARSE_DECIMAL_STRINGS
+_PARSE_FLAGS = _PARSE_STRINGS | _PARSE_DECIMAL_NUMBERS
+
+# not a flag of the C version: numbers with a fraction or an exponent were
+# decoded to Decimals, for the schema or for _PARSE_DECIMAL_NUMBERS
+_DECIMAL_FLOATS = 0x100
+
+
+def _make_time(groups):
+    from datetime import time, timedelta, timezone
+
+    hour, minute, second, fraction, sign, tz_hour, tz_minute, utc = groups
+
+    tzinfo = None
+    if utc:
+        tzinfo = timezone.utc
+    elif sign:
+        if int(tz_hour) > 23 or int(tz_minute) > 59:
+            raise ValueError('invalid UTC offset')
+        offset = timedelta(hours=int(tz_hour), minutes=int(tz_minute))
+        tzinfo = timezone(-offset if sign == '-' else offset)
+
+    return time(int(hour), int(minute), int(second), int((fraction or '0').ljust(6, '0')),
+                tzinfo)
+
+
+def _convert_scalar(kind, value):
+    # the converted value, or None if it does not match
+    if kind == _SCHEMA_DECIMAL:
+        from decimal import Decimal
+
+        if isinstance(value, Decimal):
+            # a number with a fraction or an exponent, see decode()
+            return value
+        if isinstance(value, str):
+            return Decimal(value) if _DECIMAL_FORMAT.match(value) else None
+        if type(value) is int:
+            return Decimal(value)
+        # NaN and Infinity are floats
+        return None
+
+    if not isinstance(value, str):
+        return None
+
+    if kind == _SCHEMA_UUID:
+        from uuid import UUID
+        return UUID(value) if _UUID_FORMAT.match(value) else None
+
+    from datetime import date, datetime
+
+    try:
+        if kind == _SCHEMA_DATE:
+            match = _DATE_FORMAT.match(value)
+            return match and date(*map(int, match.groups()))
+
+        if kind == _SCHEMA_TIME:
+            match = _TIME_FORMAT.match(value)
+            return match and _make_time(match.groups())
+
+        match = _DATETIME_FORMAT.match(value)
+        return match and datetime.combine(date(*map(int, match.groups()[:3])),
+                                          _make_time(match.groups()[3:]))
+    except ValueError:
+        # out of range
+        return None
+
+
+def _parse_string(value, parse):
+    # the string converted as told by the _PARSE_* flags 'parse', or None;
+    # the same formats are tried as by decoder_parse_string() in _decoder.c
+    size = len(value)
+
+    if parse & _PARSE_UUID and size == 36 and value[8] == '-':
+        return _convert_scalar(_SCHEMA_UUID, value)
+
+    if parse & _PARSE_DATETIME:
+        if size == 10 and value[4] == '-':
+            return _convert_scalar(_SCHEMA_DATE, value)
+        if size >= 19 and value[4] == '-' and value[10] == 'T':
+            return _convert_scalar(_SCHEMA_DATETIME, value)
+        if size >= 8 and value[2] == ':':
+            return _convert_scalar(_SCHEMA_TIME, value)
+
+    if parse & _PARSE_DECIMAL_STRINGS and size and (value[0] == '-' or '0' <= value[0] <= '9'):
+        return _convert_scalar(_SCHEMA_DECIMAL, value)
+
+    return None
+
+
+def _parse(value, parse):
+    """Returns ``value`` with the strings in it converted as told by the
+       ``_PARSE_*`` flags ``parse``."""
+
+    if type(value) is str:
+        converted = _parse_string(value, parse)
+        return value if converted is None else converted
+    if type(value) is list:
+        return [_parse(item, parse) for item in value]
+    if type(value) is dict:
+        return {key: _parse(item, parse) for key, item in value.items()}
+    return value
+
+
+def _has_decimal(node, seen):
+    # whether the schema 'node' has a _SCHEMA_DECIMAL node; 'seen' has the
+    # ids of the nodes walked so far, which can refer to themselves
+    if node is None or id(node) in seen:
+        return False
+    seen.add(id(node))
+
+    kind = node[0]
+    if kind == _SCHEMA_DECIMAL:
+        return True
+    if kind in (_SCHEMA_LIST, _SCHEMA_DICT):
+        return _has_decimal(node[1], seen)
+    if kind == _SCHEMA_OBJECT:
+        return any(_has_decimal(field[1], seen) for field in node[1].values())
+    return False
+
+
+def _unparse(value):
+    # 'value' with the Decimals decoded with _DECIMAL_FLOATS back to floats,
+    # the same as if decoded from the same text
+    from decimal import Decimal
+
+    if type(value) is Decimal:
+        return float(value)
+    if type(value) is list:
+        return [_unparse(item) for item in value]
+    if type(value) is dict:
+        return {key: _unparse(item) for key, item in value.items()}
+    return value
+
+
+def _convert(value, node, pos, parse=0):
+    """Returns ``value`` converted as described by the schema ``node``, and
+       the values with no node as told by the ``_PARSE_*`` flags ``parse``."""
+
+    if node is None:
+        if parse & _DECIMAL_FLOATS and not parse & _PARSE_DECIMAL_NUMBERS:
+            value = _unparse(value)
+        return _parse(value, parse) if parse & _PARSE_STRINGS else value
+    if value is None:
+        return value
+
+    kind = node[0]
+
+    if kind == _SCHEMA_ANY:
+        return _unparse(value) if parse & _DECIMAL_FLOATS else value
+
+    if kind <= _SCHEMA_DECIMAL:
+        converted = _convert_scalar(kind, value)
+
+    elif kind == _SCHEMA_LIST:
+        converted = [_convert(item, node[1], pos, parse) for item in value] \
+                        if type(value) is list else None
+
+    elif type(value) is not dict:
+        converted = None
+
+    elif kind == _SCHEMA_DICT:
+        converted = {key: _convert(item, node[1], pos, parse) for key, item in value.items()}
+
+    else:
+        fields, cls = node[1], node[2]
+        converted = {}
+        for key, item in value.items():
+            field = fields.get(key)
+            if field is not None:
+                converted[key] = _convert(item, field[1], pos, parse)
+            elif cls is None:
+                converted[key] = _convert(item, None, pos, parse)
+        if cls is not None:
+            converted = cls(**converted)
+
+    if converted is None:
+        raise DecodeError(_SCHEMA_EXPECTING[kind], pos)
+
+    return converted
+
+
+# a component of a dotted path which is an array index as well
+_INDEX = re.compile(r'[0-9]{1,18}\Z')
+
+
+def _extract_path(value, path, default):
+    dotted = isinstance(path, str)
+    if dotted:
+        path = path.split('.')
+    elif not isinstance(path, tuple):
+        raise TypeError('a path must be a str or a tuple, not {}'.format(type(path).__name__))
+    else:
+        for component in path:
+            if not isinstance(component, (str, int)):
+                raise TypeError('path components must be str or int, not {}'.format(
+                                type(component).__name__))
+
+    for component in path:
+        if type(value) is dict and isinstance(component, str):
+            if component not in value:
+                return default
+            value = value[component]
+
+        elif type(value) is list:
+            if dotted:
+                if not _INDEX.match(component):
+                    return default
+                component = int(component)
+            elif not isinstance(component, int):
+                return default
+
+            if not 0 <= component < len(value):
+                return default
+            value = value[component]
+
+        else:
+            return default
+
+    return value
+
+
+def extract(data, paths, default=None):
+    """Return a list of the values at ``paths`` in the JSON document in the
+       bytes-like object ``data``, with ``default`` for the paths not found.
+
+       A path is a str of dot-separated object keys (a key of digits can also
+       be an array index, as in ``"items.0.id"``), or a tuple of str keys and
+       int indices.
+
+       Unlike the C version, decodes and validates the whole document; if a key
+       occurs more than once in an object, the last value is used.
+    """
+    if isinstance(paths, str):
+        raise TypeError('paths must be a sequence of paths, not a str')
+
+    value = decode(data)
+    return [_extract_path(value, path, default) for path in paths]
+
+
+# see find_value_end()
+_STATE_ESCAPE, _STATE_STRING, _STATE_SCALAR = 0x01, 0x02, 0x04
+_STATE_DEPTH_SHIFT = 3
+
+_STRING_SPECIAL = re.compile(br'["\\]')
+_STRUCTURAL = re.compile(br'["{}\[\]]')
+_SCALAR_END = re.compile(br'[ \t\n\r,"{}\[\]]')
+
+
+def find_value_end(data, pos=0, state=0):
+    """Find the end of the JSON value starting at the offset ``pos`` of the
+       bytes-like object ``data`` and return an (end offset, state) tuple.
+       If ``data`` ends before the value does, the end offset is -1 and the
+       search goes on with ``find_value_end(more_data, len(data), state)``,
+       where ``more_data`` extends ``data``.
+
+       The value is not validated, ``decode()`` it to check it.  A top-level
+       number or literal is incomplete until whitespace or punctuation follows.
+    """
+
+    data = memoryview(data).cast('B')
+    size = len(data)
+
+    if not 0 <= pos <= size or state < 0:
+        raise ValueError('pos must be an offset within data')
+
+    depth = state >> _STATE_DEPTH_SHIFT
+    flags = state & ((1 << _STATE_DEPTH_SHIFT) - 1)
+
+    if state == 0 and pos < size:
+        first = data[pos]
+        if first in b'{[':
+            depth = 1
+        elif first == ord('"'):
+            flags = _STATE_STRING
+        else:
+            flags = _STATE_SCALAR
+        pos += 1
+
+    while pos < size:
+        if flags & _STATE_STRING:
+            if flags & _STATE_ESCAPE:
+                flags &= ~_STATE_ESCAPE
+                pos += 1
+
+            match = _STRING_SPECIAL.search(data, pos)
+            if match is None:
+                break
+
+            pos = match.end()
+            if data[match.start()] == ord('\\'):
+                flags |= _STATE_ESCAPE
+                continue
+
+            flags &= ~_STATE_STRING
+            if depth == 0:
+                return pos, 0
+
+        elif flags & _STATE_SCALAR:
+            match = _SCALAR_END.search(data, pos)
+            if match is None:
+                break
+
+            return match.start(), 0
+
+        else:
+            match = _STRUCTURAL.search(data, pos)
+            if match is None:
+                break
+
+            pos = match.end()
+            char = data[match.start()]
+            if char == ord('"'):
+                flags |= _STATE_STRING
+            elif char in b'{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos, 0
+
+    return -1, depth << _STATE_DEPTH_SHIFT | flags
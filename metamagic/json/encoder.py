@@ -7,42 +7,229 @@
 
 
 import types
-from re import compile as re_compile
 from numbers import Number
 from decimal import Decimal
-from math import isnan, isinf
-from collections import OrderedDict, Set, Sequence, Mapping
+from math import isnan, isinf, copysign
+from collections import OrderedDict
+from collections.abc import Set, Sequence, Mapping
 from uuid import UUID
-from datetime import date, time
+from datetime import date, datetime, time
+
+from .binary import MsgPackEmitter, CBOREmitter
+from .compression import compress as compress_data, CompressedWriter
+from .exceptions import OutputTooLargeError
 
 
 JAVASCRIPT_MAXINT = 9007199254740992  # see http://ecma262-5.com/ELS5_HTML.htm#Section_8.5
 
-BASE_ESCAPE_ASCII = re_compile(r'([\\]|[^\ -~]|[<>&])')
-ESCAPE_ASCII = re_compile(r'([\\"]|[^\ -~]|[<>&])')
+# compiled on first use, see _init_escapes()
+BASE_ESCAPE_ASCII = ESCAPE_ASCII = None
+BASE_ESCAPE_DCT = ESCAPE_DCT = None
+FRAGMENT_ESCAPE_ASCII = None
+
+
+def _init_escapes():
+    global BASE_ESCAPE_ASCII, ESCAPE_ASCII, BASE_ESCAPE_DCT, ESCAPE_DCT, FRAGMENT_ESCAPE_ASCII
+
+    from re import compile as re_compile
+
+    base_escape_dct = {}
+    for i in range(0x20):
+        base_escape_dct[chr(i)]= '\\u{0:04x}'.format(i)
+    base_escape_dct.update({
+        '\\': '\\\\',
+        '\b': '\\b',
+        '\f': '\\f',
+        '\n': '\\n',
+        '\r': '\\r',
+        '\t': '\\t',
+    })
+
+    escape_dct = {'"': '\\"'}
+    escape_dct.update(base_escape_dct)
+
+    BASE_ESCAPE_DCT, ESCAPE_DCT = base_escape_dct, escape_dct
+
+    BASE_ESCAPE_ASCII = re_compile(r'([\\]|[^\ -~]|[<>&])')
+    ESCAPE_ASCII = re_compile(r'([\\"]|[^\ -~]|[<>&])')
+
+    # in RawJSON fragments, whitespace is kept and JSON escapes are left as they are
+    FRAGMENT_ESCAPE_ASCII = re_compile(r'([^\t\n\r\ -~]|[<>&])')
+
+MSGPACK_EMITTER = MsgPackEmitter()
+CBOR_EMITTER = CBOREmitter()
+
+
+def _escape_char(match):
+    n = ord(match.group(0))
+    if n < 0x10000:
+        return '\\u{0:04x}'.format(n)
+    else:
+        # surrogate pair
+        n -= 0x10000
+        s1 = 0xd800 | ((n >> 10) & 0x3ff)
+        s2 = 0xdc00 | (n & 0x3ff)
+        return '\\u{0:04x}\\u{1:04x}'.format(s1, s2)
+
+
+class RawJSON:
+    """A fragment of pre-encoded JSON text (``str`` or a bytes-like object) which
+       the encoders insert into their output as is: as a value, or as the return
+       value of ``__mm_json__()``.  The C version splices it with a single memcpy.
+
+       The text is trusted to be valid JSON.  With ``validated`` false it is checked
+       once, here, for the characters the encoder never outputs (non-ASCII, the HTML
+       special chars ``<>&`` and control characters other than whitespace), which
+       are escaped; in valid JSON they can only be inside strings, where the escapes
+       mean the same.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data, validated=True):
+        if not isinstance(data, str):
+            data = bytes(memoryview(data))
+            if validated:
+                self.data = data
+                return
+            data = data.decode('utf-8')
+
+        if not validated:
+            if FRAGMENT_ESCAPE_ASCII is None:
+                _init_escapes()
+            data = FRAGMENT_ESCAPE_ASCII.sub(_escape_char, data)
+
+        self.data = data.encode('utf-8')
+
+    def __mm_json__(self):
+        return self.data
+
+    def __reduce__(self):
+        # the data is safe already, no need to check it again
+        return (RawJSON, (self.data,))
+
+    def __repr__(self):
+        return 'RawJSON({!r})'.format(self.data)
+
+
+# objects natively supported other than dicts, see Encoder._diff_resolve()
+_DIFF_NATIVE_TYPES = frozenset((str, int, float, bool, type(None), list, tuple, set, frozenset,
+                                UUID, Decimal, RawJSON))
+
+# types whose equal instances (of the same type) have the same JSON-encoding
+_DIFF_SCALAR_TYPES = frozenset((str, int, UUID, datetime, date, time))
+
+
+def _diff_equal(a, b):
+    """Returns True if ``a`` and ``b`` are known to have the same JSON-encoding: they
+       are the same object, or strings, numbers, UUIDs, Decimals, dates or times of
+       the same type which compare equal, or lists, tuples, dicts or OrderedDicts of
+       the same type whose items are compared in the same way, so that e.g. 1, 1.0 and
+       True are never equal.  Floats, Decimals, datetimes and times are also compared
+       by their sign, exponent and time zone, which equality ignores.  Other objects
+       (sets, instances of other classes) are only equal to themselves.
+    """
+    if a is b:
+        return True
+
+    _objtype = a.__class__
 
-BASE_ESCAPE_DCT = {}
-for i in range(0x20):
-    BASE_ESCAPE_DCT[chr(i)]= '\\u{0:04x}'.format(i)
-BASE_ESCAPE_DCT.update({
-    '\\': '\\\\',
-    '\b': '\\b',
-    '\f': '\\f',
-    '\n': '\\n',
-    '\r': '\\r',
-    '\t': '\\t',
-})
+    if _objtype is not b.__class__:
+        return False
 
-ESCAPE_DCT = {'"': '\\"'}
-ESCAPE_DCT.update(BASE_ESCAPE_DCT)
+    if _objtype is float:
+        return a == b and copysign(1.0, a) == copysign(1.0, b)
+
+    if _objtype is list or _objtype is tuple:
+        return len(a) == len(b) and all(map(_diff_equal, a, b))
+
+    if _objtype is dict or _objtype is OrderedDict:
+        return len(a) == len(b) and all(key in b and _diff_equal(value, b[key])
+                                        for key, value in a.items())
+
+    if _objtype is Decimal:
+        # Decimal('1.0') == Decimal('1.00')
+        return str(a) == str(b)
+
+    if (_objtype is datetime or _objtype is time) and a.tzinfo is not b.tzinfo:
+        # equal datetimes may be in different time zones
+        return False
+
+    return _objtype in _DIFF_SCALAR_TYPES and a == b
+
+
+# struct module codes of the numbers read from the buffers of columns,
+# see Encoder.dumpb_columns()
+_COLUMN_FORMATS = frozenset('bBhHiIlLqQnNfd?')
+
+
+def _column_values(column):
+    """Returns the values of a column of ``Encoder.dumpb_columns()``: the numbers of
+       one-dimensional buffers of native integers, floats or bools, or the items of
+       other columns.
+    """
+    if isinstance(column, (str, bytes, bytearray)):
+        raise TypeError('columns must be sequences or arrays of numbers, not {}'.format(
+                        type(column).__name__))
+
+    if not isinstance(column, (list, tuple)):
+        try:
+            view = memoryview(column)
+        except TypeError:
+            pass
+        else:
+            if view.ndim == 1 and view.format.lstrip('@') in _COLUMN_FORMATS:
+                return view.tolist()
+
+    return tuple(column)
+
+
+class _EncodeContext:
+    """State of one encoding call (the counterpart of ``EncodedData`` in the C version);
+       encoders themselves are never modified by encoding."""
+
+    __slots__ = ('nested_level', 'max_nested_level', 'max_output_bytes', 'output_size',
+                 'canonical')
+
+    def __init__(self, max_nested_level=100, max_output_bytes=None, canonical=False):
+        if max_output_bytes is not None and max_output_bytes < 0:
+            raise ValueError('max_output_bytes must not be negative')
+
+        self.nested_level = 0                       # current recursion level
+        self.max_nested_level = max_nested_level    # max allowed level
+        self.max_output_bytes = max_output_bytes    # max allowed output size
+        self.output_size = 0                        # size of the output produced before
+                                                    #   the current object
+        self.canonical = canonical                  # sort dict keys and set items
+
+    def increment_nested_level(self):
+        self.nested_level += 1
+        if (self.nested_level > self.max_nested_level):
+            raise self.nested_level_error()
+
+    def nested_level_error(self):
+        return ValueError('Exceeded maximum allowed recursion level ({}), ' \
+                          'possibly circular reference detected'.format(self.max_nested_level))
+
+    def decrement_nested_level(self):
+        self.nested_level -= 1
+
+    def check_output_size(self, size):
+        size += self.output_size
+        if self.max_output_bytes is not None and size > self.max_output_bytes:
+            raise OutputTooLargeError(size, self.max_output_bytes)
 
 
 class Encoder:
     """A Python implementation of a JSON encoder for Python objects designed
        to be compatible with native JSON decoders in various web browsers.
 
-       Can either encode to a python string (see ``dumps``) or a sequence
-       of bytes (see ``dumpb``). The string returned by dumps() is guaranteed
+       Can either encode to a python string (see ``dumps``), a sequence
+       of bytes (see ``dumpb``), a file-like object (see ``dump``) or a file descriptor
+       (see ``dump_fd``); the bytes output can be compressed on the fly.  The changes
+       between two objects can be encoded as a JSON merge patch (see ``dumpb_diff``), and
+       rows and columns of values as arrays of objects (see ``dumpb_rows`` and
+       ``dumpb_columns``). The string returned by dumps() is guaranteed
        to have only 7-bit ASCII characters [#f1]_ and ``dumps(obj).encode('ascii') = dumpb(obj)``.
 
        Supports a special encoder class method `encode_hook(obj)` which, if present, is applied to
@@ -54,7 +241,8 @@ class Encoder:
        method, if available. It is guaranteed that for all non-native types __mm_json__ and
        then __mm_serialize__ will be tried before any other attempt to encode the object [#f2]_.
        The output of __mm_serialize__ is in turn encoded as any other object (and may in turn have
-       an __mm_serialize__ method or not be supported).
+       an __mm_serialize__ method or not be supported).  ``RawJSON`` fragments (also when
+       returned by __mm_json__) are inserted into the output as is.
 
        Natively supports strings, integers, floats, True, False, None, lists, tuples,
        dicts, sets, frozensets, collections.OrderedDicts, colections.Set,
@@ -66,6 +254,9 @@ class Encoder:
        method (which can be overwrite in derived classes). If self.default succeeds,
        the output is again encoded as any other object.
 
+       Encoders keep no state between (or during) calls, so one instance can be shared
+       between threads, as long as its ``encode_hook()`` and ``default()`` are thread-safe.
+
 
        Exceptions raised:
 
@@ -84,6 +275,9 @@ class Encoder:
          the allowed nesting level (100 by default, can be overwritten by passing the
          desired value as the second argument to ``dumps()`` and ``dumpb()`` methods)
 
+       * When ``max_output_bytes`` is given, an ``OutputTooLargeError`` (a subclass of
+         ValueError) is raised as soon as the encoded output exceeds the given size.
+
 
        .. [#f1] All characters required to be escaped by the JSON spec @ http://json.org are escaped
        .. [#f2] If present, encode_hook() is applied before and independently of all other encoders
@@ -97,9 +291,7 @@ class Encoder:
                 this encoder also supports UUIDs as dictionary keys.
     """
 
-    _nested_level     = 0            # current recursion level
-    _max_nested_level = 100          # max allowed level
-    _use_hook        = False
+    _use_hook = False
 
     def __init__(self):
         # If 'Encoder.encode_hook' wasn't overridden then don't call it.
@@ -144,15 +336,6 @@ class Encoder:
         """
         raise TypeError('{!r} is not JSON serializable by this encoder'.format(obj))
 
-    def _increment_nested_level(self):
-        self._nested_level += 1
-        if (self._nested_level > self._max_nested_level):
-            raise ValueError('Exceeded maximum allowed recursion level ({}), ' \
-                             'possibly circular reference detected'.format(self._max_nested_level))
-
-    def _decrement_nested_level(self):
-        self._nested_level -= 1
-
     def _encode_str(self, obj, escape_quotes=True):
         """Return an ASCII-only JSON representation of a Python string"""
         def replace(match):
@@ -172,12 +355,14 @@ class Encoder:
                     s1 = 0xd800 | ((n >> 10) & 0x3ff)
                     s2 = 0xdc00 | (n & 0x3ff)
                     return '\\u{0:04x}\\u{1:04x}'.format(s1, s2)
+        if ESCAPE_ASCII is None:
+            _init_escapes()
         if escape_quotes:
             return '"' + ESCAPE_ASCII.sub(replace, obj) + '"'
         else:
             return BASE_ESCAPE_ASCII.sub(replace, obj)
 
-    def _encode_numbers(self, obj):
+    def _encode_numbers(self, obj, ctx, replaced=0):
         """Returns a JSON representation of a Python number (int, float or Decimal)"""
 
         # strict checks first - for speed
@@ -211,31 +396,91 @@ class Encoder:
             return '"' + str(obj) + '"'
 
         # for complex and other Numbers
-        return self._encode(self.default(obj))
+        return self._encode_replacement(self.default(obj), ctx, replaced)
 
-    def _encode_list(self, obj):# do
+    def _encode_list(self, obj, ctx):
         """Returns a JSON representation of a Python list"""
 
-        self._increment_nested_level()
+        ctx.increment_nested_level()
 
         buffer = []
-        for element in obj:
-            buffer.append(self._encode(element))
+        if ctx.max_output_bytes is None:
+            for element in obj:
+                buffer.append(self._encode(element, ctx))
+        else:
+            size = 0
+            for element in obj:
+                data = self._encode(element, ctx)
+                size += len(data) + 1
+                ctx.check_output_size(size)
+                buffer.append(data)
+
+        ctx.decrement_nested_level()
+
+        return '['+ ','.join(buffer) + ']'
+
+    def _encode_set(self, obj, ctx):
+        """Returns a JSON representation of a Python set; in the canonical mode
+           the encoded items are sorted"""
+
+        if not ctx.canonical:
+            return self._encode_list(obj, ctx)
+
+        ctx.increment_nested_level()
+
+        buffer = sorted(self._encode(element, ctx) for element in obj)
 
-        self._decrement_nested_level()
+        ctx.decrement_nested_level()
 
         return '['+ ','.join(buffer) + ']'
 
-    def _encode_dict(self, obj):
+    def _encode_sorted_dict(self, obj, ctx):
+        """Returns a JSON representation of a Python dict with keys sorted by
+           their string, ``str()`` of UUIDs (canonical mode)"""
+
+        # the index makes sure keys themselves are never compared
+        keys = []
+        for i, key in enumerate(obj):
+            resolved = self._resolve_key(key)
+            keys.append((resolved if resolved.__class__ is str else str(resolved), i, key))
+        keys.sort()
+
+        ctx.increment_nested_level()
+
+        buffer = []
+        size = 0
+        for string, _, key in keys:
+            data = self._encode_str(string) + ':' + self._encode(obj[key], ctx)
+            if ctx.max_output_bytes is not None:
+                size += len(data) + 1
+                ctx.check_output_size(size)
+            buffer.append(data)
+
+        ctx.decrement_nested_level()
+
+        return '{'+ ','.join(buffer) + '}'
+
+    def _encode_dict(self, obj, ctx):
         """Returns a JSON representation of a Python dict"""
 
-        self._increment_nested_level()
+        if ctx.canonical:
+            return self._encode_sorted_dict(obj, ctx)
+
+        ctx.increment_nested_level()
 
         buffer = []
-        for key in obj:
-            buffer.append(self._encode_key(key) + ':' + self._encode(obj[key]))
+        if ctx.max_output_bytes is None:
+            for key in obj:
+                buffer.append(self._encode_key(key) + ':' + self._encode(obj[key], ctx))
+        else:
+            size = 0
+            for key in obj:
+                data = self._encode_key(key) + ':' + self._encode(obj[key], ctx)
+                size += len(data) + 1
+                ctx.check_output_size(size)
+                buffer.append(data)
 
-        self._decrement_nested_level()
+        ctx.decrement_nested_level()
 
         return '{'+ ','.join(buffer) + '}'
 
@@ -248,6 +493,17 @@ class Encoder:
         if obj.__class__ is UUID:
             return '"' + str(obj) + '"'
 
+        key = self._resolve_key(obj)
+        if key.__class__ is str:
+            return self._encode_str(key)
+        return '"' + str(key) + '"'
+
+    def _resolve_key(self, obj):
+        """Returns the str or UUID a dictionary key is encoded as, see ``_encode_key()``"""
+
+        if obj.__class__ is str or obj.__class__ is UUID:
+            return obj
+
         # __mm_serialize__ is called before any isinstance checks (but after exact type checks)
         try:
             sx_encoder = obj.__mm_serialize__
@@ -259,13 +515,14 @@ class Encoder:
             except NotImplementedError:
                 pass
             else:
-                return self._encode_key(data)
+                return self._resolve_key(data)
 
         if isinstance(obj, UUID):
-            return '"' + str(obj) + '"'
+            return obj
 
         if isinstance(obj, str):
-            return self._encode_str(obj)
+            # an exact str
+            return str.__str__(obj)
 
         # if everything else failed try the default() method and re-raise any TypeError
         # exceptions as more specific "not a valid dict key" TypeErrors
@@ -274,14 +531,18 @@ class Encoder:
         except TypeError:
             raise TypeError('{!r} is not a valid dictionary key'.format(obj))
 
-        return self._encode_key(value)
+        return self._resolve_key(value)
 
-    def _encode(self, obj):
+    def _encode(self, obj, ctx, replaced=0, hooked=False):
         """Returns a JSON representation of a Python object - see dumps.
         Accepts objects of any type, calls the appropriate type-specific encoder.
+
+        ``replaced`` is the number of objects ``obj`` has replaced so far, see
+        ``_encode_replacement()``; ``obj`` is not passed to encode_hook() if it is
+        ``hooked`` already.
         """
 
-        if self._use_hook:
+        if self._use_hook and not hooked:
             obj = self.encode_hook(obj)
 
         # first try simple strict checks
@@ -298,16 +559,16 @@ class Encoder:
                 return 'false'
 
         if _objtype is int or _objtype is float:
-            return self._encode_numbers(obj)
+            return self._encode_numbers(obj, ctx, replaced)
 
         if _objtype is list or _objtype is tuple:
-            return self._encode_list(obj)
+            return self._encode_list(obj, ctx)
 
         if obj is None:
             return 'null'
 
         if _objtype is dict or obj is OrderedDict:
-            return self._encode_dict(obj)
+            return self._encode_dict(obj, ctx)
 
         if _objtype is UUID:
             return '"' + str(obj) + '"'
@@ -315,6 +576,9 @@ class Encoder:
         if _objtype is Decimal:
             return '"' + str(obj) + '"'
 
+        if _objtype is RawJSON:
+            return obj.data.decode('utf-8')
+
         # For all non-std types try __mm_json__ and then __mm_serialize__ before any isinstance
         # checks
 
@@ -328,6 +592,9 @@ class Encoder:
             except NotImplementedError:
                 pass
             else:
+                if not isinstance(data, (bytes, str)):
+                    # e.g. a RawJSON fragment of the C encoder
+                    return self._encode_replacement(data, ctx, replaced)
                 if isinstance(data, bytes):
                     return data.decode('utf-8')
                 else:
@@ -342,7 +609,7 @@ class Encoder:
             except NotImplementedError:
                 pass
             else:
-                return self._encode(data)
+                return self._encode_replacement(data, ctx, replaced)
 
         # do more in-depth class analysis
 
@@ -352,36 +619,500 @@ class Encoder:
         if isinstance(obj, str):
             return self._encode_str(obj)
 
-        if isinstance(obj, (list, tuple, set, frozenset, Set)):
-            return self._encode_list(obj)
+        if isinstance(obj, (list, tuple)):
+            return self._encode_list(obj, ctx)
+
+        if isinstance(obj, (set, frozenset, Set)):
+            return self._encode_set(obj, ctx)
 
         if isinstance(obj, Sequence) and not isinstance(obj, (bytes, bytearray)):
-            return self._encode_list(obj)
+            return self._encode_list(obj, ctx)
 
         if isinstance(obj, (dict, OrderedDict, Mapping)):
-            return self._encode_dict(obj)
+            return self._encode_dict(obj, ctx)
 
         # note: number checks using isinstance should come after True/False checks
         if isinstance(obj, Number):
-            return self._encode_numbers(obj)
+            return self._encode_numbers(obj, ctx, replaced)
 
         if isinstance(obj, (date, time)):
             return '"' + obj.isoformat() + '"'
 
-        return self._encode(self.default(obj))
+        return self._encode_replacement(self.default(obj), ctx, replaced)
+
+    def _encode_replacement(self, obj, ctx, replaced):
+        """Returns a JSON representation of ``obj``, the output of __mm_json__(),
+        __mm_serialize__() or default() for the object being encoded, which was
+        itself the ``replaced``-th replacement of a value.  Like nesting, chains of
+        replacements are limited by ``max_nested_level``, so that __mm_serialize__()
+        returning the object itself is caught as a circular reference.
+        """
+        if replaced >= ctx.max_nested_level:
+            raise ctx.nested_level_error()
+
+        return self._encode(obj, ctx, replaced + 1)
+
+    def _diff_resolve(self, obj, ctx):
+        """Returns the object ``obj`` is encoded as, to be compared with another one,
+        and whether it is encoded as a JSON object with its keys and values.
+
+        The object is the output of encode_hook() and, for objects which are not natively
+        supported and have no __mm_json__ method, of __mm_serialize__, applied until
+        there is no replacement.  Chains of replacements are limited as in
+        ``_encode_replacement()``.
+        """
+        replaced = 0
+        while True:
+            if replaced > ctx.max_nested_level:
+                raise ctx.nested_level_error()
+            replaced += 1
+
+            if self._use_hook:
+                obj = self.encode_hook(obj)
+
+            _objtype = obj.__class__
+
+            if _objtype is dict or _objtype is OrderedDict:
+                return obj, True
+
+            if _objtype in _DIFF_NATIVE_TYPES or hasattr(obj, '__mm_json__'):
+                return obj, False
+
+            try:
+                sx_encoder = obj.__mm_serialize__
+            except AttributeError:
+                break
+
+            try:
+                obj = sx_encoder()
+            except NotImplementedError:
+                break
+
+        # same checks and in the same order as in _encode()
+        if isinstance(obj, (str, list, tuple, set, frozenset, Set, Sequence)):
+            return obj, False
+
+        return obj, isinstance(obj, (dict, Mapping))
 
-    def dumps(self, obj, *, max_nested_level=100):
+    def _encode_diff(self, old, new, ctx):
+        """Returns the merge patch turning the JSON-encoding of ``old`` into the JSON-encoding
+        of ``new`` (see ``dumpb_diff()``), or None if both are encoded as JSON objects with
+        no differences.
+        """
+        old_value, old_is_mapping = self._diff_resolve(old, ctx)
+        new_value, new_is_mapping = self._diff_resolve(new, ctx)
+
+        if not (old_is_mapping and new_is_mapping):
+            # encode_hook() and __mm_serialize__() are not called again
+            return self._encode(new_value, ctx, hooked=True)
+
+        ctx.increment_nested_level()
+
+        buffer = []
+        for key in new_value:
+            value = new_value[key]
+            if key not in old_value:
+                buffer.append(self._encode_key(key) + ':' + self._encode(value, ctx))
+                continue
+
+            old_item = old_value[key]
+            if not _diff_equal(old_item, value):
+                data = self._encode_diff(old_item, value, ctx)
+                if data is not None:
+                    buffer.append(self._encode_key(key) + ':' + data)
+
+        # deleted keys
+        for key in old_value:
+            if key not in new_value:
+                buffer.append(self._encode_key(key) + ':null')
+
+        ctx.decrement_nested_level()
+
+        if not buffer:
+            return None
+
+        return '{' + ','.join(buffer) + '}'
+
+    def _encode_rows(self, keys, rows, ctx):
+        """Returns a JSON array of objects with the keys ``keys`` (already encoded) and
+        the values of ``rows``, see ``dumpb_rows()``
+        """
+        ctx.increment_nested_level()
+        ctx.increment_nested_level()
+
+        buffer = []
+        size = 0
+        for index, row in enumerate(rows):
+            values = tuple(row)
+            if len(values) != len(keys):
+                raise ValueError('row {} has {} values, expected {}'.format(
+                                 index, len(values), len(keys)))
+
+            data = '{' + ','.join([key + self._encode(value, ctx)
+                                   for key, value in zip(keys, values)]) + '}'
+            if ctx.max_output_bytes is not None:
+                size += len(data) + 1
+                ctx.check_output_size(size)
+            buffer.append(data)
+
+        ctx.decrement_nested_level()
+        ctx.decrement_nested_level()
+
+        return '[' + ','.join(buffer) + ']'
+
+    def _encode_binary(self, obj, emitter, ctx):
+        """Returns a binary representation of a Python object in the format of
+        ``emitter`` (see ``metamagic.json.binary``); the same as ``_encode()``,
+        except that ``__mm_json__`` is not used.
+        """
+
+        if self._use_hook:
+            obj = self.encode_hook(obj)
+
+        # first try simple strict checks
+
+        _objtype = obj.__class__
+
+        if _objtype is str:
+            return emitter.string(obj)
+
+        if _objtype is bool:
+            return emitter.boolean(obj)
+
+        if _objtype is int:
+            return emitter.integer(obj)
+
+        if _objtype is float:
+            return emitter.float(obj)
+
+        if _objtype is list or _objtype is tuple:
+            return self._encode_binary_array(obj, emitter, ctx)
+
+        if obj is None:
+            return emitter.none()
+
+        if _objtype is dict or _objtype is OrderedDict:
+            return self._encode_binary_map(obj, emitter, ctx)
+
+        if _objtype is UUID:
+            return emitter.uuid(obj)
+
+        if _objtype is Decimal:
+            return emitter.string(str(obj))
+
+        try:
+            sx_encoder = obj.__mm_serialize__
+        except AttributeError:
+            pass
+        else:
+            try:
+                data = sx_encoder()
+            except NotImplementedError:
+                pass
+            else:
+                return self._encode_binary(data, emitter, ctx)
+
+        # do more in-depth class analysis
+
+        if isinstance(obj, UUID):
+            return emitter.uuid(obj)
+
+        if isinstance(obj, str):
+            return emitter.string(obj)
+
+        if isinstance(obj, (list, tuple)):
+            return self._encode_binary_array(obj, emitter, ctx)
+
+        if isinstance(obj, (set, frozenset, Set)):
+            return self._encode_binary_array(obj, emitter, ctx, ctx.canonical)
+
+        if isinstance(obj, Sequence) and not isinstance(obj, (bytes, bytearray)):
+            return self._encode_binary_array(obj, emitter, ctx)
+
+        if isinstance(obj, (dict, OrderedDict, Mapping)):
+            return self._encode_binary_map(obj, emitter, ctx)
+
+        if isinstance(obj, int):
+            return emitter.integer(int(obj))
+
+        if isinstance(obj, float):
+            return emitter.float(obj)
+
+        if isinstance(obj, Decimal):
+            return emitter.string(str(obj))
+
+        if isinstance(obj, (date, time)):
+            return emitter.string(obj.isoformat())
+
+        return self._encode_binary(self.default(obj), emitter, ctx)
+
+    def _encode_binary_array(self, obj, emitter, ctx, sort=False):
+        ctx.increment_nested_level()
+
+        buffer = [self._encode_binary(element, emitter, ctx) for element in obj]
+        if sort:
+            buffer.sort()
+
+        ctx.decrement_nested_level()
+
+        return emitter.array(len(buffer)) + b''.join(buffer)
+
+    def _encode_binary_map(self, obj, emitter, ctx):
+        ctx.increment_nested_level()
+
+        keys = [(self._encode_binary_key(key, emitter), i, key) for i, key in enumerate(obj)]
+        if ctx.canonical:
+            keys.sort()
+
+        buffer = [emitter.map(len(keys))]
+        for encoded_key, _, key in keys:
+            buffer.append(encoded_key)
+            buffer.append(self._encode_binary(obj[key], emitter, ctx))
+
+        ctx.decrement_nested_level()
+
+        return b''.join(buffer)
+
+    def _encode_binary_key(self, obj, emitter):
+        """Encodes a dictionary key, see ``_encode_key()``"""
+
+        if obj.__class__ is str:
+            return emitter.string(obj)
+
+        if obj.__class__ is UUID:
+            return emitter.uuid(obj)
+
+        try:
+            sx_encoder = obj.__mm_serialize__
+        except AttributeError:
+            pass
+        else:
+            try:
+                data = sx_encoder()
+            except NotImplementedError:
+                pass
+            else:
+                return self._encode_binary_key(data, emitter)
+
+        if isinstance(obj, UUID):
+            return emitter.uuid(obj)
+
+        if isinstance(obj, str):
+            return emitter.string(obj)
+
+        try:
+            value = self.default(obj)
+        except TypeError:
+            raise TypeError('{!r} is not a valid dictionary key'.format(obj))
+
+        return self._encode_binary_key(value, emitter)
+
+    def _encode_limited(self, obj, ctx):
+        data = self._encode(obj, ctx)
+        if ctx.max_output_bytes is not None:
+            ctx.check_output_size(len(data))
+        return data
+
+    def dumps(self, obj, *, max_nested_level=100, max_output_bytes=None, canonical=False):
         """Returns a string representing a JSON-encoding of ``obj``.
 
            The second optional ``max_nested_level`` argument controls the maximum
            allowed recursion/nesting level.
 
+           If ``max_output_bytes`` is given, an ``OutputTooLargeError`` is raised
+           once the output exceeds the given size (for compressed output the limit
+           applies to the uncompressed data).
+
+           If ``canonical`` is true dict keys are sorted by their string (``str()`` of
+           UUIDs), as by ``json.dumps(sort_keys=True)``, and set items by their encoding,
+           so that equal objects are always encoded the same way (the output of
+           ``__mm_json__`` is used as is).
+
            See class description for details.
         """
-        self._max_nested_level = max_nested_level
-        return self._encode(obj)
+        ctx = _EncodeContext(max_nested_level, max_output_bytes, canonical)
+        return self._encode_limited(obj, ctx)
+
+    def dumpb(self, obj, *, max_nested_level=100, compress=None, level=None,
+              max_output_bytes=None, canonical=False):
+        """Similar to ``dumps()``, but returns ``bytes`` instead of a ``string``
 
-    def dumpb(self, obj, *, max_nested_level=100):
-        """Similar to ``dumps()``, but returns ``bytes`` instead of a ``string``"""
-        self._max_nested_level = max_nested_level
-        return self._encode(obj).encode('utf-8')
+           If ``compress`` is given the output is compressed with the given method
+           (``'gzip'``, ``'deflate'``, ``'bz2'`` or ``'xz'``, see
+           ``metamagic.json.compression``) and compression ``level``.
+        """
+        ctx = _EncodeContext(max_nested_level, max_output_bytes, canonical)
+        data = self._encode_limited(obj, ctx).encode('utf-8')
+        if compress is not None:
+            data = compress_data(data, compress, level)
+        return data
+
+    def dumpb_many(self, iterable, sep=b'\n', *, max_nested_level=100, max_output_bytes=None,
+                   canonical=False):
+        """Returns one ``bytes`` array with JSON-encodings of all objects in ``iterable``,
+           each followed by ``sep``; by default the output is in JSON Lines format.
+
+           ``max_output_bytes`` limits the size of the whole output.
+        """
+        ctx = _EncodeContext(max_nested_level, max_output_bytes, canonical)
+        if max_output_bytes is None:
+            return b''.join(self._encode(obj, ctx).encode('utf-8') + sep for obj in iterable)
+
+        buffer = []
+        for obj in iterable:
+            data = self._encode(obj, ctx).encode('utf-8') + sep
+            ctx.check_output_size(len(data))
+            ctx.output_size += len(data)
+            buffer.append(data)
+        return b''.join(buffer)
+
+    def dumpb_diff(self, old, new, *, max_nested_level=100, max_output_bytes=None):
+        """Returns a JSON merge patch (RFC 7386) turning the JSON-encoding of ``old`` into
+           the JSON-encoding of ``new``, as ``bytes``.
+
+           Both objects are walked together, with the same type checks, ``encode_hook()``
+           and ``__mm_serialize__`` as when encoding them.  If both are encoded as JSON
+           objects only the keys which differ are written: new keys with their values,
+           changed keys with patches of their values and deleted keys with null values.
+           Values which are the same object, or scalars (and lists, tuples and dicts of
+           them) of the same type and equal, are skipped without being encoded.
+           Anything else, including arrays, which merge patches cannot change in part,
+           is replaced: ``new`` is encoded in full.
+
+           Note: merge patches remove the keys which are null in the patch, so keys
+           with None values in ``new`` are removed when the patch is applied.
+        """
+        ctx = _EncodeContext(max_nested_level, max_output_bytes)
+        data = self._encode_diff(old, new, ctx)
+        if data is None:
+            data = '{}'
+        if max_output_bytes is not None:
+            ctx.check_output_size(len(data))
+        return data.encode('utf-8')
+
+    def dumpb_rows(self, columns, rows, *, max_nested_level=100, max_output_bytes=None):
+        """Returns a JSON array of objects, one per row of values in ``rows`` (e.g. the
+           tuples returned by DB-API cursors), with the keys in ``columns`` and the values
+           of the row in the same order, as ``bytes``.
+
+           The keys are encoded once and no dict is created per row.  Rows with
+           another number of values than ``columns`` raise a ValueError.
+        """
+        ctx = _EncodeContext(max_nested_level, max_output_bytes)
+        keys = [self._encode_key(key) + ':' for key in columns]
+        data = self._encode_rows(keys, rows, ctx)
+        if max_output_bytes is not None:
+            ctx.check_output_size(len(data))
+        return data.encode('utf-8')
+
+    def dumpb_columns(self, columns, *, max_nested_level=100, max_output_bytes=None):
+        """Similar to ``dumpb_rows()``, but with the values of the rows in the mapping
+           ``columns`` of keys to columns of values, all of the same length.
+
+           Columns are sequences of values, or one-dimensional buffers (``array.array``,
+           numpy arrays...) of native integers, floats or bools, which the C version
+           reads directly, with no Python objects created for the numbers.  Columns
+           of different lengths raise a ValueError.
+        """
+        ctx = _EncodeContext(max_nested_level, max_output_bytes)
+        items = list(columns.items())
+        keys = [self._encode_key(key) + ':' for key, _ in items]
+
+        values = [_column_values(column) for _, column in items]
+        for (key, _), column in zip(items, values):
+            if len(column) != len(values[0]):
+                raise ValueError('column {!r} has {} values, expected {}'.format(
+                                 key, len(column), len(values[0])))
+
+        data = self._encode_rows(keys, zip(*values), ctx)
+        if max_output_bytes is not None:
+            ctx.check_output_size(len(data))
+        return data.encode('utf-8')
+
+    def dump(self, obj, fp, *, max_nested_level=100, compress=None, level=None,
+             max_output_bytes=None, canonical=False):
+        """Similar to ``dumpb()``, but writes the output to the file-like object ``fp``
+
+           Note: unlike the C version, this implementation encodes the whole
+           object before writing it out.
+        """
+        ctx = _EncodeContext(max_nested_level, max_output_bytes, canonical)
+        data = self._encode_limited(obj, ctx).encode('utf-8')
+        if compress is not None:
+            writer = CompressedWriter(fp, compress, level)
+            writer.write(data)
+            writer.finish()
+        else:
+            fp.write(data)
+
+    def dump_fd(self, obj, fd, *, max_nested_level=100, max_output_bytes=None, canonical=False):
+        """Similar to ``dump()``, but writes the output to the file descriptor ``fd``:
+           an ``int`` or an object with a ``fileno()`` method, like a socket.
+
+           Partial writes are resumed, and a non-blocking ``fd`` is waited on
+           until it accepts more data, each time for at most the timeout of the
+           socket (raising ``TimeoutError``).  TLS sockets are not supported.
+
+           Note: unlike the C version, this implementation encodes the whole
+           object before writing it out, and holds the GIL while writing.
+        """
+        import os
+        import select
+        import sys
+
+        timeout = None
+        if not isinstance(fd, int):
+            ssl = sys.modules.get('ssl')
+            if ssl is not None and isinstance(fd, ssl.SSLSocket):
+                raise TypeError('dump_fd() cannot write to TLS sockets, use dump() instead')
+            if hasattr(fd, 'gettimeout'):
+                # 0 is the timeout of sockets in the non-blocking mode: wait with no limit
+                timeout = fd.gettimeout() or None
+            fd = fd.fileno()
+
+        ctx = _EncodeContext(max_nested_level, max_output_bytes, canonical)
+        data = memoryview(self._encode_limited(obj, ctx).encode('utf-8'))
+
+        while data:
+            try:
+                written = os.write(fd, data)
+            except BlockingIOError:
+                if not select.select((), (fd,), (), timeout)[1]:
+                    raise TimeoutError('timed out')
+            else:
+                data = data[written:]
+
+    def digest(self, obj, algorithm='sha256', *, max_nested_level=100, canonical=True):
+        """Returns the hex digest of the JSON-encoding of ``obj`` computed with the
+           given ``hashlib`` algorithm; by default ``obj`` is encoded in the canonical
+           mode (see ``dumps()``), so the digest can be used as an ETag or a cache key.
+
+           Note: unlike the C version, this implementation hashes the complete output.
+        """
+        import hashlib
+        hash = hashlib.new(algorithm)
+        hash.update(self.dumpb(obj, max_nested_level=max_nested_level, canonical=canonical))
+        return hash.hexdigest()
+
+    def _dump_binary(self, obj, emitter, max_nested_level, max_output_bytes, canonical):
+        ctx = _EncodeContext(max_nested_level, max_output_bytes, canonical)
+        data = self._encode_binary(obj, emitter, ctx)
+        if max_output_bytes is not None:
+            ctx.check_output_size(len(data))
+        return data
+
+    def dumpmsgpack(self, obj, *, max_nested_level=100, max_output_bytes=None, canonical=False):
+        """Similar to ``dumpb()``, but returns ``obj`` encoded in the MessagePack format.
+
+           Objects are encoded the same way as by ``dumpb()`` (using ``encode_hook()``,
+           ``__mm_serialize__()`` and ``default()``), except that ``__mm_json__()`` is not
+           used, integers are only limited by the format, and UUIDs are encoded as
+           16 raw bytes (``bin 8``).
+        """
+        return self._dump_binary(obj, MSGPACK_EMITTER, max_nested_level, max_output_bytes, canonical)
+
+    def dumpcbor(self, obj, *, max_nested_level=100, max_output_bytes=None, canonical=False):
+        """Similar to ``dumpmsgpack()``, but returns ``obj`` encoded in the CBOR format;
+           UUIDs are encoded as byte strings tagged with the tag 37.
+        """
+        return self._dump_binary(obj, CBOR_EMITTER, max_nested_level, max_output_bytes, canonical)
@@ -0,0 +1,37 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+__all__ = ('OutputTooLargeError', 'DecodeError')
+
+
+class OutputTooLargeError(ValueError):
+    """Raised when the encoded output exceeds the ``max_output_bytes`` limit.
+
+       ``size`` is the number of bytes produced when the encoder stopped
+       (greater than ``max_size``, but not necessarily the size of the
+       complete output), ``max_size`` is the limit.
+    """
+
+    def __init__(self, size, max_size):
+        super().__init__('Encoded output exceeded the maximum allowed size of {} bytes '
+                         '({} bytes produced)'.format(max_size, size))
+        self.size = size
+        self.max_size = max_size
+
+
+class DecodeError(ValueError):
+    """Raised when the input is not a valid JSON document.
+
+       ``msg`` is the description of the error, ``pos`` is the offset (in bytes)
+       in the input where it was found.
+    """
+
+    def __init__(self, msg, pos):
+        super().__init__('{}: position {}'.format(msg, pos))
+        self.msg = msg
+        self.pos = pos
@@ -0,0 +1,116 @@
+/*
+* Copyright (c) 2014 Sprymix Inc.
+* All rights reserved.
+*
+* See LICENSE for details.
+*/
+
+/*
+ * C API of the metamagic.json._encoder extension module.
+ *
+ * Lets other extension modules encode Python objects straight into their own
+ * buffers, with no Python-level calls, argument parsing or intermediate
+ * bytes() objects.  The include directory is returned by
+ * metamagic.json.get_include().
+ *
+ * Usage:
+ *
+ *     #include "metamagic_json.h"
+ *
+ *     // once, e.g. in the module init function
+ *     if (MMJson_IMPORT == NULL) return NULL;
+ *
+ *     // the GIL must be held
+ *     if (MMJson_API->encode(NULL, obj, &buffer, 0, 0) < 0)
+ *         ... a Python exception is set ...
+ */
+
+#ifndef __METAMAGIC_JSON_H__
+#define __METAMAGIC_JSON_H__
+
+#include <Python.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#define METAMAGIC_JSON_CAPSULE_NAME "metamagic.json._encoder._C_API"
+
+// incremented when incompatible changes are made to the MMJson_CAPI structure
+#define METAMAGIC_JSON_API_VERSION 1
+
+// 'flags' of the encoding functions
+#define MMJSON_CANONICAL   0x01     // sort dict keys and set items (see Encoder.dumps())
+#define MMJSON_MSGPACK     0x10     // MessagePack instead of JSON (see Encoder.dumpmsgpack())
+#define MMJSON_CBOR        0x20     // CBOR instead of JSON (see Encoder.dumpcbor())
+
+/*
+ * A growable output buffer owned by the caller.  The encoded output is
+ * appended at data + size; when more space is needed grow() is called.
+ */
+typedef struct MMJsonBuffer
+{
+    char *      data;           // may be NULL if 'allocated' is 0
+    Py_ssize_t  size;           // number of bytes used
+    Py_ssize_t  allocated;      // number of bytes allocated
+
+    // should reallocate 'data' to at least 'min_allocated' bytes, keeping
+    // its contents, and update 'data' and 'allocated'; returns 0 on success,
+    // or -1 with a Python exception set
+    int (*grow) (struct MMJsonBuffer * buffer, Py_ssize_t min_allocated);
+
+    void *      context;        // for use by grow()
+}
+MMJsonBuffer;
+
+// consumer of encoded chunks, returns 0 on success or -1 with a Python exception set
+typedef int (*MMJsonWriteFunc) (void * context, const char * data, Py_ssize_t size);
+
+typedef struct
+{
+    int version;                // METAMAGIC_JSON_API_VERSION
+
+    PyTypeObject * EncoderType; // metamagic.json._encoder.Encoder (of the interpreter
+                                //   which imported the capsule)
+
+    /*
+     * Appends the encoding of 'obj' to 'buffer'.
+     *
+     * 'encoder' is an Encoder instance (or an instance of a subclass), whose
+     * default() and encode_hook() methods are used, or NULL for the default
+     * Encoder of the current interpreter.
+     * 'max_nested_level' of 0 means the default (100).
+     *
+     * Returns 0 on success.  On errors returns -1 with a Python exception set;
+     * buffer->size is then left unchanged (but the buffer may have grown).
+     */
+    int (*encode) (PyObject * encoder, PyObject * obj, MMJsonBuffer * buffer,
+                   int flags, int max_nested_level);
+
+    /*
+     * Passes the encoding of 'obj' to 'write' chunk by chunk, as it is produced.
+     * Returns 0 on success, or -1 with a Python exception set.
+     */
+    int (*encode_to_writer) (PyObject * encoder, PyObject * obj,
+                             MMJsonWriteFunc write, void * context,
+                             int flags, int max_nested_level);
+}
+MMJson_CAPI;
+
+#ifndef METAMAGIC_JSON_MODULE
+
+// every interpreter has its own copy of the table; extension modules supporting
+// subinterpreters should import it into their module state instead
+static MMJson_CAPI * MMJson_API = NULL;
+
+// imports the C API; evaluates to NULL (with an exception set) on failure
+#define MMJson_IMPORT \
+    (MMJson_API = (MMJson_CAPI *)PyCapsule_Import(METAMAGIC_JSON_CAPSULE_NAME, 0))
+
+#endif
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif
@@ -0,0 +1,199 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""Lazy decoding of JSON documents: a document is indexed in one pass and
+its values are decoded only when they are accessed."""
+
+
+__all__ = ('lazy_loadb', 'LazyObject', 'LazyArray')
+
+
+from array import array
+from collections.abc import Mapping, Sequence
+
+try:
+    from ._decoder import scan, decode
+except ImportError:
+    from .decoder import scan, decode
+
+
+_OBJECT, _ARRAY = ord('{'), ord('[')
+
+
+class _Document:
+    """A JSON document and its structural index, see ``scan()``: every value
+       (and object key) has a (start offset, end offset, next entry) triple."""
+
+    __slots__ = ('data', 'tape')
+
+    def __init__(self, data):
+        self.data = memoryview(data).cast('B')
+        self.tape = memoryview(scan(self.data)).cast('q')
+
+    def value(self, index):
+        """Returns the value of the tape entry ``index``; containers are returned
+           as proxies, other values are decoded."""
+
+        start = self.tape[index * 3]
+        first = self.data[start]
+
+        if first == _OBJECT:
+            return LazyObject(self, index)
+        if first == _ARRAY:
+            return LazyArray(self, index)
+
+        return decode(self.data, start, self.tape[index * 3 + 1])
+
+
+class _LazyContainer:
+    __slots__ = ('_document', '_index', '_proxies')
+
+    def __init__(self, document, index):
+        self._document = document
+        self._index = index
+        self._proxies = None        # proxies of the child containers accessed
+
+    def _value(self, index):
+        proxies = self._proxies
+        if proxies is not None and index in proxies:
+            return proxies[index]
+
+        value = self._document.value(index)
+
+        # only containers are cached: they keep the index of their own children
+        if isinstance(value, _LazyContainer):
+            if proxies is None:
+                proxies = self._proxies = {}
+            proxies[index] = value
+
+        return value
+
+    @property
+    def raw(self):
+        """The JSON text of the value: a memoryview of the input document (no copy is made)"""
+        tape = self._document.tape
+        return self._document.data[tape[self._index * 3]:tape[self._index * 3 + 1]]
+
+    def decode(self):
+        """Returns the whole value decoded to dicts, lists and other Python objects"""
+        tape = self._document.tape
+        return decode(self._document.data, tape[self._index * 3], tape[self._index * 3 + 1])
+
+    def __repr__(self):
+        return '<{} of {} bytes>'.format(type(self).__name__, len(self.raw))
+
+
+class LazyObject(_LazyContainer, Mapping):
+    """A read-only mapping proxy for a JSON object.
+
+       The keys are decoded on first access, the values every time they are
+       accessed (proxies of nested containers are kept by their parent).
+       If a key occurs more than once the last value is used, as with ``loadb()``.
+    """
+
+    __slots__ = ('_keys',)
+
+    def __init__(self, document, index):
+        super().__init__(document, index)
+        self._keys = None           # key -> tape index of its value
+
+    def _get_keys(self):
+        keys = self._keys
+
+        if keys is None:
+            data = self._document.data
+            tape = self._document.tape
+
+            keys = {}
+            end = tape[self._index * 3 + 2]
+            entry = self._index + 1
+            while entry < end:
+                value = entry + 1
+                keys[decode(data, tape[entry * 3], tape[entry * 3 + 1])] = value
+                entry = tape[value * 3 + 2]
+
+            self._keys = keys
+
+        return keys
+
+    def __getitem__(self, key):
+        return self._value(self._get_keys()[key])
+
+    def __iter__(self):
+        return iter(self._get_keys())
+
+    def __len__(self):
+        return len(self._get_keys())
+
+    def __contains__(self, key):
+        return key in self._get_keys()
+
+
+class LazyArray(_LazyContainer, Sequence):
+    """A read-only sequence proxy for a JSON array; see ``LazyObject``.
+
+       Slicing returns a list.  Compares equal to lists (and other
+       LazyArrays) with equal items.
+    """
+
+    __slots__ = ('_items',)
+
+    def __init__(self, document, index):
+        super().__init__(document, index)
+        self._items = None          # tape indices of the items
+
+    def _get_items(self):
+        items = self._items
+
+        if items is None:
+            tape = self._document.tape
+
+            items = array('q')
+            end = tape[self._index * 3 + 2]
+            entry = self._index + 1
+            while entry < end:
+                items.append(entry)
+                entry = tape[entry * 3 + 2]
+
+            self._items = items
+
+        return items
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._value(item) for item in self._get_items()[i]]
+        return self._value(self._get_items()[i])
+
+    def __iter__(self):
+        for item in self._get_items():
+            yield self._value(item)
+
+    def __len__(self):
+        return len(self._get_items())
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, LazyArray)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+
+def lazy_loadb(data):
+    """Returns the top-level value of the JSON document in the bytes-like object
+       ``data`` (``bytes``, ``bytearray``, ``memoryview``...): a ``LazyObject`` or
+       ``LazyArray`` proxy for objects and arrays, the decoded value otherwise.
+
+       The document is validated and indexed in one pass, which creates no Python
+       objects; the index takes 24 bytes per value.  Proxies refer to ``data``,
+       which is not copied.  Invalid UTF-8 in strings is only detected when they
+       are decoded.
+
+       Raises ``DecodeError`` for invalid documents.
+    """
+    return _Document(data).value(0)
@@ -0,0 +1,90 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""JSON Lines (newline-delimited JSON) output."""
+
+
+__all__ = ('JSONLinesWriter',)
+
+
+try:
+    from ._encoder import Encoder
+except ImportError:
+    from .encoder import Encoder
+
+
+class JSONLinesWriter:
+    """Writes objects as JSON Lines records to the binary file-like object ``fp``.
+
+       Encoded records are collected in memory and written to ``fp`` in one
+       ``write()`` call as soon as there are at least ``flush_bytes`` of them
+       (and on ``flush()`` and ``close()``).  ``encoder`` is an Encoder class or
+       instance used to encode the records.
+
+       Can be used as a context manager; ``fp`` itself is never closed.
+
+       **Example**:
+
+       .. code-block:: python
+
+           with open('export.jsonl', 'wb') as f, JSONLinesWriter(f) as writer:
+               writer.write_many(records)
+    """
+
+    def __init__(self, fp, *, flush_bytes=1048576, encoder=Encoder, max_nested_level=100):
+        if isinstance(encoder, type):
+            encoder = encoder()
+
+        self._fp = fp
+        self._flush_bytes = flush_bytes
+        self._encoder = encoder
+        self._max_nested_level = max_nested_level
+        self._buffer = bytearray()
+
+    def write(self, obj):
+        """Encode ``obj`` as one record."""
+        self._buffer += self._encoder.dumpb(obj, max_nested_level=self._max_nested_level)
+        self._buffer += b'\n'
+        if len(self._buffer) >= self._flush_bytes:
+            self.flush()
+
+    def write_many(self, iterable):
+        """Encode each object of ``iterable`` as a record.
+
+           Objects are encoded in batches with ``Encoder.dumpb_many()``, which
+           is considerably faster than calling ``write()`` for each of them.
+        """
+        batch = []
+        for obj in iterable:
+            batch.append(obj)
+            if len(batch) == 4096:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        self._buffer += self._encoder.dumpb_many(batch, max_nested_level=self._max_nested_level)
+        if len(self._buffer) >= self._flush_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write all pending records to ``fp``."""
+        if self._buffer:
+            data, self._buffer = self._buffer, bytearray()
+            self._fp.write(data)
+
+    def close(self):
+        """Flush pending records; ``fp`` is not closed."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,115 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""Encoding of large sequences of records on multiple CPU cores."""
+
+
+__all__ = ('dump_records',)
+
+
+import collections
+import concurrent.futures
+import itertools
+import os
+
+try:
+    from ._encoder import Encoder
+except ImportError:
+    from .encoder import Encoder
+
+
+def _encode_batch(encoder, batch, sep, max_nested_level):
+    if isinstance(encoder, type):
+        encoder = encoder()
+    return encoder.dumpb_many(batch, sep, max_nested_level=max_nested_level)
+
+
+def dump_records(iterable, fp, *, workers=None, batch=1000, format='ndjson',
+                 encoder=Encoder, executor=None, max_in_flight=None,
+                 max_nested_level=100):
+    """Encode records from ``iterable`` in a process pool, writing them to ``fp``.
+
+       Records are split into batches of ``batch`` records, each batch is
+       encoded with ``Encoder.dumpb_many()`` in one of the ``workers`` processes
+       (``os.cpu_count()`` if ``None``; records are encoded in the current
+       process if ``0``) and the output is written to the binary file-like
+       object ``fp`` in the input order.
+
+       ``format`` is either ``'ndjson'`` (one record per line) or ``'array'``
+       (one JSON array of all records).
+
+       ``encoder`` is an Encoder class or instance; it must be picklable, as well
+       as the records.  Instead of creating a new process pool an existing
+       ``concurrent.futures`` executor can be given as ``executor``.
+
+       At most ``max_in_flight`` batches (twice the number of workers by
+       default) are submitted to the pool at a time, which bounds the memory
+       used by the pending input and output.
+
+       Note: the records are pickled to be sent to the workers in the current
+       process; the pool pays off when encoding the records is considerably
+       more expensive than pickling them (e.g. for objects encoded with
+       ``__mm_serialize__`` or ``default()``).
+    """
+    if format == 'ndjson':
+        sep = b'\n'
+    elif format == 'array':
+        sep = b','
+    else:
+        raise ValueError('unsupported format: {!r}'.format(format))
+
+    it = iter(iterable)
+    batches = iter(lambda: list(itertools.islice(it, batch)), [])
+
+    if format == 'array':
+        fp.write(b'[')
+
+    first = True
+
+    def write(data):
+        nonlocal first
+        if format == 'array':
+            if not first:
+                fp.write(b',')
+            # drop the trailing separator
+            data = memoryview(data)[:-1]
+        first = False
+        fp.write(data)
+
+    if workers == 0 and executor is None:
+        for records in batches:
+            write(_encode_batch(encoder, records, sep, max_nested_level))
+
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+
+        if max_in_flight is None:
+            max_in_flight = 2 * (workers or os.cpu_count() or 1)
+
+        pending = collections.deque()
+
+        try:
+            for records in batches:
+                if len(pending) >= max_in_flight:
+                    write(pending.popleft().result())
+                pending.append(executor.submit(_encode_batch, encoder, records, sep,
+                                               max_nested_level))
+
+            while pending:
+                write(pending.popleft().result())
+
+        finally:
+            for future in pending:
+                future.cancel()
+            if own_executor:
+                executor.shutdown()
+
+    if format == 'array':
+        fp.write(b']')
@@ -0,0 +1,223 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""Schemas telling the decoder which values to convert to UUIDs, datetimes and
+Decimals and which objects to decode to instances of classes, as it decodes
+them."""
+
+
+__all__ = ('Schema',)
+
+
+# kinds of the nodes of compiled schemas, see SCHEMA_* in _decoder/_decoder.h
+_UUID, _DATETIME, _DATE, _TIME, _DECIMAL, _LIST, _DICT, _OBJECT, _ANY = range(1, 10)
+
+
+class Schema:
+    """A compiled schema for ``loadb()``, ``loads()`` and ``load()``: describes
+       the values to convert as they are decoded, with no intermediate dicts
+       and no Python code called for them.
+
+       ``spec`` is one of:
+
+       * ``uuid.UUID``, ``datetime.datetime``, ``datetime.date``,
+         ``datetime.time``: a string in the format written by the encoder
+         (``str()`` of UUIDs, ISO format of dates and times, with an optional
+         UTC offset or ``Z``), converted to an instance of the class;
+
+       * ``decimal.Decimal``: a number, or a string of a finite number;
+
+       * ``[spec]``, ``List[spec]``, ``Sequence[spec]``: an array of items
+         described by ``spec``;
+
+       * ``Dict[str, spec]``, ``Mapping[str, spec]``: an object whose values
+         are described by ``spec``;
+
+       * ``{key: spec}``: an object decoded to a dict, with the values of the
+         given keys described by their spec; other keys are decoded as is;
+
+       * a class: an object decoded to an instance of the class, called with the
+         fields found in the object as keyword arguments.  The fields of
+         dataclasses are their ``__init__()`` fields, the fields of other
+         classes are their annotated attributes or their ``__slots__``; their
+         specs are their type annotations.  Other keys are ignored.
+
+       ``Optional[spec]`` and ``spec | None`` are the same as ``spec``: null
+       is decoded to None anywhere.  ``str``, ``int``, ``float``, ``bool``, ``object``, ``Any``
+       and other specs leave the value as is, and so does the lack of a spec
+       (e.g. a key not in a dict spec); only the values with no spec are
+       converted by the ``parse_*`` options of ``loadb()``.
+
+       Values of another type than the one described (e.g. a number for a UUID,
+       or a malformed date) raise ``DecodeError``.
+
+       **Example**:
+
+       .. code-block:: python
+
+           @dataclass
+           class Event:
+               id: UUID
+               created: datetime
+               amounts: List[Decimal]
+
+           schema = Schema(List[Event])
+           events = loadb(data, schema=schema)
+    """
+
+    __slots__ = ('spec', 'node')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.node = _compile(spec, {})
+
+    def __repr__(self):
+        return '<Schema {!r}>'.format(self.spec)
+
+
+def _compile(spec, classes):
+    # 'classes' maps the classes compiled so far to their nodes, which can
+    # refer to themselves through the dict of their fields
+    import typing
+    from datetime import date, datetime, time
+    from decimal import Decimal
+    from uuid import UUID
+
+    if isinstance(spec, Schema):
+        return spec.node
+
+    if isinstance(spec, list):
+        if len(spec) != 1:
+            raise TypeError('a list spec must have one item, the spec of the items')
+        return (_LIST, _compile(spec[0], classes))
+
+    if isinstance(spec, dict):
+        fields = {}
+        for key, field_spec in spec.items():
+            if not isinstance(key, str):
+                raise TypeError('the keys of a dict spec must be str, not {}'.format(
+                                type(key).__name__))
+            fields[key] = (len(fields), _compile(field_spec, classes))
+        return (_OBJECT, fields, None, tuple(fields))
+
+    node = _compile_generic(spec, classes)
+    if node is not False:
+        return node
+
+    if spec is typing.Any:
+        return (_ANY,)
+
+    if not isinstance(spec, type):
+        return None
+
+    if spec is UUID:
+        return (_UUID,)
+    if spec is datetime:
+        return (_DATETIME,)
+    if spec is date:
+        return (_DATE,)
+    if spec is time:
+        return (_TIME,)
+    if spec is Decimal:
+        return (_DECIMAL,)
+
+    if spec in classes:
+        return classes[spec]
+
+    field_specs = _class_fields(spec)
+    if field_specs is None:
+        # str, int, object...
+        return (_ANY,)
+
+    fields = {}
+    node = classes[spec] = (_OBJECT, fields, spec, tuple(field_specs))
+
+    for index, (name, field_spec) in enumerate(field_specs.items()):
+        fields[name] = (index, _compile(field_spec, classes))
+
+    return node
+
+
+def _compile_generic(spec, classes):
+    # the node for typing generics (List[X], Optional[X], X | None...), or
+    # False if 'spec' is not one
+    import collections.abc
+    import types
+
+    union_type = getattr(types, 'UnionType', None)
+    if union_type is not None and isinstance(spec, union_type):
+        # X | None (Python 3.10+)
+        return _compile_union(spec.__args__, classes)
+
+    origin = getattr(spec, '__origin__', None)
+    if origin is None:
+        return False
+
+    import typing
+
+    args = getattr(spec, '__args__', None) or ()
+
+    if origin is typing.Union:
+        return _compile_union(args, classes)
+
+    args = [arg for arg in args if arg is not type(None)]
+
+    if not isinstance(origin, type) or issubclass(origin, (str, bytes, tuple)):
+        return (_ANY,)
+
+    if issubclass(origin, collections.abc.Mapping):
+        return (_DICT, _compile(args[1], classes)) if len(args) == 2 else (_ANY,)
+
+    if issubclass(origin, collections.abc.Sequence):
+        return (_LIST, _compile(args[0], classes)) if len(args) == 1 else (_ANY,)
+
+    return (_ANY,)
+
+
+def _compile_union(args, classes):
+    # Optional[X] and X | None are X, null is accepted anywhere; other
+    # unions leave the value as is
+    args = [arg for arg in args if arg is not type(None)]
+    return _compile(args[0], classes) if len(args) == 1 else (_ANY,)
+
+
+def _class_fields(cls):
+    # {name: spec} of the fields of 'cls', None if it has none
+    import typing
+
+    try:
+        hints = typing.get_type_hints(cls)
+    except Exception:
+        # unresolved forward references
+        hints = {}
+        for base in reversed(cls.__mro__):
+            hints.update(getattr(base, '__annotations__', {}))
+
+    if hasattr(cls, '__dataclass_fields__'):
+        import dataclasses
+        return {field.name: hints.get(field.name) for field in dataclasses.fields(cls)
+                if field.init}
+
+    if hints:
+        return {name: spec for name, spec in hints.items()
+                if not _is_class_var(spec)}
+
+    slots = []
+    for base in reversed(cls.__mro__):
+        base_slots = base.__dict__.get('__slots__', ())
+        slots.extend([base_slots] if isinstance(base_slots, str) else base_slots)
+
+    slots = [name for name in slots if name not in ('__dict__', '__weakref__')]
+    return dict.fromkeys(slots) if slots else None
+
+
+def _is_class_var(spec):
+    import typing
+
+    class_var = getattr(typing, 'ClassVar', None)
+    return spec is class_var or getattr(spec, '__origin__', None) is class_var
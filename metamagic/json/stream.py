@@ -0,0 +1,211 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+"""Incremental decoding of streams of JSON values: JSON Lines (NDJSON) or
+the items of one top-level array, read in chunks of any size."""
+
+
+__all__ = ('IncrementalDecoder', 'loadb_iter')
+
+
+try:
+    from ._decoder import decode, find_value_end
+except ImportError:
+    from .decoder import decode, find_value_end
+
+from . import _parse_flags
+from .exceptions import DecodeError
+from .schema import Schema
+
+
+_WHITESPACE = b' \t\n\r'
+
+# what the decoder expects next, outside of values
+_VALUE, _ARRAY_START, _FIRST_ITEM, _COMMA, _ITEM, _END = range(6)
+
+_EXPECTING = {
+    _ARRAY_START: "Expecting '['",
+    _FIRST_ITEM:  'Expecting value',
+    _COMMA:       "Expecting ',' delimiter",
+    _ITEM:        'Expecting value',
+    _END:         'Extra data',
+}
+
+_ARRAY_OPEN, _ARRAY_CLOSE, _SEPARATOR = ord('['), ord(']'), ord(',')
+
+
+class IncrementalDecoder:
+    """Decodes a stream of JSON values fed in chunks of bytes.
+
+       By default the stream is a sequence of values separated by optional
+       whitespace, e.g. JSON Lines; with ``array=True`` it is one JSON array,
+       and its items are decoded one by one.
+
+       Only the unfinished value at the end of the input fed so far is kept, so
+       memory use is bounded by the size of the largest value (or array item),
+       and every byte is scanned once however the input is split.
+
+       ``schema`` describes every value (or array item), see ``metamagic.json.Schema``;
+       ``parse_uuid``, ``parse_datetime`` and ``parse_decimal`` convert the
+       other values as with ``metamagic.json.loadb()``.
+
+       Positions of ``DecodeError`` are offsets from the start of the stream.
+       The decoder can not be used any more after an error.
+
+       **Example**:
+
+       .. code-block:: python
+
+           decoder = IncrementalDecoder()
+           for chunk in chunks:
+               for record in decoder.feed(chunk):
+                   process(record)
+           for record in decoder.close():
+               process(record)
+    """
+
+    def __init__(self, *, array=False, schema=None, parse_uuid=False, parse_datetime=False,
+                 parse_decimal=None):
+        if schema is not None and not isinstance(schema, Schema):
+            schema = Schema(schema)
+
+        self._array = array
+        self._expect = _ARRAY_START if array else _VALUE
+        self._schema = schema.node if schema is not None else None
+        self._parse = _parse_flags(parse_uuid, parse_datetime, parse_decimal)
+
+        self._buffer = bytearray()
+        self._offset = 0            # offset of the buffer in the stream
+        self._start = 0             # start of the current value in the buffer
+        self._scanned = None        # end of its scanned part, None outside of values
+        self._state = 0             # find_value_end() state of the current value
+
+    def feed(self, chunk):
+        """Add the bytes-like object ``chunk`` to the input and return a list of
+           the values it completes.
+
+           A top-level number or literal at the very end of the input is only
+           returned once it is followed by whitespace (or by ``close()``).
+        """
+        buffer = self._buffer
+        buffer += chunk
+
+        try:
+            values = self._decode_values()
+        except DecodeError as e:
+            raise DecodeError(e.msg, self._offset + e.pos) from None
+
+        # forget the input decoded so far
+        start = self._start
+        if start:
+            del buffer[:start]
+            self._offset += start
+            self._start = 0
+            if self._scanned is not None:
+                self._scanned -= start
+
+        return values
+
+    def close(self):
+        """Signal the end of the input and return a list of the remaining values:
+           the last top-level number or literal, if any.
+
+           Raises ``DecodeError`` if the input ends inside a value, or before the
+           end of the array.
+        """
+        buffer = self._buffer
+        values = []
+
+        try:
+            if self._scanned is not None:
+                # reports what is missing if the value is incomplete
+                values.append(decode(buffer, self._start, None, self._schema, self._parse))
+                self._expect = _COMMA if self._array else _VALUE
+
+            if self._array and self._expect != _END:
+                raise DecodeError(_EXPECTING[self._expect], len(buffer))
+        except DecodeError as e:
+            raise DecodeError(e.msg, self._offset + e.pos) from None
+
+        self._offset += len(buffer)
+        self._scanned = None
+        del buffer[:]
+
+        return values
+
+    def _decode_values(self):
+        buffer = self._buffer
+        size = len(buffer)
+        values = []
+        pos = self._start
+
+        while True:
+            if self._scanned is not None:
+                end, self._state = find_value_end(buffer, self._scanned, self._state)
+                if end < 0:
+                    self._scanned = size
+                    break
+
+                values.append(decode(buffer, pos, end, self._schema, self._parse))
+                pos = end
+                self._scanned = None
+                if self._array:
+                    self._expect = _COMMA
+                continue
+
+            while pos < size and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos == size:
+                break
+
+            expect = self._expect
+            char = buffer[pos]
+
+            if expect == _VALUE or expect == _ITEM or (expect == _FIRST_ITEM and
+                                                       char != _ARRAY_CLOSE):
+                self._scanned = pos
+                self._state = 0
+                continue
+
+            if expect == _ARRAY_START and char == _ARRAY_OPEN:
+                self._expect = _FIRST_ITEM
+            elif expect == _COMMA and char == _SEPARATOR:
+                self._expect = _ITEM
+            elif (expect == _COMMA or expect == _FIRST_ITEM) and char == _ARRAY_CLOSE:
+                self._expect = _END
+            else:
+                raise DecodeError(_EXPECTING[expect], pos)
+
+            pos += 1
+
+        self._start = pos
+        return values
+
+
+def loadb_iter(fp, *, array=False, schema=None, chunk_size=65536, **options):
+    """Iterate over the JSON values read from the binary file-like object ``fp``
+       in chunks of ``chunk_size`` bytes, see ``IncrementalDecoder`` for the
+       other arguments.
+
+       **Example**:
+
+       .. code-block:: python
+
+           with open('records.ndjson', 'rb') as fp:
+               for record in loadb_iter(fp):
+                   process(record)
+    """
+    decoder = IncrementalDecoder(array=array, schema=schema, **options)
+
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        yield from decoder.feed(chunk)
+
+    yield from decoder.close()
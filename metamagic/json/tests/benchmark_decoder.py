@@ -0,0 +1,300 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import gc
+import re
+import tempfile
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+from json import dumps as std_dumps, loads as std_loads
+from typing import List
+
+from metamagic.json import load, loadb, lazy_loadb, extract, Decoder, Schema, dumpb
+from metamagic.json.stream import IncrementalDecoder
+from metamagic.test import benchmark
+
+
+def make_document(records=10000):
+    # a ~2 MB webhook-like payload, of which only a few fields are needed
+    return std_dumps({
+        'meta': {'tenant_id': 42, 'source': 'benchmark'},
+        'type': 'records.updated',
+        'records': [{'id': i, 'name': 'record %d' % i, 'score': i / 7,
+                     'tags': ['a', 'b', 'c'], 'owner': {'id': i % 100, 'active': True}}
+                    for i in range(records)]
+    }).encode()
+
+
+def make_lines(records=10000):
+    # ~1 MB of JSON Lines
+    return b''.join(std_dumps({'id': i, 'name': 'record %d' % i, 'score': i / 7,
+                               'tags': ['a', 'b', 'c']}).encode() + b'\n'
+                    for i in range(records))
+
+
+def make_rows(rows=100000, fields=20):
+    # a table: rows with the same 20 keys
+    keys = ['field_%d' % i for i in range(fields)]
+    return [{key: (i if j % 2 else 'value %d' % j) for j, key in enumerate(keys)}
+            for i in range(rows)]
+
+
+class Payment:
+    __slots__ = ('id', 'created', 'amount', 'currency', 'refunds')
+
+    id: uuid.UUID
+    created: datetime
+    amount: Decimal
+    currency: str
+    refunds: List[Decimal]
+
+    def __init__(self, id, created, amount, currency, refunds):
+        self.id, self.created, self.amount, self.currency, self.refunds = \
+            id, created, amount, currency, refunds
+
+
+def make_payments(payments=10000):
+    # ~1.3 MB of records with a UUID, a datetime and Decimals, as written by the encoder
+    start = datetime(2014, 1, 1)
+    return dumpb([{'id': uuid.UUID(int=i * 7919), 'created': start + timedelta(seconds=i * 97),
+                   'amount': Decimal(i) / 100, 'currency': 'EUR',
+                   'refunds': [Decimal(i % 5) / 10] * (i % 3)}
+                  for i in range(payments)])
+
+
+def hydrate_payment(row):
+    # the Python post-pass converting a decoded payment
+    return Payment(uuid.UUID(row['id']), datetime.strptime(row['created'], '%Y-%m-%dT%H:%M:%S'),
+                   Decimal(row['amount']), row['currency'], [Decimal(r) for r in row['refunds']])
+
+
+_HYDRATED_FORMATS = [
+    (re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z'), uuid.UUID),
+    (re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}\Z'),
+     lambda value: datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')),
+    (re.compile(r'-?[0-9]+(?:\.[0-9]+)?\Z'), Decimal),
+]
+
+
+def hydrate_value(value):
+    # the hook converting the strings of a decoded document in the formats of
+    # make_payments() back to UUIDs, datetimes and Decimals
+    if type(value) is str:
+        for pattern, convert in _HYDRATED_FORMATS:
+            if pattern.match(value):
+                return convert(value)
+    elif type(value) is list:
+        return [hydrate_value(item) for item in value]
+    elif type(value) is dict:
+        return {key: hydrate_value(item) for key, item in value.items()}
+    return value
+
+
+def report_memory_per_row(name, decode_rows, rows):
+    # memory taken by the decoded rows (and everything they refer to)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        decoded = decode_rows()
+        print('{}: {} bytes per row'.format(name, tracemalloc.get_traced_memory()[0] // rows))
+    finally:
+        tracemalloc.stop()
+    del decoded
+
+
+def report_peak_memory(name, read):
+    # peak memory taken by the input and the decoded value (memory maps are not counted)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        read()
+        print('{}: {} KB peak'.format(name, tracemalloc.get_traced_memory()[1] // 1024))
+    finally:
+        tracemalloc.stop()
+
+
+class BenchmarkLazyDecoder:
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_2_fields(self):
+        data = make_document()
+
+        def read():
+            doc = loadb(data)
+            return doc['meta']['tenant_id'], doc['type']
+
+        return read
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_lazy_loadb_2_fields(self):
+        data = make_document()
+
+        def read():
+            doc = lazy_loadb(data)
+            return doc['meta']['tenant_id'], doc['type']
+
+        return read
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_lazy_loadb_one_record(self):
+        data = make_document()
+        return lambda: lazy_loadb(data)['records'][5000]['owner']['id']
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_extract_2_fields(self):
+        data = make_document()
+        return lambda: extract(data, ['meta.tenant_id', 'type'])
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_extract_last_record(self):
+        # the whole document is skimmed
+        data = make_document()
+        return lambda: extract(data, ['records.9999.owner.id'])
+
+
+class BenchmarkDecodeRows:
+    # 100k rows with 20 keys, in one document and one document per row;
+    # the keys of all rows are the same strings unless they are decoded by
+    # separate calls with no Decoder
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_std_json_loads_table(self):
+        data = std_dumps(make_rows())
+        report_memory_per_row('std json.loads() table', lambda: std_loads(data), 100000)
+        return lambda: std_loads(data)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_table(self):
+        data = std_dumps(make_rows()).encode()
+        report_memory_per_row('loadb() table', lambda: loadb(data), 100000)
+        return lambda: loadb(data)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_std_json_loads_rows(self):
+        lines = [std_dumps(row) for row in make_rows()]
+        read = lambda: [std_loads(line) for line in lines]
+        report_memory_per_row('std json.loads() rows', read, 100000)
+        return read
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_rows(self):
+        lines = [std_dumps(row).encode() for row in make_rows()]
+        read = lambda: [loadb(line) for line in lines]
+        report_memory_per_row('loadb() rows', read, 100000)
+        return read
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_rows_decoder(self):
+        lines = [std_dumps(row).encode() for row in make_rows()]
+        decoder = Decoder()
+        read = lambda: [loadb(line, decoder) for line in lines]
+        report_memory_per_row('loadb(decoder=Decoder()) rows', read, 100000)
+        return read
+
+
+class BenchmarkIncrementalDecoder:
+    # the input arrives in 64 KB chunks
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_lines(self):
+        data = make_lines()
+        return lambda: [loadb(line) for line in data.splitlines()]
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_incremental_lines(self):
+        data = make_lines()
+
+        def read():
+            decoder = IncrementalDecoder()
+            values = []
+            for i in range(0, len(data), 65536):
+                values.extend(decoder.feed(data[i:i + 65536]))
+            return values
+
+        return read
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_incremental_array(self):
+        data = b'[' + make_lines().replace(b'\n', b',').rstrip(b',') + b']'
+
+        def read():
+            decoder = IncrementalDecoder(array=True)
+            values = []
+            for i in range(0, len(data), 65536):
+                values.extend(decoder.feed(data[i:i + 65536]))
+            return values
+
+        return read
+
+
+class BenchmarkLoadFile:
+    # a 900 KB array of 10k records, decoded whole; load() maps the file instead of
+    # reading it, which saves a copy of the input
+
+    def make_file(self):
+        file = tempfile.NamedTemporaryFile(suffix='.json')
+        file.write(make_lines().replace(b'\n', b',').join((b'[', b'null]')))
+        file.flush()
+        return file
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_read(self):
+        file = self.make_file()
+
+        def read():
+            with open(file.name, 'rb') as fp:
+                return loadb(fp.read())
+
+        report_peak_memory('loadb(fp.read())', read)
+        read.file = file            # the file is deleted with the benchmark
+        return read
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_load(self):
+        file = self.make_file()
+        read = lambda: load(file.name)
+        report_peak_memory('load(path)', read)
+        read.file = file
+        return read
+
+
+class BenchmarkSchema:
+    # 10k Payment records: decoded to dicts and converted in Python, or
+    # converted by the decoder as described by a Schema
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_post_pass(self):
+        data = make_payments()
+        return lambda: [hydrate_payment(row) for row in loadb(data)]
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_schema(self):
+        data = make_payments()
+        schema = Schema(List[Payment])
+        return lambda: loadb(data, schema=schema)
+
+
+class BenchmarkParse:
+    # 10k payments decoded to dicts with their UUIDs, datetimes and Decimals:
+    # converted by a Python hook, or by the decoder with the parse_* flags
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_std_json_loads_hook(self):
+        data = make_payments()
+        return lambda: hydrate_value(std_loads(data))
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_hook(self):
+        data = make_payments()
+        return lambda: hydrate_value(loadb(data))
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_loadb_parse(self):
+        data = make_payments()
+        return lambda: loadb(data, parse_uuid=True, parse_datetime=True, parse_decimal='strings')
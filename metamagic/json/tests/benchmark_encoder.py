@@ -7,11 +7,13 @@
 
 
 from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
 from json import dumps as std_dumps
 import random
 import marshal
 
+from metamagic.json import RawJSON
 from metamagic.json._encoder import Encoder as CEncoder
 from metamagic.json.encoder import Encoder as PyEncoder
 from metamagic.test import benchmark, skip
@@ -86,6 +88,41 @@ class BaseBenchmarkJSONEncoder:
 
         return lambda: self.encode(arr)
 
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_array_256_large_ints(self):
+        # database ids and timestamps in microseconds, above 2**30
+        arr = []
+        for _ in range(256):
+            arr.append(int(2**52 * random.random()))
+
+        return lambda: self.encode(arr)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_array_256_datetimes(self):
+        arr = []
+        for _ in range(256):
+            arr.append(datetime(2014, 1, 1) + timedelta(seconds=random.randrange(10**8),
+                                                        microseconds=random.randrange(10**6)))
+
+        return lambda: self.encode(arr)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_array_256_aware_datetimes(self):
+        tz = timezone(timedelta(hours=-5))
+        arr = []
+        for _ in range(256):
+            arr.append(datetime(2014, 1, 1, tzinfo=tz) + timedelta(seconds=random.randrange(10**8)))
+
+        return lambda: self.encode(arr)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_array_256_dates(self):
+        arr = []
+        for _ in range(256):
+            arr.append(date(2014, 1, 1) + timedelta(days=random.randrange(10**4)))
+
+        return lambda: self.encode(arr)
+
     @benchmark.throughput(seconds=3.0)
     def benchmark_array_256_decimals(self):
         arr = []
@@ -177,7 +214,154 @@ class BaseBenchmarkJSONEncoderCustom:
         return lambda: self.encode(arr)
 
 
-class BenchmarkJSONEncoder_Std(BaseBenchmarkJSONEncoder):
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_array_16_cached_fragments_str(self):
+        # pre-rendered sub-documents (e.g. from a cache) returned as str by
+        # __mm_json__ are scanned for characters to escape on every call
+        fragment = CEncoder().dumps(make_fragment())
+
+        class Cached:
+            def __mm_json__(self):
+                return fragment
+
+        arr = [Cached() for _ in range(16)]
+
+        return lambda: self.encode(arr)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_array_16_cached_fragments_raw_json(self):
+        fragment = RawJSON(CEncoder().dumpb(make_fragment()))
+        arr = [fragment] * 16
+
+        return lambda: self.encode(arr)
+
+
+def make_fragment():
+    # ~64 KB of JSON
+    return [{"id": i, "name": "item %d" % i, "tags": ["a", "b"]} for i in range(1500)]
+
+
+class BaseBenchmarkJSONEncoderMany:
+    # per-record overhead: 1M small records, one dumpb() call per record
+    # vs. a single dumpb_many() call
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_1m_small_records_dumpb(self):
+        records = [{"id": i, "ok": True} for i in range(1000000)]
+
+        def encode():
+            for record in records:
+                self.encoder().dumpb(record)
+
+        return encode
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_1m_small_records_dumpb_many(self):
+        records = [{"id": i, "ok": True} for i in range(1000000)]
+
+        return lambda: self.encoder().dumpb_many(records)
+
+
+class BaseBenchmarkJSONEncoderDiff:
+    # pushing changes of a large state: the full new state vs. a merge patch
+    # from the previous one, with a few changed fields
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_state_200kb_dumpb(self):
+        old, new = make_states(copy=False)
+        return lambda: self.encoder().dumpb(new)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_state_200kb_dumpb_diff(self):
+        # unchanged subtrees are shared with the old state
+        old, new = make_states(copy=False)
+        return lambda: self.encoder().dumpb_diff(old, new)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_state_200kb_dumpb_diff_copy(self):
+        # unchanged subtrees are equal copies
+        old, new = make_states(copy=True)
+        return lambda: self.encoder().dumpb_diff(old, new)
+
+
+def make_states(copy):
+    old = {"users": {"user%d" % i: {"id": i, "name": "user %d" % i, "score": i * 1.5,
+                                    "active": i % 3 == 0, "tags": ["a", "b", "c"]}
+                     for i in range(2000)},
+           "version": 1}
+
+    if copy:
+        new = {"users": {key: dict(user, tags=list(user["tags"]))
+                         for key, user in old["users"].items()},
+               "version": 2}
+    else:
+        new = {"users": dict(old["users"]), "version": 2}
+
+    for i in range(0, 2000, 400):
+        new["users"]["user%d" % i] = dict(old["users"]["user%d" % i], score=0.5)
+
+    return old, new
+
+
+class BaseBenchmarkJSONEncoderRows:
+    # query results as row tuples or columns: a dict built per row vs.
+    # row objects written directly
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_10k_rows_dicts_dumpb(self):
+        columns, rows = make_rows()
+        return lambda: self.encoder().dumpb([dict(zip(columns, row)) for row in rows])
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_10k_rows_dumpb_rows(self):
+        columns, rows = make_rows()
+        return lambda: self.encoder().dumpb_rows(columns, rows)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_10k_rows_columns_dicts_dumpb(self):
+        columns = make_columns()
+        return lambda: self.encoder().dumpb([dict(zip(columns, row))
+                                             for row in zip(*columns.values())])
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_10k_rows_dumpb_columns_lists(self):
+        columns = {name: list(column) for name, column in make_columns().items()}
+        return lambda: self.encoder().dumpb_columns(columns)
+
+    @benchmark.throughput(seconds=3.0)
+    def benchmark_10k_rows_dumpb_columns_arrays(self):
+        columns = make_columns()
+        return lambda: self.encoder().dumpb_columns(columns)
+
+
+def make_rows():
+    columns = ["id", "count", "price", "ok"]
+    rows = [(i, i % 100, i * 0.25, i % 2 == 0) for i in range(10000)]
+    return columns, rows
+
+
+def make_columns():
+    import array
+
+    return {"id": array.array("q", range(10000)),
+            "count": array.array("i", (i % 100 for i in range(10000))),
+            "price": array.array("d", (i * 0.25 for i in range(10000))),
+            "ok": memoryview(bytes(i % 2 for i in range(10000))).cast("?")}
+
+
+class BaseBenchmarkJSONEncoderNoDates:
+    # dates are only supported by our encoders
+    def benchmark_array_256_datetimes(self):
+        skip()
+
+    def benchmark_array_256_aware_datetimes(self):
+        skip()
+
+    def benchmark_array_256_dates(self):
+        skip()
+
+
+class BenchmarkJSONEncoder_Std(BaseBenchmarkJSONEncoderNoDates, BaseBenchmarkJSONEncoder):
     def encode(self, obj):
         return std_dumps(obj)
 
@@ -185,17 +369,49 @@ class BenchmarkJSONEncoder_Std(BaseBenchmarkJSONEncoder):
         skip()
 
 
-class BenchmarkJSONEncoder_C(BaseBenchmarkJSONEncoder, BaseBenchmarkJSONEncoderCustom):
+class BenchmarkJSONEncoder_C(BaseBenchmarkJSONEncoder, BaseBenchmarkJSONEncoderCustom,
+                             BaseBenchmarkJSONEncoderMany, BaseBenchmarkJSONEncoderDiff,
+                             BaseBenchmarkJSONEncoderRows):
+    encoder = CEncoder
+
     def encode(self, obj):
         return CEncoder().dumpb(obj)
 
 
-class BenchmarkJSONEncoder_Python(BaseBenchmarkJSONEncoder, BaseBenchmarkJSONEncoderCustom):
+class BenchmarkJSONEncoder_Python(BaseBenchmarkJSONEncoder, BaseBenchmarkJSONEncoderCustom,
+                                  BaseBenchmarkJSONEncoderMany, BaseBenchmarkJSONEncoderDiff,
+                                  BaseBenchmarkJSONEncoderRows):
+    encoder = PyEncoder
+
     def encode(self, obj):
         return PyEncoder().dumpb(obj)
 
 
-class BenchmarkJSONEncoder_Marshal(BaseBenchmarkJSONEncoder):
+class BaseBenchmarkJSONEncoderBinary:
+    # binary formats do not use __mm_json__
+    def benchmark_array_256_objs_with_mm_json(self):
+        skip()
+
+    def benchmark_array_16_cached_fragments_str(self):
+        skip()
+
+    def benchmark_array_16_cached_fragments_raw_json(self):
+        skip()
+
+
+class BenchmarkJSONEncoder_CMsgPack(BaseBenchmarkJSONEncoderBinary, BaseBenchmarkJSONEncoder,
+                                    BaseBenchmarkJSONEncoderCustom):
+    def encode(self, obj):
+        return CEncoder().dumpmsgpack(obj)
+
+
+class BenchmarkJSONEncoder_CCBOR(BaseBenchmarkJSONEncoderBinary, BaseBenchmarkJSONEncoder,
+                                 BaseBenchmarkJSONEncoderCustom):
+    def encode(self, obj):
+        return CEncoder().dumpcbor(obj)
+
+
+class BenchmarkJSONEncoder_Marshal(BaseBenchmarkJSONEncoderNoDates, BaseBenchmarkJSONEncoder):
     def benchmark_array_256_decimals(self):
         skip()
 
@@ -207,3 +423,30 @@ class BenchmarkJSONEncoder_Marshal(BaseBenchmarkJSONEncoder):
 
     def encode(self, obj):
         return marshal.dumps(obj)
+
+
+def payload_sizes():
+    """Returns ``{payload: {format: size}}`` for some of the payloads used by the
+       benchmarks above, to compare the size of the binary formats to JSON."""
+
+    user = { "userId": 3381293, "age": 213, "username": "johndoe",
+             "fullname": "John Doe the Second", "isAuthorized": True,
+             "liked": 31231.31231202, "approval": 31.1471,
+             "jobs": [ 1, 2 ], "currJob": None }
+
+    payloads = {
+        'medium_complex_object': [[user, [user] * 8]] * 6,
+        'array_256_doubles':     [10000000 * random.random() for _ in range(256)],
+        'array_256_ints':        [int(10000000 * random.random()) for _ in range(256)],
+        'array_256_small_ints':  [int(10000 * random.random()) for _ in range(256)],
+        'array_256_short_ascii': ["A pretty long string which is in a list"] * 256,
+        'array_256_dict_string_int': [{str(random.random() * 20): int(random.random() * 1000000)}
+                                      for _ in range(256)],
+    }
+
+    encoder = CEncoder()
+
+    return {name: {'json': len(encoder.dumpb(obj)),
+                   'msgpack': len(encoder.dumpmsgpack(obj)),
+                   'cbor': len(encoder.dumpcbor(obj))}
+            for name, obj in payloads.items()}
@@ -0,0 +1,57 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import os
+import subprocess
+import sys
+
+from metamagic.test import benchmark
+
+
+def import_times(statement='import metamagic.json'):
+    """Run ``statement`` in a new interpreter with ``-X importtime`` (Python 3.7+);
+       return a list of (module, self, cumulative) import times in microseconds."""
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            stderr=subprocess.PIPE, env=env, check=True).stderr
+
+    times = []
+    for line in output.decode().splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        times.append((module.strip(), int(self_us), int(cumulative_us)))
+
+    return times
+
+
+class BenchmarkImport:
+    # start-up cost of short-lived processes, compared with a bare interpreter
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_import_none(self):
+        return lambda: import_times('pass')
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_import_metamagic_json(self):
+        return lambda: import_times()
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_import_metamagic_json_dumps(self):
+        return lambda: import_times('import metamagic.json; metamagic.json.dumps([1, "a"])')
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_import_metamagic_json_loads(self):
+        return lambda: import_times('import metamagic.json; metamagic.json.loads("[1]")')
+
+
+if __name__ == '__main__':
+    # prints the modules imported by "import metamagic.json", the slowest first
+    for module, self_us, cumulative_us in sorted(import_times(), key=lambda t: -t[2]):
+        print('{:>8} {:>8}  {}'.format(self_us, cumulative_us, module))
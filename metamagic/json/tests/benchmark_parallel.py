@@ -0,0 +1,51 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import os
+import random
+
+from metamagic.json.parallel import dump_records
+from metamagic.test import benchmark
+
+
+class BaseBenchmarkParallelDump:
+    # scaling of dump_records() with the number of worker processes;
+    # workers = 0 encodes in the current process
+
+    workers = 0
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_dump_1m_records_ndjson(self):
+        records = [{"id": i, "name": "record %d" % i, "score": random.random(),
+                    "tags": ["a", "b", "c"]} for i in range(1000000)]
+
+        def dump():
+            with open(os.devnull, 'wb') as f:
+                dump_records(records, f, workers=self.workers, batch=5000)
+
+        return dump
+
+
+class BenchmarkParallelDump_0(BaseBenchmarkParallelDump):
+    workers = 0
+
+
+class BenchmarkParallelDump_1(BaseBenchmarkParallelDump):
+    workers = 1
+
+
+class BenchmarkParallelDump_2(BaseBenchmarkParallelDump):
+    workers = 2
+
+
+class BenchmarkParallelDump_4(BaseBenchmarkParallelDump):
+    workers = 4
+
+
+class BenchmarkParallelDump_8(BaseBenchmarkParallelDump):
+    workers = 8
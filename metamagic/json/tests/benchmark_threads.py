@@ -0,0 +1,155 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import random
+import sys
+import threading
+
+try:
+    import _interpreters
+except ImportError:
+    # subinterpreters with their own GIL can be created from Python since 3.13
+    _interpreters = None
+
+from metamagic.test import benchmark, skip
+
+
+# the same code runs in threads of the current interpreter and in subinterpreters
+SETUP = '''
+from metamagic.json._encoder import Encoder
+dumpb = Encoder().dumpb
+records = {records!r}
+'''
+
+ENCODE = '''
+for _ in range({rounds}):
+    dumpb(records)
+'''
+
+
+def make_records(count=1000):
+    return [{"id": i, "name": "record %d" % i, "score": random.random(),
+             "tags": ["a", "b", "c"]} for i in range(count)]
+
+
+def run_threads(target, args_list):
+    threads = [threading.Thread(target=target, args=args) for args in args_list]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class BaseBenchmarkEncoderScaling:
+    # scaling of the C encoder with the number of threads: every call does the
+    # same amount of work, split between the threads.  With the GIL, threads of
+    # one interpreter take turns; free-threaded builds and subinterpreters (each
+    # with its own GIL) run them in parallel.
+
+    threads = 1
+    rounds = 64
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_threads_dumpb_1000_records(self):
+        namespace = {}
+        exec(SETUP.format(records=make_records()), namespace)
+
+        code = compile(ENCODE.format(rounds=self.rounds // self.threads), '<encode>', 'exec')
+
+        return lambda: run_threads(exec, [(code, namespace)] * self.threads)
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_interpreters_dumpb_1000_records(self):
+        if _interpreters is None:
+            skip()
+
+        setup = 'import sys\nsys.path[:] = {!r}\n'.format(sys.path) + \
+                SETUP.format(records=make_records())
+
+        interpreters = [_interpreters.create('isolated') for _ in range(self.threads)]
+        for interpreter in interpreters:
+            error = _interpreters.exec(interpreter, setup)
+            if error is not None:
+                raise RuntimeError('subinterpreter setup failed: {}'.format(error))
+
+        code = ENCODE.format(rounds=self.rounds // self.threads)
+
+        return lambda: run_threads(_interpreters.exec,
+                                   [(interpreter, code) for interpreter in interpreters])
+
+
+class BenchmarkEncoderScaling_1(BaseBenchmarkEncoderScaling):
+    threads = 1
+
+
+class BenchmarkEncoderScaling_2(BaseBenchmarkEncoderScaling):
+    threads = 2
+
+
+class BenchmarkEncoderScaling_4(BaseBenchmarkEncoderScaling):
+    threads = 4
+
+
+class BenchmarkEncoderScaling_8(BaseBenchmarkEncoderScaling):
+    threads = 8
+
+
+class BenchmarkDumpToSocket:
+    # a large response written to a socket drained by another thread, while
+    # a third thread keeps encoding small records (the other requests of a
+    # threaded server): dump() makes a write() call and a bytes copy per chunk,
+    # dump_fd() writes the chunks itself with the GIL released
+
+    def setup_sockets(self, write):
+        import socket
+
+        from metamagic.json._encoder import Encoder
+
+        encoder = Encoder()
+        response = make_records(20000)
+        records = make_records(10)
+
+        def drain(receiver):
+            while receiver.recv(1 << 20):
+                pass
+
+        def encode_others(done):
+            while not done.is_set():
+                encoder.dumpb(records)
+
+        def run():
+            sender, receiver = socket.socketpair()
+            done = threading.Event()
+            threads = [threading.Thread(target=drain, args=(receiver,)),
+                       threading.Thread(target=encode_others, args=(done,))]
+            for thread in threads:
+                thread.start()
+            try:
+                write(encoder, response, sender)
+            finally:
+                sender.shutdown(socket.SHUT_WR)
+                done.set()
+                for thread in threads:
+                    thread.join()
+                sender.close()
+                receiver.close()
+
+        return run
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_dump_socket_file_20000_records(self):
+        def write(encoder, obj, sock):
+            with sock.makefile('wb', buffering=0) as f:
+                encoder.dump(obj, f)
+
+        return self.setup_sockets(write)
+
+    @benchmark.throughput(seconds=10.0)
+    def benchmark_dump_fd_socket_20000_records(self):
+        return self.setup_sockets(lambda encoder, obj, sock: encoder.dump_fd(obj, sock))
@@ -0,0 +1,88 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import asyncio
+
+from metamagic.utils.debug import assert_raises
+
+from metamagic.json import DecodeError
+from metamagic.json.aio import dumpb_async, dumpb_chunks, loadb_iter_async
+from ..encoder import Encoder as PyEncoder
+
+try:
+    from .._encoder import Encoder as CEncoder
+except ImportError:
+    CEncoder = PyEncoder
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_json_dumpb_async():
+    small = {'foo': [1, 2, 3]}
+    large = [{'id': i, 'name': 'x' * 100} for i in range(10000)]
+
+    for encoder in (PyEncoder, CEncoder):
+        assert run(dumpb_async(small, encoder=encoder)) == encoder().dumpb(small)
+        assert run(dumpb_async(large, encoder=encoder())) == encoder().dumpb(large)
+        assert run(dumpb_async(large, encoder=encoder, inline_threshold=10**9)) == \
+                    encoder().dumpb(large)
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            run(dumpb_async(large, encoder=encoder, max_nested_level=1))
+
+
+def test_json_dumpb_chunks():
+    large = [{'id': i, 'name': 'x' * 100} for i in range(10000)]
+
+    async def collect(obj, encoder, limit=None):
+        chunks = []
+        iterator = dumpb_chunks(obj, encoder=encoder, max_pending=1)
+        async for chunk in iterator:
+            chunks.append(chunk)
+            if len(chunks) == limit:
+                # stopping early aborts the encoder
+                await iterator.aclose()
+                break
+            await asyncio.sleep(0)
+        return chunks
+
+    for encoder in (PyEncoder, CEncoder):
+        chunks = run(collect(large, encoder))
+        assert b''.join(chunks) == encoder().dumpb(large)
+
+        assert len(run(collect(large, encoder, limit=1))) == 1
+
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            run(collect(large + [object()], encoder))
+
+    assert len(run(collect(large, CEncoder))) > 1
+
+
+def test_json_loadb_iter_async():
+    values = [{'id': i, 'name': 'x' * 100} for i in range(1000)]
+
+    async def collect(data, **kwargs):
+        reader = asyncio.StreamReader()
+        # the data arrives in pieces while the values are consumed
+        for i in range(0, len(data), 1000):
+            reader.feed_data(data[i:i + 1000])
+        reader.feed_eof()
+        return [value async for value in loadb_iter_async(reader, chunk_size=100, **kwargs)]
+
+    lines = b''.join(CEncoder().dumpb(value) + b'\n' for value in values)
+    assert run(collect(lines)) == values
+    assert run(collect(CEncoder().dumpb(values), array=True)) == values
+
+    with assert_raises(DecodeError, error_re='Unterminated string'):
+        run(collect(lines + b'"abc'))
@@ -6,7 +6,38 @@
 ##
 
 
-from metamagic.json import loads, loadb
+try:
+    from metamagic.test import skipif
+except ImportError:
+    from pytest import mark
+    def skipif(cond):
+        assert cond in (True, False)
+        return mark.skipif(repr(cond))
+
+import io
+import math
+import sys
+import typing
+from collections.abc import Mapping, Sequence
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from uuid import UUID
+
+from metamagic.utils.debug import assert_raises
+
+from metamagic.json import dumpb, load, loads, loadb, lazy_loadb, Decoder, DecodeError, Schema
+from metamagic.json.lazy import LazyObject, LazyArray
+from metamagic.json.stream import IncrementalDecoder, loadb_iter
+from ..decoder import scan as py_scan, decode as py_decode, find_value_end as py_find_value_end, \
+                      extract as py_extract, Decoder as PyDecoder
+
+SKIPC = False
+try:
+    from .._decoder import scan as c_scan, decode as c_decode, find_value_end as c_find_value_end, \
+                           extract as c_extract, Decoder as CDecoder
+except ImportError:
+    SKIPC = True
+    c_scan = c_decode = c_find_value_end = c_extract = CDecoder = None
 
 
 class TestJsonDecode:
@@ -15,3 +46,657 @@ class TestJsonDecode:
 
     def test_json_loadb(self):
         assert loadb(b'{"a":"b"}') == {'a': 'b'}
+        assert loadb(memoryview(b'[1]')) == [1]
+        assert loads('["\\ud800", "\ud800"]') == ['\ud800', '\ud800']
+
+        decoder = Decoder()
+        assert [loadb(b'{"a": %d}' % i, decoder) for i in range(3)] == [{'a': i} for i in range(3)]
+
+        # as by the json module
+        value = loadb(b'[NaN, Infinity, -Infinity]')
+        assert math.isnan(value[0]) and value[1:] == [math.inf, -math.inf]
+        assert loads('{"a": -Infinity}', schema={'a': typing.Any}) == {'a': -math.inf}
+        with assert_raises(DecodeError, error_re='Expecting a decimal number'):
+            loadb(b'[Infinity]', schema=[Decimal])
+        with assert_raises(DecodeError, error_re='Expecting value: position 1'):
+            loadb(b'[Nan]')
+        doc = lazy_loadb(b'{"a": NaN, "b": [Infinity, -Infinity]}')
+        assert math.isnan(doc['a']) and doc['b'] == [math.inf, -math.inf]
+
+    def test_json_loadb_parse(self):
+        import tempfile
+
+        value = [UUID('12345678-1234-5678-1234-567812345678'), datetime(2014, 1, 2, 3, 4, 5),
+                 date(2014, 1, 2), time(3, 4), Decimal('9.90'), 1.5, 'Ann']
+        data = dumpb(value)
+        assert loadb(data)[:5] == [str(value[0]), '2014-01-02T03:04:05', '2014-01-02',
+                                   '03:04:00', '9.90']
+
+        for decoder in (None, Decoder(), PyDecoder()):
+            assert loadb(data, decoder, parse_uuid=True, parse_datetime=True,
+                         parse_decimal='strings') == value
+            assert loads(data.decode(), decoder, parse_uuid=True)[:2] == \
+                        [value[0], '2014-01-02T03:04:05']
+            assert loadb(data, decoder, parse_decimal='numbers')[4:] == \
+                        ['9.90', Decimal('1.5'), 'Ann']
+            assert loadb(data, decoder, schema=[object], parse_decimal='numbers')[4:] == \
+                        ['9.90', 1.5, 'Ann']
+
+            with tempfile.TemporaryFile() as fp:
+                fp.write(data)
+                fp.seek(0)
+                assert load(fp, decoder, parse_datetime=True)[1:4] == value[1:4]
+
+        with assert_raises(ValueError, error_re="parse_decimal must be 'strings', 'numbers'"):
+            loadb(data, parse_decimal=True)
+
+    def test_json_load(self):
+        import mmap
+        import pathlib
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / 'doc.json'
+            path.write_bytes(b'{"a": [1, "\xc3\xa9"]}\n')
+            lines = pathlib.Path(tmp) / 'lines.json'
+            lines.write_bytes(b'header\n[1, "\xc3\xa9"]')
+
+            for decoder in (None, Decoder(), PyDecoder()):
+                assert load(str(path), decoder) == {'a': [1, '\xe9']}
+                assert load(path, decoder) == {'a': [1, '\xe9']}
+
+                # from the current position
+                with open(str(lines), 'rb') as fp:
+                    assert fp.readline() == b'header\n'
+                    assert load(fp, decoder) == [1, '\xe9']
+                    assert fp.read() == b''
+
+                with open(str(path), encoding='utf-8') as fp:
+                    assert load(fp, decoder) == {'a': [1, '\xe9']}
+
+                assert load(io.BytesIO(b'[1]'), decoder) == [1]
+
+                with open(str(path), 'rb') as fp, \
+                        mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                    assert loadb(mapping, decoder) == {'a': [1, '\xe9']}
+
+                # the mapping is closed after errors too
+                path.write_bytes(b'{"a": [1 2]}')
+                with assert_raises(DecodeError, error_re="Expecting ',' delimiter: position 9"):
+                    load(path, decoder)
+                path.write_bytes(b'')
+                with assert_raises(DecodeError, error_re='Expecting value: position 0'):
+                    load(path, decoder)
+                path.write_bytes(b'{"a": [1, "\xc3\xa9"]}\n')
+
+
+class Item:
+    __slots__ = ('sku', 'price', 'qty')
+
+    sku: str
+    price: Decimal
+    qty: int
+
+    def __init__(self, sku, price, qty=1):
+        self.sku, self.price, self.qty = sku, price, qty
+
+    def __eq__(self, other):
+        return (self.sku, self.price, self.qty) == (other.sku, other.price, other.qty)
+
+
+class Order:
+    __slots__ = ('id', 'created', 'items', 'parent')
+
+    def __init__(self, id, created=None, items=(), parent=None):
+        self.id, self.created, self.items, self.parent = id, created, items, parent
+
+
+Order.__annotations__ = {'id': UUID, 'created': typing.Optional[datetime],
+                         'items': typing.List[Item], 'parent': Order}
+
+
+class _BaseJsonDecoderTest:
+    scan = decode = find_value_end = extract = Decoder = None
+
+    def test_json_decoder_decode(self):
+        decode = self.decode
+
+        assert decode(b' [1, -2.5, 1e2, "a\\"\\u00e9\\ud83d\\ude00", true, false, null] ') == \
+                    [1, -2.5, 100.0, 'a"\xe9\U0001F600', True, False, None]
+        assert decode('{"k": {"\xe9": [[], {}]}, "k": 1}'.encode()) == {'k': 1}
+        assert decode(b'123456789012345678901234567890') == 123456789012345678901234567890
+        assert decode(b'"\\ud800"') == '\ud800'
+        assert decode(bytearray(b'[1]')) == [1]
+        assert decode(memoryview(b'x[1, 2] y'), 1, 7) == [1, 2]
+
+        for doc, error in [(b'', 'Expecting value: position 0'),
+                           (b'[1,,2]', 'Expecting value: position 3'),
+                           (b'{"a" 1}', "Expecting ':' delimiter: position 5"),
+                           (b'{"a":1,2}', 'Expecting property name.*: position 7'),
+                           (b'[1 2]', "Expecting ',' delimiter: position 3"),
+                           (b'[1] x', 'Extra data: position 4'),
+                           (b'"abc', 'Unterminated string.*: position 0'),
+                           (b'-Inf', 'Expecting value: position 0')]:
+            with assert_raises(DecodeError, error_re=error):
+                decode(doc)
+
+        with assert_raises(ValueError, error_re='offsets within data'):
+            decode(b'[1]', 2, 1)
+
+    def test_json_decoder_decoder(self):
+        decoder = self.Decoder(max_keys=2)
+
+        # keys with escapes, non-ASCII keys, more keys than max_keys
+        for doc in [b'[{"id": 1, "tags": {"a": 1}}, {"id": 2, "tags": {"a": 2, "b": 3}}, {"tags": {}}]',
+                    '{"\\u00e9": {"\u00e9": 1, "\\"": []}, "\u00e9": {"\u00e9": 2}}'.encode(),
+                    b'{"a": 1, "a": {"a": [{"x": 1, "y": 2}, {"x": 1, "x": 2}, {"y": 1, "x": 2}]}}']:
+            expected = loadb(doc)
+            assert decoder.decode(doc) == expected
+            assert decoder.decode(doc) == expected
+            assert list(decoder.decode(doc)) == list(expected)
+
+        assert decoder.decode(b'x{"a": [1, 2]}y', 1, 14) == {'a': [1, 2]}
+        decoder.clear()
+
+        with assert_raises(DecodeError, error_re="Expecting ':' delimiter: position 16"):
+            decoder.decode(b'[{"a": 1}, {"a" 1}]')
+
+        with assert_raises(ValueError, error_re='max_keys'):
+            self.Decoder(max_keys=-1)
+
+    def test_json_decoder_scan(self):
+        scan = self.scan
+
+        doc = b'{"a": [1, "x"], "b": {}}'
+        tape = memoryview(scan(doc)).cast('q')
+
+        # (start, end, next) of: the object, "a", the array, 1, "x", "b", {}
+        assert tape.tolist() == [0, 24, 7,
+                                 1, 4, 2,
+                                 6, 14, 5,
+                                 7, 8, 4,
+                                 10, 13, 5,
+                                 16, 19, 6,
+                                 21, 23, 7]
+
+        assert memoryview(scan(b' 1 ')).cast('q').tolist() == [1, 2, 1]
+        assert memoryview(scan(b'[NaN,-Infinity]')).cast('q').tolist() == \
+                    [0, 15, 3, 1, 4, 2, 5, 14, 3]
+
+        for doc, error in [(b'[1,]', 'Expecting value: position 3'),
+                           (b'{"a":1]', "Expecting ',' delimiter: position 6"),
+                           (b'[-Inf]', 'Expecting value: position 1'),
+                           (b'[1] x', 'Extra data: position 4')]:
+            with assert_raises(DecodeError, error_re=error):
+                scan(doc)
+
+    def test_json_decoder_schema(self):
+        decode = self.decode
+        uuid = UUID('12345678-1234-5678-1234-567812345678')
+
+        def convert(data, spec):
+            return decode(data, 0, None, Schema(spec).node)
+
+        assert convert(b'["12345678-1234-5678-1234-567812345678", "12345678-1234-5678-1234-567812345678"]',
+                       [UUID]) == [uuid, uuid]
+        assert convert(b'"12345678-1234-5678-1234-567812345678"', UUID).int == uuid.int
+        assert convert(b'"12345678-1234-5678-1234-567812345678"', UUID).hex == uuid.hex
+        assert convert(b'"ABCDEF78-1234-5678-1234-567812345678"', UUID) == \
+                    UUID('abcdef78-1234-5678-1234-567812345678')
+
+        assert convert(b'["2014-01-02T03:04:05", "2014-01-02T03:04:05.25+02:30", '
+                       b'"2014-01-02T03:04:05.000001-01:00", "2014-01-02T03:04:05Z"]', [datetime]) == \
+                    [datetime(2014, 1, 2, 3, 4, 5),
+                     datetime(2014, 1, 2, 3, 4, 5, 250000, timezone(timedelta(hours=2, minutes=30))),
+                     datetime(2014, 1, 2, 3, 4, 5, 1, timezone(timedelta(hours=-1))),
+                     datetime(2014, 1, 2, 3, 4, 5, tzinfo=timezone.utc)]
+        assert convert(b'["2014-01-02", null]', [date]) == [date(2014, 1, 2), None]
+        assert convert(b'"23:59:59.123456+00:00"', time) == \
+                    time(23, 59, 59, 123456, timezone.utc)
+        assert convert(b'[1, -2.50, 1e3, "1.10", "-1E+2"]', [Decimal]) == \
+                    [Decimal(1), Decimal('-2.5'), Decimal(1000), Decimal('1.10'), Decimal('-1E+2')]
+
+        # numbers are converted from their text, with all their digits; other
+        # numbers are floats
+        value = convert(b'{"total": 12345678901234567890.12, "price": 9.90, "n": [2.50]}',
+                        {'total': Decimal, 'price': Decimal})
+        assert [str(value['total']), str(value['price'])] == ['12345678901234567890.12', '9.90']
+        assert value['n'] == [2.5] and type(value['n'][0]) is float
+
+        # values are converted as they are decoded, round trips are exact
+        value = {'a': [date(2014, 1, 2)], 'b': {'x': uuid}, 'c': 'as is', 'd': {'e': 1}}
+        spec = {'a': typing.List[date], 'b': typing.Dict[str, UUID], 'd': typing.Any}
+        assert convert(dumpb(value), spec) == value
+
+        orders = convert(b'[{"id": "12345678-1234-5678-1234-567812345678", "created": null, '
+                         b'"items": [{"sku": "a", "price": "9.90", "note": [{}]}, '
+                         b'{"sku": "b", "price": 2, "qty": 3}], '
+                         b'"parent": {"id": "12345678-1234-5678-1234-567812345678", '
+                         b'"created": "2014-01-02T03:04:05"}}]', [Order])
+        assert len(orders) == 1 and orders[0].id == uuid and orders[0].created is None
+        assert orders[0].items == [Item('a', Decimal('9.90')), Item('b', Decimal(2), 3)]
+        assert orders[0].parent.created == datetime(2014, 1, 2, 3, 4, 5)
+        assert orders[0].parent.items == () and orders[0].parent.parent is None
+
+        # the same with keys interned across calls
+        decoder = self.Decoder()
+        for _ in range(3):
+            item = decoder.decode(b'{"qty": 2, "sku": "a", "price": 1}', 0, None, Schema(Item).node)
+            assert item == Item('a', Decimal(1), 2)
+
+        for data, spec, error in [(b'1', UUID, 'Expecting a UUID string'),
+                                  (b'"12345678-1234-5678-1234-56781234567"', UUID,
+                                   'Expecting a UUID string'),
+                                  (b'"12345678-1234-5678-1234_567812345678"', UUID,
+                                   'Expecting a UUID string'),
+                                  (b'"2014-02-30T00:00:00"', datetime, 'Expecting a datetime string'),
+                                  (b'"2014-01-02 00:00:00"', datetime, 'Expecting a datetime string'),
+                                  (b'"2014-01-02T00:00:00.1234567"', datetime,
+                                   'Expecting a datetime string'),
+                                  (b'"2014-01-02T00:00:00+0100"', datetime,
+                                   'Expecting a datetime string'),
+                                  (b'"2014-1-02"', date, 'Expecting a date string'),
+                                  (b'"24:00:00"', time, 'Expecting a time string'),
+                                  (b'"NaN"', Decimal, 'Expecting a decimal number or string'),
+                                  (b'true', Decimal, 'Expecting a decimal number or string'),
+                                  (b'{}', [int], 'Expecting an array'),
+                                  (b'[]', Item, 'Expecting an object'),
+                                  (b'[[1]]', [typing.Dict[str, int]], 'Expecting an object')]:
+            with assert_raises(DecodeError, error_re=error):
+                convert(data, spec)
+
+        # missing fields are missing arguments
+        with assert_raises(TypeError, error_re='sku'):
+            convert(b'{"price": 1}', Item)
+
+    def test_json_decoder_parse(self):
+        decode = self.decode
+        uuid = UUID('12345678-1234-5678-1234-567812345678')
+        UUIDS, DATETIMES, DECIMAL_STRINGS, DECIMAL_NUMBERS = 1, 2, 4, 8
+
+        value = {'id': uuid, 'at': datetime(2014, 1, 2, 3, 4, 5, 250000, timezone.utc),
+                 'naive': datetime(2014, 1, 2, 3, 4, 5), 'day': date(2014, 1, 2),
+                 'time': time(23, 59, 59, 1, timezone(timedelta(hours=-1))),
+                 'total': Decimal('-9.90'), 'big': Decimal('1E+30'), 'name': 'Ann',
+                 'n': [1, 2.5, True, None]}
+        data = dumpb(value)
+
+        # round trips are exact
+        assert decode(data, 0, None, None, UUIDS | DATETIMES | DECIMAL_STRINGS) == value
+        assert decode(b'["12345678", "2014", "12:00", ""]', 0, None, None,
+                      UUIDS | DATETIMES | DECIMAL_STRINGS) == [Decimal(12345678), Decimal(2014),
+                                                               '12:00', '']
+        assert decode(b'"2014-01-02T03:04:05Z"', 0, None, None, DATETIMES) == \
+                    datetime(2014, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        assert decode(b'"ABCDEF78-1234-5678-1234-567812345678"', 0, None, None, UUIDS) == \
+                    UUID('abcdef78-1234-5678-1234-567812345678')
+
+        # only the formats of the flags given
+        parsed = decode(data, 0, None, None, UUIDS)
+        assert parsed['id'] == uuid and parsed['day'] == '2014-01-02' and parsed['total'] == '-9.90'
+        parsed = decode(data, 0, None, None, DATETIMES)
+        assert parsed['id'] == str(uuid) and parsed['day'] == date(2014, 1, 2)
+
+        # numbers with a fraction or an exponent
+        parsed = decode(b'[1, -2.50, 1e3, "1.5"]', 0, None, None, DECIMAL_NUMBERS)
+        assert parsed == [1, Decimal('-2.50'), Decimal('1E+3'), '1.5']
+        assert type(parsed[0]) is int and str(parsed[1]) == '-2.50'
+
+        # strings almost in the formats and object keys are left as is
+        for text in ['12345678-1234-5678-1234-56781234567', '12345678-1234-5678-1234_567812345678',
+                     '2014-02-30', '2014-01-02 03:04:05', '2014-01-02T03:04:05+0100',
+                     '24:00:00', '12:00:00.1234567', 'NaN', '-', '1.', '1e', '+1', 'Infinity',
+                     '007', '0123', '00.5', '-01']:
+            doc = dumpb({text: [text]})
+            assert decode(doc, 0, None, None, UUIDS | DATETIMES | DECIMAL_STRINGS) == {text: [text]}
+        assert decode(b'["0", "-0.5", "10"]', 0, None, None, DECIMAL_STRINGS) == \
+                    [Decimal(0), Decimal('-0.5'), Decimal(10)]
+
+        # schemas take precedence, the flags convert the values with no spec
+        node = Schema({'total': Decimal, 'id': str}).node
+        parsed = decode(b'{"total": 1.5, "id": "12345678-1234-5678-1234-567812345678", '
+                        b'"other": ["2014-01-02"]}', 0, None, node, UUIDS | DATETIMES)
+        assert parsed == {'total': Decimal('1.5'), 'id': '12345678-1234-5678-1234-567812345678',
+                          'other': [date(2014, 1, 2)]}
+        item = decode(b'{"sku": "2014-01-02", "price": 1.5, "qty": 2.5}', 0, None,
+                      Schema(Item).node, DATETIMES | DECIMAL_NUMBERS)
+        assert item == Item('2014-01-02', Decimal('1.5'), 2.5) and type(item.qty) is float
+        node = Schema({'meta': typing.Any, 'tags': typing.Dict[str, str]}).node
+        parsed = decode(b'{"meta": {"at": ["2014-01-02", 1.5, true]}, "tags": {"a": "1"}, '
+                        b'"at": "2014-01-02"}', 0, None, node,
+                        UUIDS | DATETIMES | DECIMAL_STRINGS | DECIMAL_NUMBERS)
+        assert parsed == {'meta': {'at': ['2014-01-02', 1.5, True]}, 'tags': {'a': '1'},
+                          'at': date(2014, 1, 2)}
+        assert type(parsed['meta']['at'][1]) is float
+
+        decoder = self.Decoder()
+        for _ in range(3):
+            assert decoder.decode(b'{"a": "1.10"}', 0, None, None, DECIMAL_STRINGS) == \
+                        {'a': Decimal('1.10')}
+
+        with assert_raises(ValueError, error_re='invalid parse flags'):
+            decode(b'1', 0, None, None, 16)
+
+    def test_json_decoder_extract(self):
+        extract = self.extract
+
+        doc = '{"meta": {"tenant_id": 7, "tags": ["a", {"x": null}]}, "type": "created", ' \
+              '"k\\"ey": {"\u00e9": [1, 2]}, "0": {"1": 2}}'.encode()
+
+        assert extract(doc, ['meta.tenant_id', 'type', 'meta.tags.1', 'meta.tags.1.x']) == \
+                    [7, 'created', {'x': None}, None]
+        assert extract(doc, ['k"ey.\u00e9.1', ('k"ey', '\u00e9', 0), ('meta', 'tags', '0')]) == \
+                    [2, 1, None]
+        assert extract(doc, ['0.1', ('0', 1), 'meta.tags.2', 'type.x', 'missing']) == \
+                    [2, None, None, None, None]
+        assert extract(doc, ['meta', 'meta.tenant_id', ()]) == \
+                    [loadb(doc)['meta'], 7, loadb(doc)]
+        assert extract(memoryview(b' [[1, [2]], 3] '), ['0.1.0', (1,), 'x'], default=-1) == [2, 3, -1]
+        assert extract(doc, []) == []
+
+        for doc, error in [(b'{"a": [1, 2', "Expecting ',' delimiter: position 11"),
+                           (b'{"a" 1}', "Expecting ':' delimiter: position 5"),
+                           (b'[1 2]', "Expecting ',' delimiter: position 3"),
+                           (b'{"b": 1} x', 'Extra data: position 9')]:
+            with assert_raises(DecodeError, error_re=error):
+                extract(doc, ['a.0', 'c'])
+
+        with assert_raises(TypeError, error_re='not a str'):
+            extract(b'{}', 'a')
+        with assert_raises(TypeError, error_re='must be a str or a tuple'):
+            extract(b'{}', [1])
+        with assert_raises(TypeError, error_re='must be str or int'):
+            extract(b'{}', [('a', None)])
+
+    def test_json_decoder_find_value_end(self):
+        find_value_end = self.find_value_end
+
+        doc = b'{"a": ["}\\"", {"b": []}], "c": "]"} 12 "x\\"y" true\n'
+        ends = []
+        pos = 0
+        while True:
+            while pos < len(doc) and doc[pos] in b' \n':
+                pos += 1
+            if pos == len(doc):
+                break
+            pos = find_value_end(doc, pos)[0]
+            ends.append(pos)
+        assert ends == [35, 38, 45, 50]
+
+        # fed one byte at a time, every split point is resumed from
+        for start, end in [(0, 35), (36, 38), (39, 45), (46, 50)]:
+            state = 0
+            for size in range(start + 1, end):
+                result, state = find_value_end(doc[:size], max(start, size - 1), state)
+                assert result == -1
+            assert find_value_end(doc[:end + 1], end - 1, state) == (end, 0)
+
+        # a top-level number or literal may go on in the next chunk
+        assert find_value_end(b'12', 0) == (-1, find_value_end(b'1', 0)[1])
+        assert find_value_end(b'[1, [2]]', 4) == (7, 0)
+        assert find_value_end(b'', 0) == (-1, 0)
+
+        with assert_raises(ValueError, error_re='offset within data'):
+            find_value_end(b'[1]', 4)
+
+
+class TestPyJsonDecoder(_BaseJsonDecoderTest):
+    scan = staticmethod(py_scan)
+    decode = staticmethod(py_decode)
+    find_value_end = staticmethod(py_find_value_end)
+    extract = staticmethod(py_extract)
+    Decoder = PyDecoder
+
+
+@skipif(SKIPC)
+class TestCJsonDecoder(_BaseJsonDecoderTest):
+    scan = staticmethod(c_scan)
+    decode = staticmethod(c_decode)
+    find_value_end = staticmethod(c_find_value_end)
+    extract = staticmethod(c_extract)
+    Decoder = CDecoder
+
+    def test_json_decoder_schema_same_as_py(self):
+        node = Schema([{'total': Decimal, 'items': [{'sku': str, 'price': Decimal}]}]).node
+        data = b'[{"total": 12345678901234567890.12, "items": [{"sku": "a", "price": 9.90, ' \
+               b'"qty": 1.50}], "n": 1E+2}, {"total": -0.000100, "items": []}]'
+        decoded = self.decode(data, 0, None, node)
+        assert repr(decoded) == repr(py_decode(data, 0, None, node))
+        assert str(decoded[0]['total']) == '12345678901234567890.12'
+        assert str(decoded[0]['items'][0]['price']) == '9.90'
+
+    def test_json_decoder_deep_nesting(self):
+        # nesting is not limited by the C stack
+        deep = b'[{"a":' * 100000 + b'[]' + b'}]' * 100000
+        assert self.decode(deep)[0]['a'][0]['a'][0]['a'][0]['a'] is not None
+        assert len(self.scan(deep)) == 24 * 300001
+
+    def test_json_decoder_schema_errors(self):
+        node = Schema({'a': [UUID], 'b': Item}).node
+
+        for data, error in [(b'{"a": ["12345678-1234-5678-1234-567812345678", 1]}',
+                             'Expecting a UUID string: position 47'),
+                            (b'{"b": {"sku": "a", "price": "x"}}', 'Expecting a decimal.*: position 28'),
+                            (b'{"b": 1}', 'Expecting an object: position 6')]:
+            with assert_raises(DecodeError, error_re=error):
+                self.decode(data, 0, None, node)
+
+        for node in [(0,), (1, 2), (8, {}, None), (8, {'a': (1, None)}, Item, ()), [1]]:
+            with assert_raises(TypeError, error_re='invalid schema node'):
+                self.decode(b'{"a": 1}', 0, None, node)
+
+    def test_json_decoder_parse_escapes(self):
+        # only strings with no escapes and no non-ASCII characters are converted
+        assert self.decode(b'["2014-01-0\\u0032", "2014-01-02"]', 0, None, None, 2) == \
+                    ['2014-01-02', date(2014, 1, 2)]
+        assert self.decode('["\uff11", "1"]'.encode(), 0, None, None, 4) == ['\uff11', Decimal(1)]
+
+    def test_json_decoder_extract_skims(self):
+        # values off the paths are skimmed, and reading stops once all are found
+        assert self.extract(b'{"a": [1 2 {"b": }], "b": 1, "c": tru', ['b']) == [1]
+        assert self.extract(b'{"x": {"y": [1 2]}, "b": 1, "b": 2, garbage', ['b']) == [1]
+
+        deep = b'{"a": ' + b'[{"a":' * 100000 + b'1' + b'}]' * 100000 + b', "b": 2}'
+        assert self.extract(deep, ['b']) == [2]
+
+    def test_json_decoder_key_interning(self):
+        def key(obj, name):
+            return next(k for k in obj if k == name)
+
+        rows = self.decode(b'[{"id": 1, "n": {"id": 2}}, {"id": 3, "n": {}}, {"n": 4, "id": 5}]')
+        assert key(rows[0], 'id') is key(rows[1], 'id') is key(rows[2], 'id') is \
+                    key(rows[0]['n'], 'id')
+
+        # keys are kept across calls by Decoder instances only
+        decoder = self.Decoder()
+        first = decoder.decode('{"id": 1, "\u00e9": 2}'.encode())
+        second = decoder.decode('{"\u00e9": 3, "id": 4}'.encode())
+        assert key(first, 'id') is key(second, 'id')
+        assert key(first, '\u00e9') is key(second, '\u00e9')
+        assert key(self.decode(b'{"id": 1}'), 'id') is not key(first, 'id')
+
+        decoder.clear()
+        assert key(decoder.decode(b'{"id": 1}'), 'id') is not key(first, 'id')
+
+        decoder = self.Decoder(max_keys=0)
+        assert key(decoder.decode(b'{"id": 1}'), 'id') is not key(decoder.decode(b'{"id": 1}'), 'id')
+
+        # a full table is emptied
+        decoder = self.Decoder(max_keys=2)
+        first = decoder.decode(b'{"a": 1}')
+        decoder.decode(b'{"b": 1}')
+        decoder.decode(b'[{"c": 1}, {"d": 1}]')
+        assert key(decoder.decode(b'{"a": 1}'), 'a') is not key(first, 'a')
+
+
+def test_json_lazy_loadb():
+    data = b'{"meta": {"tenant": 7, "tags": ["a", "b"]}, "items": [1, 2.5, null, {"x": []}], ' \
+           b'"name": "caf\\u00e9", "meta": {"tenant": 8}}'
+
+    doc = lazy_loadb(data)
+    assert isinstance(doc, LazyObject) and isinstance(doc, Mapping)
+
+    # the last value of a duplicate key is used
+    assert len(doc) == 3
+    assert list(doc) == ['meta', 'items', 'name']
+    assert doc['meta'] == {'tenant': 8}
+    assert doc['name'] == 'caf\xe9'
+    assert 'items' in doc and 'x' not in doc
+    assert doc.get('x') is None
+    with assert_raises(KeyError):
+        doc['x']
+
+    items = doc['items']
+    assert isinstance(items, LazyArray) and isinstance(items, Sequence)
+    assert items is doc['items']
+    assert len(items) == 4
+    assert items[0] == 1 and items[-3] == 2.5 and items[2] is None
+    assert items[1:3] == [2.5, None]
+    assert items[3]['x'] == []
+    assert items == [1, 2.5, None, {'x': []}]
+    assert items != [1, 2.5, None]
+    with assert_raises(IndexError):
+        items[4]
+
+    assert bytes(items.raw) == b'[1, 2.5, null, {"x": []}]'
+    assert items.decode() == [1, 2.5, None, {'x': []}]
+    assert doc.decode() == loadb(data)
+
+    # no copy of the input is made
+    assert lazy_loadb(memoryview(data))['name'] == 'caf\xe9'
+    assert lazy_loadb(bytearray(b'[[1]]')) == [[1]]
+    assert lazy_loadb(b' "x" ') == 'x'
+
+    with assert_raises(DecodeError, error_re='position 7'):
+        lazy_loadb(b'{"a": [}')
+
+
+def test_json_incremental_decoder():
+    values = [{'a': ['x', '}\\"'], 'b': {}}, 1.5, 'str\u00e9', [], True, None, -7]
+    lines = b''.join(dumpb(value) + b'\n' for value in values)
+
+    def decode_chunks(chunks, **kwargs):
+        decoder = IncrementalDecoder(**kwargs)
+        result = []
+        for chunk in chunks:
+            result.extend(decoder.feed(chunk))
+        result.extend(decoder.close())
+        return result
+
+    array = dumpb(values)
+
+    for data, kwargs in [(lines, {}), (array, {'array': True}), (b' [ ] ', {'array': True})]:
+        expected = values if data != b' [ ] ' else []
+
+        assert decode_chunks([data], **kwargs) == expected
+        # split at every offset, and fed byte by byte
+        for i in range(len(data)):
+            assert decode_chunks([data[:i], data[i:]], **kwargs) == expected
+        assert decode_chunks([data[i:i + 1] for i in range(len(data))], **kwargs) == expected
+
+    # values are returned as soon as they are complete; the input decoded is dropped
+    decoder = IncrementalDecoder(array=True)
+    assert decoder.feed(b'[{"a": 1}, [2') == [{'a': 1}]
+    assert len(decoder._buffer) == 2
+    assert decoder.feed(b'], 3') == [[2]]
+    assert decoder.feed(b']') == [3]
+    assert decoder.close() == []
+
+    assert decode_chunks([b'1 2', b'3 "a""b"[][]']) == [1, 23, 'a', 'b', [], []]
+
+    for chunks, kwargs, error in [
+            ([b'{"a": 1}\n{"a" 2}'], {}, "Expecting ':' delimiter: position 14"),
+            ([b'[1, 2', b'] [3'], {}, "Expecting ',' delimiter: position 9"),
+            ([b'[1, 2] 3'], {'array': True}, 'Extra data: position 7'),
+            ([b'{"a": 1}'], {'array': True}, "Expecting '\\[': position 0"),
+            ([b'[1', b' 2]'], {'array': True}, "Expecting ',' delimiter: position 3"),
+            ([b'[1,', b' 2'], {'array': True}, "Expecting ',' delimiter: position 5"),
+            ([b''], {'array': True}, "Expecting '\\[': position 0"),
+            ([b'"abc'], {}, 'Unterminated string.*: position 0')]:
+        with assert_raises(DecodeError, error_re=error):
+            decode_chunks(chunks, **kwargs)
+
+    assert list(loadb_iter(io.BytesIO(lines), chunk_size=3)) == values
+    assert list(loadb_iter(io.BytesIO(array), array=True)) == values
+    assert list(loadb_iter(io.BytesIO(b'["2014-01-02", 1.5]'), array=True, parse_datetime=True,
+                           parse_decimal='numbers')) == [date(2014, 1, 2), Decimal('1.5')]
+
+
+def test_json_schema():
+    uuid = UUID('12345678-1234-5678-1234-567812345678')
+
+    # compilation
+    assert Schema(UUID).node == (1,)
+    assert Schema([typing.Optional[Decimal]]).node == (6, (5,))
+    assert Schema(typing.Sequence[typing.Mapping[str, date]]).node == (6, (7, (3,)))
+    assert Schema({'a': time, 'b': str}).node == (8, {'a': (0, (4,)), 'b': (1, (9,))}, None, ('a', 'b'))
+    for spec in (str, int, float, bool, object, typing.Any, typing.Tuple[int], typing.Union[int, str]):
+        assert Schema(spec).node == (9,)
+
+    node = Schema(Item).node
+    assert node == (8, {'sku': (0, (9,)), 'price': (1, (5,)), 'qty': (2, (9,))}, Item,
+                    ('sku', 'price', 'qty'))
+    schema = Schema(Item)
+    assert Schema(schema).node is schema.node
+
+    # classes referring to themselves
+    node = Schema(Order).node
+    assert node[1]['parent'][1] is node
+
+    with assert_raises(TypeError, error_re='one item'):
+        Schema([int, str])
+
+    # with loadb() and friends
+    data = b'{"id": "12345678-1234-5678-1234-567812345678", "items": [{"sku": "a", "price": 1}]}'
+    order = loadb(data, schema=Order)
+    assert order.id == uuid and order.items == [Item('a', Decimal(1))]
+    assert loads(data.decode(), Decoder(), Schema(Order)).id == uuid
+    assert load(io.BytesIO(data), schema={'id': UUID}) == \
+                {'id': uuid, 'items': [{'sku': 'a', 'price': 1}]}
+
+    decoder = IncrementalDecoder(schema=[Decimal])
+    assert decoder.feed(b'[1.5]\n["2') == [[Decimal('1.5')]]
+    assert decoder.feed(b'"]') == [[Decimal(2)]]
+    assert list(loadb_iter(io.BytesIO(b'[1, 2, 3]'), array=True, schema=Decimal)) == \
+                [Decimal(1), Decimal(2), Decimal(3)]
+
+
+@skipif(sys.version_info < (3, 10))
+def test_json_schema_union_types():
+    # PEP 604 unions
+    assert Schema(datetime | None).node == (2,)
+    assert Schema(None | typing.List[Decimal]).node == (6, (5,))
+    assert Schema(list[date | None]).node == (6, (3,))
+    assert Schema(int | str).node == (9,)
+
+    class Event:
+        __slots__ = ('at',)
+        at: datetime | None
+
+        def __init__(self, at):
+            self.at = at
+
+    assert loadb(b'{"at": "2014-01-02T03:04:05"}', schema=Event).at == datetime(2014, 1, 2, 3, 4, 5)
+    assert loadb(b'{"at": null}', schema=Event).at is None
+
+
+@skipif(sys.version_info < (3, 7))
+def test_json_schema_dataclasses():
+    from dataclasses import dataclass, field
+
+    @dataclass(frozen=True)
+    class Event:
+        id: UUID
+        amounts: typing.List[Decimal] = field(default_factory=list)
+        tags: typing.ClassVar[int] = 0
+
+        def __post_init__(self):
+            assert isinstance(self.id, UUID)
+
+    node = Schema(Event).node
+    assert node[1:] == ({'id': (0, (1,)), 'amounts': (1, (6, (5,)))}, Event, ('id', 'amounts'))
+
+    assert loadb(b'[{"amounts": [1, "2.5"], "id": "12345678-1234-5678-1234-567812345678"}, '
+                 b'{"id": "12345678-1234-5678-1234-567812345678", "other": 1}]', schema=[Event]) == \
+                [Event(UUID('12345678-1234-5678-1234-567812345678'), [Decimal(1), Decimal('2.5')]),
+                 Event(UUID('12345678-1234-5678-1234-567812345678'))]
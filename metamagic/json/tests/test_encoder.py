@@ -16,12 +16,21 @@ except ImportError:
 
 from json import loads as std_loads, dumps as std_dumps
 from decimal import Decimal
-from collections import OrderedDict, Set, Sequence, Mapping
+from collections import OrderedDict
+from collections.abc import Set, Sequence, Mapping
 from uuid import UUID
-from datetime import datetime, tzinfo, timedelta, date, time
+from datetime import datetime, tzinfo, timedelta, timezone, date, time
 
+from metamagic.json import OutputTooLargeError
+
+import bz2
 import functools
+import gzip
+import hashlib
+import io
+import lzma
 import random
+import zlib
 
 from metamagic.utils.debug import assert_raises
 
@@ -107,6 +116,12 @@ class _BaseJsonEncoderTest:
         # 9007199254740992 is the largest possible integer in JavaScript
         self.encoder_test(9007199254740992, '9007199254740992')
 
+        # around the digit pairs and the sizes of the internal representation
+        for n in (9, 10, 99, 100, 101, 999, 1000, 12345, 2**15, 2**30 - 1, 2**30, 2**31,
+                  10**15 - 1, 10**15, 9007199254740991):
+            self.encoder_test(n, str(n))
+            self.encoder_test(-n, str(-n))
+
         # std module just returns a string representation for
         # all valid python numbers (even for non-jscript representable numbers)
         with assert_raises(ValueError, error_re='out of range'):
@@ -159,6 +174,13 @@ class _BaseJsonEncoderTest:
         with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
             self.dumps(a)
 
+        deep = []
+        for _ in range(100):
+            deep = [{'a': (deep,)}]
+        assert self.dumps(deep, max_nested_level=301) == '[{"a":[' * 100 + '[]' + ']}]' * 100
+        with assert_raises(ValueError, error_re=r'Exceeded maximum allowed recursion level \(300\)'):
+            self.dumps(deep, max_nested_level=300)
+
         # by design type "bytes" is not serializable and should raise a TypeError
         with assert_raises(TypeError, error_re='not JSON serializable'):
             self.encoder_test(bytes([1,2,3]), None)
@@ -230,6 +252,21 @@ class _BaseJsonEncoderTest:
         tm = time(12, 13, 14, 15)
         self.encoder_test(tm, '"12:13:14.000015"', False, False)
 
+        self.encoder_test([datetime.min, datetime.max, date.min, time.max],
+                          '["0001-01-01T00:00:00","9999-12-31T23:59:59.999999",'
+                          '"0001-01-01","23:59:59.999999"]', False, False)
+
+        # subclasses are encoded the same way, unless they have their own encoding
+        class MyDate(date):
+            pass
+
+        class JSONDate(date):
+            def __mm_json__(self):
+                return '"today"'
+
+        self.encoder_test([MyDate(2012, 6, 1), JSONDate(2012, 6, 1)], '["2012-06-01","today"]',
+                          False, False)
+
         # Marquesas Islands Time, UTC-09:30
         class MART(tzinfo):
             def utcoffset(self, dt):
@@ -327,6 +364,38 @@ class _BaseJsonEncoderTest:
         with assert_raises(ZeroDivisionError):
             self.dumps({Spam(): 1})
 
+        # replacing an object with itself, or a cycle of replacements, is a circular reference
+        class Itself:
+            def __mm_serialize__(self):
+                return self
+
+        class ItselfJson:
+            def __mm_json__(self):
+                return self
+
+        class Ping:
+            def __mm_serialize__(self):
+                return Pong()
+
+        class Pong:
+            def __mm_serialize__(self):
+                return Ping()
+
+        for obj in (Itself(), ItselfJson(), [Ping()]):
+            with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+                self.dumps(obj)
+
+        class Countdown:
+            def __init__(self, n):
+                self.n = n
+
+            def __mm_serialize__(self):
+                return Countdown(self.n - 1) if self.n else 'done'
+
+        assert self.dumps(Countdown(9), max_nested_level=10) == '"done"'
+        with assert_raises(ValueError, error_re=r'recursion level \(9\)'):
+            self.dumps(Countdown(9), max_nested_level=9)
+
     def test_json_default(self):
         class Foo:
             pass
@@ -337,15 +406,25 @@ class _BaseJsonEncoderTest:
         class Spam:
             pass
 
+        class Key:
+            pass
+
         class Encoder(self.encoder):
             def default(self, obj):
                 if isinstance(obj, Foo):
                     return ['Foo', 'Foo']
+                if isinstance(obj, Key):
+                    return 'key'
                 if isinstance(obj, Spam):
                     1/0
                 return super().default(obj)
 
         assert Encoder().dumps([Foo(), Foo()]) == '[["Foo","Foo"],["Foo","Foo"]]'
+        assert Encoder().dumps({Key(): Key()}) == '{"key":"key"}'
+
+        # the output of default() for a key must be a valid key as well
+        with assert_raises(TypeError, error_re='is not a valid dictionary key'):
+            Encoder().dumps({Foo(): 1})
 
         with assert_raises(TypeError, error_re='is not JSON seri'):
             Encoder().dumps(Bar())
@@ -444,6 +523,643 @@ class _BaseJsonEncoderTest:
 
         assert self.dumps([MyInt(10)]) == '[10]'
 
+    def test_json_encoder_dump(self):
+        obj = {'foo': ['bar' * 50000, 1, 2.5], 'spam': [{'ham': i} for i in range(20000)]}
+
+        fp = io.BytesIO()
+        assert self.encoder().dump(obj, fp) is None
+        assert fp.getvalue() == self.dumpb(obj)
+
+        fp = io.BytesIO()
+        self.encoder().dump([[1]], fp, max_nested_level=2)
+        assert fp.getvalue() == b'[[1]]'
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            self.encoder().dump([[1]], io.BytesIO(), max_nested_level=1)
+
+        class BrokenFile:
+            def write(self, data):
+                1/0
+
+        with assert_raises(ZeroDivisionError):
+            self.encoder().dump(obj, BrokenFile())
+
+        # write() may change the list being encoded, the items are kept alive
+        items = ['x' * 100000 + str(i) for i in range(10)]
+
+        class MutatingFile(io.BytesIO):
+            def write(self, data):
+                items[:] = [0] * len(items)
+                return super().write(data)
+
+        fp = MutatingFile()
+        self.encoder().dump(items, fp)
+        decoded = std_loads(fp.getvalue().decode())
+        assert len(decoded) == 10 and decoded[0] == 'x' * 100000 + '0'
+
+    def test_json_encoder_raw_json(self):
+        import pickle
+
+        for RawJSON in RAW_JSON_TYPES:
+            fragment = RawJSON(b'{"a": [1, "<x>"]}')
+
+            assert self.dumpb([1, fragment, 2]) == b'[1,{"a": [1, "<x>"]},2]'
+            assert self.dumps({'f': fragment}) == '{"f":{"a": [1, "<x>"]}}'
+            assert self.dumpb([fragment], canonical=True) == b'[{"a": [1, "<x>"]}]'
+
+            class Cached:
+                def __mm_json__(self):
+                    return fragment
+
+            assert self.dumpb([Cached()]) == b'[{"a": [1, "<x>"]}]'
+
+            # the text is checked and escaped once, if asked to
+            assert RawJSON('["<é>"]').data == '["<é>"]'.encode('utf-8')
+            for data in ('{"k": "<é\U0001f600>\\n"}\n', '{"k": "<é\U0001f600>\\n"}\n'.encode(),
+                         bytearray(b'[1,\t2]'), memoryview(b'"a&b"')):
+                text = data if isinstance(data, str) else bytes(data).decode()
+                assert std_loads(RawJSON(data, validated=False).data.decode('ascii')) == \
+                            std_loads(text)
+
+            assert RawJSON('{"k": "<é\U0001f600>\\n"}\n', validated=False).data == \
+                        b'{"k": "\\u003c\\u00e9\\ud83d\\ude00\\u003e\\n"}\n'
+            assert RawJSON(b'[1, 2]', validated=False).data == b'[1, 2]'
+
+            with assert_raises(UnicodeDecodeError):
+                RawJSON(b'"\xff"', validated=False)
+
+            with assert_raises(TypeError):
+                RawJSON(1)
+
+            assert repr(RawJSON('[1]')) == "RawJSON(b'[1]')"
+            assert pickle.loads(pickle.dumps(fragment)).data == fragment.data
+
+            # binary formats have no use for JSON text
+            with assert_raises(TypeError, error_re='not JSON serializable'):
+                self.encoder().dumpmsgpack([fragment])
+
+    def test_json_encoder_dumpb_many(self):
+        records = [{'id': i, 'tags': ['a', 'b']} for i in range(10000)]
+
+        out = self.encoder().dumpb_many(records)
+        assert out == b''.join(self.dumpb(r) + b'\n' for r in records)
+        assert [std_loads(line) for line in out.decode().splitlines()] == records
+
+        assert self.encoder().dumpb_many(iter([1, 'a', None]), b',') == b'1,"a",null,'
+        assert self.encoder().dumpb_many([]) == b''
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            self.encoder().dumpb_many([[1], [[1]]], max_nested_level=1)
+
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            self.encoder().dumpb_many([1, 1+2j])
+
+        def gen():
+            yield 1
+            1/0
+
+        with assert_raises(ZeroDivisionError):
+            self.encoder().dumpb_many(gen())
+
+    def test_json_encoder_dumpb_diff(self):
+        def merge_patch(target, patch):
+            # RFC 7386
+            if not isinstance(patch, dict):
+                return patch
+            if not isinstance(target, dict):
+                target = {}
+            for key, value in patch.items():
+                if value is None:
+                    target.pop(key, None)
+                else:
+                    target[key] = merge_patch(target.get(key), value)
+            return target
+
+        class Unencodable:
+            def __mm_serialize__(self):
+                raise AssertionError('unchanged values should not be encoded')
+
+        class Record:
+            def __init__(self, **fields):
+                self.fields = fields
+
+            def __mm_serialize__(self):
+                return self.fields
+
+        skipped = Unencodable()
+        old = {'users': {str(i): {'name': 'user{}'.format(i), 'tags': ['a', 'b'], 'score': 1.5}
+                         for i in range(100)},
+               'config': OrderedDict([('a', 1), ('b', [1, 2])]),
+               'skipped': skipped,
+               'removed': 1,
+               'id': UUID('00000000-0000-0000-0000-000000000001'),
+               'record': Record(a=1, b={'c': 2, 'd': 3})}
+
+        new = {'users': dict(old['users']),
+               'config': OrderedDict([('a', 1), ('b', [1, 2, 3])]),
+               'skipped': skipped,
+               'added': {'x': [None]},
+               'id': UUID('00000000-0000-0000-0000-000000000001'),
+               'record': Record(a=1, b={'c': 2, 'd': 4})}
+        new['users']['1'] = dict(new['users']['1'], score=2.5)
+        new['users']['2'] = {'name': 'user2', 'tags': ['a', 'b'], 'score': 1.5}
+        del new['users']['3']
+
+        patch = self.encoder().dumpb_diff(old, new)
+        assert std_loads(patch.decode()) == {'users': {'1': {'score': 2.5}, '3': None},
+                                             'config': {'b': [1, 2, 3]},
+                                             'added': {'x': [None]},
+                                             'record': {'b': {'d': 4}},
+                                             'removed': None}
+
+        old['skipped'] = new['skipped'] = None
+        assert merge_patch(std_loads(self.dumps(old)), std_loads(patch.decode())) == \
+                   std_loads(self.dumps(new))
+
+        # no differences
+        assert self.encoder().dumpb_diff(old, old) == b'{}'
+        assert self.encoder().dumpb_diff({'a': [1, {'b': 2}]}, {'a': [1, {'b': 2}]}) == b'{}'
+        assert self.encoder().dumpb_diff({'a': Record(b=1)}, {'a': Record(b=1)}) == b'{}'
+
+        # values encoded differently are never equal
+        for old_value, new_value in ((1, True), (1, 1.0), (0.0, -0.0), ([1], (1,)),
+                                     (Decimal('1.0'), Decimal('1.00')),
+                                     (datetime(2014, 1, 1, tzinfo=timezone.utc),
+                                      datetime(2014, 1, 1, 1, tzinfo=timezone(timedelta(hours=1))))):
+            assert self.encoder().dumpb_diff({'a': old_value}, {'a': new_value}) == \
+                       b'{"a":' + self.dumpb(new_value) + b'}'
+
+        assert self.encoder().dumpb_diff({'x': OrderedDict(a=1)}, {'x': OrderedDict(a=True)}) == \
+                   b'{"x":{"a":true}}'
+        assert self.encoder().dumpb_diff({'x': {1}}, {'x': {True}}) == b'{"x":[true]}'
+        # sets and other objects are only known to be unchanged if they are the same object
+        assert self.encoder().dumpb_diff({'x': frozenset([1])}, {'x': frozenset([1])}) == \
+                   b'{"x":[1]}'
+
+        # replaced values are hooked and serialized once
+        calls = []
+
+        class Counted:
+            def __mm_serialize__(self):
+                calls.append('serialize')
+                return [1]
+
+        class Encoder(self.encoder):
+            def encode_hook(self, obj):
+                if isinstance(obj, Counted):
+                    calls.append('hook')
+                return obj
+
+        assert Encoder().dumpb_diff({'a': {'b': 1}}, {'a': Counted()}) == b'{"a":[1]}'
+        assert calls == ['hook', 'serialize']
+
+        class Itself:
+            def __mm_serialize__(self):
+                return self
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            self.encoder().dumpb_diff({'a': 1}, {'a': Itself()})
+
+        # anything but objects is replaced
+        assert self.encoder().dumpb_diff([1, 2], [1, 2, 3]) == b'[1,2,3]'
+        assert self.encoder().dumpb_diff({'a': 1}, [1]) == b'[1]'
+        assert self.encoder().dumpb_diff([1], {'a': 1}) == b'{"a":1}'
+        assert self.encoder().dumpb_diff({'a': {'b': 1}}, {'a': [1]}) == b'{"a":[1]}'
+        assert self.encoder().dumpb_diff({'a': 'b'}, {'a': {'b': 1}}) == b'{"a":{"b":1}}'
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            self.encoder().dumpb_diff({'a': {'b': 1}}, {'a': {'b': 2}}, max_nested_level=1)
+        assert self.encoder().dumpb_diff({'a': {'b': 1}}, {'a': {'b': 2}},
+                                         max_nested_level=2) == b'{"a":{"b":2}}'
+
+        with assert_raises(OutputTooLargeError):
+            self.encoder().dumpb_diff({}, {'a': 'b' * 100}, max_output_bytes=100)
+
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            self.encoder().dumpb_diff({}, {'a': 1+2j})
+
+        with assert_raises(TypeError, error_re='is not a valid dictionary key'):
+            self.encoder().dumpb_diff({}, {1+2j: 1})
+
+    def test_json_encoder_dumpb_rows(self):
+        columns = ['id', 'name', UUID('00000000-0000-0000-0000-000000000001')]
+        rows = [(i, 'name {}'.format(i), [i, None]) for i in range(1000)]
+        records = [dict(zip(map(str, columns), row)) for row in rows]
+
+        assert self.encoder().dumpb_rows(columns, rows) == self.dumpb(records)
+        assert self.encoder().dumpb_rows(columns=iter(columns), rows=iter(rows)) == \
+                   self.dumpb(records)
+        assert self.encoder().dumpb_rows(['a'], [[1], (2,), iter([3])]) == \
+                   b'[{"a":1},{"a":2},{"a":3}]'
+        assert self.encoder().dumpb_rows(['a'], []) == b'[]'
+        assert self.encoder().dumpb_rows([], [(), ()]) == b'[{},{}]'
+
+        with assert_raises(ValueError, error_re='row 1 has 1 values, expected 2'):
+            self.encoder().dumpb_rows(['a', 'b'], [(1, 2), (1,)])
+
+        with assert_raises(TypeError, error_re='is not a valid dictionary key'):
+            self.encoder().dumpb_rows([1], [(1,)])
+
+        with assert_raises(TypeError, error_re='not iterable'):
+            self.encoder().dumpb_rows(['a'], [1])
+
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            self.encoder().dumpb_rows(['a'], [(1+2j,)])
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            self.encoder().dumpb_rows(['a'], [([1],)], max_nested_level=2)
+        assert self.encoder().dumpb_rows(['a'], [([1],)], max_nested_level=3) == b'[{"a":[1]}]'
+
+        with assert_raises(OutputTooLargeError):
+            self.encoder().dumpb_rows(columns, rows, max_output_bytes=1000)
+
+    def test_json_encoder_dumpb_columns(self):
+        import array
+
+        ints = list(range(-500, 500))
+        floats = [i / 8 for i in ints]
+        columns = OrderedDict([('i', array.array('i', ints)),
+                               ('q', array.array('q', ints)),
+                               ('B', array.array('B', [i % 256 for i in ints])),
+                               ('Q', array.array('Q', range(1000))),
+                               ('d', array.array('d', floats)),
+                               ('f', array.array('f', floats)),
+                               ('strided', memoryview(array.array('d', floats * 2))[::2]),
+                               ('list', ['x{}'.format(i) for i in ints]),
+                               ('tuple', tuple(ints)),
+                               ('bool', memoryview(bytes(i % 2 for i in ints)).cast('?')),
+                               ('range', range(1000))])
+        expected = [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+        assert std_loads(self.encoder().dumpb_columns(columns).decode()) == expected
+        assert self.encoder().dumpb_columns({'a': [1, 2], 'b': array.array('d', [0.5, 1.5])}) == \
+                   b'[{"a":1,"b":0.5},{"a":2,"b":1.5}]'
+        assert self.encoder().dumpb_columns({'a': array.array('q')}) == b'[]'
+        assert self.encoder().dumpb_columns({}) == b'[]'
+
+        with assert_raises(ValueError, error_re="column 'b' has 1 values, expected 2"):
+            self.encoder().dumpb_columns(OrderedDict([('a', [1, 2]), ('b', array.array('d', [1]))]))
+
+        with assert_raises(ValueError, error_re='Number out of range'):
+            self.encoder().dumpb_columns({'a': array.array('q', [2 ** 60])})
+
+        with assert_raises(ValueError, error_re='Number out of range'):
+            self.encoder().dumpb_columns({'a': array.array('Q', [2 ** 64 - 1])})
+
+        with assert_raises(ValueError, error_re='NaN is not supported'):
+            self.encoder().dumpb_columns({'a': array.array('d', [float('nan')])})
+
+        with assert_raises(TypeError, error_re='columns must be sequences or arrays of numbers'):
+            self.encoder().dumpb_columns({'a': b'abc'})
+
+        with assert_raises(TypeError, error_re='not iterable'):
+            self.encoder().dumpb_columns({'a': 1})
+
+        # buffers of other numbers are sequences of values like any other
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            self.encoder().dumpb_columns({'a': memoryview(b'ab').cast('c')})
+
+    def test_json_encoder_max_output_bytes(self):
+        obj = {'spam': [{'ham': i} for i in range(20000)]}
+        expected = self.dumpb(obj)
+
+        assert self.encoder().dumpb(obj, max_output_bytes=len(expected)) == expected
+        assert self.encoder().dumps(obj, max_output_bytes=len(expected)) == expected.decode()
+        assert self.encoder().dumpb(obj, max_output_bytes=None) == expected
+
+        with assert_raises(OutputTooLargeError, error_re='maximum allowed size of 1000 bytes'):
+            self.encoder().dumpb(obj, max_output_bytes=1000)
+
+        with assert_raises(ValueError, error_re='maximum allowed size'):
+            self.encoder().dumps(obj, max_output_bytes=len(expected) - 1)
+
+        try:
+            self.encoder().dumpb(obj, max_output_bytes=1000)
+        except OutputTooLargeError as e:
+            assert e.max_size == 1000
+            assert 1000 < e.size < len(expected)
+
+        with assert_raises(ValueError, error_re='must not be negative'):
+            self.encoder().dumpb(obj, max_output_bytes=-1)
+
+        # the limit applies to the uncompressed output
+        with assert_raises(OutputTooLargeError):
+            self.encoder().dumpb(obj, compress='gzip', max_output_bytes=1000)
+        assert gzip.decompress(self.encoder().dumpb(obj, compress='gzip',
+                                                    max_output_bytes=len(expected))) == expected
+
+        # the limit applies to all records together
+        records = [{'id': i} for i in range(1000)]
+        out = self.encoder().dumpb_many(records)
+        assert self.encoder().dumpb_many(records, max_output_bytes=len(out)) == out
+        with assert_raises(OutputTooLargeError):
+            self.encoder().dumpb_many(records, max_output_bytes=len(out) - 1)
+
+    def test_json_encoder_dump_max_output_bytes(self):
+        obj = ['x' * 1000 for i in range(10000)]
+        fp = io.BytesIO()
+
+        with assert_raises(OutputTooLargeError):
+            self.encoder().dump(obj, fp, max_output_bytes=5000)
+
+        # no more than the allowed size is ever written out
+        assert len(fp.getvalue()) <= 5000
+
+    def test_json_encoder_dump_fd(self):
+        import os
+        import socket
+        import tempfile
+        import threading
+
+        obj = {'foo': ['bar' * 50000, 1, 2.5], 'spam': [{'ham': i} for i in range(20000)]}
+        expected = self.dumpb(obj)
+
+        def read_all(fd, received, delay=0):
+            # the writer blocks on the full pipe or socket until this thread reads,
+            # which it can only do if the GIL is released while writing
+            if delay:
+                threading.Event().wait(delay)
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                received.append(data)
+
+        def dump_to_reader(write, fd, close, delay=0):
+            received = []
+            reader = threading.Thread(target=read_all, args=(fd, received, delay))
+            reader.start()
+            try:
+                write()
+            finally:
+                close()
+                reader.join()
+            return b''.join(received)
+
+        r, w = os.pipe()
+        try:
+            assert dump_to_reader(lambda: self.encoder().dump_fd(obj, w), r,
+                                  lambda: os.close(w)) == expected
+        finally:
+            os.close(r)
+
+        with tempfile.TemporaryFile() as f:
+            self.encoder().dump_fd(obj, f.fileno(), canonical=True)
+            self.encoder().dump_fd([[1]], f, max_nested_level=2)
+            f.seek(0)
+            assert f.read() == self.dumpb(obj, canonical=True) + b'[[1]]'
+
+            with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+                self.encoder().dump_fd([[1]], f, max_nested_level=1)
+
+            with assert_raises(OutputTooLargeError):
+                self.encoder().dump_fd(obj, f, max_output_bytes=1000)
+
+        # a non-blocking socket is waited on when its buffer is full
+        sender, receiver = socket.socketpair()
+        try:
+            sender.setblocking(False)
+            assert dump_to_reader(lambda: self.encoder().dump_fd(obj, sender), receiver.fileno(),
+                                  lambda: sender.shutdown(socket.SHUT_WR), delay=0.1) == expected
+        finally:
+            sender.close()
+            receiver.close()
+
+        # ... for at most the timeout of the socket
+        sender, receiver = socket.socketpair()
+        try:
+            sender.settimeout(0.05)
+            with assert_raises(TimeoutError):
+                self.encoder().dump_fd(obj, sender)
+        finally:
+            sender.close()
+            receiver.close()
+
+        r, w = os.pipe()
+        os.close(r)
+        os.close(w)
+        with assert_raises(OSError):
+            self.encoder().dump_fd(obj, w)
+
+        with assert_raises(io.UnsupportedOperation):
+            self.encoder().dump_fd(obj, io.BytesIO())
+
+    def test_json_encoder_canonical(self):
+        obj = {'b': 1, 'a': [{'z': None, 'y': {3, 1, 2}}, frozenset(['x', 'b'])],
+               'c': OrderedDict([('q', 1), ('p', 2)]),
+               UUID('d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a'): 'uuid'}
+
+        expected = ('{"a":[{"y":[1,2,3],"z":null},["b","x"]],"b":1,"c":{"p":2,"q":1},'
+                    '"d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a":"uuid"}')
+
+        assert self.encoder().dumps(obj, canonical=True) == expected
+        assert self.encoder().dumpb(obj, canonical=True) == expected.encode()
+        assert self.encoder().dumpb_many([obj], canonical=True) == expected.encode() + b'\n'
+
+        fp = io.BytesIO()
+        self.encoder().dump(obj, fp, canonical=True)
+        assert fp.getvalue() == expected.encode()
+
+        # insertion order does not matter
+        d1 = {'k{}'.format(i): [i, {'x': i, 'a': -i}] for i in range(1000)}
+        d2 = {'k{}'.format(i): [i, {'a': -i, 'x': i}] for i in reversed(range(1000))}
+        assert self.dumpb(d1) != self.dumpb(d2)
+        assert self.encoder().dumpb(d1, canonical=True) == self.encoder().dumpb(d2, canonical=True)
+        assert std_loads(self.encoder().dumps(d1, canonical=True)) == d1
+
+        # keys are sorted by their string, as by json.dumps(sort_keys=True)
+        assert self.encoder().dumps({'b': 1, 'a"': 2, 'a': 3}, canonical=True) == \
+                                                            '{"a":3,"a\\"":2,"b":1}'
+        obj = {'a!': 1, 'a': 2, '\xe9': 3, 'b': 4, 'B': 5, 'a\n': 6, '\U0001f600': 7, '\uffff': 8}
+        assert self.encoder().dumps(obj, canonical=True) == \
+                    std_dumps(obj, sort_keys=True, separators=(',', ':'))
+
+        class Key:
+            def __init__(self, key):
+                self.key = key
+
+            def __mm_serialize__(self):
+                return self.key
+
+        uuid = UUID('d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a')
+        assert self.encoder().dumps({Key('e'): 1, uuid: 2, Key(uuid): 3, 'd8': 4}, canonical=True) == \
+                    '{"d8":4,"d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a":2,' \
+                    '"d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a":3,"e":1}'
+
+        with assert_raises(TypeError, error_re='is not a valid dictionary key'):
+            self.encoder().dumps({1: 2}, canonical=True)
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            self.encoder().dumps({'a': {'b': [{1}]}}, canonical=True, max_nested_level=3)
+        assert self.encoder().dumps({'a': {'b': [{1}]}}, canonical=True, max_nested_level=4) == \
+                                                            '{"a":{"b":[[1]]}}'
+
+    def test_json_encoder_digest(self):
+        obj = {'spam': [{'ham': i, 'eggs': str(i)} for i in range(20000)], 'foo': {'bar'}}
+        canonical = self.encoder().dumpb(obj, canonical=True)
+
+        assert self.encoder().digest(obj) == hashlib.sha256(canonical).hexdigest()
+        assert self.encoder().digest(obj, 'md5') == hashlib.md5(canonical).hexdigest()
+        assert self.encoder().digest(obj, 'sha1', canonical=False) == \
+                                            hashlib.sha1(self.dumpb(obj)).hexdigest()
+
+        with assert_raises(ValueError):
+            self.encoder().digest(obj, 'no-such-hash')
+
+    def test_json_encoder_msgpack(self):
+        dump = self.encoder().dumpmsgpack
+
+        assert dump(None) == b'\xc0'
+        assert dump(True) == b'\xc3'
+        assert dump(False) == b'\xc2'
+
+        assert dump(0) == b'\x00'
+        assert dump(127) == b'\x7f'
+        assert dump(128) == b'\xcc\x80'
+        assert dump(256) == b'\xcd\x01\x00'
+        assert dump(65536) == b'\xce\x00\x01\x00\x00'
+        assert dump(2**32) == b'\xcf\x00\x00\x00\x01\x00\x00\x00\x00'
+        assert dump(2**64 - 1) == b'\xcf' + b'\xff' * 8
+        assert dump(-1) == b'\xff'
+        assert dump(-32) == b'\xe0'
+        assert dump(-33) == b'\xd0\xdf'
+        assert dump(-129) == b'\xd1\xff\x7f'
+        assert dump(-32769) == b'\xd2\xff\xff\x7f\xff'
+        assert dump(-2**63) == b'\xd3\x80' + b'\x00' * 7
+
+        assert dump(1.5) == b'\xcb\x3f\xf8' + b'\x00' * 6
+
+        assert dump('') == b'\xa0'
+        assert dump('abc') == b'\xa3abc'
+        assert dump('€') == b'\xa3\xe2\x82\xac'
+        assert dump('a' * 32) == b'\xd9\x20' + b'a' * 32
+        assert dump('a' * 256) == b'\xda\x01\x00' + b'a' * 256
+
+        assert dump([]) == b'\x90'
+        assert dump((1, [2])) == b'\x92\x01\x91\x02'
+        assert dump(list(range(16))) == b'\xdc\x00\x10' + bytes(range(16))
+        assert dump({}) == b'\x80'
+        assert dump({'a': None}) == b'\x81\xa1a\xc0'
+        assert dump(OrderedDict([('b', 1), ('a', 2)])) == b'\x82\xa1b\x01\xa1a\x02'
+        assert dump({'b': 1, 'a': 2}, canonical=True) == b'\x82\xa1a\x02\xa1b\x01'
+        assert dump({3, 1, 2}, canonical=True) == b'\x93\x01\x02\x03'
+
+        uuid = UUID('d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a')
+        assert dump(uuid) == b'\xc4\x10' + uuid.bytes
+        assert dump({uuid: 1}) == b'\x81\xc4\x10' + uuid.bytes + b'\x01'
+
+        assert dump(Decimal('1.5')) == b'\xa31.5'
+        assert dump(date(2014, 1, 2)) == b'\xaa2014-01-02'
+
+        class Foo:
+            def __mm_json__(self):
+                return '"json"'
+
+            def __mm_serialize__(self):
+                return ['serialized']
+
+        assert dump(Foo()) == b'\x91\xaaserialized'
+
+        with assert_raises(ValueError, error_re='Number out of range'):
+            dump(2**64)
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            dump([[1]], max_nested_level=1)
+
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            dump([1+2j])
+
+        with assert_raises(TypeError, error_re='is not a valid dictionary key'):
+            dump({1: 2})
+
+    def test_json_encoder_cbor(self):
+        dump = self.encoder().dumpcbor
+
+        assert dump(None) == b'\xf6'
+        assert dump(True) == b'\xf5'
+        assert dump(False) == b'\xf4'
+
+        assert dump(0) == b'\x00'
+        assert dump(23) == b'\x17'
+        assert dump(24) == b'\x18\x18'
+        assert dump(1000) == b'\x19\x03\xe8'
+        assert dump(1000000) == b'\x1a\x00\x0f\x42\x40'
+        assert dump(1000000000000) == b'\x1b\x00\x00\x00\xe8\xd4\xa5\x10\x00'
+        assert dump(2**64 - 1) == b'\x1b' + b'\xff' * 8
+        assert dump(-1) == b'\x20'
+        assert dump(-100) == b'\x38\x63'
+        assert dump(-1000) == b'\x39\x03\xe7'
+        assert dump(-2**64) == b'\x3b' + b'\xff' * 8
+
+        assert dump(1.1) == b'\xfb\x3f\xf1\x99\x99\x99\x99\x99\x9a'
+
+        assert dump('') == b'\x60'
+        assert dump('IETF') == b'\x64IETF'
+        assert dump('ü') == b'\x62\xc3\xbc'
+
+        assert dump([]) == b'\x80'
+        assert dump([1, [2, 3], [4, 5]]) == b'\x83\x01\x82\x02\x03\x82\x04\x05'
+        assert dump(list(range(1, 26))) == b'\x98\x19' + bytes(range(1, 24)) + b'\x18\x18\x18\x19'
+        assert dump({}) == b'\xa0'
+        assert dump({'a': 1, 'b': [2, 3]}, canonical=True) == b'\xa2\x61a\x01\x61b\x82\x02\x03'
+
+        uuid = UUID('d8d19bf8-4a4f-4bcb-b3c5-6a4d4c4e5e3a')
+        assert dump(uuid) == b'\xd8\x25\x50' + uuid.bytes
+
+        with assert_raises(ValueError, error_re='Number out of range'):
+            dump(-2**64 - 1)
+
+    def test_json_encoder_compress(self):
+        obj = {'foo': ['bar' * 50000, 1, 2.5], 'spam': [{'ham': i} for i in range(20000)]}
+        expected = self.dumpb(obj)
+
+        assert gzip.decompress(self.dumpb(obj, compress='gzip')) == expected
+        assert zlib.decompress(self.dumpb(obj, compress='deflate', level=1)) == expected
+        assert bz2.decompress(self.dumpb(obj, compress='bz2')) == expected
+        assert lzma.decompress(self.dumpb(obj, compress='xz', level=0)) == expected
+
+        assert gzip.decompress(self.dumpb([], compress='gzip')) == b'[]'
+
+        fp = io.BytesIO()
+        self.encoder().dump(obj, fp, compress='gzip', level=9)
+        assert gzip.decompress(fp.getvalue()) == expected
+
+        with assert_raises(ValueError, error_re='unsupported compression method'):
+            self.dumpb(obj, compress='zip')
+
+    def test_json_encoder_shared(self):
+        # encoders keep no per-call state, one instance can be used by many threads
+        import threading
+
+        encoder = self.encoder()
+        errors = []
+
+        def encode(depth):
+            obj = []
+            for i in range(depth):
+                obj = [{'level': i, 'items': obj}, {i}]
+            expected = self.dumps(obj, max_nested_level=depth * 2 + 1)
+            try:
+                for _ in range(200):
+                    assert encoder.dumps(obj, max_nested_level=depth * 2 + 1) == expected
+                    with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion'):
+                        encoder.dumps(obj, max_nested_level=depth * 2)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=encode, args=(depth,)) for depth in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+
+        # a failed call leaves nothing behind
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion'):
+            encoder.dumps([[[1, 2]]], max_nested_level=2)
+        assert encoder.dumps([[[1, 2]]], max_nested_level=3) == '[[[1,2]]]'
+
 
 from ..encoder import Encoder as PyEncoder
 
@@ -458,10 +1174,156 @@ try:
 except ImportError:
     SKIPC = True
 
+# both encoders accept both kinds of fragments
+from ..encoder import RawJSON as PyRawJSON
+if SKIPC:
+    RAW_JSON_TYPES = (PyRawJSON,)
+else:
+    from .._encoder import RawJSON as CRawJSON
+    RAW_JSON_TYPES = (PyRawJSON, CRawJSON)
+
 @skipif(SKIPC)
 class TestCJsonEncoder(_BaseJsonEncoderTest):
     encoder = CEncoder
 
+    def test_json_encoder_deep_nesting(self):
+        # nesting is not limited by the C stack
+        deep = []
+        for _ in range(100000):
+            deep = [{'a': deep}]
+        assert self.dumpb(deep, max_nested_level=200001) == \
+                    b'[{"a":' * 100000 + b'[]' + b'}]' * 100000
+
+    def test_json_encoder_subinterpreters(self):
+        try:
+            import _interpreters
+        except ImportError:
+            # Python < 3.13
+            return
+
+        import sys
+
+        code = '''if True:
+            import sys
+            sys.path[:] = {!r}
+
+            from decimal import Decimal
+            from metamagic.json._encoder import Encoder
+
+            assert Encoder().dumpb([Decimal('1.5'), {{'a': None}}]) == b'["1.5",{{"a":null}}]'
+        '''.format(sys.path)
+
+        # an interpreter with its own GIL, unless the module is not isolated
+        interpreter = _interpreters.create('isolated')
+        try:
+            for _ in range(2):
+                assert _interpreters.exec(interpreter, code) is None
+        finally:
+            _interpreters.destroy(interpreter)
+
+        assert self.dumpb([Decimal('1.5')]) == b'["1.5"]'
+
+    def test_json_encoder_c_api(self):
+        # the C API is used through ctypes here, see include/metamagic_json.h
+        import ctypes
+        import os.path
+
+        from metamagic.json import get_include
+        from .. import _encoder
+
+        assert os.path.exists(os.path.join(get_include(), 'metamagic_json.h'))
+
+        class Buffer(ctypes.Structure):
+            pass
+
+        GROW = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.POINTER(Buffer), ctypes.c_ssize_t)
+        WRITE = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ssize_t)
+
+        Buffer._fields_ = [('data', ctypes.c_void_p),
+                           ('size', ctypes.c_ssize_t),
+                           ('allocated', ctypes.c_ssize_t),
+                           ('grow', GROW),
+                           ('context', ctypes.c_void_p)]
+
+        # PYFUNCTYPE: the GIL must be held while calling the API
+        ENCODE = ctypes.PYFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.py_object,
+                                   ctypes.POINTER(Buffer), ctypes.c_int, ctypes.c_int)
+        ENCODE_TO_WRITER = ctypes.PYFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.py_object,
+                                             WRITE, ctypes.c_void_p, ctypes.c_int, ctypes.c_int)
+
+        class API(ctypes.Structure):
+            _fields_ = [('version', ctypes.c_int),
+                        ('EncoderType', ctypes.c_void_p),
+                        ('encode', ENCODE),
+                        ('encode_to_writer', ENCODE_TO_WRITER)]
+
+        get_pointer = ctypes.pythonapi.PyCapsule_GetPointer
+        get_pointer.restype = ctypes.c_void_p
+        get_pointer.argtypes = [ctypes.py_object, ctypes.c_char_p]
+
+        api = API.from_address(get_pointer(_encoder._C_API, b'metamagic.json._encoder._C_API'))
+
+        assert api.version == 1
+        assert api.EncoderType == id(CEncoder)
+
+        memory = []
+
+        @GROW
+        def grow(buffer, min_allocated):
+            buffer = buffer.contents
+            data = ctypes.create_string_buffer(min_allocated)
+            if buffer.size:
+                ctypes.memmove(data, buffer.data, buffer.size)
+            memory.append(data)
+            buffer.data = ctypes.addressof(data)
+            buffer.allocated = min_allocated
+            return 0
+
+        def encode(obj, flags=0, encoder=None, max_nested_level=0):
+            buffer = Buffer(None, 0, 0, grow, None)
+            if api.encode(encoder, obj, ctypes.byref(buffer), flags, max_nested_level) < 0:
+                return None
+            return ctypes.string_at(buffer.data, buffer.size)
+
+        obj = {'b': [1, 2.5, None, True], 'a': 'x' * 100000}
+
+        assert encode(obj) == self.dumpb(obj)
+        assert encode(obj, flags=0x01) == self.dumpb(obj, canonical=True)
+        assert encode(obj, flags=0x10) == self.encoder().dumpmsgpack(obj)
+        assert encode(obj, flags=0x21) == self.encoder().dumpcbor(obj, canonical=True)
+
+        class Encoder(CEncoder):
+            def default(self, obj):
+                return 'default'
+
+        encoder = Encoder()
+        assert encode([object()], encoder=ctypes.c_void_p(id(encoder))) == b'["default"]'
+
+        with assert_raises(TypeError, error_re='not JSON serializable'):
+            encode([object()])
+
+        with assert_raises(ValueError, error_re='Exceeded maximum allowed recursion level'):
+            encode([[[1]]], max_nested_level=2)
+
+        # on errors the size of a non-empty buffer is left unchanged
+        buffer = Buffer(None, 0, 0, grow, None)
+        assert api.encode(None, 'abc', ctypes.byref(buffer), 0, 0) == 0
+        with assert_raises(TypeError):
+            api.encode(None, ['x' * 100000, object()], ctypes.byref(buffer), 0, 0)
+        assert ctypes.string_at(buffer.data, buffer.size) == b'"abc"'
+
+        chunks = []
+
+        @WRITE
+        def write(context, data, size):
+            chunks.append(ctypes.string_at(data, size))
+            return 0
+
+        obj = ['x' * 1000] * 1000
+        assert api.encode_to_writer(None, obj, write, None, 0, 0) == 0
+        assert len(chunks) > 1
+        assert b''.join(chunks) == self.dumpb(obj)
+
 
 def test_json_dump():
     #test bindings
@@ -469,3 +1331,80 @@ def test_json_dump():
 
     assert dumps(True) == 'true'
     assert dumpb(True) == b'true'
+
+    class MyEncoder(PyEncoder):
+        instances = 0
+
+        def __init__(self):
+            super().__init__()
+            MyEncoder.instances += 1
+
+        def encode_hook(self, obj):
+            return '*' + str(obj) if isinstance(obj, int) else obj
+
+    # the encoder class is honored and its instance is shared between calls
+    assert dumps([1], encoder=MyEncoder) == '["*1"]'
+    assert dumpb([2], encoder=MyEncoder) == b'["*2"]'
+    assert MyEncoder.instances == 1
+
+    assert dumps([1], encoder=PyEncoder) == '[1]'
+    assert dumps([1], encoder=CEncoder) == '[1]'
+
+    # as well as an encoder instance
+    assert dumps([3], encoder=MyEncoder()) == '["*3"]'
+
+
+@skipif(SKIPC)
+def test_json_lazy_imports():
+    # the C encoder does not import the modules of the classes it supports,
+    # it recognizes them once they are imported
+    import os
+    import subprocess
+    import sys
+
+    code = '''if True:
+        import sys
+        import metamagic.json as json
+
+        assert not {'decimal', 'uuid', 'json'} & set(sys.modules)
+        assert json.dumps([1]) == '[1]'
+
+        from collections import OrderedDict
+        from datetime import date
+        from decimal import Decimal
+        from uuid import UUID
+
+        for _ in range(2):
+            assert json.dumps([OrderedDict(a=Decimal('1.5')), {UUID(int=1): date(2014, 1, 2)}]) == \\
+                '[{"a":"1.5"},{"00000000-0000-0000-0000-000000000001":"2014-01-02"}]'
+    '''
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+
+
+def test_json_lines_writer():
+    from metamagic.json import JSONLinesWriter
+
+    records = [{'id': i, 'name': 'record'} for i in range(1000)]
+
+    for encoder in (PyEncoder, CEncoder):
+        class File:
+            def __init__(self):
+                self.writes = []
+
+            def write(self, data):
+                self.writes.append(bytes(data))
+
+        f = File()
+        with JSONLinesWriter(f, flush_bytes=4096, encoder=encoder) as writer:
+            for record in records[:500]:
+                writer.write(record)
+            assert len(f.writes) == 3
+            writer.write_many(records[500:])
+            assert len(f.writes) == 4
+            assert all(len(data) >= 4096 for data in f.writes)
+
+        out = b''.join(f.writes)
+        assert out == encoder().dumpb_many(records)
+        assert [std_loads(line) for line in out.splitlines()] == records
@@ -0,0 +1,46 @@
+##
+# Copyright (c) 2014 Sprymix Inc.
+# All rights reserved.
+#
+# See LICENSE for details.
+##
+
+
+import io
+from json import loads as std_loads
+
+from metamagic.utils.debug import assert_raises
+
+from metamagic.json.parallel import dump_records
+from ..encoder import Encoder as PyEncoder
+
+try:
+    from .._encoder import Encoder as CEncoder
+except ImportError:
+    CEncoder = PyEncoder
+
+
+def test_json_dump_records():
+    records = [{'id': i, 'name': 'record'} for i in range(2500)]
+
+    for encoder in (PyEncoder, CEncoder):
+        for workers in (0, 2):
+            fp = io.BytesIO()
+            dump_records(records, fp, workers=workers, batch=100, encoder=encoder)
+            assert fp.getvalue() == encoder().dumpb_many(records)
+
+            fp = io.BytesIO()
+            dump_records(iter(records), fp, workers=workers, batch=1000, format='array',
+                         encoder=encoder, max_in_flight=1)
+            assert fp.getvalue() == encoder().dumpb(records)
+            assert std_loads(fp.getvalue().decode()) == records
+
+            fp = io.BytesIO()
+            dump_records([], fp, workers=workers, format='array', encoder=encoder)
+            assert fp.getvalue() == b'[]'
+
+            with assert_raises(TypeError, error_re='not JSON serializable'):
+                dump_records(records + [1+2j], io.BytesIO(), workers=workers, encoder=encoder)
+
+    with assert_raises(ValueError, error_re='unsupported format'):
+        dump_records(records, io.BytesIO(), format='csv')
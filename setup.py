@@ -31,6 +31,9 @@ setup(
     ext_modules=[
         Extension('metamagic.json._encoder',
                   sources=['metamagic/json/_encoder/_encoder.c'],
+                  extra_compile_args=['-O3']),
+        Extension('metamagic.json._decoder',
+                  sources=['metamagic/json/_decoder/_decoder.c'],
                   extra_compile_args=['-O3'])
     ],
     classifiers=[
@@ -46,7 +49,11 @@ setup(
     packages=[
         'metamagic.json',
         'metamagic.json._encoder',
+        'metamagic.json._decoder',
         'metamagic.json.tests'
     ],
+    package_data={
+        'metamagic.json': ['include/*.h']
+    },
     include_package_data=True
 )